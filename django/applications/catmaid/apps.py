@@ -137,6 +137,22 @@ class CATMAIDConfig(AppConfig):
         if settings.PREPARED_STATEMENTS:
             db_signals.connection_created.connect(prepare_db_statements)
 
+        # Processes with a node result cache need to learn about edits of
+        # other processes. Edit notifications are only sent by the database for
+        # connections that enable them.
+        if getattr(settings, 'NODE_RESULT_CACHE_SIZE', 0):
+            from catmaid.control.node_result_cache import \
+                    enable_node_edit_notifications
+            db_signals.connection_created.connect(enable_node_edit_notifications)
+
+        # Binary NBLAST similarity matrices are stored in files, which are
+        # removed along with their similarity.
+        from catmaid.control.similarity import (on_config_delete,
+                on_similarity_delete)
+        from catmaid.models import NblastConfig, NblastSimilarity
+        signals.pre_delete.connect(on_config_delete, sender=NblastConfig)
+        signals.post_delete.connect(on_similarity_delete, sender=NblastSimilarity)
+
         self.check_superuser()
 
         # Make sure the existing version is what we expect
@@ -171,6 +187,7 @@ class CATMAIDConfig(AppConfig):
         "MEDIA_CROPPING_SUBDIRECTORY": str,
         "MEDIA_ROI_SUBDIRECTORY": str,
         "MEDIA_TREENODE_SUBDIRECTORY": str,
+        "MEDIA_NBLAST_SUBDIRECTORY": str,
         "GENERATED_FILES_MAXIMUM_SIZE": int,
         "USER_REGISTRATION_ALLOWED": bool,
         "NEW_USER_DEFAULT_GROUPS": list,
@@ -1,13 +1,13 @@
 # -*- coding: utf-8 -*-
 
 from collections import namedtuple, defaultdict
-from itertools import chain, islice
+from itertools import islice
 from functools import partial
-from networkx import Graph, single_source_shortest_path
 
 from django.db import connection
 from django.http import JsonResponse
 
+from catmaid.control.arbor import Arbor
 from catmaid.control.common import get_request_list
 from catmaid.control.authentication import requires_user_role
 from catmaid.models import UserRole
@@ -313,14 +313,11 @@ def _analyze_skeleton(project_id, skeleton_id, adjacents):
     # Check if two or more connectors share pre treenodes and post skeletons,
     # or pre skeletons and post treenodes,
     # considering the treenode and its parent as a group.
-    if adjacents > 0:
-        graph = Graph()
-        for node_id, props in nodes.items():
-            if props[0]:
-                # Nodes are added automatically
-                graph.add_edge(props[0], node_id)
-    else:
-        graph = None
+    arbor = Arbor(list(nodes.keys()), [props[0] for props in nodes.values()])
+
+    def nearby_treenodes(treenode_id):
+        index = arbor.index(treenode_id)
+        return set(arbor.node_ids[arbor.nodes_within_edges(index, adjacents)].tolist())
 
     Connector = namedtuple("Connector", ['id', 'treenode_id', 'treenodes', 'skeletons'])
 
@@ -329,8 +326,7 @@ def _analyze_skeleton(project_id, skeleton_id, adjacents):
     for connector_id in pre_connector_ids:
         c = connectors[connector_id]
         treenode_id = next(iter(c[PRE])).id
-        shortest_path = single_source_shortest_path(graph, treenode_id, adjacents)
-        pre_treenodes = set(chain.from_iterable(shortest_path.values()))
+        pre_treenodes = nearby_treenodes(treenode_id)
         post_skeletons = set(t.skeleton_id for t in c[POST])
         pre_connectors.append(Connector(connector_id, treenode_id, pre_treenodes, post_skeletons))
 
@@ -352,8 +348,7 @@ def _analyze_skeleton(project_id, skeleton_id, adjacents):
             continue
         treenode_id = next(t.id for t in c[POST] if t.skeleton_id == skeleton_id)
         pre_skeletons = set(t.skeleton_id for t in c[PRE])
-        shortest_path = single_source_shortest_path(graph, treenode_id, adjacents)
-        post_treenodes = set(chain.from_iterable(shortest_path.values()))
+        post_treenodes = nearby_treenodes(treenode_id)
         post_connectors.append(Connector(connector_id, treenode_id, post_treenodes, pre_skeletons))
 
     issue4s(post_connectors)
@@ -0,0 +1,471 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from collections import OrderedDict
+
+from django.db import connection
+
+
+class Arbor(object):
+    """A compact representation of one or more trees of nodes, e.g. the
+    treenodes of skeletons, backed by NumPy arrays. Nodes are referred to by
+    their index, i.e. the position of their ID in <node_ids>. The parent index
+    of root nodes is -1. Derived data like the children of each node or the
+    number of edges to the root is computed on first use and then kept.
+
+    Compared to a networkx graph, which needs about a kilobyte per node, an
+    arbor needs a few dozen bytes per node.
+    """
+
+    __slots__ = ('node_ids', 'parent_index', 'positions', '_id_order',
+            '_sorted_ids', '_child_offsets', '_child_indices', '_depths',
+            '_order')
+
+    def __init__(self, node_ids, parent_ids, positions=None):
+        """Create a new arbor from a list of node IDs, the list of their
+        parent IDs (-1 or None for roots) and optionally an N x 3 array of
+        node positions. Parents that aren't part of the arbor are ignored.
+        """
+        self.node_ids = np.asarray(node_ids, dtype=np.int64).reshape(-1)
+        self.positions = None if positions is None else \
+                np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        self._id_order = np.argsort(self.node_ids, kind='mergesort')
+        self._sorted_ids = self.node_ids[self._id_order]
+        self._child_offsets = None
+        self._child_indices = None
+        self._depths = None
+        self._order = None
+
+        if not isinstance(parent_ids, np.ndarray):
+            parent_ids = [-1 if p is None else p for p in parent_ids]
+        parent_ids = np.asarray(parent_ids, dtype=np.int64)
+        self.parent_index = self.indices(parent_ids, missing=-1)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Create a new arbor from rows of the form (id, parent_id) or
+        (id, parent_id, x, y, z).
+        """
+        rows = list(rows)
+        node_ids = [row[0] for row in rows]
+        parent_ids = [row[1] for row in rows]
+        positions = [row[2:5] for row in rows] \
+                if rows and len(rows[0]) > 2 else None
+        return cls(node_ids, parent_ids, positions)
+
+    def __len__(self):
+        return len(self.node_ids)
+
+    def indices(self, node_ids, missing=None):
+        """Return the indices of the passed in node IDs. Unknown node IDs are
+        mapped to <missing> or raise a ValueError if <missing> is None.
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        n = len(self._sorted_ids)
+        if n == 0:
+            found = np.zeros(node_ids.shape, dtype=bool)
+            positions = np.zeros(node_ids.shape, dtype=np.int64)
+        else:
+            positions = np.searchsorted(self._sorted_ids, node_ids)
+            positions[positions == n] = 0
+            found = self._sorted_ids[positions] == node_ids
+        if missing is None:
+            if not found.all():
+                raise ValueError("Node #%s is not part of this arbor" %
+                        node_ids[~found].flat[0])
+            return self._id_order[positions]
+        return np.where(found, self._id_order[positions], missing)
+
+    def index(self, node_id):
+        """Return the index of a single node ID."""
+        return int(self.indices([node_id])[0])
+
+    @property
+    def roots(self):
+        """The indices of all root nodes."""
+        return np.flatnonzero(self.parent_index == -1)
+
+    @property
+    def root(self):
+        """The ID of the root node, or of the first root node if the arbor
+        consists of multiple trees.
+        """
+        roots = self.roots
+        return int(self.node_ids[roots[0]]) if len(roots) else None
+
+    @property
+    def n_children(self):
+        """The number of children of each node."""
+        self._build_children()
+        return np.diff(self._child_offsets)
+
+    def _build_children(self):
+        """Store the children of all nodes in compressed sparse row form: the
+        children of node i are _child_indices[_child_offsets[i]:_child_offsets[i+1]].
+        """
+        if self._child_offsets is not None:
+            return
+        child = np.flatnonzero(self.parent_index != -1)
+        parent = self.parent_index[child]
+        self._child_indices = child[np.argsort(parent, kind='mergesort')]
+        self._child_offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(parent, minlength=len(self)),
+                out=self._child_offsets[1:])
+
+    def children(self, index):
+        """Return the indices of the children of the node at <index>."""
+        self._build_children()
+        return self._child_indices[
+                self._child_offsets[index]:self._child_offsets[index + 1]]
+
+    def children_of(self, indices):
+        """Return the indices of all children of the passed in nodes."""
+        self._build_children()
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self._child_offsets[indices]
+        counts = self._child_offsets[indices + 1] - starts
+        total = counts.sum()
+        if total == 0:
+            return np.zeros(0, dtype=np.int64)
+        # Offsets of each child within the children of its parent
+        within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        return self._child_indices[np.repeat(starts, counts) + within]
+
+    def accumulate_to_root(self, values):
+        """Return for each node the sum of <values> of the node itself and all
+        its ancestors. This is done by pointer jumping, which needs a number of
+        vectorized steps that is logarithmic in the depth of the arbor.
+        """
+        total = np.array(values, copy=True)
+        ancestor = self.parent_index.copy()
+        jump = ancestor != -1
+        while jump.any():
+            targets = ancestor[jump]
+            total[jump] += total[targets]
+            ancestor[jump] = ancestor[targets]
+            jump = ancestor != -1
+        return total
+
+    def accumulate_to_leaves(self, values):
+        """Return for each node the sum of <values> of the node itself and all
+        nodes in its subtree. This is done one level of the arbor at a time,
+        starting with the nodes farthest away from their root.
+        """
+        total = np.array(values, copy=True)
+        order = self.topological_order
+        boundaries = np.flatnonzero(np.diff(self.depths[order])) + 1
+        for level in reversed(np.split(order, boundaries)):
+            parents = self.parent_index[level]
+            has_parent = parents != -1
+            np.add.at(total, parents[has_parent], total[level[has_parent]])
+        return total
+
+    def component_roots(self, mask=None):
+        """Return for each node the index of the topmost ancestor it is
+        connected to through nodes in the boolean <mask> only, i.e. the root of
+        its component in the sub-forest of masked nodes. Without a mask, this
+        is the root of each node's tree. Nodes outside the mask map to -1.
+        """
+        parent_index = self.parent_index
+        if mask is not None:
+            parent_index = np.where(mask[parent_index] & (parent_index != -1),
+                    parent_index, -1)
+        target = np.where(parent_index == -1, np.arange(len(self)), parent_index)
+        while True:
+            next_target = target[target]
+            if np.array_equal(next_target, target):
+                break
+            target = next_target
+        if mask is not None:
+            target[~mask] = -1
+        return target
+
+    @property
+    def depths(self):
+        """The number of edges between each node and its root."""
+        if self._depths is None:
+            self._depths = self.accumulate_to_root(
+                    (self.parent_index != -1).astype(np.int64))
+        return self._depths
+
+    @property
+    def topological_order(self):
+        """Node indices ordered so that parents come before their children."""
+        if self._order is None:
+            self._order = np.argsort(self.depths, kind='mergesort')
+        return self._order
+
+    def edge_lengths(self):
+        """The distance of each node to its parent, 0 for root nodes."""
+        if self.positions is None:
+            raise ValueError("Arbor has no node positions")
+        child = np.flatnonzero(self.parent_index != -1)
+        lengths = np.zeros(len(self))
+        lengths[child] = np.linalg.norm(self.positions[child] -
+                self.positions[self.parent_index[child]], axis=1)
+        return lengths
+
+    def cable_length(self):
+        """The summed length of all edges."""
+        return float(self.edge_lengths().sum())
+
+    def distances_to_root(self, edge_lengths=None):
+        """The length of the path of each node to its root, based on the
+        passed in length of the edge of each node to its parent or the
+        euclidean edge length.
+        """
+        if edge_lengths is None:
+            edge_lengths = self.edge_lengths()
+        return self.accumulate_to_root(np.asarray(edge_lengths, dtype=np.float64))
+
+    def path_to_root(self, index):
+        """Return the list of indices on the path from the node at <index> to
+        its root, including both.
+        """
+        path = [index]
+        parent = self.parent_index[index]
+        while parent != -1:
+            path.append(int(parent))
+            parent = self.parent_index[parent]
+        return path
+
+    def common_ancestor(self, a, b):
+        """Return the index of the nearest common ancestor of the nodes at
+        indices <a> and <b>, or -1 if they are in different trees.
+        """
+        depths = self.depths
+        while depths[a] > depths[b]:
+            a = self.parent_index[a]
+        while depths[b] > depths[a]:
+            b = self.parent_index[b]
+        while a != b:
+            a = self.parent_index[a]
+            b = self.parent_index[b]
+            if a == -1 or b == -1:
+                return -1
+        return int(a)
+
+    def subtree_mask(self, index):
+        """Return a boolean mask of all nodes in the subtree of the node at
+        <index>, including the node itself.
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        mask[index] = True
+        order = self.topological_order
+        depths = self.depths[order]
+        # Propagate the mask one level at a time, starting below the node
+        start = np.searchsorted(depths, self.depths[index], side='right')
+        boundaries = np.flatnonzero(np.diff(depths[start:])) + 1
+        for level in np.split(order[start:], boundaries):
+            if len(level) == 0:
+                continue
+            mask[level] = mask[self.parent_index[level]]
+            if not mask[level].any():
+                break
+        return mask
+
+    def nodes_within_edges(self, index, max_edges):
+        """Return the indices of all nodes that are at most <max_edges> edges
+        away from the node at <index>, in any direction.
+        """
+        seen = np.zeros(len(self), dtype=bool)
+        seen[index] = True
+        frontier = np.array([index], dtype=np.int64)
+        for _ in range(max_edges):
+            parents = self.parent_index[frontier]
+            neighbors = np.concatenate((self.children_of(frontier),
+                    parents[parents != -1]))
+            frontier = np.unique(neighbors[~seen[neighbors]])
+            if len(frontier) == 0:
+                break
+            seen[frontier] = True
+        return np.flatnonzero(seen)
+
+    def partition(self):
+        """Partition the arbor into a list of sequences of node indices, with
+        branch nodes repeated as ends of all sequences except the longest one
+        that finishes at the root. Each sequence runs from an end node to
+        either the root or a branch node. Ends that are farthest away from
+        their root come first.
+        """
+        has_parent = self.parent_index != -1
+        ends = np.flatnonzero(has_parent & (self.n_children == 0))
+        ends = ends[np.argsort(-self.depths[ends], kind='mergesort')]
+        seen = np.zeros(len(self), dtype=bool)
+        parent_index = self.parent_index.tolist()
+        sequences = []
+        for end in ends.tolist():
+            sequence = [end]
+            parent = parent_index[end]
+            while parent != -1:
+                sequence.append(parent)
+                if seen[parent]:
+                    break
+                seen[parent] = True
+                parent = parent_index[parent]
+            sequences.append(sequence)
+        return sequences
+
+    def simplify(self, keep=None, min_distance=None, tolerance=None):
+        """Return a boolean mask of the nodes of a topology preserving
+        simplification of the arbor, along with the index of the nearest kept
+        ancestor of each node (-1 for roots). Root, branch and end nodes as
+        well as the nodes at the indices in <keep> are always kept. If
+        <min_distance> is given, other nodes are kept where the cable distance
+        to the root crosses a multiple of it, i.e. about every <min_distance>
+        along each path. If <tolerance> is given, other nodes are kept if the
+        simplified cable between two kept nodes would otherwise be further
+        away from them than this (Douglas-Peucker). Nodes that match either
+        criterion are kept.
+        """
+        has_parent = self.parent_index != -1
+        mask = ~has_parent | (self.n_children != 1)
+        if keep is not None:
+            mask[keep] = True
+
+        if min_distance:
+            buckets = np.floor(self.distances_to_root() / min_distance)
+            child = np.flatnonzero(has_parent)
+            mask[child[buckets[child] != buckets[self.parent_index[child]]]] = True
+
+        if tolerance is not None:
+            fixed = mask.copy()
+            for sequence in self.partition():
+                # Simplify each run of nodes between fixed nodes
+                start = 0
+                for i in range(1, len(sequence)):
+                    if fixed[sequence[i]]:
+                        if i - start > 1:
+                            run = sequence[start:i + 1]
+                            mask[run] |= _douglas_peucker(self.positions[run],
+                                    tolerance)
+                        start = i
+
+        # Find the nearest kept ancestor of each node by pointer jumping. Roots
+        # are always kept, which makes kept nodes the fix points.
+        target = np.where(mask, np.arange(len(self)), self.parent_index)
+        while True:
+            next_target = target[target]
+            if np.array_equal(next_target, target):
+                break
+            target = next_target
+        simplified_parent_index = np.where(has_parent,
+                target[self.parent_index], -1)
+
+        return mask, simplified_parent_index
+
+    def minify(self, keep):
+        """Return the indices of the nodes of a tree that only contains the
+        nodes at the indices in <keep> and the branch nodes between them, along
+        with the edges of this tree as pairs of node indices. All nodes in
+        <keep> have to be part of the same tree, which can't be empty.
+        """
+        keep = np.unique(np.asarray(keep, dtype=np.int64))
+        # With one of the nodes to keep as root, branch nodes between them are
+        # nodes with more than one child that leads to a node to keep.
+        arbor = self.reroot(int(self.node_ids[keep[0]]))
+        counts = np.zeros(len(self), dtype=np.int64)
+        counts[keep] = 1
+        on_path = arbor.accumulate_to_leaves(counts) > 0
+        child = np.flatnonzero(on_path & (arbor.parent_index != -1))
+        kept = np.bincount(arbor.parent_index[child], minlength=len(self)) > 1
+        kept[keep] = True
+
+        # Find the nearest kept ancestor of each node on a path to the root by
+        # pointer jumping. The root is kept, which makes kept nodes fix points.
+        target = np.where(kept | ~on_path, np.arange(len(self)),
+                arbor.parent_index)
+        while True:
+            next_target = target[target]
+            if np.array_equal(next_target, target):
+                break
+            target = next_target
+
+        indices = np.flatnonzero(kept)
+        child = indices[indices != keep[0]]
+        edges = np.column_stack((child, target[arbor.parent_index[child]]))
+        return indices, edges
+
+    def reroot(self, node_id):
+        """Return a new arbor with the same nodes, but with the passed in node
+        as root of its tree.
+        """
+        index = self.index(node_id)
+        path = self.path_to_root(index)
+        parent_index = self.parent_index.copy()
+        parent_index[path[1:]] = path[:-1]
+        parent_index[index] = -1
+        parent_ids = np.where(parent_index == -1, -1,
+                self.node_ids[parent_index])
+        return Arbor(self.node_ids, parent_ids, self.positions)
+
+
+def _douglas_peucker(points, tolerance):
+    """Return a boolean mask of the points of a polyline that are kept by the
+    Douglas-Peucker algorithm with the passed in tolerance. The first and last
+    point are always kept.
+    """
+    mask = np.zeros(len(points), dtype=bool)
+    mask[0] = mask[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        segment = points[last] - points[first]
+        offsets = points[first + 1:last] - points[first]
+        length = np.dot(segment, segment)
+        if length > 0:
+            t = np.clip(offsets.dot(segment) / length, 0.0, 1.0)
+            offsets = offsets - np.outer(t, segment)
+        distances = np.linalg.norm(offsets, axis=1)
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            mask[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return mask
+
+
+def load_arbors(skeleton_ids, with_positions=True):
+    """Return an ordered dict that maps each of the passed in skeleton IDs to
+    an arbor of its treenodes. All skeletons are loaded with a single query,
+    skeletons without treenodes are not included.
+    """
+    position_select = ', location_x, location_y, location_z' \
+            if with_positions else ''
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT skeleton_id, id, parent_id {position_select}
+        FROM treenode
+        WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        ORDER BY skeleton_id
+    '''.format(position_select=position_select), {
+        'skeleton_ids': [int(skid) for skid in skeleton_ids],
+    })
+
+    rows_by_skeleton = OrderedDict()
+    for row in cursor.fetchall():
+        rows = rows_by_skeleton.get(row[0])
+        if rows is None:
+            rows = rows_by_skeleton[row[0]] = []
+        rows.append(row[1:])
+
+    return OrderedDict((skid, Arbor.from_rows(rows))
+            for skid, rows in rows_by_skeleton.items())
+
+
+def load_arbor(skeleton_id, with_positions=True):
+    """Return an arbor of the treenodes of the passed in skeleton."""
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT id, parent_id {position_select}
+        FROM treenode
+        WHERE skeleton_id = %(skeleton_id)s
+    '''.format(position_select=', location_x, location_y, location_z' \
+            if with_positions else ''), {
+        'skeleton_id': int(skeleton_id),
+    })
+    return Arbor.from_rows(cursor.fetchall())
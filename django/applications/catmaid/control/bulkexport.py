@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+
+import io
+import logging
+import multiprocessing
+import os
+import tarfile
+import zipfile
+
+from datetime import datetime
+from itertools import chain, groupby
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection, connections
+from django.http import JsonResponse
+
+from rest_framework.decorators import api_view
+
+from catmaid.consumers import msg_user
+from catmaid.control.annotation import (get_annotated_entities,
+        get_annotation_to_id_map)
+from catmaid.control.authentication import requires_user_role
+from catmaid.control.common import (get_request_bool, get_request_list,
+        urljoin)
+from catmaid.control.nat import export_skeleton_as_nrrd
+from catmaid.control.node import get_batches
+from catmaid.control.skeletonexport import get_soma_node_ids, render_swc
+from catmaid.models import Class, Message, Relation, User, UserRole
+
+from celery.task import task
+
+
+logger = logging.getLogger(__name__)
+
+# The path were server side exported files get stored in
+output_path = os.path.join(settings.MEDIA_ROOT,
+    settings.MEDIA_EXPORT_SUBDIRECTORY)
+
+EXPORT_FORMATS = ('swc', 'nrrd')
+
+ARCHIVE_FORMATS = ('zip', 'tar', 'tar.gz')
+
+# The number of skeletons of which treenodes are loaded with a single query.
+DEFAULT_BULK_EXPORT_BATCH_SIZE = 500
+
+
+class SkeletonArchive(object):
+    """Write files to a zip or (optionally gzip compressed) tar archive on disk,
+    to be used as a context manager.
+    """
+
+    def __init__(self, path, archive_format='zip'):
+        if archive_format not in ARCHIVE_FORMATS:
+            raise ValueError("Unknown archive format: {}".format(archive_format))
+        self.path = path
+        self.archive_format = archive_format
+        self.archive = None
+
+    def __enter__(self):
+        if self.archive_format == 'zip':
+            self.archive = zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED,
+                    allowZip64=True)
+        else:
+            mode = 'w:gz' if self.archive_format == 'tar.gz' else 'w'
+            self.archive = tarfile.open(self.path, mode)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.archive.close()
+        self.archive = None
+
+    def add(self, name, data):
+        """Add a file with the passed in name and content (bytes)."""
+        if self.archive_format == 'zip':
+            self.archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = datetime.now().timestamp()
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def add_file(self, name, path):
+        """Add an existing file under the passed in name."""
+        if self.archive_format == 'zip':
+            self.archive.write(path, name)
+        else:
+            self.archive.add(path, name)
+
+
+def get_annotated_skeleton_ids(project_id, annotations):
+    """Return the sorted IDs of all skeletons modeling neurons that are
+    annotated with all of the passed in annotation names, either directly or
+    through sub-annotations.
+    """
+    classes = dict(Class.objects.filter(
+            project_id=project_id).values_list('class_name', 'id'))
+    relations = dict(Relation.objects.filter(
+            project_id=project_id).values_list('relation_name', 'id'))
+
+    annotation_map = get_annotation_to_id_map(project_id, annotations,
+            relations, classes)
+    annotation_ids = list(map(str, annotation_map.values()))
+    if len(annotation_ids) != len(set(annotations)):
+        missing_annotations = set(annotations) - set(annotation_map.keys())
+        raise ValueError("Could not find the following annotations: " +
+                ", ".join(missing_annotations))
+
+    query_params = {
+        'annotated_with': ",".join(annotation_ids),
+        'sub_annotated_with': ",".join(annotation_ids)
+    }
+    neuron_info, num_total_records = get_annotated_entities(project_id,
+            query_params, relations, classes, ['neuron'], with_skeletons=True)
+    return sorted(set(chain.from_iterable(n['skeleton_ids'] for n in neuron_info)))
+
+
+def init_export_worker():
+    """Make sure a worker process doesn't use the database connection of its
+    parent process.
+    """
+    for conn in connections.all():
+        conn.connection = None
+
+
+def render_swc_job(job):
+    """Render a single skeleton as SWC in a worker process. A job is a tuple of
+    skeleton ID, treenode rows and the arguments of render_swc(). Returns the
+    skeleton ID and the encoded SWC data.
+    """
+    skeleton_id, rows, soma_node_id, mark_root_as_soma, linearize_ids = job
+    return skeleton_id, render_swc(rows, soma_node_id, mark_root_as_soma,
+            linearize_ids).encode('utf-8')
+
+
+def get_swc_jobs(project_id, skeleton_ids, linearize_ids, soma_markers,
+        errors):
+    """Load the treenodes and soma nodes of the passed in skeletons and return
+    a list of rendering jobs for them. Skeletons without nodes or with more
+    than one soma node are added to <errors>.
+    """
+    soma_nodes = get_soma_node_ids(project_id, skeleton_ids, soma_markers)
+    mark_root_as_soma = bool(soma_markers) and 'root' in soma_markers
+
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT skeleton_id, id, parent_id, location_x, location_y,
+            location_z, radius
+        FROM treenode
+        WHERE project_id = %(project_id)s
+          AND skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        ORDER BY skeleton_id, id
+    ''', {
+        'project_id': project_id,
+        'skeleton_ids': skeleton_ids,
+    })
+
+    jobs = []
+    for skeleton_id, rows in groupby(cursor.fetchall(), lambda row: row[0]):
+        soma_node_ids = soma_nodes.get(skeleton_id, [])
+        if len(soma_node_ids) > 1:
+            errors[skeleton_id] = "More than one soma node found"
+            continue
+        jobs.append((skeleton_id, [row[1:] for row in rows],
+                soma_node_ids[0] if soma_node_ids else None,
+                mark_root_as_soma, linearize_ids))
+
+    for skeleton_id in set(skeleton_ids) - set(job[0] for job in jobs) - set(errors):
+        errors[skeleton_id] = "Skeleton has no nodes"
+
+    return jobs
+
+
+def export_skeleton_archive(project_id, skeleton_ids, path, export_format='swc',
+        archive_format='zip', linearize_ids=False, soma_markers=None,
+        nrrd_options=None, user_id=None, n_jobs=1,
+        batch_size=DEFAULT_BULK_EXPORT_BATCH_SIZE, progress=None):
+    """Export the passed in skeletons as one file each into a single archive at
+    <path>. For SWC, treenodes of <batch_size> skeletons are loaded with one
+    query and rendered by <n_jobs> worker processes, while results are written
+    to the archive as they arrive. NRRD files are created through R, by
+    <n_jobs> parallel R processes, using the <nrrd_options> dict with
+    source_ref, target_ref and mirror fields on behalf of the passed in user.
+    <progress> is called with the number of processed and total skeletons after
+    every batch. Returns a dict that maps the IDs of all skeletons that
+    couldn't be exported to an error message, which is also added to the
+    archive as errors.txt.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: {}".format(export_format))
+    if export_format == 'nrrd' and (not nrrd_options or user_id is None):
+        raise ValueError("NRRD export needs NRRD options and a user")
+    if batch_size < 1:
+        raise ValueError("Batch size needs to be positive")
+
+    skeleton_ids = [int(skid) for skid in skeleton_ids]
+    n_jobs = max(1, int(n_jobs or 1))
+    if n_jobs > 1 and export_format == 'swc' and \
+            multiprocessing.current_process().daemon:
+        # Daemon processes like the workers of Celery's default prefork pool
+        # can't start child processes. NRRD exports use threads and aren't
+        # affected.
+        logger.warning("Can't use worker processes in daemon process, " +
+                "rendering SWC files in a single process")
+        n_jobs = 1
+
+    errors = {}
+    n_processed = 0
+    pool = None
+    if n_jobs > 1:
+        if export_format == 'swc':
+            # Database connections can't be shared with forked processes.
+            connections.close_all()
+            pool = multiprocessing.Pool(n_jobs, initializer=init_export_worker)
+        else:
+            pool = ThreadPool(n_jobs)
+    try:
+        with SkeletonArchive(path, archive_format) as archive:
+            for batch in get_batches(skeleton_ids, batch_size):
+                if export_format == 'swc':
+                    jobs = get_swc_jobs(project_id, batch, linearize_ids,
+                            soma_markers, errors)
+                    results = pool.imap(render_swc_job, jobs) if pool else \
+                            map(render_swc_job, jobs)
+                    for skeleton_id, data in results:
+                        archive.add('{}.swc'.format(skeleton_id), data)
+                else:
+                    def export_nrrd(skeleton_id):
+                        return skeleton_id, export_skeleton_as_nrrd(skeleton_id,
+                                nrrd_options['source_ref'],
+                                nrrd_options['target_ref'], user_id,
+                                nrrd_options.get('mirror', True))
+
+                    def export_nrrd_in_thread(skeleton_id):
+                        # Each pool thread opens its own database connection,
+                        # which isn't closed automatically.
+                        try:
+                            return export_nrrd(skeleton_id)
+                        finally:
+                            connection.close()
+
+                    results = pool.imap(export_nrrd_in_thread, batch) if pool \
+                            else map(export_nrrd, batch)
+                    for skeleton_id, result in results:
+                        if result['errors']:
+                            errors[skeleton_id] = '; '.join(result['errors'])
+                            continue
+                        archive.add_file('{}.nrrd'.format(skeleton_id),
+                                result['nrrd_path'])
+                        os.remove(result['nrrd_path'])
+
+                n_processed += len(batch)
+                if progress:
+                    progress(n_processed, len(skeleton_ids))
+
+            if errors:
+                archive.add('errors.txt', ''.join('{} {}\n'.format(skid, error)
+                        for skid, error in sorted(errors.items())).encode('utf-8'))
+    except:
+        if pool:
+            pool.terminate()
+            pool.join()
+            pool = None
+        raise
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return errors
+
+
+@task()
+def export_skeleton_archive_async(project_id, user_id, skeleton_ids,
+        export_format='swc', archive_format='zip', linearize_ids=False,
+        soma_markers=None, nrrd_options=None):
+    """Export skeletons into an archive in the export media folder, report
+    progress to the user through WebSockets and create a message with the
+    download link once done.
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
+    archive_name = "skeletons-{}-{}-{}.{}".format(project_id, export_format,
+            timestamp, archive_format)
+    archive_path = os.path.join(output_path, archive_name)
+
+    def progress(n_processed, n_total):
+        msg_user(user_id, 'skeleton-archive-update', {
+            'archive_name': archive_name,
+            'n_processed': n_processed,
+            'n_total': n_total,
+        })
+
+    msg = Message()
+    msg.user = User.objects.get(pk=int(user_id))
+    msg.read = False
+    try:
+        errors = export_skeleton_archive(project_id, skeleton_ids,
+                archive_path, export_format, archive_format, linearize_ids,
+                soma_markers, nrrd_options, user_id,
+                getattr(settings, 'BULK_EXPORT_JOBS', 1), progress=progress)
+    except Exception as e:
+        if os.path.exists(archive_path):
+            os.remove(archive_path)
+        msg.title = "Exporting skeletons failed"
+        msg.text = "The skeleton archive couldn't be created: {}".format(e)
+        msg.action = ""
+        msg.save()
+        raise
+
+    url = urljoin(urljoin(settings.MEDIA_URL, settings.MEDIA_EXPORT_SUBDIRECTORY), archive_name)
+    msg.title = "Exported {} skeletons as {} files".format(
+            len(skeleton_ids) - len(errors), export_format.upper())
+    msg.text = "The requested skeletons were exported. You can download " \
+            "the archive from this location: <a href='{}'>{}</a>".format(url, url)
+    if errors:
+        msg.text += " {} skeletons couldn't be exported, they are listed " \
+                "in errors.txt.".format(len(errors))
+    msg.action = url
+    msg.save()
+
+    return archive_path
+
+
+@api_view(['POST'])
+@requires_user_role(UserRole.Browse)
+def export_skeleton_archive_view(request, project_id=None):
+    """Queue the export of many skeletons into a single archive.
+
+    Skeletons are either selected by ID or by annotations. Once the export is
+    finished, the user is notified with a message that links to the archive.
+    Progress is reported through the "skeleton-archive-update" WebSocket event.
+    ---
+    parameters:
+    - name: project_id
+      description: Project of skeletons
+      type: integer
+      paramType: path
+      required: true
+    - name: skeleton_ids
+      description: IDs of skeletons to export
+      type: array
+      items:
+        type: integer
+      paramType: form
+      required: false
+    - name: annotations
+      description: |
+        Names of annotations that neurons of exported skeletons have to be
+        annotated with, directly or through sub-annotations. Used if no
+        skeleton IDs are provided.
+      type: array
+      items:
+        type: string
+      paramType: form
+      required: false
+    - name: format
+      description: Either "swc" (default) or "nrrd".
+      type: string
+      paramType: form
+      required: false
+    - name: archive_format
+      description: Either "zip" (default), "tar" or "tar.gz".
+      type: string
+      paramType: form
+      required: false
+    - name: linearize_ids
+      description: Whether SWC node IDs should be renumbered from 1.
+      type: boolean
+      paramType: form
+      required: false
+    - name: soma_markers
+      description: |
+        How the SWC soma node is found: "tag:soma", "radius:<min radius>"
+        and/or "root".
+      type: array
+      items:
+        type: string
+      paramType: form
+      required: false
+    - name: source_ref
+      description: NRRD only, the source reference space.
+      type: string
+      paramType: form
+      required: false
+    - name: target_ref
+      description: NRRD only, the target reference space.
+      type: string
+      paramType: form
+      required: false
+    - name: mirror
+      description: NRRD only, whether skeletons should be mirrored.
+      type: boolean
+      paramType: form
+      required: false
+    """
+    project_id = int(project_id)
+    skeleton_ids = get_request_list(request.POST, 'skeleton_ids', map_fn=int)
+    if not skeleton_ids:
+        annotations = get_request_list(request.POST, 'annotations')
+        if not annotations:
+            raise ValueError("Need skeleton IDs or annotations")
+        skeleton_ids = get_annotated_skeleton_ids(project_id, annotations)
+        if not skeleton_ids:
+            raise ValueError("No skeletons found with these annotations")
+
+    export_format = request.POST.get('format', 'swc')
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError("Unknown export format: {}".format(export_format))
+    archive_format = request.POST.get('archive_format', 'zip')
+    if archive_format not in ARCHIVE_FORMATS:
+        raise ValueError("Unknown archive format: {}".format(archive_format))
+
+    nrrd_options = None
+    if export_format == 'nrrd':
+        nrrd_options = {
+            'source_ref': request.POST['source_ref'],
+            'target_ref': request.POST['target_ref'],
+            'mirror': get_request_bool(request.POST, 'mirror', False),
+        }
+
+    # Make sure the output path can be written to
+    if not os.path.exists(output_path) or not os.access(output_path, os.W_OK):
+        raise ValueError("The output path is not accessible")
+
+    export_skeleton_archive_async.delay(project_id, request.user.id,
+            skeleton_ids, export_format, archive_format,
+            get_request_bool(request.POST, 'linearize_ids', False),
+            get_request_list(request.POST, 'soma_markers', []), nrrd_options)
+
+    return JsonResponse({
+        'n_skeletons': len(skeleton_ids),
+        'message': 'The skeleton archive is currently exporting. You will be '
+                'notified once it is ready for download.',
+    })
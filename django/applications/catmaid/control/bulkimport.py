@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import io
+import numpy as np
+
+from django.db import connection
+
+from catmaid.control.arbor import Arbor
+from catmaid.control.common import (insert_into_log, get_class_to_id_map,
+        get_relation_to_id_map)
+from catmaid.models import ClassInstance, ClassInstanceClassInstance
+
+
+# The number of skeletons that are written with a single COPY statement when
+# importing many skeletons.
+DEFAULT_BULK_IMPORT_BATCH_SIZE = 1000
+
+
+def parse_swc(swc_string):
+    """Parse a skeleton in SWC format into NumPy arrays. Returns a tuple of
+    the SWC node IDs, the index of the parent of each node (-1 for the root),
+    an N x 3 array of positions and the radii. Nodes are ordered so that
+    parents come before their children. Raises a ValueError if the SWC is
+    malformed, i.e. if a line doesn't have seven fields, node IDs aren't unique,
+    a parent doesn't exist, there isn't exactly one root or there is a cycle.
+    """
+    rows = []
+    for line in swc_string.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        row = line.split()
+        if len(row) != 7:
+            raise ValueError('SWC has a malformed line: {}'.format(line))
+        rows.append(row)
+    if not rows:
+        raise ValueError('SWC contains no nodes')
+
+    data = np.array(rows, dtype=np.float64)
+    node_ids = data[:, 0].astype(np.int64)
+    parent_ids = data[:, 6].astype(np.int64)
+    if len(np.unique(node_ids)) != len(node_ids):
+        raise ValueError('SWC has duplicate node IDs')
+
+    arbor = Arbor(node_ids, parent_ids)
+    unknown = (parent_ids != -1) & (arbor.parent_index == -1)
+    if unknown.any():
+        raise ValueError('SWC node {} has unknown parent {}'.format(
+                node_ids[unknown][0], parent_ids[unknown][0]))
+    if len(arbor.roots) != 1:
+        raise ValueError('SWC skeleton needs exactly one root, found {}'.format(
+                len(arbor.roots)))
+
+    # Visit nodes level by level from the root. Nodes on a cycle can't be
+    # reached, because their parent is part of the cycle as well.
+    levels = []
+    frontier = arbor.roots
+    while len(frontier):
+        levels.append(frontier)
+        frontier = arbor.children_of(frontier)
+    order = np.concatenate(levels)
+    if len(order) != len(arbor):
+        raise ValueError('SWC skeleton is malformed: it contains a cycle.')
+
+    # Map parent indices into the new order
+    new_index = np.empty(len(order), dtype=np.int64)
+    new_index[order] = np.arange(len(order))
+    parent_index = arbor.parent_index[order]
+    parent_index = np.where(parent_index == -1, -1, new_index[parent_index])
+
+    return node_ids[order], parent_index, data[order, 2:5], data[order, 5]
+
+
+def import_swc_skeletons(user, project_id, skeletons):
+    """Create a new neuron and skeleton for each of the passed in (name, swc)
+    tuples, where swc is the result of parse_swc(). Neurons and skeletons are
+    named after <name>. IDs for all class instances and treenodes are reserved
+    up front, so that all treenodes can be written with a single COPY
+    statement. The treenode triggers then update the edge table and the
+    skeleton summary table once for all skeletons. Returns a list with a tuple
+    (neuron_id, skeleton_id, treenode_ids) for each skeleton, where
+    treenode_ids is an array of the new IDs of the SWC nodes in the order of
+    the parsed SWC.
+    """
+    skeletons = list(skeletons)
+    if not skeletons:
+        return []
+
+    relation_map = get_relation_to_id_map(project_id)
+    class_map = get_class_to_id_map(project_id)
+    cursor = connection.cursor()
+
+    n_nodes = sum(len(swc[0]) for _, swc in skeletons)
+    cursor.execute("""
+        SELECT nextval('concept_id_seq') FROM generate_series(1, %(n)s)
+    """, {'n': 2 * len(skeletons)})
+    concept_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute("""
+        SELECT nextval('location_id_seq') FROM generate_series(1, %(n)s)
+    """, {'n': n_nodes})
+    treenode_ids = np.fromiter((row[0] for row in cursor.fetchall()),
+            dtype=np.int64, count=n_nodes)
+
+    neurons = []
+    new_skeletons = []
+    links = []
+    for i, (name, swc) in enumerate(skeletons):
+        neuron_id, skeleton_id = concept_ids[2 * i], concept_ids[2 * i + 1]
+        neurons.append(ClassInstance(id=neuron_id, user=user,
+                project_id=project_id, class_column_id=class_map['neuron'],
+                name=name or 'neuron {}'.format(neuron_id)))
+        new_skeletons.append(ClassInstance(id=skeleton_id, user=user,
+                project_id=project_id, class_column_id=class_map['skeleton'],
+                name=name or 'skeleton {}'.format(skeleton_id)))
+        links.append(ClassInstanceClassInstance(user=user,
+                project_id=project_id, relation_id=relation_map['model_of'],
+                class_instance_a_id=skeleton_id, class_instance_b_id=neuron_id))
+    ClassInstance.objects.bulk_create(neurons + new_skeletons)
+    ClassInstanceClassInstance.objects.bulk_create(links)
+
+    # Write all treenodes as tab separated text, parents first
+    data = io.StringIO()
+    result = []
+    offset = 0
+    for i, (name, swc) in enumerate(skeletons):
+        node_ids, parent_index, positions, radii = swc
+        ids = treenode_ids[offset:offset + len(node_ids)]
+        offset += len(node_ids)
+        skeleton_id = concept_ids[2 * i + 1]
+        parent_ids = np.where(parent_index == -1, -1, ids[parent_index])
+        for node_id, parent_id, position, radius in zip(ids.tolist(),
+                parent_ids.tolist(), positions.tolist(), radii.tolist()):
+            data.write('{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n'.format(
+                    node_id, project_id, user.id, user.id, position[0],
+                    position[1], position[2], radius, skeleton_id,
+                    '\\N' if parent_id == -1 else parent_id))
+        result.append((concept_ids[2 * i], skeleton_id, ids))
+    data.seek(0)
+    cursor.copy_from(data, 'treenode', columns=('id', 'project_id', 'user_id',
+            'editor_id', 'location_x', 'location_y', 'location_z', 'radius',
+            'skeleton_id', 'parent_id'))
+
+    insert_into_log(project_id, user.id, 'create_neuron', None,
+            'Create {} neurons and skeletons via bulk import'.format(
+            len(skeletons)))
+
+    return result
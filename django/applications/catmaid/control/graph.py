@@ -9,14 +9,13 @@ from networkx.algorithms import weakly_connected_component_subgraphs
 from collections import defaultdict
 from itertools import chain
 from functools import partial
-from numpy import subtract
-from numpy.linalg import norm
 from math import sqrt
 
 from django.db import connection
 from django.http import JsonResponse
 
 from catmaid.models import Relation, UserRole
+from catmaid.control.arbor import Arbor
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import get_relation_to_id_map, get_request_list
 from catmaid.control.link import KNOWN_LINK_PAIRS
@@ -70,7 +69,7 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
             treenode_ids = []
             connector_ids =[]
             relation_ids = []
-            for treenode_id in filter(treenode_connector.has_key, graph.nodes_iter()):
+            for treenode_id in (n for n in graph.nodes_iter() if n in treenode_connector):
                 for c in treenode_connector.get(treenode_id):
                     connector_id, relation = c
                     treenode_ids.append(treenode_id)
@@ -81,15 +80,14 @@ def split_by_synapse_domain(bandwidth, locations, arbors, treenode_connector, mi
                 subdomains.append(graph)
                 continue
 
-            for parent_id, treenode_id in graph.edges_iter():
-                loc0 = locations[treenode_id]
-                loc1 = locations[parent_id]
-                graph[parent_id][treenode_id]['weight'] = norm(subtract(loc0, loc1))
-
-            # Invoke Casey's magic
-            max_density = tree_max_density(graph.to_undirected(), treenode_ids,
+            # Invoke Casey's magic, which works on arbors
+            node_ids = graph.nodes()
+            arbor = Arbor(node_ids,
+                    [next(graph.predecessors_iter(n), None) for n in node_ids],
+                    [locations[n] for n in node_ids])
+            max_density = tree_max_density(arbor, treenode_ids,
                     connector_ids, relation_ids, [bandwidth])
-            synapse_group = next(max_density.values())
+            synapse_group = next(iter(max_density.values()))
             # The list of nodes of each synapse_group contains only nodes that have connectors
             # A local_max is the skeleton node most central to a synapse_group
             anchors = {}
@@ -1,14 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import json
-import networkx as nx
+import numpy as np
 
-from networkx.algorithms import weakly_connected_component_subgraphs
 from collections import defaultdict
-from itertools import count
+from itertools import count, groupby
 from functools import partial
-from numpy import subtract
-from numpy.linalg import norm
+from operator import itemgetter
 
 from django.db import connection
 from django.http import JsonResponse
@@ -16,11 +14,11 @@ from django.http import JsonResponse
 from rest_framework.decorators import api_view
 
 from catmaid.models import UserRole
+from catmaid.control.arbor import Arbor
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import (get_relation_to_id_map, get_request_bool,
         get_request_list)
 from catmaid.control.link import KNOWN_LINK_PAIRS
-from catmaid.control.tree_util import simplify
 from catmaid.control.synapseclustering import tree_max_density
 
 
@@ -128,27 +126,13 @@ def confidence_split_graph(project_id, skeleton_ids, confidence_threshold,
     # All nodes of the graph
     nodeIDs = []
 
-    # Read out into memory only one skeleton at a time
-    current_skid = None
-    tree = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
-            # Build the tree, breaking it at the low-confidence edges
-            if row[2] and row[3] >= confidence_threshold:
-                    tree.add_edge(row[2], row[1])
-            continue
-
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
-
-    if tree:
-        nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
+    # Build the arbor of one skeleton at a time, breaking it at the
+    # low-confidence edges
+    for skid, rows in groupby(cursor.fetchall(), itemgetter(0)):
+        arbor, chunk_roots = split_arbor((row[1:] for row in rows),
+                confidence_threshold)
+        nodeIDs.extend(split_by_confidence(skid, arbor, chunk_roots,
+                stc[skid], connectors))
 
     # Create the edges of the graph from the connectors, which was populated as a side effect of 'split_by_confidence'
     edges = defaultdict(partial(defaultdict, make_new_synapse_count_array)) # pre vs post vs count
@@ -216,27 +200,13 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
         ORDER BY skeleton_id
         ''' % (project_id, ",".join(str(int(skid)) for skid in not_to_expand)))
 
-        # Read out into memory only one skeleton at a time
-        current_skid = None
-        tree = None
-        for row in cursor.fetchall():
-            if row[0] == current_skid:
-                # Build the tree, breaking it at the low-confidence edges
-                if row[2] and row[3] >= confidence_threshold:
-                        tree.add_edge(row[2], row[1])
-                continue
-
-            if tree:
-                nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
-
-            # Start the next tree
-            current_skid = row[0]
-            tree = nx.DiGraph()
-            if row[2] and row[3] > confidence_threshold:
-                tree.add_edge(row[2], row[1])
-
-        if tree:
-            nodeIDs.extend(split_by_confidence(current_skid, tree, stc[current_skid], connectors))
+        # Build the arbor of one skeleton at a time, breaking it at the
+        # low-confidence edges
+        for skid, rows in groupby(cursor.fetchall(), itemgetter(0)):
+            arbor, chunk_roots = split_arbor((row[1:] for row in rows),
+                    confidence_threshold)
+            nodeIDs.extend(split_by_confidence(skid, arbor, chunk_roots,
+                    stc[skid], connectors))
     else:
         # No need to split.
         # Populate connectors from the connections among them
@@ -261,33 +231,12 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
     # list of branch nodes, merely structural
     branch_nodeIDs = []
 
-    # reset
-    current_skid = None
-    tree = None
-    locations = None
-    for row in cursor.fetchall():
-        if row[0] == current_skid:
-            # Build the tree, breaking it at the low-confidence edges
-            locations[row[1]] = row[4:]
-            if row[2] and row[3] >= confidence_threshold:
-                    tree.add_edge(row[2], row[1])
-            continue
-
-        if tree:
-            ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
-            nodeIDs.extend(ns)
-            branch_nodeIDs.extend(bs)
-
-        # Start the next tree
-        current_skid = row[0]
-        tree = nx.DiGraph()
-        locations = {}
-        locations[row[1]] = row[4:]
-        if row[2] and row[3] > confidence_threshold:
-            tree.add_edge(row[2], row[1])
-
-    if tree:
-        ns, bs = split_by_both(current_skid, tree, locations, bandwidth, stc[current_skid], connectors, intraedges)
+    for skid, rows in groupby(cursor.fetchall(), itemgetter(0)):
+        # Build the arbor, breaking it at the low-confidence edges
+        arbor, chunk_roots = split_arbor((row[1:] for row in rows),
+                confidence_threshold)
+        ns, bs = split_by_both(skid, arbor, chunk_roots, bandwidth,
+                stc[skid], connectors, intraedges)
         nodeIDs.extend(ns)
         branch_nodeIDs.extend(bs)
 
@@ -309,18 +258,43 @@ def dual_split_graph(project_id, skeleton_ids, confidence_threshold, bandwidth,
     }
 
 
-def populate_connectors(chunkIDs, chunks, cs, connectors):
+def split_arbor(rows, confidence_threshold):
+    """ Create an arbor from treenode rows of the form (id, parent_id,
+    confidence) or (id, parent_id, confidence, x, y, z), without the edges
+    below the confidence threshold. Returns the arbor along with the index of
+    the root of the chunk each node belongs to, which is -1 for nodes that
+    aren't connected to any other node. """
+    rows = list(rows)
+    parent_ids = [row[1] if row[1] and row[2] >= confidence_threshold else None
+            for row in rows]
+    positions = [row[3:6] for row in rows] if rows and len(rows[0]) > 3 else None
+    arbor = Arbor([row[0] for row in rows], parent_ids, positions)
+    chunk_roots = arbor.component_roots()
+    chunk_roots[(arbor.parent_index == -1) & (arbor.n_children == 0)] = -1
+    return arbor, chunk_roots
+
+
+def connector_chunks(arbor, chunk_roots, cs):
+    """ Return the chunk root index for the treenode of each connector
+    link in cs, -1 if the treenode isn't part of any chunk. """
+    if not cs:
+        return []
+    indices = arbor.indices([c[0] for c in cs], missing=-1)
+    return np.where(indices != -1, chunk_roots[indices], -1).tolist()
+
+
+def populate_connectors(chunkIDs, chunks, arbor, chunk_roots, cs, connectors):
     # Build up edges via the connectors
-    for c in cs:
+    chunkIDs = dict(zip(chunks, chunkIDs))
+    for c, chunk in zip(cs, connector_chunks(arbor, chunk_roots, cs)):
         # c is (treenode_id, connector_id, relation_id, confidence)
-        for chunkID, chunk in zip(chunkIDs, chunks):
-            if c[0] in chunk:
-                connectors[c[1]][c[2]].append((chunkID, c[3]))
-                break
+        chunkID = chunkIDs.get(chunk)
+        if chunkID is not None:
+            connectors[c[1]][c[2]].append((chunkID, c[3]))
 
 
-def subgraphs(digraph, skeleton_id):
-    chunks = list(weakly_connected_component_subgraphs(digraph))
+def subgraphs(chunk_roots, skeleton_id):
+    chunks = np.unique(chunk_roots[chunk_roots != -1]).tolist()
     if 1 == len(chunks):
         chunkIDs = (str(skeleton_id),)
     else:
@@ -328,39 +302,33 @@ def subgraphs(digraph, skeleton_id):
     return chunks, chunkIDs
 
 
-def split_by_confidence(skeleton_id, digraph, cs, connectors):
+def split_by_confidence(skeleton_id, arbor, chunk_roots, cs, connectors):
     """ Split by confidence threshold. Populates connectors (side effect). """
-    chunks, chunkIDs = subgraphs(digraph, skeleton_id)
-    populate_connectors(chunkIDs, chunks, cs, connectors)
+    chunks, chunkIDs = subgraphs(chunk_roots, skeleton_id)
+    populate_connectors(chunkIDs, chunks, arbor, chunk_roots, cs, connectors)
     return chunkIDs
 
 
-def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, intraedges):
+def split_by_both(skeleton_id, arbor, chunk_roots, bandwidth, cs, connectors, intraedges):
     """ Split by confidence and synapse domain. Populates connectors and intraedges (side effects). """
     nodes = []
     branch_nodes = []
 
-    chunks, chunkIDs = subgraphs(digraph, skeleton_id)
+    chunks, chunkIDs = subgraphs(chunk_roots, skeleton_id)
+    cs_chunks = connector_chunks(arbor, chunk_roots, cs)
 
     for i, chunkID, chunk in zip(count(start=1), chunkIDs, chunks):
-        # Populate edge properties with the weight
-        for parent, child in chunk.edges_iter():
-            chunk[parent][child]['weight'] = norm(subtract(locations[child], locations[parent]))
-
         # Check if need to expand at all
-        blob = tuple(c for c in cs if c[0] in chunk)
+        blob = tuple(c for c, c_chunk in zip(cs, cs_chunks) if c_chunk == chunk)
         if 0 == len(blob):
             nodes.append(chunkID)
             continue
 
         treenode_ids, connector_ids, relation_ids, confidences = list(zip(*blob))
 
-        if 0 == len(connector_ids):
-            nodes.append(chunkID)
-            continue
-
-        # Invoke Casey's magic: split by synapse domain
-        max_density = tree_max_density(chunk.to_undirected(), treenode_ids,
+        # Invoke Casey's magic: split by synapse domain. Other chunks of the
+        # arbor aren't connected to this one and don't affect the result.
+        max_density = tree_max_density(arbor, treenode_ids,
                 connector_ids, relation_ids, [bandwidth])
         # Get first element of max_density
         domains = next(iter(max_density.values()))
@@ -377,8 +345,8 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
         # Pick one treenode from each domain to act as anchor
         anchors = {d.node_ids[0]: (i+k, d) for k, d in domains.items()}
 
-        # Create new Graph where the edges are the edges among synapse domains
-        mini = simplify(chunk, anchors.keys())
+        # Create a new tree where the edges are the edges among synapse domains
+        mini, mini_edges = arbor.minify(arbor.indices(list(anchors.keys())))
 
         # Many side effects:
         # * add internal edges to intraedges
@@ -386,7 +354,7 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
         # * custom-apply populate_connectors with the known synapses of each domain
         #   (rather than having to sift through all in cs)
         mini_nodes = {}
-        for node in mini.nodes_iter():
+        for node in arbor.node_ids[mini].tolist():
             blob = anchors.get(node, None)
             if blob:
                 index, domain = blob
@@ -400,7 +368,7 @@ def split_by_both(skeleton_id, digraph, locations, bandwidth, cs, connectors, in
                 branch_nodes.append(domainID)
             mini_nodes[node] = domainID
 
-        for a1, a2 in mini.edges_iter():
+        for a1, a2 in arbor.node_ids[mini_edges].tolist():
             intraedges.append((mini_nodes[a1], mini_nodes[a2]))
 
     return nodes, branch_nodes
@@ -13,6 +13,7 @@ from django.db import connection
 from django.conf import settings
 from django.http import JsonResponse, HttpResponse
 
+from catmaid.control import nblast as native_nblast
 from catmaid.control.common import get_request_bool, urljoin
 from catmaid.control.authentication import requires_user_role
 from catmaid.models import (Message, User, UserRole, NblastConfig,
@@ -244,10 +245,11 @@ def setup_r_environment():
 def compute_scoring_matrix(project_id, user_id, matching_skeleton_ids,
         random_skeleton_ids, distbreaks=NblastConfigDefaultDistanceBreaks,
         dotbreaks=NblastConfigDefaultDotBreaks, resample_step=1000,
-        tangent_neighbors=5, omit_failures=True):
+        tangent_neighbors=5, omit_failures=True, backend='r'):
     """Create NBLAST scoring matrix for a set of matching skeleton IDs and a set
     of random skeleton IDs. Matching skeletons are skeletons with a similar
-    morphology, e.g. KCy in FAFB.
+    morphology, e.g. KCy in FAFB. With <backend> set to 'native', the matrix is
+    computed with NumPy from the database directly, otherwise R is used.
 
     The following R script is executed through Rpy2:
 
@@ -295,6 +297,11 @@ def compute_scoring_matrix(project_id, user_id, matching_skeleton_ids,
         'dotbreaks': dotbreaks,
         'k': tangent_neighbors
     """
+    if backend == 'native':
+        return native_nblast.compute_scoring_matrix(matching_skeleton_ids,
+                random_skeleton_ids, distbreaks, dotbreaks, resample_step,
+                tangent_neighbors, omit_failures, project_id)
+
     timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     similarity = None
     matching_histogram = None
@@ -517,12 +524,53 @@ def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
     query_dp = dotprops(query, resample=1, k=5)
     target_dp = dotprops(target, resample=1, k=5)
     neurons.similarity = nblast_allbyall.neuronlist(neurons.dps, smat, FALSE, 'raw')
+
+    If the configuration's backend is 'native', the same is computed with
+    NumPy from the database directly, without R.
     """
     timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
     similarity = None
     errors = []
     try:
         config = NblastConfig.objects.get(project_id=project_id, pk=config_id)
+
+        # Indicate an all-by-all computation. This disabled <remove_target_duplicates>.
+        all_by_all = not query_object_ids and not target_object_ids and \
+                query_type == target_type
+        if all_by_all:
+            logger.debug('Disabling remove_target_duplicates option due to all-by-all computation')
+            remove_target_duplicates = False
+
+        # In case either query_object_ids or target_object_ids is not given, the
+        # value will be filled in with all objects of the respective type.
+        from catmaid.control.similarity import get_all_object_ids
+        if all_by_all:
+            query_object_ids = get_all_object_ids(project_id, user_id,
+                    query_type, min_nodes, min_soma_nodes, soma_tags)
+            target_object_ids = query_object_ids
+        else:
+            if not query_object_ids:
+                query_object_ids = get_all_object_ids(project_id, user_id,
+                        query_type, min_nodes, min_soma_nodes, soma_tags)
+            if not target_object_ids:
+                target_object_ids = get_all_object_ids(project_id, user_id,
+                        target_type, min_nodes, min_soma_nodes, soma_tags)
+
+        # If both query and target IDs are of the same type, the target list of
+        # object IDs can't contain any of the query IDs.
+        if query_type == target_type and remove_target_duplicates:
+            target_object_ids = list(set(target_object_ids) - set(query_object_ids))
+
+        if config.backend == 'native':
+            similarity = native_nblast.nblast(config, query_object_ids,
+                    target_object_ids, query_type, target_type, omit_failures,
+                    normalized, use_alpha, simplify, required_branches)
+            logger.debug('NBLAST computation done')
+            return {
+                "errors": errors,
+                "similarity": similarity
+            }
+
         token, _ = Token.objects.get_or_create(user_id=config.user_id)
 
         server_params = {
@@ -540,18 +588,9 @@ def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
         rcatmaid = importr('catmaid')
         Matrix = robjects.r.matrix
 
-        # Indicate an all-by-all computation. This disabled <remove_target_duplicates>.
-        all_by_all = not query_object_ids and not target_object_ids and \
-                query_type == target_type
-        if all_by_all:
-            logger.debug('Disabling remove_target_duplicates option due to all-by-all computation')
-            remove_target_duplicates = False
-
         conn = rcatmaid.catmaid_login(**server_params)
         nblast_params = {}
 
-        config = NblastConfig.objects.get(project_id=project_id, pk=config_id)
-
         parallel = False
         if settings.MAX_PARALLEL_ASYNC_WORKERS > 1:
             #' # Parallelise NBLASTing across 4 cores using doMC package
@@ -561,28 +600,6 @@ def nblast(project_id, user_id, config_id, query_object_ids, target_object_ids,
 
         nblast_params['.parallel'] = parallel
 
-        cursor = connection.cursor()
-
-        # In case either query_object_ids or target_object_ids is not given, the
-        # value will be filled in with all objects of the respective type.
-        from catmaid.control.similarity import get_all_object_ids
-        if all_by_all:
-            query_object_ids = get_all_object_ids(project_id, user_id,
-                    query_type, min_nodes, min_soma_nodes, soma_tags)
-            target_object_ids = query_object_ids
-        else:
-            if not query_object_ids:
-                query_object_ids = get_all_object_ids(project_id, user_id,
-                        query_type, min_nodes, min_soma_nodes, soma_tags)
-            if not target_object_ids:
-                target_object_ids = get_all_object_ids(project_id, user_id,
-                        target_type, min_nodes, min_soma_nodes, soma_tags)
-
-        # If both query and target IDs are of the same type, the target list of
-        # object IDs can't contain any of the query IDs.
-        if query_type == target_type and remove_target_duplicates:
-            target_object_ids = list(set(target_object_ids) - set(query_object_ids))
-
         effective_query_object_ids = query_object_ids
         effective_target_object_ids = target_object_ids
 
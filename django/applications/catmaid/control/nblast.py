@@ -0,0 +1,858 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import numpy as np
+import psycopg2
+
+from collections import defaultdict
+from itertools import product
+from scipy.spatial import cKDTree
+
+from django.db import connection
+
+from catmaid.control.arbor import Arbor, load_arbors
+from catmaid.models import (NblastConfigDefaultDistanceBreaks,
+        NblastConfigDefaultDotBreaks, NblastSimilarityTile, PointSet)
+
+
+logger = logging.getLogger(__name__)
+
+# The available NBLAST implementations, selectable per NblastConfig.
+NBLAST_BACKENDS = ('r', 'native')
+
+# The types of objects dotprops can be computed for.
+DOTPROPS_OBJECT_TYPES = ('skeleton', 'pointcloud', 'pointset')
+
+# The number of objects whose newly computed dotprops are written to the
+# dotprops cache with a single statement.
+DOTPROPS_CACHE_BATCH_SIZE = 100
+
+# The default number of query and target objects in each tile of a similarity
+# matrix that is computed in tiles.
+DEFAULT_NBLAST_TILE_SIZE = 500
+
+# The default number of candidates that are scored with NBLAST when searching
+# for the most similar skeletons and the voxel edge length in nm that is used
+# to find them.
+DEFAULT_NBLAST_CANDIDATES = 200
+DEFAULT_NBLAST_VOXEL_SIZE = 5000
+
+
+class Dotprops(object):
+    """The points of an object along with the tangent vector at each point and
+    how well the local neighborhood of each point is described by a line
+    (alpha), like nat's dotprops. Coordinates are in µm.
+    """
+
+    __slots__ = ('points', 'tangents', 'alpha', '_tree')
+
+    def __init__(self, points, tangents, alpha):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.tangents = np.asarray(tangents, dtype=np.float64).reshape(-1, 3)
+        self.alpha = np.asarray(alpha, dtype=np.float64).reshape(-1)
+        self._tree = None
+
+    @classmethod
+    def from_points(cls, points, k=5):
+        """Compute the dotprops of an N x 3 array of points. The tangent of a
+        point is the first principal component of its <k> nearest points
+        (including itself) and alpha is (l1 - l2) / (l1 + l2 + l3) of the
+        eigenvalues l1 >= l2 >= l3 of their scatter matrix.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        n = len(points)
+        if n == 0:
+            return cls(points, points, np.zeros(0))
+        k = max(1, min(int(k), n))
+        _, neighbors = cKDTree(points).query(points, k=k)
+        neighbors = neighbors.reshape(n, k)
+        local = points[neighbors]
+        local = local - local.mean(axis=1)[:, np.newaxis, :]
+        scatter = np.einsum('nki,nkj->nij', local, local)
+        # Eigenvalues are returned in ascending order
+        values, vectors = np.linalg.eigh(scatter)
+        total = values.sum(axis=1)
+        alpha = np.zeros(n)
+        np.divide(values[:, 2] - values[:, 1], total, out=alpha,
+                where=total > 0)
+        return cls(points, vectors[:, :, 2], alpha)
+
+    def __len__(self):
+        return len(self.points)
+
+    @property
+    def tree(self):
+        """A KD-tree of the points, built on first use."""
+        if self._tree is None:
+            self._tree = cKDTree(self.points)
+        return self._tree
+
+
+def resample_arbor(arbor, step):
+    """Return the points of an arbor resampled to about <step> spacing, like
+    nat's resample(). Root, branch and end nodes are kept and each segment
+    between them is replaced with points at multiples of <step> along its
+    cable, measured from its proximal end.
+    """
+    if len(arbor) == 0:
+        return np.zeros((0, 3))
+    n_children = arbor.n_children
+    structural = (arbor.parent_index == -1) | (n_children != 1)
+    points = [arbor.positions[structural]]
+    for sequence in arbor.partition():
+        # Partition sequences run from an end to a branch or the root and can
+        # pass through branch nodes, which start new segments.
+        sequence = sequence[::-1]
+        start = 0
+        for i in range(1, len(sequence)):
+            if structural[sequence[i]]:
+                segment = arbor.positions[sequence[start:i + 1]]
+                points.append(_resample_segment(segment, step))
+                start = i
+    return np.concatenate(points)
+
+
+def _resample_segment(segment, step):
+    """Return the points at multiples of <step> along a polyline, excluding
+    both of its ends.
+    """
+    lengths = np.linalg.norm(np.diff(segment, axis=0), axis=1)
+    cumulative = np.concatenate(([0.0], np.cumsum(lengths)))
+    total = cumulative[-1]
+    if total <= step:
+        return np.zeros((0, 3))
+    samples = np.arange(step, total, step)
+    samples = samples[samples < total]
+    return np.column_stack([np.interp(samples, cumulative, segment[:, i])
+            for i in range(3)])
+
+
+def simplify_arbor(arbor, n_branches):
+    """Return a new arbor that only consists of the longest path from the root
+    and the <n_branches> branches that add most cable to it, chosen greedily,
+    similar to elmr's simplify_neuron(). Arbors with no more branch nodes are
+    returned unchanged.
+    """
+    n_children = arbor.n_children
+    if np.count_nonzero(n_children > 1) <= n_branches:
+        return arbor
+
+    distances = arbor.distances_to_root()
+    has_parent = arbor.parent_index != -1
+    ends = np.flatnonzero(has_parent & (n_children == 0))
+    kept = ~has_parent
+    parent_index = arbor.parent_index.tolist()
+    for _ in range(n_branches + 1):
+        # Find the nearest kept ancestor of each end by pointer jumping
+        target = np.where(kept, np.arange(len(arbor)), arbor.parent_index)
+        while True:
+            next_target = target[target]
+            if np.array_equal(next_target, target):
+                break
+            target = next_target
+        added = distances[ends] - distances[target[ends]]
+        best = int(np.argmax(added))
+        if kept[ends[best]]:
+            break
+        node = int(ends[best])
+        while not kept[node]:
+            kept[node] = True
+            node = parent_index[node]
+
+    parent_ids = np.where(has_parent, arbor.node_ids[arbor.parent_index], -1)
+    return Arbor(arbor.node_ids[kept], parent_ids[kept],
+            arbor.positions[kept])
+
+
+def skeleton_dotprops(skeleton_ids, resample_step=1000, k=5, simplify=False,
+        required_branches=10):
+    """Return a list with the dotprops of each passed in skeleton, or None for
+    skeletons without nodes. Node positions are converted from nm to µm and
+    resampled to <resample_step> nm. Optionally, skeletons are simplified
+    first to their <required_branches> most important branches.
+    """
+    arbors = load_arbors(skeleton_ids)
+    dotprops = []
+    for skeleton_id in skeleton_ids:
+        arbor = arbors.get(int(skeleton_id))
+        if arbor is None:
+            dotprops.append(None)
+            continue
+        if simplify:
+            arbor = simplify_arbor(arbor, required_branches)
+        arbor.positions /= 1e3
+        points = resample_arbor(arbor, resample_step / 1e3)
+        dotprops.append(Dotprops.from_points(points, k))
+    return dotprops
+
+
+def pointcloud_dotprops(pointcloud_ids, k=5):
+    """Return a list with the dotprops of each passed in point cloud, or None
+    for point clouds without points. Coordinates are converted to µm.
+    """
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT pcp.pointcloud_id, p.location_x, p.location_y, p.location_z
+        FROM pointcloud_point pcp
+        JOIN point p
+            ON p.id = pcp.point_id
+        WHERE pcp.pointcloud_id = ANY(%(pointcloud_ids)s::integer[])
+    """, {
+        'pointcloud_ids': [int(pcid) for pcid in pointcloud_ids],
+    })
+    points = defaultdict(list)
+    for row in cursor.fetchall():
+        points[row[0]].append(row[1:])
+    return [Dotprops.from_points(np.array(points[int(pcid)]) / 1e3, k)
+            if int(pcid) in points else None for pcid in pointcloud_ids]
+
+
+def pointset_dotprops(pointset_ids, k=5):
+    """Return a list with the dotprops of each passed in point set, or None for
+    unknown or empty point sets. Coordinates are converted to µm.
+    """
+    points = dict(PointSet.objects.filter(pk__in=pointset_ids) \
+            .values_list('id', 'points'))
+    return [Dotprops.from_points(np.array(points[int(psid)]) / 1e3, k)
+            if points.get(int(psid)) else None for psid in pointset_ids]
+
+
+def compute_object_dotprops(object_type, object_ids, resample_step=1000, k=5,
+        simplify=False, required_branches=10):
+    """Return a list with the dotprops of each passed in skeleton, point cloud
+    or point set, or None for objects that can't be loaded.
+    """
+    if object_type == 'skeleton':
+        return skeleton_dotprops(object_ids, resample_step, k, simplify,
+                required_branches)
+    elif object_type == 'pointcloud':
+        return pointcloud_dotprops(object_ids, k)
+    elif object_type == 'pointset':
+        return pointset_dotprops(object_ids, k)
+    else:
+        raise ValueError("Unknown object type: {}".format(object_type))
+
+
+def get_object_versions(object_type, object_ids):
+    """Return a dict that maps each passed in object ID to the version of the
+    object, which changes with every edit. Skeletons use their export version,
+    point clouds and point sets their edition time in microseconds. Unknown
+    point clouds and point sets are not included.
+    """
+    cursor = connection.cursor()
+    object_ids = [int(object_id) for object_id in object_ids]
+    if object_type == 'skeleton':
+        cursor.execute("""
+            SELECT o.id, COALESCE(v.version, 0)
+            FROM UNNEST(%(object_ids)s::bigint[]) o(id)
+            LEFT JOIN skeleton_export_version v
+                ON v.skeleton_id = o.id
+        """, {
+            'object_ids': object_ids,
+        })
+    elif object_type in ('pointcloud', 'pointset'):
+        cursor.execute("""
+            SELECT id, (EXTRACT(EPOCH FROM edition_time) * 1000000)::bigint
+            FROM {table}
+            WHERE id = ANY(%(object_ids)s::bigint[])
+        """.format(table='pointcloud' if object_type == 'pointcloud' else
+                'point_set'), {
+            'object_ids': object_ids,
+        })
+    else:
+        raise ValueError("Unknown object type: {}".format(object_type))
+    return dict(cursor.fetchall())
+
+
+def get_dotprops_cache_options(object_type, resample_step, k, simplify,
+        required_branches):
+    """Return the resample step, the number of tangent neighbors and the
+    number of required branches that identify cached dotprops. Only skeletons
+    are resampled and simplified.
+    """
+    if object_type != 'skeleton':
+        return 0.0, int(k), -1
+    return float(resample_step), int(k), \
+            int(required_branches) if simplify else -1
+
+
+def load_cached_dotprops(object_type, versions, resample_step, k,
+        required_branches):
+    """Return a dict that maps object IDs to their cached dotprops, for all
+    objects of the passed in {object_id: version} dict that have dotprops for
+    their current version and the passed in options cached.
+    """
+    if not versions:
+        return {}
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT c.object_id, c.points, c.tangents, c.alpha
+        FROM nblast_dotprops_cache c
+        JOIN UNNEST(%(object_ids)s::bigint[], %(versions)s::bigint[])
+            o(id, version)
+            ON c.object_id = o.id
+            AND c.version = o.version
+        WHERE c.object_type = %(object_type)s
+            AND c.resample_step = %(resample_step)s
+            AND c.tangent_neighbors = %(k)s
+            AND c.required_branches = %(required_branches)s
+    """, {
+        'object_ids': list(versions.keys()),
+        'versions': list(versions.values()),
+        'object_type': object_type,
+        'resample_step': resample_step,
+        'k': k,
+        'required_branches': required_branches,
+    })
+    return dict((row[0], Dotprops(_from_float32(row[1]),
+            _from_float32(row[2]), _from_float32(row[3])))
+            for row in cursor.fetchall())
+
+
+def store_dotprops(project_id, object_type, entries, resample_step, k,
+        required_branches):
+    """Add the dotprops of each passed in (object_id, version, dotprops) tuple
+    to the dotprops cache, replacing entries of older versions.
+    """
+    if not entries:
+        return
+    cursor = connection.cursor()
+    cursor.execute("""
+        INSERT INTO nblast_dotprops_cache (project_id, object_type, object_id,
+            resample_step, tangent_neighbors, required_branches, version,
+            n_points, points, tangents, alpha)
+        SELECT %(project_id)s, %(object_type)s, e.object_id,
+            %(resample_step)s, %(k)s, %(required_branches)s, e.version,
+            e.n_points, e.points, e.tangents, e.alpha
+        FROM UNNEST(%(object_ids)s::bigint[], %(versions)s::bigint[],
+            %(n_points)s::integer[], %(points)s::bytea[],
+            %(tangents)s::bytea[], %(alpha)s::bytea[])
+            e(object_id, version, n_points, points, tangents, alpha)
+        ON CONFLICT (object_type, object_id, resample_step, tangent_neighbors,
+            required_branches)
+        DO UPDATE SET version = EXCLUDED.version,
+            update_time = now(),
+            n_points = EXCLUDED.n_points,
+            points = EXCLUDED.points,
+            tangents = EXCLUDED.tangents,
+            alpha = EXCLUDED.alpha
+        WHERE nblast_dotprops_cache.version <= EXCLUDED.version
+    """, {
+        'project_id': project_id,
+        'object_type': object_type,
+        'resample_step': resample_step,
+        'k': k,
+        'required_branches': required_branches,
+        'object_ids': [int(e[0]) for e in entries],
+        'versions': [e[1] for e in entries],
+        'n_points': [len(e[2]) for e in entries],
+        'points': [_to_float32(e[2].points) for e in entries],
+        'tangents': [_to_float32(e[2].tangents) for e in entries],
+        'alpha': [_to_float32(e[2].alpha) for e in entries],
+    })
+
+
+def _to_float32(values):
+    return psycopg2.Binary(np.asarray(values, dtype='<f4').tobytes())
+
+
+def _from_float32(data):
+    return np.frombuffer(data, dtype='<f4')
+
+
+def cached_object_dotprops(project_id, object_type, object_ids,
+        resample_step=1000, k=5, simplify=False, required_branches=10):
+    """Like compute_object_dotprops(), but dotprops are read from the dotprops
+    cache if they are available for the current version of an object. All
+    other dotprops are computed and added to the cache in batches.
+    """
+    options = get_dotprops_cache_options(object_type, resample_step, k,
+            simplify, required_branches)
+    versions = get_object_versions(object_type, object_ids)
+    dotprops = load_cached_dotprops(object_type, versions, *options)
+
+    missing = []
+    seen = set(dotprops.keys())
+    for object_id in object_ids:
+        object_id = int(object_id)
+        if object_id in versions and object_id not in seen:
+            missing.append(object_id)
+            seen.add(object_id)
+    logger.debug('Using {} cached {} dotprops, computing {}'.format(
+            len(object_ids) - len(missing), object_type, len(missing)))
+
+    for start in range(0, len(missing), DOTPROPS_CACHE_BATCH_SIZE):
+        batch = missing[start:start + DOTPROPS_CACHE_BATCH_SIZE]
+        computed = compute_object_dotprops(object_type, batch, resample_step,
+                k, simplify, required_branches)
+        entries = [(object_id, versions[object_id], dps)
+                for object_id, dps in zip(batch, computed) if dps is not None]
+        store_dotprops(project_id, object_type, entries, *options)
+        dotprops.update((e[0], e[2]) for e in entries)
+
+    return [dotprops.get(int(object_id)) for object_id in object_ids]
+
+
+def object_dotprops(object_type, object_ids, resample_step=1000, k=5,
+        simplify=False, required_branches=10, omit_failures=True,
+        project_id=None):
+    """Return a list with the dotprops of each passed in skeleton, point cloud
+    or point set. If a <project_id> is passed in, the dotprops cache of the
+    project is used. Objects that can't be loaded are represented by empty
+    dotprops if <omit_failures> is true, otherwise a ValueError is raised.
+    """
+    if object_type not in DOTPROPS_OBJECT_TYPES:
+        raise ValueError("Unknown object type: {}".format(object_type))
+    if project_id is None:
+        dotprops = compute_object_dotprops(object_type, object_ids,
+                resample_step, k, simplify, required_branches)
+    else:
+        dotprops = cached_object_dotprops(project_id, object_type, object_ids,
+                resample_step, k, simplify, required_branches)
+
+    for object_id, dps in zip(object_ids, dotprops):
+        if dps is None:
+            if not omit_failures:
+                raise ValueError("Could not load {} {}".format(object_type,
+                        object_id))
+            logger.debug("Could not load {} {}".format(object_type, object_id))
+    empty = Dotprops(np.zeros((0, 3)), np.zeros((0, 3)), np.zeros(0))
+    return [empty if dps is None else dps for dps in dotprops]
+
+
+def dists_dotprods(query, target):
+    """Return for each point of the query dotprops the distance to its nearest
+    point in the target dotprops, the absolute dot product of both tangents
+    and the index of the target point.
+    """
+    distances, nearest = target.tree.query(query.points)
+    dots = np.abs(np.einsum('ij,ij->i', query.tangents,
+            target.tangents[nearest]))
+    # Rounding errors can make the dot product of parallel unit vectors
+    # slightly larger than one.
+    np.minimum(dots, 1.0, out=dots)
+    return distances, dots, nearest
+
+
+def stack_dotprops(dotprops):
+    """Concatenate a list of dotprops into a single dotprops object. Returns it
+    along with the index of the dotprops each point belongs to.
+    """
+    sizes = [len(dps) for dps in dotprops]
+    owner = np.repeat(np.arange(len(dotprops)), sizes)
+    if not sum(sizes):
+        empty = np.zeros((0, 3))
+        return Dotprops(empty, empty, np.zeros(0)), owner
+    return Dotprops(np.concatenate([dps.points for dps in dotprops]),
+            np.concatenate([dps.tangents for dps in dotprops]),
+            np.concatenate([dps.alpha for dps in dotprops])), owner
+
+
+def point_scores(query, target, scoring, distance_breaks, dot_breaks,
+        use_alpha=False):
+    """Return the NBLAST score of each query point against the target's
+    dotprops. The score of each query point is looked up in the <scoring>
+    matrix, rows of which are distance bins and columns dot product bins.
+    Values outside the breaks fall into the first or last bin, like with
+    nat.nblast's lodsby2dhist().
+    """
+    distances, dots, nearest = dists_dotprods(query, target)
+    distance_bins = np.clip(np.searchsorted(distance_breaks, distances,
+            side='right') - 1, 0, len(distance_breaks) - 2)
+    dot_bins = np.clip(np.searchsorted(dot_breaks, dots, side='right') - 1,
+            0, len(dot_breaks) - 2)
+    scores = scoring[distance_bins, dot_bins]
+    if use_alpha:
+        scores = scores * np.sqrt(query.alpha * target.alpha[nearest])
+    return scores
+
+
+def score_pair(query, target, scoring, distance_breaks, dot_breaks,
+        use_alpha=False):
+    """Return the raw NBLAST score of a query's dotprops against a target's
+    dotprops, see point_scores().
+    """
+    if len(query) == 0 or len(target) == 0:
+        return 0.0
+    return float(point_scores(query, target, scoring, distance_breaks,
+            dot_breaks, use_alpha).sum())
+
+
+def score_stacked(queries, owner, n_queries, target, scoring, distance_breaks,
+        dot_breaks, use_alpha=False):
+    """Return the raw NBLAST scores of <n_queries> query dotprops, stacked with
+    stack_dotprops(), against a single target. The nearest target points of
+    all queries are found with a single KD-tree query.
+    """
+    if len(queries) == 0 or len(target) == 0:
+        return np.zeros(n_queries)
+    scores = point_scores(queries, target, scoring, distance_breaks,
+            dot_breaks, use_alpha)
+    return np.bincount(owner, weights=scores, minlength=n_queries)
+
+
+def nblast_scores(query_dps, target_dps, scoring, distance_breaks, dot_breaks,
+        normalized='raw', use_alpha=False):
+    """Return a matrix with the NBLAST score of each query (rows) against each
+    target (columns). With <normalized> set to 'normalized', scores are divided
+    by the self-score of the query. With 'mean', the normalized scores of both
+    directions are averaged. If the same list is passed in as queries and
+    targets, the reverse scores and self-scores are taken from the forward
+    scores.
+    """
+    scoring = np.asarray(scoring, dtype=np.float64)
+    distance_breaks = np.asarray(distance_breaks, dtype=np.float64)
+    dot_breaks = np.asarray(dot_breaks, dtype=np.float64)
+    if scoring.shape != (len(distance_breaks) - 1, len(dot_breaks) - 1):
+        raise ValueError("The scoring matrix doesn't match the distance and "
+                "dot product breaks")
+
+    def score(query, target):
+        return score_pair(query, target, scoring, distance_breaks, dot_breaks,
+                use_alpha)
+
+    def score_all(queries, targets):
+        # Each target's KD-tree is queried once with the points of all queries
+        stacked, owner = stack_dotprops(queries)
+        scores = np.zeros((len(queries), len(targets)))
+        for i, target in enumerate(targets):
+            scores[:, i] = score_stacked(stacked, owner, len(queries), target,
+                    scoring, distance_breaks, dot_breaks, use_alpha)
+        return scores
+
+    def normalize(scores, self_scores):
+        result = np.zeros(scores.shape)
+        np.divide(scores, self_scores, out=result, where=self_scores != 0)
+        return result
+
+    symmetric = query_dps is target_dps
+    scores = score_all(query_dps, target_dps)
+    if normalized == 'raw':
+        return scores
+
+    if symmetric:
+        query_self_scores = np.diag(scores).copy()
+    else:
+        query_self_scores = np.array([score(q, q) for q in query_dps])
+    forward = normalize(scores, query_self_scores[:, np.newaxis])
+    if normalized == 'normalized':
+        return forward
+    elif normalized == 'mean':
+        if symmetric:
+            return (forward + forward.T) / 2.0
+        reverse = score_all(target_dps, query_dps).T
+        target_self_scores = np.array([score(t, t) for t in target_dps])
+        reverse = normalize(reverse, target_self_scores[np.newaxis, :])
+        return (forward + reverse) / 2.0
+    else:
+        raise ValueError("Unknown normalization: {}".format(normalized))
+
+
+def nblast(config, query_object_ids, target_object_ids, query_type='skeleton',
+        target_type='skeleton', omit_failures=True, normalized='raw',
+        use_alpha=False, simplify=True, required_branches=10):
+    """Compute the NBLAST similarity of each query object to each target object
+    with the passed in NblastConfig, without R. Returns a list with one list of
+    scores per query object.
+    """
+    logger.debug('Computing {} query {} dotprops'.format(
+            len(query_object_ids), query_type))
+    query_dps = object_dotprops(query_type, query_object_ids,
+            config.resample_step, config.tangent_neighbors, simplify,
+            required_branches, omit_failures, config.project_id)
+    if query_type == target_type and \
+            list(query_object_ids) == list(target_object_ids):
+        target_dps = query_dps
+    else:
+        logger.debug('Computing {} target {} dotprops'.format(
+                len(target_object_ids), target_type))
+        target_dps = object_dotprops(target_type, target_object_ids,
+                config.resample_step, config.tangent_neighbors, simplify,
+                required_branches, omit_failures, config.project_id)
+
+    logger.debug('Computing score (alpha: {a}, normalized: {n})'.format(**{
+        'a': 'Yes' if use_alpha else 'No',
+        'n': normalized,
+    }))
+    return nblast_scores(query_dps, target_dps, config.scoring,
+            config.distance_breaks, config.dot_breaks, normalized,
+            use_alpha).tolist()
+
+
+def get_tiles(n_queries, n_targets, tile_size=DEFAULT_NBLAST_TILE_SIZE):
+    """Split a similarity matrix of <n_queries> rows and <n_targets> columns
+    into tiles of at most <tile_size> rows and columns. Each tile is returned
+    as (query_start, query_end, target_start, target_end) tuple.
+    """
+    if tile_size < 1:
+        raise ValueError("The tile size has to be positive")
+    return [(query_start, min(query_start + tile_size, n_queries),
+            target_start, min(target_start + tile_size, n_targets))
+            for query_start in range(0, n_queries, tile_size)
+            for target_start in range(0, n_targets, tile_size)]
+
+
+def get_stored_tiles(similarity_id):
+    """Return the set of the bounds of all stored tiles of a similarity."""
+    return set(NblastSimilarityTile.objects.filter(
+            similarity_id=similarity_id).values_list('query_start',
+            'query_end', 'target_start', 'target_end'))
+
+
+def store_tile(similarity_id, tile, scores):
+    """Store the scores of a tile of a similarity matrix, replacing an existing
+    tile with the same bounds.
+    """
+    query_start, query_end, target_start, target_end = tile
+    scores = np.asarray(scores, dtype='<f4')
+    if scores.shape != (query_end - query_start, target_end - target_start):
+        raise ValueError("Scores don't match tile {}".format(tile))
+    NblastSimilarityTile.objects.update_or_create(similarity_id=similarity_id,
+            query_start=query_start, query_end=query_end,
+            target_start=target_start, target_end=target_end, defaults={
+                'scores': scores.tobytes(),
+            })
+
+
+def delete_tiles(similarity_id, keep=None):
+    """Delete all stored tiles of a similarity, except the ones with bounds in
+    <keep>.
+    """
+    keep = set(keep or [])
+    tile_ids = [tile_id for tile_id, bounds in (
+            (row[0], tuple(row[1:])) for row in NblastSimilarityTile.objects \
+                .filter(similarity_id=similarity_id).values_list('id',
+                'query_start', 'query_end', 'target_start', 'target_end'))
+            if bounds not in keep]
+    NblastSimilarityTile.objects.filter(id__in=tile_ids).delete()
+
+
+def assemble_tiles(similarity_id, n_queries, n_targets, tile_size, out=None):
+    """Return the similarity matrix made of the stored tiles of a similarity
+    that have the passed in tile size. If <out> is passed in, tiles are written
+    to this array instead of a new one, which can e.g. be a memory-mapped file.
+    A ValueError is raised if not all tiles are stored.
+    """
+    tiles = set(get_tiles(n_queries, n_targets, tile_size))
+    if not get_stored_tiles(similarity_id).issuperset(tiles):
+        raise ValueError("Similarity {} is missing tiles".format(similarity_id))
+    if out is None:
+        scores = np.zeros((n_queries, n_targets), dtype=np.float32)
+    elif out.shape == (n_queries, n_targets):
+        scores = out
+    else:
+        raise ValueError("Output array doesn't match the similarity matrix")
+    for tile in NblastSimilarityTile.objects.filter(
+            similarity_id=similarity_id).iterator():
+        bounds = (tile.query_start, tile.query_end, tile.target_start,
+                tile.target_end)
+        if bounds not in tiles:
+            continue
+        scores[tile.query_start:tile.query_end,
+                tile.target_start:tile.target_end] = np.frombuffer(
+                    tile.scores, dtype='<f4').reshape(
+                        tile.query_end - tile.query_start,
+                        tile.target_end - tile.target_start)
+    return scores
+
+
+def voxel_signature(points, voxel_size):
+    """Return the unique integer coordinates of all cubic voxels with edge
+    length <voxel_size> that contain any of the passed in points.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    if not len(points):
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.unique(np.floor(points / voxel_size).astype(np.int64), axis=0)
+
+
+def dilate_voxels(voxels, radius=1):
+    """Return the passed in voxels along with all voxels at most <radius>
+    voxels away from them along each axis.
+    """
+    offsets = np.array(list(product(range(-radius, radius + 1), repeat=3)),
+            dtype=np.int64)
+    voxels = np.asarray(voxels, dtype=np.int64).reshape(-1, 1, 3)
+    if not len(voxels):
+        return np.zeros((0, 3), dtype=np.int64)
+    return np.unique((voxels + offsets).reshape(-1, 3), axis=0)
+
+
+def find_candidate_skeletons(project_id, skeleton_id,
+        n_candidates=DEFAULT_NBLAST_CANDIDATES,
+        voxel_size=DEFAULT_NBLAST_VOXEL_SIZE, target_ids=None, min_nodes=0):
+    """Return up to <n_candidates> (skeleton ID, overlap) tuples of skeletons
+    that are likely similar to the query skeleton, ordered by decreasing
+    overlap. Only skeletons with nodes in the bounding box of the query
+    skeleton are considered, which is cheap due to the spatial index. Their
+    overlap is the number of voxels of edge length <voxel_size> (in nm) that
+    contain nodes of a candidate and are at most one voxel away from the query
+    skeleton. It is divided by the geometric mean of the number of voxels
+    occupied by both skeletons, but at least this number of shared voxels, so
+    that it ranges from 0 to 1. The number of voxels of candidates is estimated
+    from their cable length.
+    """
+    arbors = load_arbors([skeleton_id])
+    arbor = arbors.get(int(skeleton_id))
+    if arbor is None:
+        raise ValueError("Could not load skeleton {}".format(skeleton_id))
+
+    # Resample with half the voxel size to find all voxels the query's cable
+    # passes through.
+    query_voxels = voxel_signature(resample_arbor(arbor, voxel_size / 2.0),
+            voxel_size)
+    search_voxels = dilate_voxels(query_voxels)
+    min_corner = search_voxels.min(axis=0) * voxel_size
+    max_corner = (search_voxels.max(axis=0) + 1) * voxel_size
+
+    extra_where = []
+    params = {
+        'project_id': project_id,
+        'skeleton_id': skeleton_id,
+        'voxel_size': voxel_size,
+        'min_nodes': min_nodes,
+        'x': search_voxels[:, 0].tolist(),
+        'y': search_voxels[:, 1].tolist(),
+        'z': search_voxels[:, 2].tolist(),
+        'minx': float(min_corner[0]),
+        'miny': float(min_corner[1]),
+        'minz': float(min_corner[2]),
+        'maxx': float(max_corner[0]),
+        'maxy': float(max_corner[1]),
+        'maxz': float(max_corner[2]),
+    }
+    if target_ids:
+        extra_where.append("t.skeleton_id = ANY(%(target_ids)s::bigint[])")
+        params['target_ids'] = [int(t) for t in target_ids]
+
+    cursor = connection.cursor()
+    cursor.execute("""
+        WITH search_voxel(x, y, z) AS (
+            SELECT * FROM UNNEST(%(x)s::bigint[], %(y)s::bigint[],
+                %(z)s::bigint[])
+        ), candidate_voxel AS (
+            SELECT DISTINCT t.skeleton_id,
+                floor(t.location_x / %(voxel_size)s)::bigint AS x,
+                floor(t.location_y / %(voxel_size)s)::bigint AS y,
+                floor(t.location_z / %(voxel_size)s)::bigint AS z
+            FROM treenode_edge te
+            JOIN treenode t
+                ON t.id = te.id
+            WHERE te.edge &&& ST_MakeLine(ARRAY[
+                ST_MakePoint(%(minx)s, %(maxy)s, %(maxz)s),
+                ST_MakePoint(%(maxx)s, %(miny)s, %(minz)s)] ::geometry[])
+            AND te.project_id = %(project_id)s
+            AND t.skeleton_id <> %(skeleton_id)s
+            {extra_where}
+        )
+        SELECT cv.skeleton_id, count(*), css.cable_length
+        FROM candidate_voxel cv
+        JOIN search_voxel sv
+            ON (sv.x, sv.y, sv.z) = (cv.x, cv.y, cv.z)
+        JOIN catmaid_skeleton_summary css
+            ON css.skeleton_id = cv.skeleton_id
+        WHERE css.num_nodes >= %(min_nodes)s
+        GROUP BY cv.skeleton_id, css.cable_length
+    """.format(**{
+        'extra_where': ' AND '.join([''] + extra_where) if extra_where else '',
+    }), params)
+
+    n_query_voxels = len(query_voxels)
+    candidates = []
+    for candidate_id, n_shared, cable_length in cursor.fetchall():
+        n_candidate_voxels = max(n_shared, cable_length / voxel_size)
+        candidates.append((candidate_id, n_shared / np.sqrt(
+                max(n_shared, n_query_voxels) * n_candidate_voxels)))
+    candidates.sort(key=lambda c: (-c[1], c[0]))
+
+    return candidates[:n_candidates]
+
+
+def histogram(dotprops, distance_breaks, dot_breaks):
+    """Return the histogram of nearest neighbor distances (rows) and absolute
+    dot products (columns) of all ordered pairs of different dotprops. Bins
+    are closed on the right and values outside the breaks are ignored, except
+    for values that equal the lowest break, which are counted in the first
+    bin, like with nat.nblast's calc_prob_mat().
+    """
+    distance_breaks = np.asarray(distance_breaks, dtype=np.float64)
+    dot_breaks = np.asarray(dot_breaks, dtype=np.float64)
+    n_distance_bins = len(distance_breaks) - 1
+    n_dot_bins = len(dot_breaks) - 1
+    counts = np.zeros(n_distance_bins * n_dot_bins, dtype=np.int64)
+    stacked, owner = stack_dotprops(dotprops)
+    if len(stacked) == 0:
+        return counts.reshape(n_distance_bins, n_dot_bins)
+    for i, target in enumerate(dotprops):
+        if len(target) == 0:
+            continue
+        # All other dotprops are matched against the target at once.
+        distances, dots, _ = dists_dotprods(stacked, target)
+        distance_bins = np.searchsorted(distance_breaks, distances,
+                side='left') - 1
+        distance_bins[distances == distance_breaks[0]] = 0
+        dot_bins = np.searchsorted(dot_breaks, dots, side='left') - 1
+        dot_bins[dots == dot_breaks[0]] = 0
+        valid = (owner != i) & \
+                (distance_bins >= 0) & (distance_bins < n_distance_bins) & \
+                (dot_bins >= 0) & (dot_bins < n_dot_bins)
+        counts += np.bincount(distance_bins[valid] * n_dot_bins +
+                dot_bins[valid], minlength=len(counts))
+    return counts.reshape(n_distance_bins, n_dot_bins)
+
+
+def compute_scoring_matrix(matching_skeleton_ids, random_skeleton_ids,
+        distbreaks=NblastConfigDefaultDistanceBreaks,
+        dotbreaks=NblastConfigDefaultDotBreaks, resample_step=1000,
+        tangent_neighbors=5, omit_failures=True, project_id=None):
+    """Create an NBLAST scoring matrix for a set of matching skeleton IDs and a
+    set of random skeleton IDs without R. The result has the same format as
+    the result of the R based compute_scoring_matrix() in catmaid.control.nat.
+    If a <project_id> is passed in, the dotprops cache of the project is used.
+    """
+    similarity = None
+    matching_histogram = None
+    random_histogram = None
+    matching_probability = None
+    random_probability = None
+    errors = []
+    try:
+        logger.debug('Computing matching skeleton stats')
+        matching_dps = object_dotprops('skeleton', matching_skeleton_ids,
+                resample_step, tangent_neighbors, omit_failures=omit_failures,
+                project_id=project_id)
+        logger.debug('Computing random skeleton stats')
+        random_dps = object_dotprops('skeleton', random_skeleton_ids,
+                resample_step, tangent_neighbors, omit_failures=omit_failures,
+                project_id=project_id)
+
+        logger.debug('Computing matching skeleton probability distribution')
+        match_hist = histogram(matching_dps, distbreaks, dotbreaks)
+        logger.debug('Computing random skeleton probability distribution')
+        rand_hist = histogram(random_dps, distbreaks, dotbreaks)
+        if not match_hist.any() or not rand_hist.any():
+            raise ValueError("Not enough skeleton data to compute a scoring matrix")
+
+        match_prob = match_hist / float(match_hist.sum())
+        rand_prob = rand_hist / float(rand_hist.sum())
+
+        logger.debug('Computing scoring matrix')
+        epsilon = 1e-6
+        smat = np.log2((match_prob + epsilon) / (rand_prob + epsilon))
+
+        similarity = smat.tolist()
+        matching_histogram = match_hist.tolist()
+        random_histogram = rand_hist.tolist()
+        matching_probability = match_prob.tolist()
+        random_probability = rand_prob.tolist()
+    except ValueError as e:
+        errors.append(str(e))
+
+    return {
+        "errors": errors,
+        "similarity": similarity,
+        "matching_histogram": matching_histogram,
+        "random_histogram": random_histogram,
+        "matching_probability": matching_probability,
+        "random_probability": random_probability
+    }
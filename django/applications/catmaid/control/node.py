@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
 
 import copy
+import gzip
 import json
+import logging
+import math
 import msgpack
+import multiprocessing
+import numpy as np
+import struct
+import time
 import ujson
 import psycopg2.extras
 
@@ -11,24 +18,34 @@ from abc import ABCMeta
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.conf import settings
-from django.db import connection
+from django.db import connection, connections, transaction
 from django.http import HttpResponse, JsonResponse
 from django.utils import timezone
+from django.utils.cache import patch_vary_headers
 from django.shortcuts import get_object_or_404
 
 from rest_framework.decorators import api_view
 
 from catmaid import state
 from catmaid.models import (UserRole, Treenode, ClassInstanceClassInstance,
-        Review, Project)
+        Review, Project, NodeGridCache)
 from catmaid.control.authentication import requires_user_role, \
         can_edit_all_or_fail
 from catmaid.control.common import (get_relation_to_id_map, get_request_bool,
         get_request_list)
+from catmaid.control.node_result_cache import get_node_result_cache
 
 from PIL import Image, ImageDraw
 from aggdraw import Draw, Pen, Brush, Font
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+logger = logging.getLogger(__name__)
+
 
 ORIENTATIONS = {
     'xy': 0,
@@ -36,6 +53,14 @@ ORIENTATIONS = {
     'zy': 2
 }
 
+# The treenode columns and bounding box parameters of the two planar dimensions
+# of each orientation, used for level of detail sampling.
+LOD_SAMPLING_PLANES = {
+    'xy': ('location_x', 'left', 'right', 'location_y', 'top', 'bottom'),
+    'xz': ('location_x', 'left', 'right', 'location_z', 'z1', 'z2'),
+    'zy': ('location_z', 'z1', 'z2', 'location_y', 'top', 'bottom'),
+}
+
 class BasicNodeProvider(object):
 
     def __init__(self, *args, **kwargs):
@@ -95,132 +120,350 @@ def get_extra_nodes(params, project_id, explicit_treenode_ids,
     explicit_node_params['z1'] = float('inf')
     explicit_node_params['z2'] = float('inf')
     explicit_node_params['halfz'] = float('inf')
+    explicit_node_params['lod'] = False
 
     node_provider = Postgis2dNodeProvider()
     return node_provider.get_tuples(explicit_node_params, project_id,
         explicit_treenode_ids, explicit_connector_ids, include_labels,
         with_relation_map)
 
-class CachedJsonNodeNodeProvder(BasicNodeProvider):
-    """Retrieve cached msgpack data from the node_query_cache table.
+class CachedSectionNodeProvider(BasicNodeProvider):
+    """Retrieve cached node data from the node_query_cache table. Besides the
+    data type of a provider, cache entries can store other representations of
+    the same result, optionally compressed. If one of them matches the
+    requested response format and accepted content encodings, it is returned
+    as is, without being decoded and encoded again.
     """
 
+    data_type = None
+
+    def get_data_types(self, params, with_extra_nodes):
+        """Return all cache data types that can be used for the passed in query,
+        ordered by preference.
+        """
+        data_types = []
+        target_type = TARGET_FORMAT_DATA_TYPES.get(params.get('format'))
+        if target_type:
+            # Extra nodes can't be added to compressed data without
+            # decompressing it first.
+            if not with_extra_nodes:
+                for encoding in params.get('accepted_encodings', []):
+                    data_types.append('{}_{}'.format(target_type, encoding))
+            data_types.append(target_type)
+        if self.data_type not in data_types:
+            data_types.append(self.data_type)
+        return data_types
+
     def get_tuples(self, params, project_id, explicit_treenode_ids,
             explicit_connector_ids, include_labels, with_relation_map):
+        with_extra_nodes = bool(explicit_treenode_ids or explicit_connector_ids)
+        data_types = self.get_data_types(params, with_extra_nodes)
+
+        columns = []
+        for dt in data_types:
+            if dt == 'json_text':
+                # JSON data can be converted to text by Postgres, which is
+                # much faster than decoding and encoding it in Python.
+                columns.append('COALESCE(json_text_data, json_data::text)')
+            else:
+                columns.append(CACHE_DATA_COLUMNS[dt])
+
+        if 'json' in data_types:
+            # For JSONB type cache, use ujson to decode, this is roughly 2x faster
+            psycopg2.extras.register_default_jsonb(loads=ujson.loads)
+
         cursor = connection.cursor()
-        # For JSONB type cache, use ujson to decode, this is roughly 2x faster
-        psycopg2.extras.register_default_jsonb(loads=ujson.loads)
         cursor.execute("""
-            SELECT json_data FROM node_query_cache
+            SELECT {columns} FROM node_query_cache
             WHERE project_id = %s AND depth = %s
+            AND NOT dirty
             LIMIT 1
-        """, (project_id, params['z1']))
-        rows = cursor.fetchone()
-
-        if rows and rows[0]:
-            tuples = rows[0]
-            # If there are exta nodes required, query them explicitely using a
-            # regular Postgis 2D query. Inject the result into cached data.
-            if explicit_treenode_ids or explicit_connector_ids:
-                extra_tuples, extra_type = get_extra_nodes(params, project_id,
-                    explicit_treenode_ids, explicit_connector_ids, include_labels,
-                    with_relation_map)
-                if extra_type != 'json':
-                    raise ValueError("Unexpected type")
-
-                if len(tuples) == 5:
-                    tuples.append([extra_tuples])
-                elif len(tuples) == 6:
-                    tuples[5].append(extra_tuples)
-                else:
-                    raise ValueError("Unexpected cached JSON tuple format")
+        """.format(columns=', '.join(columns)), (project_id, params['z1']))
+        row = cursor.fetchone()
+        if not row:
+            return None, None
 
-            return tuples, 'json'
+        for tuples, data_type in zip(row, data_types):
+            if tuples is not None:
+                break
         else:
             return None, None
 
+        if data_type not in ('json', 'json_text'):
+            tuples = bytes(tuples)
+
+        # If there are exta nodes required, query them explicitely using a
+        # regular Postgis 2D query. Inject the result into cached data.
+        if with_extra_nodes:
+            extra_tuples, extra_type = get_extra_nodes(params, project_id,
+                explicit_treenode_ids, explicit_connector_ids, include_labels,
+                with_relation_map)
+            if extra_type != 'json':
+                raise ValueError("Unexpected type")
+            tuples = add_extra_nodes(tuples, data_type, extra_tuples)
+
+        return tuples, data_type
 
-class CachedJsonTextNodeProvder(BasicNodeProvider):
+
+class CachedJsonNodeNodeProvder(CachedSectionNodeProvider):
+    """Retrieve cached JSON data from the node_query_cache table.
+    """
+    data_type = 'json'
+
+
+class CachedJsonTextNodeProvder(CachedSectionNodeProvider):
+    """Retrieve cached JSON text data from the node_query_cache table.
+    """
+    data_type = 'json_text'
+
+
+class CachedMsgpackNodeProvder(CachedSectionNodeProvider):
     """Retrieve cached msgpack data from the node_query_cache table.
     """
+    data_type = 'msgpack'
 
-    def get_tuples(self, params, project_id, explicit_treenode_ids,
-                explicit_connector_ids, include_labels, with_relation_map):
-        cursor = connection.cursor()
-        cursor.execute("""
-            SELECT json_text_data FROM node_query_cache
-            WHERE project_id = %s AND depth = %s
-            LIMIT 1
-        """, (project_id, params['z1']))
-        rows = cursor.fetchone()
-
-        if rows and rows[0]:
-            tuples = rows[0]
-            # If there are exta nodes required, query them explicitely using a
-            # regular Postgis 2D query. Inject the result into cached data.
-            if explicit_treenode_ids or explicit_connector_ids:
-                extra_tuples, extra_type = get_extra_nodes(params, project_id,
-                    explicit_treenode_ids, explicit_connector_ids, include_labels,
-                    with_relation_map)
-                if extra_type != 'json':
-                    raise ValueError("Unexpected type")
-
-                extra_tuples_json = json.dumps(extra_tuples)
-                if tuples[-2] == '}':
-                    # If cached response doesn't contain any extra nodes, add a
-                    # new field
-                    tuples = tuples[0:-1] + ', [' + extra_tuples_json + ']]'
-                elif tuples[-2] == ']':
-                    tuples = tuples[0:-2] + ', ' + extra_tuples_json + ']]'
-                else:
-                    raise ValueError("Unexpected cached JSON text tuple format")
 
-            return tuples, 'json_text'
+def add_extra_nodes(tuples, data_type, extra_tuples):
+    """Add the result of an extra node query to encoded node query result
+    without decoding the latter. The extra nodes are added as sixth element.
+    """
+    if data_type == 'json':
+        if len(tuples) == 5:
+            tuples.append([extra_tuples])
+        elif len(tuples) == 6:
+            tuples[5].append(extra_tuples)
         else:
-            return None, None
+            raise ValueError("Unexpected cached JSON tuple format")
+    elif data_type == 'json_text':
+        extra_tuples_json = json.dumps(extra_tuples)
+        if tuples[-2] == '}':
+            # If cached response doesn't contain any extra nodes, add a
+            # new field
+            tuples = tuples[0:-1] + ', [' + extra_tuples_json + ']]'
+        elif tuples[-2] == ']':
+            tuples = tuples[0:-2] + ', ' + extra_tuples_json + ']]'
+        else:
+            raise ValueError("Unexpected cached JSON text tuple format")
+    elif data_type == 'msgpack':
+        # To inject msgpack data, we expect a five element list, which
+        # means the first byte is '\x95'. For now an error is raised if,
+        # the first byte is something else.
+        if tuples[0:1] != b'\x95':
+            raise ValueError("Unexpected cached Msgpack tuple format")
+
+        extra_msgpack = msgpack.packb([extra_tuples])
+
+        # Extend the five-element list with extra tuples by making it a
+        # six element list and just appending the extra list
+        tuples = b'\x96' + tuples[1:] + extra_msgpack
+    else:
+        raise ValueError("Can't add extra nodes to data type: {}".format(data_type))
 
+    return tuples
 
-class CachedMsgpackNodeProvder(BasicNodeProvider):
-    """Retrieve cached msgpack data from the node_query_cache table.
+
+class CachedGridNodeProvider(BasicNodeProvider):
+    """Retrieve cached node data from the node_grid_cache_cell table. Unlike
+    the section based caches, only the grid cells that intersect with the
+    query bounding box are loaded. Their data is merged into a single result.
+    If a grid cell size is configured, only a grid with these dimensions will
+    be used. Otherwise the grid with the smallest cells is used.
     """
 
+    data_type = None
+
+    def __init__(self, *args, **kwargs):
+        super(CachedGridNodeProvider, self).__init__(*args, **kwargs)
+        self.cell_width = kwargs.get('cell_width')
+        self.cell_height = kwargs.get('cell_height')
+        self.cell_depth = kwargs.get('cell_depth')
+
+    def get_grid(self, cursor, params, project_id):
+        """Find the grid to use for the passed in query parameters. Returns
+        None if no matching grid is available.
+        """
+        constraints = []
+        for dim in ('cell_width', 'cell_height', 'cell_depth'):
+            if getattr(self, dim):
+                constraints.append('AND {} = %({})s'.format(dim, dim))
+
+        cursor.execute("""
+            SELECT id, cell_width, cell_height, cell_depth, allow_empty,
+                min_x_index, max_x_index, min_y_index, max_y_index,
+                min_z_index, max_z_index
+            FROM node_grid_cache
+            WHERE project_id = %(project_id)s
+            AND orientation = %(orientation)s
+            {constraints}
+            ORDER BY cell_width * cell_height * cell_depth
+            LIMIT 1
+        """.format(constraints='\n'.join(constraints)), {
+            'project_id': project_id,
+            'orientation': ORIENTATIONS.get(params.get('orientation'), 0),
+            'cell_width': self.cell_width,
+            'cell_height': self.cell_height,
+            'cell_depth': self.cell_depth,
+        })
+        return cursor.fetchone()
+
     def get_tuples(self, params, project_id, explicit_treenode_ids,
-                explicit_connector_ids, include_labels, with_relation_map):
+            explicit_connector_ids, include_labels, with_relation_map):
         cursor = connection.cursor()
+        grid = self.get_grid(cursor, params, project_id)
+        if not grid:
+            return None, None
+        grid_id, cell_width, cell_height, cell_depth, allow_empty = grid[0:5]
+        extent = grid[5:11]
+
+        min_x, max_x = get_grid_index_range(params['left'], params['right'], cell_width)
+        min_y, max_y = get_grid_index_range(params['top'], params['bottom'], cell_height)
+        min_z, max_z = get_grid_index_range(params['z1'], params['z2'], cell_depth)
+
+        if self.data_type == 'json':
+            # For JSONB type cache, use ujson to decode, this is roughly 2x faster
+            psycopg2.extras.register_default_jsonb(loads=ujson.loads)
+
         cursor.execute("""
-            SELECT msgpack_data FROM node_query_cache
-            WHERE project_id = %s AND depth = %s
-            LIMIT 1
-        """, (project_id, params['z1']))
-        rows = cursor.fetchone()
-
-        if rows and rows[0]:
-            tuples = rows[0]
-            # If there are exta nodes required, query them explicitely using a
-            # regular Postgis 2D query. Inject the result into cached data.
-            if explicit_treenode_ids or explicit_connector_ids:
-                extra_tuples, extra_type = get_extra_nodes(params, project_id,
-                    explicit_treenode_ids, explicit_connector_ids, include_labels,
-                    with_relation_map)
-                if extra_type != 'json':
-                    raise ValueError("Unexpected type")
-
-                # To inject msgpack data, we expect a five element list, which
-                # means the first byte is '\x95'. For now an error is raised if,
-                # the first byte is something else.
-                if tuples[0] != b'\x95':
-                    raise ValueError("Unexpected cached Msgpack tuple format")
-
-                extra_msgpack = msgpack.packb([extra_tuples])
-
-                # Extend the five-element list with extra tuples by making it a
-                # six element list and just appending the extra list
-                tuples = b'\x96' + tuples[1:] + extra_msgpack
-
-            return bytes(tuples), 'msgpack'
-        else:
+            SELECT {column}, dirty, x_index, y_index, z_index
+            FROM node_grid_cache_cell
+            WHERE grid_id = %(grid_id)s
+            AND z_index BETWEEN %(min_z)s AND %(max_z)s
+            AND y_index BETWEEN %(min_y)s AND %(max_y)s
+            AND x_index BETWEEN %(min_x)s AND %(max_x)s
+        """.format(column=CACHE_DATA_COLUMNS[self.data_type]), {
+            'grid_id': grid_id,
+            'min_x': min_x,
+            'max_x': max_x,
+            'min_y': min_y,
+            'max_y': max_y,
+            'min_z': min_z,
+            'max_z': max_z,
+        })
+        rows = cursor.fetchall()
+
+        # Unless empty cells are explicitly allowed to be missing, every
+        # intersecting cell within the populated range of the grid needs to be
+        # available. Otherwise the cache isn't populated for this region and
+        # other node providers are asked. Missing cells outside of the populated
+        # range are empty, because edits create dirty placeholder cells.
+        if not allow_empty:
+            if None in extent:
+                extent = (min_x, max_x, min_y, max_y, min_z, max_z)
+            ranges = [(max(lo, ext_lo), min(hi, ext_hi)) for lo, hi, ext_lo, ext_hi in (
+                    (min_x, max_x, extent[0], extent[1]),
+                    (min_y, max_y, extent[2], extent[3]),
+                    (min_z, max_z, extent[4], extent[5]))]
+            n_expected_cells = 1
+            for lo, hi in ranges:
+                n_expected_cells *= max(0, hi - lo + 1)
+            n_populated_cells = sum(1 for row in rows
+                    if all(lo <= i <= hi for i, (lo, hi) in zip(row[2:5], ranges)))
+            if n_populated_cells != n_expected_cells:
+                return None, None
+
+        # Cells that have been invalidated by edits or that have no data of the
+        # requested type can't be used either.
+        if any(row[1] or row[0] is None for row in rows):
             return None, None
 
+        if self.data_type == 'json':
+            cells = [row[0] for row in rows]
+        elif self.data_type == 'json_text':
+            cells = [ujson.loads(row[0]) for row in rows]
+        elif self.data_type == 'msgpack':
+            cells = [msgpack.unpackb(bytes(row[0]), raw=False) for row in rows]
+        else:
+            raise ValueError("Unknown data type: {}".format(self.data_type))
+
+        tuples = merge_node_query_results(cells)
+
+        # If there are exta nodes required, query them explicitely using a
+        # regular Postgis 2D query. Inject the result into cached data.
+        if explicit_treenode_ids or explicit_connector_ids:
+            extra_tuples, extra_type = get_extra_nodes(params, project_id,
+                explicit_treenode_ids, explicit_connector_ids, include_labels,
+                with_relation_map)
+            if extra_type != 'json':
+                raise ValueError("Unexpected type")
+            tuples.append([extra_tuples])
+
+        return tuples, 'json'
+
+
+class CachedJsonGridNodeProvider(CachedGridNodeProvider):
+    """Retrieve cached JSON grid cell data from the node_grid_cache_cell table.
+    """
+    data_type = 'json'
+
+
+class CachedJsonTextGridNodeProvider(CachedGridNodeProvider):
+    """Retrieve cached JSON text grid cell data from the node_grid_cache_cell
+    table.
+    """
+    data_type = 'json_text'
+
+
+class CachedMsgpackGridNodeProvider(CachedGridNodeProvider):
+    """Retrieve cached msgpack grid cell data from the node_grid_cache_cell
+    table.
+    """
+    data_type = 'msgpack'
+
+
+def get_grid_index_range(min_value, max_value, cell_size):
+    """Return the first and last index of all grid cells of size <cell_size>
+    that intersect with the half-open interval [min_value, max_value). The
+    grid is aligned to the project space origin.
+    """
+    min_index = int(math.floor(min_value / cell_size))
+    max_index = int(math.ceil(max_value / cell_size)) - 1
+    return min_index, max(min_index, max_index)
+
+
+def merge_node_query_results(results):
+    """Merge multiple node query results (e.g. from individual grid cells) into
+    a single result of the form [treenodes, connectors, labels,
+    node_limit_reached, relation_map]. Nodes and connector links that are part
+    of multiple results are only included once.
+    """
+    treenodes = []
+    connectors = []
+    labels = {}
+    limit_reached = False
+    relation_map = {}
+
+    seen_treenodes = set()
+    seen_links = set()
+    connector_map = {}
+
+    for result in results:
+        for tn in result[0]:
+            if tn[0] not in seen_treenodes:
+                seen_treenodes.add(tn[0])
+                treenodes.append(tn)
+
+        for c in result[1]:
+            connector = connector_map.get(c[0])
+            if connector is None:
+                connector = list(c[0:7]) + [[]]
+                connector_map[c[0]] = connector
+                connectors.append(connector)
+            # Links of a connector can be split across results, merge them.
+            partners = connector[7]
+            for link in c[7]:
+                if link[4] not in seen_links:
+                    seen_links.add(link[4])
+                    partners.append(link)
+
+        for node_id, node_labels in result[2].items():
+            if node_id not in labels:
+                labels[node_id] = node_labels
+
+        limit_reached = limit_reached or result[3]
+        relation_map.update(result[4])
+
+    return [treenodes, connectors, labels, limit_reached, relation_map]
+
 
 class PostgisNodeProvider(BasicNodeProvider, metaclass=ABCMeta):
 
@@ -255,11 +498,21 @@ class PostgisNodeProvider(BasicNodeProvider, metaclass=ABCMeta):
         self.treenode_query_psycopg = treenode_query_template.format(
             **{k: '%({})s'.format(k) for k in treenode_query_params})
 
+        # Level of detail (LOD) sampling uses the treenode query without limit.
+        self.lod = kwargs.get('lod', False)
+        self.lod_cell_size = kwargs.get('lod_cell_size')
+        self.treenode_lod_query_psycopg = self.treenode_query.format(
+            **{k: '%({})s'.format(k) for k in treenode_query_params})
+
         connector_query_params = ['project_id', 'left', 'top', 'z1', 'right',
                                   'bottom', 'z2', 'halfz', 'halfzdiff', 'limit', 'sanitized_connector_ids']
         self.connector_query_psycopg = connector_query_template.format(
             **{k: '%({})s'.format(k) for k in connector_query_params})
 
+        # Queries of multiple sections limit nodes per section on their own.
+        self.connector_section_query_psycopg = self.connector_query.format(
+            **{k: '%({})s'.format(k) for k in connector_query_params})
+
         # Create prepared statement version
         prepare_var_names = {
             'project_id': '$1',
@@ -306,15 +559,113 @@ class PostgisNodeProvider(BasicNodeProvider, metaclass=ABCMeta):
             {}
         """.format(self.CONNECTOR_STATEMENT_NAME, self.connector_query_prepare))
 
+    def get_skeleton_filter_joins(self, params):
+        """Get the JOIN clauses for the treenode query that implement the
+        n_largest_skeletons_limit, n_last_edited_skeletons_limit and
+        hidden_last_editor_id skeleton filters.
+        """
+        n_largest_skeletons_limit= params.get('n_largest_skeletons_limit') or 0
+        n_last_edited_skeletons_limit = params.get('n_last_edited_skeletons_limit') or 0
+        hidden_last_editor_id = params.get('hidden_last_editor_id')
+
+        query = ''
+
+        # The parenthesises around the individual filters are needed for the
+        # union operator.
+        summary = []
+        if n_largest_skeletons_limit:
+            summary.append("""
+                (SELECT skeleton_id
+                FROM catmaid_skeleton_summary css
+                WHERE project_id = %(project_id)s
+                ORDER BY css.cable_length DESC
+                LIMIT %(n_largest_skeletons_limit)s)
+            """)
+        if n_last_edited_skeletons_limit:
+            summary.append("""
+                (SELECT skeleton_id
+                FROM catmaid_skeleton_summary css
+                WHERE project_id = %(project_id)s
+                ORDER BY css.last_edition_time DESC
+                LIMIT %(n_last_edited_skeletons_limit)s)
+            """)
+
+        if summary:
+            query += '''
+                JOIN (
+                    {summary}
+                ) summary(skeleton_id)
+                    ON summary.skeleton_id = t1.skeleton_id
+            '''.format(**{
+                'summary': ' UNION '.join(summary)
+            })
+
+        # User constraints are joined separately, so they are AND-combined
+        if hidden_last_editor_id is not None:
+            query += """
+                JOIN (
+                    SELECT skeleton_id
+                    FROM catmaid_skeleton_summary css
+                    WHERE project_id = %(project_id)s
+                    AND last_editor_id <> %(hidden_last_editor_id)s
+                ) visible(skeleton_id)
+                    ON visible.skeleton_id = t1.skeleton_id
+            """
+
+        return query
+
+    def limit_per_section(self, query, params, columns, ids_param):
+        """Wrap a query without limit, so that at most <limit> rows are
+        returned for each section of a query that covers multiple sections,
+        see node_list_sections(). Sections start at the section_start
+        parameter and are section_thickness thick. Rows belong to the section
+        that contains their location. Rows of the IDs in the <ids_param>
+        parameter are preferred.
+        """
+        depth_index = SECTION_DEPTH_DIMENSIONS[params.get('orientation') or 'xy'][2]
+        return """
+            SELECT {columns}
+            FROM (
+                SELECT q.*, row_number() OVER (
+                    PARTITION BY floor((q.{depth_column} - %(section_start)s) /
+                        %(section_thickness)s)
+                    ORDER BY q.id = ANY(%({ids_param})s::bigint[]) DESC
+                ) AS section_row
+                FROM (
+                    {query}
+                ) q({columns})
+            ) ranked
+            WHERE section_row <= %(limit)s
+        """.format(**{
+            'columns': ', '.join(columns),
+            'depth_column': ('location_x', 'location_y', 'location_z')[depth_index],
+            'ids_param': ids_param,
+            'query': query,
+        })
+
     def get_treenode_data(self, cursor, params, extra_treenode_ids=None):
         """ Selects all treenodes of which links to other treenodes intersect
         with the request bounding box. Will optionally fetch additional
-        treenodes.
+        treenodes. Returns the treenode IDs, the treenodes and whether level of
+        detail sampling was applied.
         """
         params['halfzdiff'] = abs(params['z2'] - params['z1']) * 0.5
         params['halfz'] = params['z1'] + (params['z2'] - params['z1']) * 0.5
         params['sanitized_treenode_ids'] = list(map(int, extra_treenode_ids or []))
 
+        if params.get('section_thickness') and params.get('limit'):
+            cursor.execute(self.limit_per_section(self.treenode_lod_query_psycopg +
+                    self.get_skeleton_filter_joins(params), params, (
+                        'id', 'parent_id', 'location_x', 'location_y',
+                        'location_z', 'confidence', 'radius', 'skeleton_id',
+                        'edition_time', 'user_id'),
+                    'sanitized_treenode_ids'), params)
+            treenodes = cursor.fetchall()
+            return [t[0] for t in treenodes], treenodes, False
+
+        if self.use_lod(params):
+            return self.get_lod_treenode_data(cursor, params)
+
         if self.prepared_statements:
             # Use a prepared statement to get the treenodes
             cursor.execute('''
@@ -326,7 +677,6 @@ class PostgisNodeProvider(BasicNodeProvider, metaclass=ABCMeta):
         else:
             n_largest_skeletons_limit= params.get('n_largest_skeletons_limit') or 0
             n_last_edited_skeletons_limit = params.get('n_last_edited_skeletons_limit') or 0
-            hidden_last_editor_id = params.get('hidden_last_editor_id')
 
             limit = n_largest_skeletons_limit + n_last_edited_skeletons_limit
 
@@ -336,47 +686,7 @@ class PostgisNodeProvider(BasicNodeProvider, metaclass=ABCMeta):
                 # If there is a new limit, strip the old one away
                 query = query.rstrip('LIMIT %(limit)s')
 
-            # The parenthesises around the individual filters are needed for the
-            # union operator.
-            summary = []
-            if n_largest_skeletons_limit:
-                summary.append("""
-                    (SELECT skeleton_id
-                    FROM catmaid_skeleton_summary css
-                    WHERE project_id = %(project_id)s
-                    ORDER BY css.cable_length DESC
-                    LIMIT %(n_largest_skeletons_limit)s)
-                """)
-            if n_last_edited_skeletons_limit:
-                summary.append("""
-                    (SELECT skeleton_id
-                    FROM catmaid_skeleton_summary css
-                    WHERE project_id = %(project_id)s
-                    ORDER BY css.last_edition_time DESC
-                    LIMIT %(n_last_edited_skeletons_limit)s)
-                """)
-
-            if summary:
-                query += '''
-                    JOIN (
-                        {summary}
-                    ) summary(skeleton_id)
-                        ON summary.skeleton_id = t1.skeleton_id
-                '''.format(**{
-                    'summary': ' UNION '.join(summary)
-                })
-
-            # User constraints are joined separately, so they are AND-combined
-            if hidden_last_editor_id is not None:
-                query += """
-                    JOIN (
-                        SELECT skeleton_id
-                        FROM catmaid_skeleton_summary css
-                        WHERE project_id = %(project_id)s
-                        AND last_editor_id <> %(hidden_last_editor_id)s
-                    ) visible(skeleton_id)
-                        ON visible.skeleton_id = t1.skeleton_id
-                """
+            query += self.get_skeleton_filter_joins(params)
 
             if limit:
                 # Add new limit
@@ -390,7 +700,143 @@ class PostgisNodeProvider(BasicNodeProvider, metaclass=ABCMeta):
         treenodes = cursor.fetchall()
         treenode_ids = [t[0] for t in treenodes]
 
-        return treenode_ids, treenodes
+        return treenode_ids, treenodes, False
+
+    def use_lod(self, params):
+        """Whether level of detail sampling should be used for the passed in
+        query. The "lod" query parameter overrides the "lod" option of the
+        node provider. Sampling needs a node limit and a finite bounding box.
+        """
+        lod = params.get('lod')
+        if lod is None:
+            lod = self.lod
+        if not lod or not params.get('limit'):
+            return False
+        return all(math.isfinite(params[p]) for p in
+                ('left', 'top', 'z1', 'right', 'bottom', 'z2'))
+
+    def get_lod_treenode_data(self, cursor, params):
+        """Like get_treenode_data(), but if more treenodes than the node limit
+        intersect with the query bounding box, a spatially stratified subset is
+        returned: the field of view is divided into a regular grid of cells and
+        for each cell only one treenode located in it is selected. Root nodes
+        are preferred over branch nodes, which are preferred over end nodes and
+        then over other nodes. Nodes of larger skeletons are preferred among
+        equal node types. Explicitly requested treenodes are always included.
+        Returns the treenode IDs, the treenodes and whether sampling was
+        applied.
+        """
+        # Test first whether the node limit is exceeded at all, which doesn't
+        # need more than one row beyond the limit.
+        params['lod_probe_limit'] = params['limit'] + 1
+        cursor.execute(self.treenode_lod_query_psycopg +
+                self.get_skeleton_filter_joins(params) + """
+            LIMIT %(lod_probe_limit)s
+        """, params)
+        treenodes = cursor.fetchall()
+        if len(treenodes) <= params['limit']:
+            return [t[0] for t in treenodes], treenodes, False
+
+        orientation = params.get('orientation') or 'xy'
+        u_column, u_min, u_max, v_column, v_min, v_max = LOD_SAMPLING_PLANES[orientation]
+
+        limit = params['limit']
+        cell_size = self.lod_cell_size
+        if not cell_size:
+            # Use a grid with about as many cells as the node limit allows.
+            area = (params[u_max] - params[u_min]) * (params[v_max] - params[v_min])
+            cell_size = math.sqrt(max(area, 1.0) / limit)
+
+        params['lod_u_min'] = params[u_min]
+        params['lod_v_min'] = params[v_min]
+        params['lod_cell_size'] = cell_size
+        params['lod_n_u'] = max(1, int(math.ceil((params[u_max] - params[u_min]) / cell_size)))
+        params['lod_n_v'] = max(1, int(math.ceil((params[v_max] - params[v_min]) / cell_size)))
+
+        # The treenode query is evaluated for each grid cell separately, with
+        # the cell as its bounding box. This way the spatial index only has to
+        # provide the nodes of a cell and only the best ranked one of them is
+        # kept, rather than ranking all nodes of the field of view.
+        bounds = {b: '%({})s'.format(b) for b in
+                ('left', 'top', 'z1', 'right', 'bottom', 'z2')}
+        bounds[u_min] = 'cell.u_min'
+        bounds[u_max] = 'cell.u_max'
+        bounds[v_min] = 'cell.v_min'
+        bounds[v_max] = 'cell.v_max'
+        cell_query = self.treenode_query.format(**dict(bounds, **{
+            'project_id': '%(project_id)s',
+            'halfz': '(({z1} + {z2}) * 0.5)'.format(**bounds),
+            'halfzdiff': '(abs({z2} - {z1}) * 0.5)'.format(**bounds),
+            'sanitized_treenode_ids': 'ARRAY[]',
+        }))
+
+        query = """
+            SELECT sampled.*
+            FROM (
+                SELECT %(lod_u_min)s + cu * %(lod_cell_size)s,
+                       %(lod_u_min)s + (cu + 1) * %(lod_cell_size)s,
+                       %(lod_v_min)s + cv * %(lod_cell_size)s,
+                       %(lod_v_min)s + (cv + 1) * %(lod_cell_size)s
+                FROM generate_series(0, %(lod_n_u)s - 1) cu,
+                     generate_series(0, %(lod_n_v)s - 1) cv
+            ) cell(u_min, u_max, v_min, v_max)
+            CROSS JOIN LATERAL (
+                SELECT c.*
+                FROM (
+                    {cell_query}
+                ) c(id, parent_id, location_x, location_y, location_z,
+                    confidence, radius, skeleton_id, edition_time, user_id)
+                LEFT JOIN catmaid_skeleton_summary css
+                    ON css.skeleton_id = c.skeleton_id
+                WHERE c.{u_column} >= cell.u_min AND c.{u_column} < cell.u_max
+                AND c.{v_column} >= cell.v_min AND c.{v_column} < cell.v_max
+                AND c.id <> ALL(%(sanitized_treenode_ids)s::bigint[])
+                ORDER BY CASE WHEN c.parent_id IS NULL THEN 0
+                              ELSE (
+                                  SELECT CASE count(*) WHEN 0 THEN 2
+                                                       WHEN 1 THEN 3
+                                                       ELSE 1 END
+                                  FROM (
+                                      SELECT 1 FROM treenode child
+                                      WHERE child.parent_id = c.id
+                                      LIMIT 2
+                                  ) children
+                              )
+                         END,
+                         css.cable_length DESC NULLS LAST, c.id
+                LIMIT 1
+            ) sampled
+            LIMIT %(limit)s
+        """.format(**{
+            'cell_query': cell_query + self.get_skeleton_filter_joins(params),
+            'u_column': u_column,
+            'v_column': v_column,
+        })
+        cursor.execute(query, params)
+        treenodes = cursor.fetchall()
+
+        if params['sanitized_treenode_ids']:
+            cursor.execute("""
+                SELECT
+                    t1.id,
+                    t1.parent_id,
+                    t1.location_x,
+                    t1.location_y,
+                    t1.location_z,
+                    t1.confidence,
+                    t1.radius,
+                    t1.skeleton_id,
+                    EXTRACT(EPOCH FROM t1.edition_time),
+                    t1.user_id
+                FROM treenode t1
+                {}
+                WHERE t1.id = ANY(%(sanitized_treenode_ids)s::bigint[])
+            """.format(self.get_skeleton_filter_joins(params)), params)
+            treenodes.extend(cursor.fetchall())
+
+        treenode_ids = [t[0] for t in treenodes]
+
+        return treenode_ids, treenodes, True
 
     def get_connector_data(self, cursor, params, missing_connector_ids=None):
         """Selects all connectors that are in or have links that intersect the
@@ -400,7 +846,14 @@ class PostgisNodeProvider(BasicNodeProvider, metaclass=ABCMeta):
         params['halfzdiff'] = abs(params['z2'] - params['z1']) * 0.5
         params['sanitized_connector_ids'] = list(map(int, missing_connector_ids or []))
 
-        if self.prepared_statements:
+        if params.get('section_thickness') and params.get('limit'):
+            cursor.execute(self.limit_per_section(
+                    self.connector_section_query_psycopg, params, ('id',
+                        'location_x', 'location_y', 'location_z', 'confidence',
+                        'edition_time', 'user_id', 'treenode_id',
+                        'relation_id', 'link_confidence', 'link_edition_time',
+                        'link_id'), 'sanitized_connector_ids'), params)
+        elif self.prepared_statements:
             # Use a prepared statement to get connectors
             cursor.execute('''
                 EXECUTE {}(%(project_id)s,
@@ -908,6 +1361,9 @@ AVAILABLE_NODE_PROVIDERS = {
     'cached_json': CachedJsonNodeNodeProvder,
     'cached_json_text': CachedJsonTextNodeProvder,
     'cached_msgpack': CachedMsgpackNodeProvder,
+    'cached_json_grid': CachedJsonGridNodeProvider,
+    'cached_json_text_grid': CachedJsonTextGridNodeProvider,
+    'cached_msgpack_grid': CachedMsgpackGridNodeProvider,
     'extra_nodes_only': ExtraNodesOnlyNodeProvider,
 }
 
@@ -920,6 +1376,122 @@ CACHE_NODE_PROVIDER_DATA_TYPES = {
 }
 
 
+# The database cache identifier for each grid cache node provider
+GRID_CACHE_NODE_PROVIDER_DATA_TYPES = {
+    'cached_json_grid': 'json',
+    'cached_json_text_grid': 'json_text',
+    'cached_msgpack_grid': 'msgpack',
+}
+
+
+# The cache table column for each cache data type
+CACHE_DATA_COLUMNS = {
+    'json': 'json_data',
+    'json_text': 'json_text_data',
+    'msgpack': 'msgpack_data',
+    'json_text_gzip': 'json_text_gzip_data',
+    'json_text_br': 'json_text_br_data',
+    'msgpack_gzip': 'msgpack_gzip_data',
+    'msgpack_br': 'msgpack_br_data',
+}
+
+
+# The data types that can be stored in the section cache
+SECTION_CACHE_DATA_TYPES = ('json', 'json_text', 'msgpack', 'json_text_gzip',
+        'json_text_br', 'msgpack_gzip', 'msgpack_br')
+
+
+# The data types that can be stored in the grid cache. Grid cells need to be
+# decoded to be merged, which is why there are no compressed types.
+GRID_CACHE_DATA_TYPES = ('json', 'json_text', 'msgpack')
+
+
+# The uncompressed data type and content encoding of compressed data types
+COMPRESSED_DATA_TYPES = {
+    'json_text_gzip': ('json_text', 'gzip'),
+    'json_text_br': ('json_text', 'br'),
+    'msgpack_gzip': ('msgpack', 'gzip'),
+    'msgpack_br': ('msgpack', 'br'),
+}
+
+
+# The cache data type that can be sent without any conversion for each response
+# format.
+TARGET_FORMAT_DATA_TYPES = {
+    'json': 'json_text',
+    'msgpack': 'msgpack',
+}
+
+
+# Supported content encodings of cached data, in order of preference
+CACHE_CONTENT_ENCODINGS = ('br', 'gzip')
+
+
+# The number of sections or grid cells that are computed and stored together
+# during a cache update.
+DEFAULT_CACHE_UPDATE_BATCH_SIZE = 10
+
+
+# The maximum number of adjacent sections that can be requested along with a
+# section.
+MAX_ADJACENT_SECTIONS = 20
+
+
+# The bounding box parameters and location element of the depth dimension of
+# each orientation.
+SECTION_DEPTH_DIMENSIONS = {
+    'xy': ('z1', 'z2', 2),
+    'xz': ('top', 'bottom', 1),
+    'zy': ('left', 'right', 0),
+}
+
+
+# The columnar node list format starts with a fixed size little-endian header:
+# magic bytes, format version, flags, the number of treenodes, connectors and
+# connector links and the length of the JSON trailer in bytes.
+COLUMNAR_NODE_LIST_MAGIC = b'CMNL'
+COLUMNAR_NODE_LIST_VERSION = 1
+COLUMNAR_NODE_LIST_HEADER = struct.Struct('<4sHHIIII')
+
+# Header flags of the columnar node list format
+COLUMNAR_NODE_LIST_LIMIT_REACHED = 1
+
+# The fields and types of the arrays of the columnar node list format, in the
+# order they follow the header. Each array is padded to a multiple of eight
+# bytes. Root nodes have a parent ID of -1.
+COLUMNAR_TREENODE_FIELDS = (
+    ('id', '<i8'),
+    ('parent_id', '<i8'),
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('z', '<f4'),
+    ('confidence', 'u1'),
+    ('radius', '<f4'),
+    ('skeleton_id', '<i8'),
+    ('edition_time', '<f8'),
+    ('user_id', '<i4'),
+)
+
+COLUMNAR_CONNECTOR_FIELDS = (
+    ('id', '<i8'),
+    ('x', '<f4'),
+    ('y', '<f4'),
+    ('z', '<f4'),
+    ('confidence', 'u1'),
+    ('edition_time', '<f8'),
+    ('user_id', '<i4'),
+    ('n_links', '<u4'),
+)
+
+COLUMNAR_LINK_FIELDS = (
+    ('treenode_id', '<i8'),
+    ('relation_id', '<i8'),
+    ('confidence', 'u1'),
+    ('edition_time', '<f8'),
+    ('link_id', '<i8'),
+)
+
+
 def get_configured_node_providers(provider_entries, connection=None):
     node_providers = []
     for entry in provider_entries:
@@ -942,7 +1514,16 @@ def get_configured_node_providers(provider_entries, connection=None):
     return node_providers
 
 
-def update_node_query_cache(node_providers=None, log=print):
+def update_node_query_cache(node_providers=None, only_dirty=False, n_jobs=None,
+        batch_size=None, log=print):
+    """Update the caches of all caching node providers in <node_providers>,
+    which defaults to the NODE_PROVIDERS setting. If <only_dirty> is true,
+    only cache entries invalidated by edits are recomputed for caches that
+    exist already. Cache entries are computed by <n_jobs> worker processes,
+    which can also be configured per node provider with the "n_jobs" option.
+    Additional data types to store can be configured with the
+    "extra_data_types" option of a node provider.
+    """
     if not node_providers:
         node_providers = settings.NODE_PROVIDERS
 
@@ -968,23 +1549,57 @@ def update_node_query_cache(node_providers=None, log=print):
         hidden_last_editor_id = options.get('hidden_last_editor_id')
 
         data_type = CACHE_NODE_PROVIDER_DATA_TYPES.get(key)
-        if not data_type:
+        grid_data_type = GRID_CACHE_NODE_PROVIDER_DATA_TYPES.get(key)
+        if not data_type and not grid_data_type:
             log("Skipping non-caching node provider: {}".format(key))
             continue
 
-        for project_id in project_ids:
-            log("Updating cache for project {}".format(project_id))
-            orientations = [options.get('orientation', 'xy')]
-            steps = [options.get('step')]
-            if not steps:
-                raise ValueError("Need 'step' parameter in node provider configuration")
-            node_limit = options.get('node_limit', None)
-            update_cache(project_id, data_type, orientations, steps,
-                    node_limit=node_limit,
-                    n_largest_skeletons_limit=n_largest_skeletons_limit,
-                    n_last_edited_skeletons_limit=n_last_edited_skeletons_limit,
-                    hidden_last_editor_id=hidden_last_editor_id,
-                    delete=clean_cache, log=log)
+        # Additional representations of the cached data, e.g. to allow
+        # passing through compressed data.
+        extra_data_types = options.get('extra_data_types', [])
+        if data_type:
+            data_type = [data_type] + list(extra_data_types)
+        else:
+            grid_data_type = [grid_data_type] + list(extra_data_types)
+
+        provider_n_jobs = n_jobs or options.get('n_jobs', 1)
+        provider_batch_size = batch_size or options.get('batch_size',
+                DEFAULT_CACHE_UPDATE_BATCH_SIZE)
+
+        # All projects share the same worker processes.
+        with create_cache_update_pool(provider_n_jobs) as pool:
+            for project_id in project_ids:
+                log("Updating cache for project {}".format(project_id))
+                orientations = [options.get('orientation', 'xy')]
+                node_limit = options.get('node_limit', None)
+                if grid_data_type:
+                    cell_width = options.get('cell_width')
+                    cell_height = options.get('cell_height')
+                    cell_depth = options.get('cell_depth')
+                    if not (cell_width and cell_height and cell_depth):
+                        raise ValueError("Need 'cell_width', 'cell_height' and "
+                                "'cell_depth' parameters in grid node provider "
+                                "configuration")
+                    update_grid_cache(project_id, grid_data_type, orientations,
+                            [cell_depth], cell_width, cell_height,
+                            node_limit=node_limit,
+                            n_largest_skeletons_limit=n_largest_skeletons_limit,
+                            n_last_edited_skeletons_limit=n_last_edited_skeletons_limit,
+                            hidden_last_editor_id=hidden_last_editor_id,
+                            allow_empty=options.get('allow_empty', False),
+                            delete=clean_cache, only_dirty=only_dirty,
+                            batch_size=provider_batch_size, pool=pool, log=log)
+                else:
+                    steps = [options.get('step')]
+                    if not steps[0]:
+                        raise ValueError("Need 'step' parameter in node provider configuration")
+                    update_cache(project_id, data_type, orientations, steps,
+                            node_limit=node_limit,
+                            n_largest_skeletons_limit=n_largest_skeletons_limit,
+                            n_last_edited_skeletons_limit=n_last_edited_skeletons_limit,
+                            hidden_last_editor_id=hidden_last_editor_id,
+                            delete=clean_cache, only_dirty=only_dirty,
+                            batch_size=provider_batch_size, pool=pool, log=log)
 
 
 def get_tracing_bounding_box(project_id, cursor=None):
@@ -1010,26 +1625,21 @@ def get_tracing_bounding_box(project_id, cursor=None):
 
     return row
 
-def update_cache(project_id, data_type, orientations, steps, node_limit=None,
-        n_largest_skeletons_limit=None, n_last_edited_skeletons_limit=None,
-        hidden_last_editor_id=None, delete=False, bb_limits=None, log=print):
-    if data_type not in ('json', 'json_text', 'msgpack'):
-        raise ValueError('Type must be one of: json, json_text, msgpack')
-    if len(steps) != len(orientations):
-        raise ValueError('Need one depth resolution flag per orientation')
-    if project_id is None:
-        raise ValueError('Need project ID')
-
-    orientation_ids = list(map(lambda x: ORIENTATIONS[x], orientations))
-
-    cursor = connection.cursor()
 
+def get_cache_update_params(project_id, cursor, node_limit=None,
+        n_largest_skeletons_limit=None, n_last_edited_skeletons_limit=None,
+        hidden_last_editor_id=None, bb_limits=None, log=print):
+    """Find the tracing data bounding box of the passed in project, optionally
+    constrained by <bb_limits>, and create the node query parameters that are
+    common to all cache updates. Returns a tuple (bounding box, parameters) or
+    None if the project has no tracing data.
+    """
     log(' -> Finding tracing data bounding box')
     row = get_tracing_bounding_box(project_id, cursor)
     bb = [row[0], row[1]]
     if None in bb[0] or None in bb[1]:
         log(' -> Found no valid bounding box, skipping project: {}'.format(bb))
-        return
+        return None
     else:
         log(' -> Found bounding box: {}'.format(bb))
 
@@ -1042,19 +1652,6 @@ def update_cache(project_id, data_type, orientations, steps, node_limit=None,
         bb[1][2] = min(bb[1][2], bb_limits[1][2])
         log(' -> Applied limits to bounding box: {}'.format(bb))
 
-    if delete:
-        for n, o in enumerate(orientations):
-            orientation_id = orientation_ids[n]
-            log(' -> Deleting existing cache entries in orientation {}'.format(project_id, o))
-            cursor.execute("""
-                DELETE FROM node_query_cache
-                WHERE project_id = %(project_id)s
-                AND orientation = %(orientation)s
-            """, {
-                'project_id': project_id,
-                'orientation': orientation_id
-            })
-
     params = {
         'left': bb[0][0],
         'top': bb[0][1],
@@ -1077,58 +1674,632 @@ def update_cache(project_id, data_type, orientations, steps, node_limit=None,
                 'field of view in eeach section'). format(n_last_edited_skeletons_limit))
 
     if hidden_last_editor_id:
-        param['hidden_last_editor_id'] = int(hidden_last_editor_id)
+        params['hidden_last_editor_id'] = int(hidden_last_editor_id)
         log((' -> Only nodes not edited last by user {} will be allowed'.format(
                 hidden_last_editor_id)))
 
+    return bb, params
+
+
+def get_cache_data_type_list(data_type, available_data_types):
+    """Return a list of cache data types from <data_type>, which can be either
+    a single data type or a list of them. A ValueError is raised if a data type
+    isn't part of <available_data_types>.
+    """
+    data_types = [data_type] if isinstance(data_type, str) else list(data_type)
+    if not data_types:
+        raise ValueError('Need at least one data type')
+    for dt in data_types:
+        if dt not in available_data_types:
+            raise ValueError('Type must be one of: {}'.format(
+                    ', '.join(available_data_types)))
+        if dt in COMPRESSED_DATA_TYPES and \
+                COMPRESSED_DATA_TYPES[dt][1] == 'br' and not brotli:
+            raise ValueError('The brotli module is needed for type ' + dt)
+    return data_types
+
+
+def compress_cache_data(data, encoding):
+    if encoding == 'gzip':
+        return gzip.compress(data)
+    elif encoding == 'br':
+        return brotli.compress(data)
+    else:
+        raise ValueError("Unknown content encoding: {}".format(encoding))
+
+
+def decompress_cache_data(data, encoding):
+    if encoding == 'gzip':
+        return gzip.decompress(data)
+    elif encoding == 'br':
+        if not brotli:
+            raise ValueError("The brotli module is needed to decompress data")
+        return brotli.decompress(data)
+    else:
+        raise ValueError("Unknown content encoding: {}".format(encoding))
+
+
+def encode_cache_data(result_tuple, data_types):
+    """Encode a node query result so that it can be stored in the cache columns
+    of the passed in data types. Every uncompressed representation is created
+    only once, compressed types are based on them.
+    """
+    encoded = {}
+
+    def encode(data_type):
+        key = 'json_text' if data_type == 'json' else data_type
+        if key not in encoded:
+            if key == 'json_text':
+                encoded[key] = json.dumps(result_tuple)
+            elif key == 'msgpack':
+                encoded[key] = msgpack.packb(result_tuple)
+            elif key in COMPRESSED_DATA_TYPES:
+                base_type, encoding = COMPRESSED_DATA_TYPES[key]
+                data = encode(base_type)
+                if base_type == 'json_text':
+                    data = data.encode('utf-8')
+                encoded[key] = compress_cache_data(data, encoding)
+            else:
+                raise ValueError("Unknown data type: {}".format(data_type))
+        return encoded[key]
+
+    return [encode(dt) if dt in ('json', 'json_text') else
+            psycopg2.Binary(encode(dt)) for dt in data_types]
+
+
+def get_populated_data_types_sql(available_data_types):
+    """Return a list of SQL expressions that test whether the cache column of
+    each passed in data type is populated.
+    """
+    return ['{} IS NOT NULL'.format(CACHE_DATA_COLUMNS[dt])
+            for dt in available_data_types]
+
+
+def get_cache_data_types_to_update(entries, data_types,
+        available_data_types):
+    """Return all data types that have to be computed for a set of cache
+    entries. If an existing entry is dirty, all its already populated data
+    types are refreshed along with the requested ones, because otherwise they
+    would be stale. Each entry in <entries> is expected to contain a
+    populated flag for each of <available_data_types>, followed by the dirty
+    flag.
+    """
+    data_types = list(data_types)
+    n_data_types = len(available_data_types)
+    for entry in entries:
+        if not entry[n_data_types]:
+            continue
+        for dt, populated in zip(available_data_types, entry[0:n_data_types]):
+            if populated and dt not in data_types:
+                data_types.append(dt)
+    return data_types
+
+
+class CacheUpdatePool(object):
+    """Run cache update jobs either in the current process or, if more than one
+    job is allowed, in a pool of worker processes. Each worker process uses its
+    own database connection. A job is a tuple of a function and its argument,
+    both need to be picklable. Every job function returns the number of cache
+    entries it processed. Daemon processes, like Celery prefork workers, can't
+    start child processes, they always run jobs in the current process.
+    """
+
+    def __init__(self, n_jobs=1):
+        self.n_jobs = max(1, int(n_jobs or 1))
+        if self.n_jobs > 1 and multiprocessing.current_process().daemon:
+            logger.warning("Can't use worker processes in daemon process, " +
+                    "updating node query caches in a single process")
+            self.n_jobs = 1
+        self.pool = None
+
+    def __enter__(self):
+        if self.n_jobs > 1:
+            # Database connections can't be shared with forked processes.
+            connections.close_all()
+            self.pool = multiprocessing.Pool(self.n_jobs,
+                    initializer=init_cache_update_worker)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.pool:
+            if exc_type:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def run(self, jobs, progress=None):
+        """Run all passed in jobs and report each finished one to <progress>.
+        """
+        if self.pool:
+            results = self.pool.imap_unordered(run_cache_update_job, jobs)
+        else:
+            results = map(run_cache_update_job, jobs)
+        for n_processed in results:
+            if progress:
+                progress.update(n_processed)
+
+
+def create_cache_update_pool(n_jobs=1):
+    """Create a new CacheUpdatePool with <n_jobs> worker processes, to be used
+    as a context manager.
+    """
+    return CacheUpdatePool(n_jobs)
+
+
+def init_cache_update_worker():
+    """Make sure a worker process opens its own database connection rather than
+    using one inherited from its parent process.
+    """
+    for conn in connections.all():
+        conn.connection = None
+
+
+def run_cache_update_job(job):
+    fn, args = job
+    return fn(*args)
+
+
+class CacheUpdateProgress(object):
+    """Log the progress and throughput of a cache update, at most every
+    <interval> seconds and when all work is done.
+    """
+
+    def __init__(self, total, unit, log=print, interval=5.0):
+        self.total = total
+        self.unit = unit
+        self.log = log
+        self.interval = interval
+        self.done = 0
+        self.start = time.time()
+        self.last_report = self.start
+
+    def update(self, n):
+        self.done += n
+        now = time.time()
+        if self.done >= self.total or now - self.last_report >= self.interval:
+            self.last_report = now
+            elapsed = now - self.start
+            rate = self.done / elapsed if elapsed > 0 else 0.0
+            self.log(' -> {}/{} {} done ({:.2f} {}/s, {:.1f}s elapsed)'.format(
+                    self.done, self.total, self.unit, rate, self.unit, elapsed))
+
+
+def get_batches(items, batch_size):
+    """Split the passed in iterable in lists of at most <batch_size> items.
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def update_cache(project_id, data_type, orientations, steps, node_limit=None,
+        n_largest_skeletons_limit=None, n_last_edited_skeletons_limit=None,
+        hidden_last_editor_id=None, delete=False, bb_limits=None,
+        only_dirty=False, n_jobs=1, batch_size=DEFAULT_CACHE_UPDATE_BATCH_SIZE,
+        pool=None, log=print):
+    """Populate the section cache of a project for the passed in orientations.
+    If <only_dirty> is true and cache entries exist already for an
+    orientation, only entries that have been marked as dirty due to edits are
+    recomputed. Sections are computed in batches of <batch_size> by <n_jobs>
+    worker processes, unless an existing CacheUpdatePool is passed in.
+    <data_type> can be a single data type or a list of data types, which are
+    all stored for each section.
+    """
+    data_types = get_cache_data_type_list(data_type, SECTION_CACHE_DATA_TYPES)
+    if len(steps) != len(orientations):
+        raise ValueError('Need one depth resolution flag per orientation')
+    if project_id is None:
+        raise ValueError('Need project ID')
+    if batch_size < 1:
+        raise ValueError('Batch size needs to be positive')
+
+    if not pool:
+        with create_cache_update_pool(n_jobs) as pool:
+            return update_cache(project_id, data_type, orientations, steps,
+                    node_limit, n_largest_skeletons_limit,
+                    n_last_edited_skeletons_limit, hidden_last_editor_id,
+                    delete, bb_limits, only_dirty, batch_size=batch_size,
+                    pool=pool, log=log)
+
+    orientation_ids = list(map(lambda x: ORIENTATIONS[x], orientations))
+
+    cursor = connection.cursor()
+
+    update_params = get_cache_update_params(project_id, cursor, node_limit,
+            n_largest_skeletons_limit, n_last_edited_skeletons_limit,
+            hidden_last_editor_id, bb_limits, log)
+    if not update_params:
+        return
+    bb, params = update_params
+
+    if delete and not only_dirty:
+        for n, o in enumerate(orientations):
+            orientation_id = orientation_ids[n]
+            log(' -> Deleting existing cache entries in orientation {}'.format(project_id, o))
+            cursor.execute("""
+                DELETE FROM node_query_cache
+                WHERE project_id = %(project_id)s
+                AND orientation = %(orientation)s
+            """, {
+                'project_id': project_id,
+                'orientation': orientation_id
+            })
+
     min_z = bb[0][2]
     max_z = bb[1][2]
 
-    data_types = [data_type]
-    update_json_cache = 'json' in data_types
-    update_json_text_cache = 'json_text' in data_types
-    update_msgpack_cache = 'msgpack' in data_types
+    for o, step in zip(orientations, steps):
+        orientation_id = ORIENTATIONS[o]
 
+        sections = None
+        if only_dirty:
+            cursor.execute("""
+                SELECT EXISTS(
+                    SELECT 1 FROM node_query_cache
+                    WHERE project_id = %(project_id)s
+                    AND orientation = %(orientation)s
+                )
+            """, {
+                'project_id': project_id,
+                'orientation': orientation_id,
+            })
+            if cursor.fetchone()[0]:
+                cursor.execute("""
+                    SELECT depth, COALESCE(step, %(step)s)
+                    FROM node_query_cache
+                    WHERE project_id = %(project_id)s
+                    AND orientation = %(orientation)s
+                    AND dirty
+                    ORDER BY depth
+                """, {
+                    'project_id': project_id,
+                    'orientation': orientation_id,
+                    'step': step,
+                })
+                sections = cursor.fetchall()
+                log(' -> Refreshing {} dirty sections in orientation {} for types: {}'.format(
+                        len(sections), o, ', '.join(data_types)))
+            else:
+                log(' -> No cache entries found for orientation {}, populating all sections'.format(o))
+
+        if sections is None:
+            log(' -> Populating cache for orientation {} with depth resolution {} for types: {}'.format(
+                    o, step, ', '.join(data_types)))
+            sections = []
+            z = min_z
+            while z < max_z:
+                sections.append((z, step))
+                z += step
+
+        if not sections:
+            continue
+
+        progress = CacheUpdateProgress(len(sections), 'sections', log)
+        pool.run(((update_cache_sections, (project_id, orientation_id, batch,
+                params, data_types)) for batch in get_batches(sections, batch_size)),
+                progress)
+
+
+def update_cache_sections(project_id, orientation_id, sections, params,
+        data_types):
+    """Recompute the node query results of a list of (depth, step) sections and
+    store them in the section cache using a single statement. Results are
+    computed without locking cache entries, concurrent edits instead increment
+    the version of affected entries. An existing entry is only overwritten if
+    its version didn't change during the computation, otherwise it stays dirty.
+    Entries locked by an edit at the time of writing are skipped, because they
+    will be marked dirty anyway. Returns the number of processed sections.
+    """
+    cursor = connection.cursor()
     provider = Postgis2dNodeProvider()
-    types = ', '.join(data_types)
+    params = copy.copy(params)
+
+    # Read the current state of all sections, in the order of <sections>.
+    cursor.execute("""
+        SELECT c.depth, COALESCE(c.version, 0), {populated}, c.dirty
+        FROM UNNEST(%s::real[]) WITH ORDINALITY s(depth, i)
+        LEFT JOIN node_query_cache c
+            ON c.project_id = %s
+            AND c.orientation = %s
+            AND c.depth = s.depth
+        ORDER BY s.i
+    """.format(populated=', '.join('c.' + p for p in get_populated_data_types_sql(
+            SECTION_CACHE_DATA_TYPES))),
+            ([s[0] for s in sections], project_id, orientation_id))
+    entries = cursor.fetchall()
+    data_types = get_cache_data_types_to_update([e[2:] for e in entries
+            if e[0] is not None], data_types, SECTION_CACHE_DATA_TYPES)
+
+    results = []
+    for depth, step in sections:
+        params['z1'] = depth
+        params['z2'] = depth + step
+        result_tuple = _node_list_tuples_query(params, project_id, provider)
+        results.append(encode_cache_data(result_tuple, data_types))
+
+    with transaction.atomic():
+        cursor.execute("""
+            SELECT depth
+            FROM node_query_cache
+            WHERE project_id = %s AND orientation = %s
+            AND depth = ANY(%s::real[])
+            FOR UPDATE SKIP LOCKED
+        """, (project_id, orientation_id, [e[0] for e in entries
+                if e[0] is not None]))
+        locked = set(r[0] for r in cursor.fetchall())
+
+        n_stored = 0
+        query_params = []
+        for (depth, step), entry, data in zip(sections, entries, results):
+            if entry[0] is not None and entry[0] not in locked:
+                continue
+            n_stored += 1
+            query_params.extend([project_id, orientation_id, depth, step,
+                    entry[1]])
+            query_params.extend(data)
+
+        if n_stored:
+            columns = [CACHE_DATA_COLUMNS[dt] for dt in data_types]
+            row_template = '(%s, %s, %s, %s, now(), false, %s, {})'.format(
+                    ', '.join(['%s'] * len(columns)))
+            cursor.execute("""
+                INSERT INTO node_query_cache (project_id, orientation, depth,
+                    step, update_time, dirty, version, {columns})
+                VALUES {values}
+                ON CONFLICT (project_id, orientation, depth)
+                DO UPDATE SET {updates}, step = EXCLUDED.step,
+                    update_time = EXCLUDED.update_time, dirty = false
+                WHERE node_query_cache.version = EXCLUDED.version;
+            """.format(**{
+                'columns': ', '.join(columns),
+                'values': ', '.join([row_template] * n_stored),
+                'updates': ', '.join('{c} = EXCLUDED.{c}'.format(c=c) for c in columns),
+            }), query_params)
+
+    return len(sections)
+
+
+def update_grid_cache(project_id, data_type, orientations, steps, cell_width,
+        cell_height, node_limit=None, n_largest_skeletons_limit=None,
+        n_last_edited_skeletons_limit=None, hidden_last_editor_id=None,
+        allow_empty=False, delete=False, bb_limits=None, only_dirty=False,
+        n_jobs=1, batch_size=DEFAULT_CACHE_UPDATE_BATCH_SIZE, pool=None,
+        log=print):
+    """Populate the grid cache of a project for the passed in orientations.
+    Each grid cell has a size of <cell_width> x <cell_height> x <step> and
+    stores the result of a node query for its own bounding box. If
+    <allow_empty> is true, cells without any nodes aren't stored. If
+    <only_dirty> is true and the grid exists already, only cells that have
+    been marked as dirty due to edits are recomputed. Like with update_cache(),
+    cells are computed in batches of <batch_size> by <n_jobs> worker
+    processes, unless an existing CacheUpdatePool is passed in. Like with
+    update_cache(), <data_type> can be a list of data types.
+    """
+    data_types = get_cache_data_type_list(data_type, GRID_CACHE_DATA_TYPES)
+    if len(steps) != len(orientations):
+        raise ValueError('Need one depth resolution flag per orientation')
+    if project_id is None:
+        raise ValueError('Need project ID')
+    if not cell_width or not cell_height:
+        raise ValueError('Need positive cell width and cell height')
+    if batch_size < 1:
+        raise ValueError('Batch size needs to be positive')
+
+    if not pool:
+        with create_cache_update_pool(n_jobs) as pool:
+            return update_grid_cache(project_id, data_type, orientations,
+                    steps, cell_width, cell_height, node_limit,
+                    n_largest_skeletons_limit, n_last_edited_skeletons_limit,
+                    hidden_last_editor_id, allow_empty, delete, bb_limits,
+                    only_dirty, batch_size=batch_size, pool=pool, log=log)
+
+    cursor = connection.cursor()
+
+    update_params = get_cache_update_params(project_id, cursor, node_limit,
+            n_largest_skeletons_limit, n_last_edited_skeletons_limit,
+            hidden_last_editor_id, bb_limits, log)
+    if not update_params:
+        return
+    bb, params = update_params
+
+    min_x, max_x = get_grid_index_range(bb[0][0], bb[1][0], cell_width)
+    min_y, max_y = get_grid_index_range(bb[0][1], bb[1][1], cell_height)
 
     for o, step in zip(orientations, steps):
-        orientation_id = ORIENTATIONS[o]
-        log(' -> Populating cache for orientation {} with depth resolution {} for types: {}'.format(o, step, types))
-        z = min_z
-        while z < max_z:
-            params['z1'] = z
-            params['z2'] = z + step
-            result_tuple = _node_list_tuples_query(params, project_id, provider)
-
-            if update_json_cache:
-                data = ujson.dumps(result_tuple)
-                cursor.execute("""
-                    INSERT INTO node_query_cache (project_id, orientation, depth, update_time, json_data)
-                    VALUES (%s, %s, %s, now(), %s)
-                    ON CONFLICT (project_id, orientation, depth)
-                    DO UPDATE SET json_data = EXCLUDED.json_data, update_time = EXCLUDED.update_time;
-                """, (project_id, orientation_id, z, json.dumps(result_tuple)))
-
-            if update_json_text_cache:
-                data = ujson.dumps(result_tuple)
-                cursor.execute("""
-                    INSERT INTO node_query_cache (project_id, orientation, depth, update_time, json_text_data)
-                    VALUES (%s, %s, %s, now(), %s)
-                    ON CONFLICT (project_id, orientation, depth)
-                    DO UPDATE SET json_text_data = EXCLUDED.json_text_data, update_time = EXCLUDED.update_time;
-                """, (project_id, orientation_id, z, json.dumps(result_tuple)))
-
-            if update_msgpack_cache:
-                data = msgpack.packb(result_tuple)
+        grid, created = NodeGridCache.objects.get_or_create(project_id=project_id,
+                orientation=ORIENTATIONS[o], cell_width=cell_width,
+                cell_height=cell_height, cell_depth=step, defaults={
+                    'allow_empty': allow_empty,
+                })
+        if grid.allow_empty != allow_empty:
+            grid.allow_empty = allow_empty
+            grid.save()
+
+        if only_dirty and not created:
+            cursor.execute("""
+                SELECT x_index, y_index, z_index
+                FROM node_grid_cache_cell
+                WHERE grid_id = %(grid_id)s
+                AND dirty
+                ORDER BY z_index, y_index, x_index
+            """, {
+                'grid_id': grid.id,
+            })
+            cells = cursor.fetchall()
+            n_cells = len(cells)
+            log(' -> Refreshing {} dirty grid cells in orientation {} for types: {}'.format(
+                    n_cells, o, ', '.join(data_types)))
+        else:
+            if delete:
+                log(' -> Deleting existing grid cache cells in orientation {}'.format(o))
                 cursor.execute("""
-                    INSERT INTO node_query_cache (project_id, orientation, depth, update_time, msgpack_data)
-                    VALUES (%s, %s, %s, now(), %s)
-                    ON CONFLICT (project_id, orientation, depth)
-                    DO UPDATE SET msgpack_data = EXCLUDED.msgpack_data, update_time = EXCLUDED.update_time;
-                """, (project_id, orientation_id, z, psycopg2.Binary(data)))
+                    DELETE FROM node_grid_cache_cell
+                    WHERE grid_id = %(grid_id)s
+                """, {
+                    'grid_id': grid.id,
+                })
+
+            min_z, max_z = get_grid_index_range(bb[0][2], bb[1][2], step)
+            extend_grid_extent(grid, (min_x, max_x), (min_y, max_y),
+                    (min_z, max_z), replace=delete)
+            log(' -> Populating grid cache for orientation {} with cell size {} x {} x {} for types: {}'.format(
+                    o, cell_width, cell_height, step, ', '.join(data_types)))
+            # Cells are ordered by depth so that batches are formed from cells
+            # of a single z slab if possible.
+            cells = ((x_index, y_index, z_index)
+                    for z_index in range(min_z, max_z + 1)
+                    for y_index in range(min_y, max_y + 1)
+                    for x_index in range(min_x, max_x + 1))
+            n_cells = (max_x - min_x + 1) * (max_y - min_y + 1) * (max_z - min_z + 1)
+
+        if not n_cells:
+            continue
 
-            z += step
+        progress = CacheUpdateProgress(n_cells, 'cells', log)
+        pool.run(((update_grid_cells, (project_id, grid.id, batch, params,
+                cell_width, cell_height, step, data_types, allow_empty))
+                for batch in get_batches(cells, batch_size)), progress)
+
+
+def extend_grid_extent(grid, x_range, y_range, z_range, replace=False):
+    """Add the passed in (min, max) index ranges to the populated range of
+    <grid>. With <replace>, the existing range is dropped.
+    """
+    for dim, (min_index, max_index) in zip('xyz', (x_range, y_range, z_range)):
+        min_field, max_field = 'min_{}_index'.format(dim), 'max_{}_index'.format(dim)
+        current_min, current_max = getattr(grid, min_field), getattr(grid, max_field)
+        if not replace and current_min is not None:
+            min_index = min(min_index, current_min)
+        if not replace and current_max is not None:
+            max_index = max(max_index, current_max)
+        setattr(grid, min_field, min_index)
+        setattr(grid, max_field, max_index)
+    grid.save()
+
+
+def set_grid_cell_params(params, x_index, y_index, z_index, cell_width,
+        cell_height, cell_depth):
+    """Update the bounding box in <params> to match the passed in grid cell.
+    """
+    params['left'] = x_index * cell_width
+    params['right'] = params['left'] + cell_width
+    params['top'] = y_index * cell_height
+    params['bottom'] = params['top'] + cell_height
+    params['z1'] = z_index * cell_depth
+    params['z2'] = params['z1'] + cell_depth
+
+
+def update_grid_cells(project_id, grid_id, cells, params, cell_width,
+        cell_height, cell_depth, data_types, allow_empty=False):
+    """Recompute the node query results of a list of (x, y, z) grid cells and
+    store them in the grid cache. Like with sections, results are computed
+    without locks and cells are only updated if their version didn't change in
+    the meantime. If <allow_empty> is true, empty cells are removed. Returns
+    the number of processed cells.
+    """
+    cursor = connection.cursor()
+    provider = Postgis2dNodeProvider()
+    params = copy.copy(params)
+    x_indices, y_indices, z_indices = (list(c) for c in zip(*cells))
+
+    cursor.execute("""
+        SELECT c.x_index, c.y_index, c.z_index, c.version, {populated}, c.dirty
+        FROM node_grid_cache_cell c
+        JOIN UNNEST(%s::int[], %s::int[], %s::int[]) i(x_index, y_index, z_index)
+            ON c.x_index = i.x_index
+            AND c.y_index = i.y_index
+            AND c.z_index = i.z_index
+        WHERE c.grid_id = %s
+    """.format(populated=', '.join('c.' + p for p in get_populated_data_types_sql(
+            GRID_CACHE_DATA_TYPES))),
+            (x_indices, y_indices, z_indices, grid_id))
+    entries = cursor.fetchall()
+    versions = dict((tuple(e[0:3]), e[3]) for e in entries)
+    data_types = get_cache_data_types_to_update([e[4:] for e in entries],
+            data_types, GRID_CACHE_DATA_TYPES)
+
+    # Empty results are represented by None.
+    results = []
+    for x_index, y_index, z_index in cells:
+        set_grid_cell_params(params, x_index, y_index, z_index,
+                cell_width, cell_height, cell_depth)
+        result_tuple = _node_list_tuples_query(params, project_id, provider,
+                with_relation_map='used')
+        if allow_empty and not result_tuple[0] and not result_tuple[1]:
+            results.append(None)
+        else:
+            results.append(encode_cache_data(result_tuple, data_types))
+
+    with transaction.atomic():
+        cursor.execute("""
+            SELECT c.x_index, c.y_index, c.z_index
+            FROM node_grid_cache_cell c
+            JOIN UNNEST(%s::int[], %s::int[], %s::int[]) i(x_index, y_index, z_index)
+                ON c.x_index = i.x_index
+                AND c.y_index = i.y_index
+                AND c.z_index = i.z_index
+            WHERE c.grid_id = %s
+            FOR UPDATE OF c SKIP LOCKED
+        """, (x_indices, y_indices, z_indices, grid_id))
+        locked = set(cursor.fetchall())
+
+        empty_cells = []
+        n_stored = 0
+        query_params = []
+        for cell, data in zip(cells, results):
+            cell = tuple(cell)
+            version = versions.get(cell)
+            if version is not None and cell not in locked:
+                continue
+
+            if data is None:
+                if version is not None:
+                    empty_cells.append(cell + (version,))
+                continue
+
+            n_stored += 1
+            query_params.extend([grid_id, cell[0], cell[1], cell[2],
+                    version or 0])
+            query_params.extend(data)
+
+        if empty_cells:
+            cursor.execute("""
+                DELETE FROM node_grid_cache_cell c
+                USING UNNEST(%s::int[], %s::int[], %s::int[], %s::int[])
+                    i(x_index, y_index, z_index, version)
+                WHERE c.grid_id = %s
+                AND c.x_index = i.x_index
+                AND c.y_index = i.y_index
+                AND c.z_index = i.z_index
+                AND c.version = i.version
+            """, [list(c) for c in zip(*empty_cells)] + [grid_id])
+
+        if n_stored:
+            columns = [CACHE_DATA_COLUMNS[dt] for dt in data_types]
+            row_template = '(%s, %s, %s, %s, now(), false, %s, {})'.format(
+                    ', '.join(['%s'] * len(columns)))
+            cursor.execute("""
+                INSERT INTO node_grid_cache_cell (grid_id, x_index, y_index,
+                    z_index, update_time, dirty, version, {columns})
+                VALUES {values}
+                ON CONFLICT (grid_id, x_index, y_index, z_index)
+                DO UPDATE SET {updates}, update_time = EXCLUDED.update_time,
+                    dirty = false
+                WHERE node_grid_cache_cell.version = EXCLUDED.version;
+            """.format(**{
+                'columns': ', '.join(columns),
+                'values': ', '.join([row_template] * n_stored),
+                'updates': ', '.join('{c} = EXCLUDED.{c}'.format(c=c) for c in columns),
+            }), query_params)
+
+    return len(cells)
 
 
 def prepare_db_statements(connection):
@@ -1137,6 +2308,74 @@ def prepare_db_statements(connection):
         node_provider.prepare_db_statements(connection)
 
 
+def parse_node_list_request(request, project_id):
+    """Parse the parameters of a node list request, see node_list_tuples().
+    Returns a tuple of the form (params, treenode_ids, connector_ids,
+    include_labels, target_format, target_options, override_provider,
+    with_relation_map).
+    """
+    if request.method == 'POST':
+        data = request.POST
+    elif request.method == 'GET':
+        data = request.GET
+    else:
+        raise ValueError("Unsupported HTTP method: " + request.method)
+
+    params = {}
+
+    treenode_ids = get_request_list(data, 'treenode_ids', tuple(), int)
+    connector_ids = get_request_list(data, 'connector_ids', tuple(), int)
+    for p in ('top', 'left', 'bottom', 'right', 'z1', 'z2'):
+        params[p] = float(data.get(p, 0))
+    # Limit the number of retrieved treenodes within the section
+    params['limit'] = settings.NODE_LIST_MAXIMUM_COUNT
+    params['n_largest_skeletons_limit'] = int(data.get('n_largest_skeletons_limit', 0))
+    params['n_last_edited_skeletons_limit'] = int(data.get('n_last_edited_skeletons_limit', 0))
+    params['hidden_last_editor_id'] = int(data['hidden_last_editor_id']) if 'hidden_last_editor_id' in data else None
+    params['project_id'] = project_id
+    include_labels = get_request_bool(data, 'labels', False)
+    # Level of detail sampling, if not set the node provider setting is used
+    params['lod'] = get_request_bool(data, 'lod')
+    target_format = data.get('format', 'json')
+    # Cached node providers can pass through pre-encoded data if it matches the
+    # requested format and is compressed with an accepted encoding.
+    params['format'] = target_format
+    params['accepted_encodings'] = get_accepted_encodings(request)
+    target_options = {
+        'view_width': int(data.get('view_width', 1000)),
+        'view_height': int(data.get('view_height', 1000)),
+    }
+    override_provider = data.get('src')
+    with_relation_map = data.get('with_relation_map', 'used')
+    if with_relation_map not in ("none", "used", "all"):
+        raise ValueError("Relation map can only be 'none', 'used' or 'all'")
+    if with_relation_map == 'none':
+        with_relation_map = None
+    # The orientation parameter is used to override the dominant depth
+    # dimension. This dimension is used do some queries.
+    orientation = data.get('orientation')
+    width = params['width'] = params.get('right') - params.get('left')
+    height = params['height'] = params.get('bottom') - params.get('top')
+    depth = params['depth'] = params.get('z2') - params.get('z1')
+    if not orientation:
+        if depth < width:
+            if depth < height:
+                orientation = 'xy'
+            else:
+                orientation = 'xz'
+        else:
+            if depth < height:
+                orientation = 'zy'
+            elif width < height:
+                orientation = 'zy'
+            else:
+                orientation = 'xz'
+    params['orientation'] = orientation
+
+    return (params, treenode_ids, connector_ids, include_labels, target_format,
+            target_options, override_provider, with_relation_map)
+
+
 @requires_user_role([UserRole.Annotate, UserRole.Browse])
 def node_list_tuples(request, project_id=None, provider=None):
     '''Retrieve all nodes intersecting a bounding box
@@ -1238,7 +2477,9 @@ def node_list_tuples(request, project_id=None, provider=None):
       paramType: form
     - name: format
       description: |
-        Either "json" (default) or "msgpack", optional.
+        Either "json" (default), "msgpack", "columnar", "png" or "gif",
+        optional. The "columnar" format is a binary format with one typed
+        little-endian array per field, see encode_columnar_node_list().
       required: false
       type: string
       paramType: form
@@ -1251,6 +2492,15 @@ def node_list_tuples(request, project_id=None, provider=None):
       type: string
       defaultValue: used
       paramType: form
+    - name: lod
+      description: |
+        Whether a spatially stratified subset of at most "limit" treenodes
+        should be returned, if more treenodes intersect with the bounding box,
+        rather than an arbitrary subset. Only supported by the PostGIS based
+        node providers, which use their "lod" option if this isn't set.
+      required: false
+      type: boolean
+      paramType: form
     - name: n_largest_skeletons_limit
       description: |
         Maximum number of the largest skeletons in view
@@ -1276,68 +2526,259 @@ def node_list_tuples(request, project_id=None, provider=None):
       required: true
     '''
     project_id = int(project_id) # sanitize
-    if request.method == 'POST':
-        data = request.POST
-    elif request.method == 'GET':
-        data = request.GET
-    else:
-        raise ValueError("Unsupported HTTP method: " + request.method)
-
-    params = {}
-
-    treenode_ids = get_request_list(data, 'treenode_ids', tuple(), int)
-    connector_ids = get_request_list(data, 'connector_ids', tuple(), int)
-    for p in ('top', 'left', 'bottom', 'right', 'z1', 'z2'):
-        params[p] = float(data.get(p, 0))
-    # Limit the number of retrieved treenodes within the section
-    params['limit'] = settings.NODE_LIST_MAXIMUM_COUNT
-    params['n_largest_skeletons_limit'] = int(data.get('n_largest_skeletons_limit', 0))
-    params['n_last_edited_skeletons_limit'] = int(data.get('n_last_edited_skeletons_limit', 0))
-    params['hidden_last_editor_id'] = int(data['hidden_last_editor_id']) if 'hidden_last_editor_id' in data else None
-    params['project_id'] = project_id
-    include_labels = get_request_bool(data, 'labels', False)
-    target_format = data.get('format', 'json')
-    target_options = {
-        'view_width': int(data.get('view_width', 1000)),
-        'view_height': int(data.get('view_height', 1000)),
-    }
-    override_provider = data.get('src')
-    with_relation_map = data.get('with_relation_map', 'used')
-    if with_relation_map not in ("none", "used", "all"):
-        raise ValueError("Relation map can only be 'none', 'used' or 'all'")
-    if with_relation_map == 'none':
-        with_relation_map = None
-    # The orientation parameter is used to override the dominant depth
-    # dimension. This dimension is used do some queries.
-    orientation = data.get('orientation')
-    width = params['width'] = params.get('right') - params.get('left')
-    height = params['height'] = params.get('bottom') - params.get('top')
-    depth = params['depth'] = params.get('z2') - params.get('z1')
-    if not orientation:
-        if depth < width:
-            if depth < height:
-                orientation = 'xy'
-            else:
-                orientation = 'xz'
-        else:
-            if depth < height:
-                orientation = 'zy'
-            elif width < height:
-                orientation = 'zy'
-            else:
-                orientation = 'xz'
-    params['orientation'] = orientation
+    params, treenode_ids, connector_ids, include_labels, target_format, \
+            target_options, override_provider, with_relation_map = \
+            parse_node_list_request(request, project_id)
 
     if override_provider:
         node_providers = get_configured_node_providers([override_provider])
     else:
         node_providers = get_configured_node_providers(settings.NODE_PROVIDERS)
 
+    # Only results that are sent without further conversion are cached.
+    # Columnar results are cached in their final encoding.
+    cache = get_node_result_cache()
+    if cache and (target_format in TARGET_FORMAT_DATA_TYPES or
+            target_format == 'columnar'):
+        return compile_cached_node_list_result(cache, project_id,
+            node_providers, override_provider, params, treenode_ids,
+            connector_ids, include_labels, target_format, target_options,
+            with_relation_map)
+
     return compile_node_list_result(project_id, node_providers, params,
         treenode_ids, connector_ids, include_labels, target_format,
         target_options, with_relation_map)
 
 
+@api_view(['GET', 'POST'])
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def node_list_sections(request, project_id=None):
+    """Retrieve the node lists of a section and its adjacent sections.
+
+    Accepts the same parameters as the node list API (node/list) for the
+    bounding box of a single section, plus the number of sections below and
+    above it. The section thickness is the extent of the bounding box along
+    its depth dimension. All sections are queried at once with a PostGIS node
+    provider and the result is partitioned by depth.
+
+    Returned is a list with an element for each section, ordered by depth:
+
+    [{start: section_start, end: section_end, nodes: node_list}]
+
+    Each node_list has the form of a regular node list response, i.e.
+    [[treenodes], [connectors], {labels}, node_limit_reached, {relation_map}].
+    Treenodes are included in a section if they are in it or if the edge to
+    their parent intersects with it. Explicitly requested treenodes and
+    connectors are only included in the sections that contain them. The node
+    limit applies to the nodes located in each section separately. Level of
+    detail sampling isn't applied.
+    ---
+    parameters:
+    - name: n_sections_below
+      description: |
+        Number of sections with a smaller depth to return.
+      required: false
+      type: integer
+      defaultValue: 0
+      paramType: form
+    - name: n_sections_above
+      description: |
+        Number of sections with a larger depth to return.
+      required: false
+      type: integer
+      defaultValue: 0
+      paramType: form
+    - name: format
+      description: |
+        Either "json" (default) or "msgpack", optional.
+      required: false
+      type: string
+      paramType: form
+    type:
+    - type: array
+      items:
+        type: object
+      required: true
+    """
+    project_id = int(project_id) # sanitize
+    params, treenode_ids, connector_ids, include_labels, target_format, \
+            target_options, override_provider, with_relation_map = \
+            parse_node_list_request(request, project_id)
+    data = request.POST if request.method == 'POST' else request.GET
+
+    if target_format not in ('json', 'msgpack'):
+        raise ValueError("Only the json and msgpack formats are supported")
+
+    n_below = int(data.get('n_sections_below', 0))
+    n_above = int(data.get('n_sections_above', 0))
+    if n_below < 0 or n_above < 0:
+        raise ValueError("The number of adjacent sections can't be negative")
+    if n_below + n_above > MAX_ADJACENT_SECTIONS:
+        raise ValueError("At most {} adjacent sections can be requested".format(
+                MAX_ADJACENT_SECTIONS))
+
+    # Only spatial queries can cover multiple sections at once.
+    if override_provider:
+        node_providers = get_configured_node_providers([override_provider])
+    else:
+        node_providers = get_configured_node_providers(settings.NODE_PROVIDERS)
+    node_providers = [p for p in node_providers
+            if isinstance(p, PostgisNodeProvider)]
+    if not node_providers:
+        if override_provider:
+            raise ValueError("Only PostGIS node providers support multiple sections")
+        node_providers = [Postgis3dNodeProvider()]
+
+    depth_min, depth_max, depth_index = SECTION_DEPTH_DIMENSIONS[params['orientation']]
+    start, end = params[depth_min], params[depth_max]
+    thickness = end - start
+    sections = [(start + i * thickness, start + (i + 1) * thickness)
+            for i in range(-n_below, n_above + 1)]
+
+    # Query all sections at once, the node limit is applied to each section
+    # by the node provider. Compressed data would have to be decoded.
+    params[depth_min] = sections[0][0]
+    params[depth_max] = sections[-1][1]
+    params['depth'] = params['z2'] - params['z1']
+    params['width'] = params['right'] - params['left']
+    params['height'] = params['bottom'] - params['top']
+    params['section_start'] = sections[0][0]
+    params['section_thickness'] = thickness
+    params['lod'] = False
+    params['accepted_encodings'] = []
+
+    result, data_type = get_node_list_tuples(project_id, node_providers,
+            params, treenode_ids, connector_ids, include_labels,
+            with_relation_map)
+    result = merge_extra_nodes(decode_node_list_data(result, data_type))
+
+    section_results = partition_node_list_result(result, sections,
+            depth_index, treenode_ids, params['limit'])
+    response = [{
+        'start': section_start,
+        'end': section_end,
+        'nodes': section_result,
+    } for (section_start, section_end), section_result in zip(sections, section_results)]
+
+    if target_format == 'msgpack':
+        return HttpResponse(msgpack.packb(response),
+                content_type='application/octet-stream')
+    return HttpResponse(ujson.dumps(response), content_type='application/json')
+
+
+def partition_node_list_result(result, sections, depth_index,
+        explicit_treenode_ids=tuple(), limit=None):
+    """Split a node list result of the form [treenodes, connectors, labels,
+    node_limit_reached, relation_map] into one result per section. Sections
+    are (start, end) tuples along the depth dimension, which is the location
+    element <depth_index> (0-2) of treenodes and connectors. Like for regular
+    node queries, treenodes are included if they or the edge to their parent
+    intersects with a section, along with their parent. Connectors are
+    included if they or one of their links intersect with a section, along
+    with the linked treenodes. Explicitly requested treenodes are included in
+    the sections that contain them. If a node <limit> is passed in, the node
+    limit of a section is reached if it contains this many treenodes,
+    otherwise the node_limit_reached flag of the result is used.
+    """
+    treenodes, connectors, labels, limit_reached, relation_map = result[:5]
+    explicit_treenode_ids = set(explicit_treenode_ids)
+
+    treenode_index = dict((t[0], i) for i, t in enumerate(treenodes))
+    depth = np.array([t[2 + depth_index] for t in treenodes], dtype=np.float64)
+    parent_index = np.array([treenode_index.get(t[1], -1) for t in treenodes],
+            dtype=np.int64)
+    has_parent = parent_index != -1
+    parent_depth = np.where(has_parent, depth[parent_index], depth)
+    edge_min = np.minimum(depth, parent_depth)
+    edge_max = np.maximum(depth, parent_depth)
+    is_explicit = np.array([t[0] in explicit_treenode_ids for t in treenodes],
+            dtype=bool)
+
+    section_results = []
+    for section_start, section_end in sections:
+        # Treenodes whose edge to their parent intersects with the section
+        in_section = (edge_min < section_end) & (edge_max >= section_start)
+        included = in_section | (is_explicit & (depth >= section_start) &
+                (depth < section_end))
+        included[parent_index[in_section & has_parent]] = True
+
+        section_connectors = []
+        for c in connectors:
+            c_depth = c[1 + depth_index]
+            c_in_section = section_start <= c_depth < section_end
+            links = []
+            for link in c[7]:
+                t = treenode_index.get(link[0])
+                if t is None:
+                    continue
+                link_min, link_max = min(c_depth, depth[t]), max(c_depth, depth[t])
+                if link_min < section_end and link_max >= section_start:
+                    links.append(link)
+                    included[t] = True
+            if c_in_section or links:
+                section_connectors.append(list(c[:7]) + [links])
+
+        section_treenodes = [treenodes[i] for i in np.flatnonzero(included)]
+        node_ids = set(t[0] for t in section_treenodes)
+        node_ids.update(c[0] for c in section_connectors)
+        section_labels = dict((node_id, node_labels)
+                for node_id, node_labels in labels.items()
+                if int(node_id) in node_ids)
+
+        if limit:
+            section_limit_reached = np.count_nonzero((depth >= section_start) &
+                    (depth < section_end)) >= limit
+        else:
+            section_limit_reached = limit_reached
+
+        section_results.append([section_treenodes, section_connectors,
+                section_labels, bool(section_limit_reached), relation_map])
+
+    return section_results
+
+
+@api_view(['GET'])
+@requires_user_role([UserRole.Annotate, UserRole.Browse])
+def node_result_cache_stats(request, project_id=None):
+    """Get statistics on the node result cache of the process that handles
+    this request.
+
+    If the node result cache is enabled with the NODE_RESULT_CACHE_SIZE
+    setting, each server process keeps its own cache. Returned are the number
+    of cached results, their total size in bytes, the size limit as well as
+    the number of cache hits, misses, evicted entries and entries that were
+    invalidated by edits. If the cache is disabled, only "enabled: false" is
+    returned.
+    ---
+    type:
+      enabled:
+        type: boolean
+        required: true
+      entries:
+        type: integer
+      size:
+        type: integer
+      max_size:
+        type: integer
+      hits:
+        type: integer
+      misses:
+        type: integer
+      evictions:
+        type: integer
+      invalidations:
+        type: integer
+    """
+    cache = get_node_result_cache()
+    if not cache:
+        return JsonResponse({
+            'enabled': False,
+        })
+    stats = cache.stats()
+    stats['enabled'] = True
+    return JsonResponse(stats)
+
+
 def _node_list_tuples_query(params, project_id, node_provider,
         explicit_treenode_ids=tuple(), explicit_connector_ids=tuple(),
         include_labels=False, with_relation_map=True):
@@ -1404,8 +2845,8 @@ def _node_list_tuples_query(params, project_id, node_provider,
 
         response_on_error = 'Failed to query treenodes'
 
-        treenode_ids, treenodes = node_provider.get_treenode_data(cursor,
-                params, missing_treenode_ids)
+        treenode_ids, treenodes, lod_sampled = node_provider.get_treenode_data(
+                cursor, params, missing_treenode_ids)
         n_retrieved_nodes = len(treenode_ids)
 
         labels = defaultdict(list)
@@ -1459,7 +2900,8 @@ def _node_list_tuples_query(params, project_id, node_provider,
             export_relation_map = {}
 
         result = [treenodes, connectors, labels,
-                n_retrieved_nodes == params['limit'], export_relation_map]
+                n_retrieved_nodes == params['limit'] or lod_sampled,
+                export_relation_map]
 
         return result
 
@@ -1486,6 +2928,19 @@ def compile_node_list_result(project_id, node_providers, params,
     override_provider is not passed in, the list of node_providers will be
     iterated until a result is found.
     """
+    result_tuple, data_type = get_node_list_tuples(project_id, node_providers,
+            params, explicit_treenode_ids, explicit_connector_ids,
+            include_labels, with_relation_map)
+
+    return create_node_response(result_tuple, params, target_format, target_options, data_type)
+
+
+def get_node_list_tuples(project_id, node_providers, params,
+        explicit_treenode_ids=tuple(), explicit_connector_ids=tuple(),
+        include_labels=False, with_relation_map=True):
+    """Ask all matching node providers for a result of the passed in node
+    query, until one returns a result. Returns a tuple (result, data_type).
+    """
     result_tuple, data_type = None, None
     for node_provider in node_providers:
         if node_provider.matches(params):
@@ -1500,9 +2955,196 @@ def compile_node_list_result(project_id, node_providers, params,
     if not (result_tuple and data_type):
         raise ValueError("Could not find matching node provider for request")
 
-    return create_node_response(result_tuple, params, target_format, target_options, data_type)
+    return result_tuple, data_type
+
+
+def compile_cached_node_list_result(cache, project_id, node_providers,
+        provider_key, params, explicit_treenode_ids=tuple(),
+        explicit_connector_ids=tuple(), include_labels=False,
+        target_format='json', target_options=None, with_relation_map=True):
+    """Like compile_node_list_result(), but results are looked up in and stored
+    in the passed in NodeResultCache. Results are computed for the quantized
+    bounding box of the query and without extra nodes. This allows different
+    clients to share a result. Extra nodes are added to the encoded result
+    afterwards.
+    """
+    generation = cache.sync()
+
+    # Columnar results are cached in their final encoding, which can't be
+    # extended by extra nodes. Requests with extra nodes share the msgpack
+    # result instead, which is converted afterwards.
+    with_extra_nodes = bool(explicit_treenode_ids or explicit_connector_ids)
+    cache_format = 'msgpack' if target_format == 'columnar' and \
+            with_extra_nodes else target_format
+
+    query_params = cache.quantize(params)
+    key = (project_id, provider_key, cache_format, include_labels,
+            with_relation_map) + tuple(query_params.get(p) for p in (
+                'left', 'top', 'z1', 'right', 'bottom', 'z2', 'orientation',
+                'limit', 'n_largest_skeletons_limit',
+                'n_last_edited_skeletons_limit', 'hidden_last_editor_id', 'lod'))
+
+    cached = cache.get(key)
+    if cached:
+        result_tuple, data_type = cached
+    else:
+        # Compressed data can't be extended by extra nodes.
+        query_params['accepted_encodings'] = []
+        result_tuple, data_type = get_node_list_tuples(project_id,
+                node_providers, query_params, include_labels=include_labels,
+                with_relation_map=with_relation_map)
+
+        # Store the result in the type that is sent for the requested format.
+        target_type = TARGET_FORMAT_DATA_TYPES.get(cache_format, cache_format)
+        if target_type == 'columnar':
+            result_tuple = encode_columnar_node_list(
+                    decode_node_list_data(result_tuple, data_type))
+            data_type = target_type
+        elif data_type != target_type:
+            if data_type == 'json':
+                data = result_tuple
+            elif data_type == 'json_text':
+                data = ujson.loads(result_tuple)
+            else:
+                data = msgpack.unpackb(result_tuple, use_list=False)
+            if target_type == 'json_text':
+                result_tuple = ujson.dumps(data)
+            else:
+                result_tuple = msgpack.packb(data)
+            data_type = target_type
+
+        bb = [query_params['left'], query_params['top'], query_params['z1'],
+                query_params['right'], query_params['bottom'], query_params['z2']]
+        cache.set(key, (result_tuple, data_type), len(result_tuple),
+                project_id, bb, generation)
+
+    if with_extra_nodes:
+        extra_tuples, extra_type = get_extra_nodes(params, project_id,
+            explicit_treenode_ids, explicit_connector_ids, include_labels,
+            with_relation_map)
+        if extra_type != 'json':
+            raise ValueError("Unexpected type")
+        result_tuple = add_extra_nodes(result_tuple, data_type, extra_tuples)
+
+    return create_node_response(result_tuple, params, target_format,
+            target_options, data_type)
+
+def get_accepted_encodings(request):
+    """Return all content encodings of cached data that are accepted by the
+    client, ordered by preference.
+    """
+    accepted = set()
+    for entry in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = entry.split(';')
+        encoding = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if encoding and quality > 0:
+            accepted.add(encoding)
+    return [e for e in CACHE_CONTENT_ENCODINGS if e in accepted]
+
+
+def encode_columnar_node_list(result):
+    """Encode a decoded node query result of the form [treenodes, connectors,
+    labels, node_limit_reached, relation_map] into the columnar node list
+    format: a header (COLUMNAR_NODE_LIST_HEADER), followed by one typed array
+    per field of treenodes, connectors and connector links (in this order, see
+    COLUMNAR_*_FIELDS) and a UTF-8 encoded JSON trailer with labels and the
+    relation map. The links of all connectors are stored consecutively, the
+    n_links array of connectors maps them back to their connector.
+    """
+    treenodes, connectors, labels, limit_reached, relation_map = result[:5]
+
+    # Each array is filled directly from the result rows, without building
+    # intermediate lists of columns.
+    n_links = np.fromiter((len(c[7]) for c in connectors),
+            dtype=COLUMNAR_CONNECTOR_FIELDS[7][1], count=len(connectors))
+    total_links = int(n_links.sum())
+
+    arrays = []
+    for i, (name, dtype) in enumerate(COLUMNAR_TREENODE_FIELDS):
+        if name == 'parent_id':
+            # Root nodes have no parent
+            values = (-1 if t[i] is None else t[i] for t in treenodes)
+        else:
+            values = (t[i] for t in treenodes)
+        arrays.append(np.fromiter(values, dtype=dtype, count=len(treenodes)))
+    for i, (name, dtype) in enumerate(COLUMNAR_CONNECTOR_FIELDS):
+        if name == 'n_links':
+            arrays.append(n_links)
+        else:
+            arrays.append(np.fromiter((c[i] for c in connectors), dtype=dtype,
+                    count=len(connectors)))
+    for i, (name, dtype) in enumerate(COLUMNAR_LINK_FIELDS):
+        arrays.append(np.fromiter((l[i] for c in connectors for l in c[7]),
+                dtype=dtype, count=total_links))
+
+    trailer = json.dumps({
+        'labels': labels or {},
+        'relation_map': relation_map or {},
+    }).encode('utf-8')
+
+    flags = COLUMNAR_NODE_LIST_LIMIT_REACHED if limit_reached else 0
+    parts = [COLUMNAR_NODE_LIST_HEADER.pack(COLUMNAR_NODE_LIST_MAGIC,
+            COLUMNAR_NODE_LIST_VERSION, flags, len(treenodes), len(connectors),
+            total_links, len(trailer))]
+
+    for array in arrays:
+        data = array.tobytes()
+        parts.append(data)
+        padding = -len(data) % 8
+        if padding:
+            parts.append(b'\x00' * padding)
+
+    parts.append(trailer)
+    return b''.join(parts)
+
+
+def merge_extra_nodes(result):
+    """Merge the extra nodes of a decoded node query result, if any, into its
+    regular nodes.
+    """
+    if len(result) > 5:
+        return merge_node_query_results([result[:5]] + list(result[5]))
+    return result
+
+
+def decode_node_list_data(result, data_type):
+    """Decode an encoded node query result into Python lists and dicts.
+    """
+    if data_type == 'json':
+        return result
+    elif data_type == 'json_text':
+        return ujson.loads(result)
+    elif data_type == 'msgpack':
+        return msgpack.unpackb(result, use_list=False, raw=False)
+    else:
+        raise ValueError("Unknown data type: " + data_type)
+
 
 def create_node_response(result, params, target_format, target_options, data_type):
+    if data_type in COMPRESSED_DATA_TYPES:
+        base_data_type, encoding = COMPRESSED_DATA_TYPES[data_type]
+        if TARGET_FORMAT_DATA_TYPES.get(target_format) == base_data_type:
+            # Compressed data in the requested format is sent as is.
+            if target_format == 'json':
+                response = HttpResponse(result, content_type='application/json')
+            else:
+                response = HttpResponse(result, content_type='application/octet-stream')
+            response['Content-Encoding'] = encoding
+            patch_vary_headers(response, ('Accept-Encoding',))
+            return response
+        result = decompress_cache_data(result, encoding)
+        if base_data_type == 'json_text':
+            result = result.decode('utf-8')
+        data_type = base_data_type
+
     if target_format == 'json':
         if data_type == 'json':
             data = ujson.dumps(result)
@@ -1512,7 +3154,9 @@ def create_node_response(result, params, target_format, target_options, data_typ
             data = ujson.dumps(msgpack.unpackb(result, use_list=False))
         else:
             raise ValueError("Unknown data type: " + data_type)
-        return HttpResponse(data, content_type='application/json')
+        response = HttpResponse(data, content_type='application/json')
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
     elif target_format == 'msgpack':
         if data_type == 'json':
             data = msgpack.packb(result)
@@ -1522,7 +3166,18 @@ def create_node_response(result, params, target_format, target_options, data_typ
             data = result
         else:
             raise ValueError("Unknown data type: " + data_type)
-        return HttpResponse(data, content_type='application/octet-stream')
+        response = HttpResponse(data, content_type='application/octet-stream')
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+    elif target_format == 'columnar':
+        if data_type == 'columnar':
+            data = result
+        else:
+            data = encode_columnar_node_list(
+                    merge_extra_nodes(decode_node_list_data(result, data_type)))
+        response = HttpResponse(data, content_type='application/octet-stream')
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
     elif target_format == 'png' or target_format == 'gif':
         if data_type == 'json':
             data = result
@@ -1553,9 +3208,13 @@ def create_node_response(result, params, target_format, target_options, data_typ
 
 def render_nodes_xy(node_data, params, width, height, view_min_x=0, view_min_y=0,
         xscale=1.0, yscale=1.0):
-    """Render the passed in node data to an image.
+    """Render the passed in node data to an image. Treenodes in the bounding
+    box of the query are drawn along with the parts of their edges within the
+    Z range of the query and virtual nodes where edges of nodes outside of it
+    cross the section. Connectors in the bounding box are drawn with their
+    links. All geometry is computed for all nodes at once and then drawn at
+    pixel resolution, i.e. overlapping nodes and edges are only drawn once.
     """
-    import random
     background = (255, 0, 0, 0)
     image = Image.new('RGBA', (width, height), background)
 
@@ -1563,72 +3222,128 @@ def render_nodes_xy(node_data, params, width, height, view_min_x=0, view_min_y=0
     hr = radius / 2.0
     node_pen = Pen((255, 0, 255), 1)
     root_pen = Pen('red', 1)
-    #leaf_pen = Pen('red', 1)
     node_brush = Brush((255, 0, 255))
     root_brush = Brush('red')
-    #leaf_brush = Brush('red')
-
-    virtual_nodes = True
+    edge_pen = Pen((255, 255, 0), 1)
+    connector_pen = Pen((0, 0, 255), 1)
+    connector_brush = Brush((0, 0, 255))
+    link_pens = {
+        'presynaptic_to': Pen((200, 0, 0), 1),
+        'postsynaptic_to': Pen((0, 217, 232), 1),
+    }
+    default_link_pen = Pen((128, 128, 128), 1)
 
     left, right = params['left'], params['right']
     top, bottom = params['top'], params['bottom']
     z1, z2 = params['z1'], params['z2']
 
-    # Map parents to children
-    nodes = dict()
-    treenodes = node_data[0]
-    for tn in treenodes:
-        nodes[tn[0]] = tn
+    def to_screen(locations):
+        """Map project space XY coordinates to integer pixel coordinates."""
+        return np.column_stack((
+            np.rint(xscale * (locations[:, 0] - view_min_x)),
+            np.rint(yscale * (locations[:, 1] - view_min_y)))).astype(np.int32)
 
-    draw = Draw(image)
-    # Add treenodes:
-    for tn in treenodes:
-        parent_id = tn[1]
-        x, y, z = tn[2], tn[3], tn[4]
-        xs, ys = None, None
-        virtual_node_created = False
-
-        is_outside = x < left or x >= right or y < top \
-                or y >= bottom or z < z1 or z >= z2
-
-        # If this node and its parent are outside, create a virtual node
-        # location and replace current coordinates.
-        if is_outside:
-            if virtual_nodes and parent_id:
-                parent_node = nodes.get(parent_id)
-                if parent_node:
-                    px, py, pz = parent_node[2], parent_node[3], parent_node[4]
-                    p_is_outside = px < left or px >= right or py < top \
-                            or py >= bottom or pz < z1 or pz >= z2
-
-                    # If the parent ist outside, too, find virtual node
-                    # location.
-                    if p_is_outside:
-                        dx, dy, dz = px - x, py - y, pz - z
-                        if dz > -0.0001 and dz < 0.0001:
-                            continue
-                        t = (z1 - z) / dz
-
-                        x = x + t * dx
-                        y = y + t * dy
-                        z = z1
-                        virtual_node_created = True
-
-            if not virtual_node_created:
-                continue
+    def unique_rows(a):
+        """Remove duplicate rows, e.g. of nodes mapped to the same pixel."""
+        return np.unique(a, axis=0).tolist() if len(a) else []
 
-        xs = xscale * (x - view_min_x)
-        ys = yscale * (y - view_min_y)
+    def inside_mask(locations):
+        return (locations[:, 0] >= left) & (locations[:, 0] < right) & \
+                (locations[:, 1] >= top) & (locations[:, 1] < bottom) & \
+                (locations[:, 2] >= z1) & (locations[:, 2] < z2)
 
-        if parent_id:
-            pen = node_pen
-            brush = node_brush
-        else:
-            pen = root_pen
-            brush = root_brush
+    draw = Draw(image)
+
+    treenodes = node_data[0]
+    treenode_ids = np.array([tn[0] for tn in treenodes], dtype=np.int64)
+    treenode_locations = np.array([tn[2:5] for tn in treenodes],
+            dtype=np.float64).reshape(-1, 3)
+
+    if len(treenodes):
+        parent_ids = np.array([-1 if tn[1] is None else tn[1] for tn in treenodes],
+                dtype=np.int64)
+        is_root = parent_ids == -1
+        is_inside = inside_mask(treenode_locations)
+
+        # Find the index of each parent in the result, if it is part of it.
+        order = np.argsort(treenode_ids)
+        sorted_ids = treenode_ids[order]
+        parent_pos = np.clip(np.searchsorted(sorted_ids, parent_ids), 0,
+                len(sorted_ids) - 1)
+        has_parent = (~is_root) & (sorted_ids[parent_pos] == parent_ids)
+        parent_index = order[parent_pos]
+
+        # Clip each edge to the Z range of the query. With p(t) = child +
+        # t * (parent - child), the edge is visible for t0 <= t <= t1.
+        child_locations = treenode_locations[has_parent]
+        parent_locations = treenode_locations[parent_index[has_parent]]
+        delta = parent_locations - child_locations
+        dz = delta[:, 2]
+        flat = np.abs(dz) < 0.0001
+        safe_dz = np.where(flat, 1.0, dz)
+        ta = (z1 - child_locations[:, 2]) / safe_dz
+        tb = (z2 - child_locations[:, 2]) / safe_dz
+        t0 = np.where(flat, 0.0, np.maximum(0.0, np.minimum(ta, tb)))
+        t1 = np.where(flat, 1.0, np.minimum(1.0, np.maximum(ta, tb)))
+        flat_visible = (child_locations[:, 2] >= z1) & (child_locations[:, 2] < z2)
+        edge_visible = np.where(flat, flat_visible, t0 <= t1)
+
+        edge_starts = to_screen(child_locations + t0[:, np.newaxis] * delta)
+        edge_ends = to_screen(child_locations + t1[:, np.newaxis] * delta)
+        edges = unique_rows(np.hstack((edge_starts, edge_ends))[edge_visible])
+        for x0, y0, x1, y1 in edges:
+            if x0 != x1 or y0 != y1:
+                draw.line((x0, y0, x1, y1), edge_pen)
+
+        # Nodes outside of the bounding box whose parent is outside as well
+        # are represented by a virtual node where their edge crosses the
+        # section.
+        parent_outside = np.zeros(len(treenodes), dtype=bool)
+        parent_outside[has_parent] = ~is_inside[parent_index[has_parent]]
+        is_virtual = (~is_inside)[has_parent] & parent_outside[has_parent] & \
+                ~flat & (ta >= 0.0) & (ta <= 1.0)
+        virtual_locations = child_locations[is_virtual] + \
+                ta[is_virtual, np.newaxis] * delta[is_virtual]
+
+        node_locations = np.vstack((treenode_locations[is_inside],
+                virtual_locations))
+        node_is_root = np.concatenate((is_root[is_inside],
+                np.zeros(len(virtual_locations), dtype=bool)))
+        nodes = unique_rows(np.column_stack((to_screen(node_locations),
+                node_is_root)))
+        for xs, ys, root in nodes:
+            if root:
+                pen, brush = root_pen, root_brush
+            else:
+                pen, brush = node_pen, node_brush
+            draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), pen, brush)
+
+    connectors = node_data[1]
+    if len(connectors):
+        connector_locations = np.array([c[1:4] for c in connectors],
+                dtype=np.float64)
+        connector_inside = inside_mask(connector_locations)
+        connector_screen = to_screen(connector_locations)
+
+        # Links are drawn from visible connectors to their partners, if the
+        # partner is part of the result.
+        relation_names = dict((int(k), v) for k, v in
+                (node_data[4] if len(node_data) > 4 and node_data[4] else {}).items())
+        node_index = dict(zip(treenode_ids.tolist(), range(len(treenode_ids))))
+        treenode_screen = to_screen(treenode_locations).tolist()
+        for i in np.flatnonzero(connector_inside):
+            cx, cy = connector_screen[i].tolist()
+            for link in connectors[i][7]:
+                partner_index = node_index.get(link[0])
+                if partner_index is None:
+                    continue
+                px, py = treenode_screen[partner_index]
+                pen = link_pens.get(relation_names.get(link[1]), default_link_pen)
+                draw.line((cx, cy, px, py), pen)
 
-        # Render node or virtual node
-        draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), pen, brush)
+        for xs, ys in unique_rows(connector_screen[connector_inside]):
+            draw.ellipse((xs - hr, ys - hr, xs + hr, ys + hr), connector_pen,
+                    connector_brush)
 
     draw.flush()
 
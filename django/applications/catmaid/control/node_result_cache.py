@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import math
+import threading
+import time
+
+from collections import OrderedDict, deque
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger(__name__)
+
+
+# The database notification channel that tracing data changes are reported on.
+# See the mark_node_query_cache_dirty() database function.
+NODE_EDIT_CHANNEL = 'catmaid_node_edits'
+
+# The database setting that enables edit notifications for a connection. It is
+# set for all connections of processes that use the node result cache.
+NODE_EDIT_NOTIFY_SETTING = 'catmaid.notify_node_edits'
+
+# The number of recent invalidations that are remembered to detect results
+# that were computed before an invalidation, but are stored after it.
+MAX_RECENT_INVALIDATIONS = 1000
+
+
+def enable_node_edit_notifications(sender, connection, **kwargs):
+    """Make the database send edit notifications for changes done through the
+    passed in connection. This is meant to be a connection_created signal
+    handler.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT set_config(%s, 'on', false)",
+            (NODE_EDIT_NOTIFY_SETTING,))
+    cursor.close()
+
+
+class NodeEditListener(object):
+    """Listen for notifications about tracing data changes in the database,
+    using a dedicated database connection. Notifications are only sent for
+    committed transactions and in commit order.
+    """
+
+    def __init__(self, db_alias='default'):
+        self.db_alias = db_alias
+        self.connection = None
+
+    def connect(self):
+        db = connections[self.db_alias]
+        self.connection = db.get_new_connection(db.get_connection_params())
+        self.connection.autocommit = True
+        cursor = self.connection.cursor()
+        cursor.execute('LISTEN {}'.format(NODE_EDIT_CHANNEL))
+        cursor.close()
+
+    def close(self):
+        if self.connection:
+            try:
+                self.connection.close()
+            except Exception:
+                pass
+            self.connection = None
+
+    def poll(self):
+        """Return a list of (project_id, bounding box) tuples for all changes
+        that were committed since the last call. The bounding box is a list of
+        the form [min_x, min_y, min_z, max_x, max_y, max_z]. If it isn't known
+        what changed, e.g. because the listener just (re)connected or the
+        connection was lost, None is returned.
+        """
+        try:
+            if not self.connection:
+                self.connect()
+                return None
+            self.connection.poll()
+        except Exception as e:
+            logger.warning('Could not receive node edit notifications: {}'.format(e))
+            self.close()
+            return None
+
+        edits = []
+        while self.connection.notifies:
+            notification = self.connection.notifies.pop(0)
+            try:
+                edit = json.loads(notification.payload)
+                edits.append((edit['project_id'], edit['bb']))
+            except (ValueError, KeyError):
+                return None
+        return edits
+
+
+class NodeResultCache(object):
+    """A size bounded LRU cache for node query results in the memory of the
+    current process. Each entry is associated with a project and a bounding
+    box of the form [min_x, min_y, min_z, max_x, max_y, max_z]. Entries that
+    intersect with changed tracing data are removed as soon as the change is
+    reported by the database (see sync()). Every invalidation increments the
+    generation of the cache. A result computed while an invalidation is
+    received isn't stored if it is affected by it.
+    """
+
+    def __init__(self, max_size, max_age=None, quantization=None,
+            listener=None):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.quantization = quantization
+        self.listener = listener
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.generation = 0
+        self.recent_invalidations = deque(maxlen=MAX_RECENT_INVALIDATIONS)
+        self.lock = threading.RLock()
+
+    def quantize(self, params):
+        """Return a copy of the passed in node query parameters with the XY
+        extent of the bounding box expanded to the quantization grid, which
+        allows similar queries to share a result.
+        """
+        params = dict(params)
+        q = self.quantization
+        if q:
+            params['left'] = math.floor(params['left'] / q) * q
+            params['top'] = math.floor(params['top'] / q) * q
+            params['right'] = math.ceil(params['right'] / q) * q
+            params['bottom'] = math.ceil(params['bottom'] / q) * q
+        return params
+
+    def sync(self):
+        """Remove all entries that are affected by changes reported by the
+        database since the last call. If it isn't known what changed, all
+        entries are removed. Returns the current generation of the cache, which
+        should be passed to set() for results computed after this call.
+        """
+        with self.lock:
+            if self.listener:
+                edits = self.listener.poll()
+                if edits is None:
+                    self.clear()
+                else:
+                    for project_id, bb in edits:
+                        self.invalidate(project_id, bb)
+            return self.generation
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.max_age and \
+                    time.time() - entry[4] > self.max_age:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, size, project_id, bb, generation=None):
+        """Store a result. If <generation> is passed in, the result isn't
+        stored if it is affected by an invalidation after this generation.
+        """
+        if size > self.max_size:
+            return
+        with self.lock:
+            if generation is not None and \
+                    self.invalidated_since(generation, project_id, bb):
+                return
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, project_id, bb, time.time())
+            self.size += size
+            while self.size > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, project_id, bb=None):
+        """Remove all entries of the passed in project that intersect with the
+        bounding box <bb>, or all entries of the project if no bounding box is
+        passed in.
+        """
+        with self.lock:
+            self.generation += 1
+            self.recent_invalidations.append((self.generation, project_id, bb))
+            for key, entry in list(self.entries.items()):
+                if entry[2] != project_id:
+                    continue
+                if bb is None or intersects(entry[3], bb):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def invalidated_since(self, generation, project_id, bb):
+        """Test whether an invalidation after <generation> affects the passed
+        in project and bounding box.
+        """
+        with self.lock:
+            if generation == self.generation:
+                return False
+            # Older invalidations might have been forgotten already.
+            if not self.recent_invalidations or \
+                    self.recent_invalidations[0][0] > generation + 1:
+                return True
+            for g, p, b in reversed(self.recent_invalidations):
+                if g <= generation:
+                    break
+                if p is None or (p == project_id and
+                        (b is None or intersects(b, bb))):
+                    return True
+            return False
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.recent_invalidations.append((self.generation, None, None))
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.size -= entry[1]
+
+
+def intersects(a, b):
+    """Test whether two bounding boxes of the form [min_x, min_y, min_z, max_x,
+    max_y, max_z] intersect.
+    """
+    return a[0] <= b[3] and b[0] <= a[3] and \
+            a[1] <= b[4] and b[1] <= a[4] and \
+            a[2] <= b[5] and b[2] <= a[5]
+
+
+_node_result_cache = None
+
+
+def get_node_result_cache():
+    """Return the node result cache of this process or None if it is disabled
+    through the NODE_RESULT_CACHE_SIZE setting.
+    """
+    global _node_result_cache
+    max_size = getattr(settings, 'NODE_RESULT_CACHE_SIZE', 0)
+    if not max_size:
+        return None
+    if not _node_result_cache or _node_result_cache.max_size != max_size:
+        if _node_result_cache and _node_result_cache.listener:
+            _node_result_cache.listener.close()
+        _node_result_cache = NodeResultCache(max_size,
+                getattr(settings, 'NODE_RESULT_CACHE_MAX_AGE', None),
+                getattr(settings, 'NODE_RESULT_CACHE_QUANTIZATION', None),
+                NodeEditListener())
+    return _node_result_cache
@@ -1,10 +1,16 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import multiprocessing
+import numpy as np
+import os
+import tempfile
 
+from celery import group
 from celery.task import task
 from itertools import chain
-from django.db import connection, transaction
+from django.conf import settings
+from django.db import connection, connections, transaction
 from django.http import JsonResponse
 from django.utils.decorators import method_decorator
 
@@ -23,10 +29,29 @@ from catmaid.models import (NblastConfig, NblastSample, Project, PointSet,
         NblastSimilarity, PointCloud, UserRole)
 from catmaid.control.nat import (compute_scoring_matrix, nblast,
         test_r_environment, setup_r_environment)
+from catmaid.control.nblast import (NBLAST_BACKENDS,
+        DEFAULT_NBLAST_CANDIDATES, DEFAULT_NBLAST_TILE_SIZE,
+        DEFAULT_NBLAST_VOXEL_SIZE, assemble_tiles, delete_tiles,
+        find_candidate_skeletons, get_stored_tiles, get_tiles, store_tile)
 
 
 logger = logging.getLogger('__name__')
 
+NBLAST_SIMILARITY_STORAGE_TYPES = ('array', 'float32', 'float16')
+
+SIMILARITY_FILE_DTYPES = {
+    'float32': '<f4',
+    'float16': '<f2',
+}
+
+# The number of rows that are read at once when selecting parts of a
+# similarity matrix.
+SIMILARITY_READ_BATCH_SIZE = 256
+
+# Binary similarity matrices are stored as .npy files in this folder
+similarity_path = os.path.join(settings.MEDIA_ROOT,
+    settings.MEDIA_NBLAST_SUBDIRECTORY)
+
 
 def serialize_sample(sample):
     return {
@@ -64,10 +89,178 @@ def serialize_config(config, simple=False):
             'scoring': config.scoring,
             'resample_step': config.resample_step,
             'tangent_neighbors': config.tangent_neighbors,
+            'backend': config.backend,
         }
 
 
-def serialize_similarity(similarity):
+def get_similarity_file_path(similarity_id):
+    return os.path.join(similarity_path, 'similarity-{}.npy'.format(similarity_id))
+
+
+def get_similarity_file_dtype(similarity):
+    """Get the data type of the binary matrix of a similarity. Raw scores can
+    exceed the range of float16 (65504), which is therefore only used for
+    normalized scores. Raw scores are stored as float32 instead.
+    """
+    if similarity.storage == 'float16' and similarity.normalized == 'raw':
+        return SIMILARITY_FILE_DTYPES['float32']
+    return SIMILARITY_FILE_DTYPES[similarity.storage]
+
+
+def write_similarity_file(similarity, shape, fill):
+    """Write the matrix of a binary similarity using the passed in function,
+    which gets a writable memory-mapped array of the passed in shape. An
+    existing file of the similarity is only replaced once the new matrix is
+    complete, so readers never see a partially written matrix.
+    """
+    os.makedirs(similarity_path, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(suffix='.npy', dir=similarity_path)
+    os.close(fd)
+    try:
+        matrix = np.lib.format.open_memmap(tmp_path, mode='w+',
+                dtype=get_similarity_file_dtype(similarity), shape=shape)
+        fill(matrix)
+        matrix.flush()
+        del matrix
+        os.replace(tmp_path, get_similarity_file_path(similarity.id))
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+def delete_similarity_file(similarity_id):
+    path = get_similarity_file_path(similarity_id)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def on_similarity_delete(sender, instance, **kwargs):
+    """Remove the binary matrix file of a deleted similarity, once the
+    deletion is committed.
+    """
+    similarity_id = instance.id
+    transaction.on_commit(lambda: delete_similarity_file(similarity_id))
+
+
+def on_config_delete(sender, instance, **kwargs):
+    """Similarities of a configuration are deleted by the database along with
+    it, which doesn't send delete signals for them. Their binary matrix files
+    are removed once the deletion is committed.
+    """
+    similarity_ids = list(NblastSimilarity.objects.filter(
+            config_id=instance.id).values_list('id', flat=True))
+
+    def delete_files():
+        for similarity_id in similarity_ids:
+            delete_similarity_file(similarity_id)
+
+    transaction.on_commit(delete_files)
+
+
+def set_similarity_scoring(similarity, scores):
+    """Set the similarity matrix of a similarity, either as scoring array or in
+    a binary file, depending on the similarity's storage type. The similarity
+    itself isn't saved.
+    """
+    if similarity.storage == 'array':
+        similarity.scoring = scores.tolist() \
+                if isinstance(scores, np.ndarray) else scores
+        return
+
+    scores = np.asarray(scores, dtype=np.float32)
+    if scores.ndim != 2:
+        raise ValueError("Expected a two-dimensional similarity matrix")
+
+    def fill(matrix):
+        matrix[:] = scores
+
+    write_similarity_file(similarity, scores.shape, fill)
+    similarity.scoring = None
+
+
+def get_similarity_scoring(similarity):
+    """Return the similarity matrix of a similarity as array or None if it
+    isn't computed. Binary matrices are memory-mapped and only the parts that
+    are accessed are read from disk.
+    """
+    if similarity.storage == 'array':
+        if similarity.scoring is None:
+            return None
+        return np.asarray(similarity.scoring, dtype=np.float32)
+
+    path = get_similarity_file_path(similarity.id)
+    if not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+def _get_object_indices(object_ids, selected_ids, object_kind):
+    index = {}
+    for i, object_id in enumerate(object_ids):
+        index.setdefault(object_id, i)
+    try:
+        return [index[object_id] for object_id in selected_ids]
+    except KeyError as e:
+        raise ValueError("Unknown {} object: {}".format(object_kind, e.args[0]))
+
+
+def select_scoring(scoring, query_objects, target_objects, query_ids=None,
+        target_ids=None, row_offset=0, row_limit=None, top_k=None):
+    """Return a part of a similarity matrix. Rows and columns can be limited to
+    the passed in query and target object IDs and the resulting rows can be
+    paged through with <row_offset> and <row_limit>. Returns a dictionary with
+    the query object ID of each returned row in 'rows' and the target object ID
+    of each column in 'columns'. The scores are returned as 'scoring' matrix or,
+    if <top_k> is set, as 'top_matches' list with the <top_k> best [target ID,
+    score] pairs of each row, ordered by decreasing score.
+    """
+    if query_ids:
+        rows = _get_object_indices(query_objects, query_ids, 'query')
+    else:
+        rows = list(range(len(query_objects)))
+    rows = rows[row_offset:(row_offset + row_limit) if row_limit else None]
+
+    if target_ids:
+        columns = _get_object_indices(target_objects, target_ids, 'target')
+    else:
+        columns = None
+    column_ids = np.asarray(target_objects if columns is None else
+            [target_objects[c] for c in columns])
+
+    result = {
+        'rows': [query_objects[r] for r in rows],
+        'columns': column_ids.tolist(),
+    }
+    selected = []
+    for start in range(0, len(rows), SIMILARITY_READ_BATCH_SIZE):
+        # Only the selected rows are read from memory-mapped matrices
+        block = np.asarray(scoring[rows[start:start + SIMILARITY_READ_BATCH_SIZE]],
+                dtype=np.float64)
+        if columns is not None:
+            block = block[:, columns]
+        if top_k:
+            k = min(top_k, block.shape[1])
+            best = np.argsort(-block, axis=1, kind='mergesort')[:, :k]
+            for row, row_best in zip(block, best):
+                selected.append([[int(t), float(s)] for t, s in
+                        zip(column_ids[row_best], row[row_best])])
+        else:
+            selected.extend(block.tolist())
+
+    result['top_matches' if top_k else 'scoring'] = selected
+    return result
+
+
+def serialize_similarity(similarity, with_scoring=True):
+    if with_scoring and similarity.storage != 'array':
+        scoring = get_similarity_scoring(similarity)
+        scoring = None if scoring is None else \
+                np.asarray(scoring, dtype=np.float64).tolist()
+    elif with_scoring:
+        scoring = similarity.scoring
+    else:
+        scoring = None
+
     return {
         'id': similarity.id,
         'user_id': similarity.user_id,
@@ -76,13 +269,14 @@ def serialize_similarity(similarity):
         'config_id': similarity.config_id,
         'name': similarity.name,
         'status': similarity.status,
-        'scoring': similarity.scoring,
+        'scoring': scoring,
         'query_objects': similarity.query_objects,
         'target_objects': similarity.target_objects,
         'query_type': similarity.query_type_id,
         'target_type': similarity.target_type_id,
         'use_alpha': similarity.use_alpha,
         'normalized': similarity.normalized,
+        'storage': similarity.storage,
     }
 
 
@@ -138,12 +332,8 @@ class ConfigurationDetail(APIView):
         """
         can_edit_or_fail(request.user, config_id, 'nblast_config')
         config = NblastConfig.objects.get(pk=config_id, project_id=project_id)
-
-        cursor = connection.cursor()
-        cursor.execute("""
-            DELETE FROM nblast_config
-            WHERE project_id=%s AND id = %s
-        """, [project_id, config_id])
+        # Similarities of the configuration are deleted by the database.
+        config.delete()
 
         return JsonResponse({
             'deleted': True,
@@ -212,6 +402,13 @@ class ConfigurationList(APIView):
             required: false
             defaultValue: 20
             paramType: form
+          - name: backend
+            description: |
+              The NBLAST implementation to use with this configuration, either
+              "r" (nat.nblast through Rpy2) or "native" (NumPy, no R needed).
+            required: false
+            defaultValue: r
+            paramType: form
           - name: matching_skeleton_ids
             description: A list of matching skeleton IDs if <source> is not "data".
             required: false
@@ -241,6 +438,9 @@ class ConfigurationList(APIView):
         distance_breaks = get_request_list(request.data, 'distance_breaks', map_fn=float)
         dot_breaks = get_request_list(request.data, 'dot_breaks', map_fn=float)
         tangent_neighbors = int(request.data.get('tangent_neighbors', '20'))
+        backend = request.data.get('backend', 'r')
+        if backend not in NBLAST_BACKENDS:
+            raise ValueError("Unknown NBLAST backend: " + backend)
         matching_sample_id = int(request.data.get('matching_sample_id')) \
                 if 'matching_sample_id' in request.data else None
         random_sample_id = int(request.data.get('random_sample_id')) \
@@ -259,7 +459,7 @@ class ConfigurationList(APIView):
         if source == 'data':
             data = request.data['data']
             config = self.add_from_raw_data(data, distance_breaks, dot_breaks,
-                    matching_sample_id, random_sample_id)
+                    matching_sample_id, random_sample_id, backend=backend)
             return Response(serialize_config(config))
         elif source == 'request':
             matching_skeleton_ids = get_request_list(request.data,
@@ -280,7 +480,7 @@ class ConfigurationList(APIView):
 
             config = self.add_delayed(matching_skeleton_ids,
                     random_skeleton_ids, distance_breaks, dot_breaks,
-                    tangent_neighbors=tangent_neighbors)
+                    tangent_neighbors=tangent_neighbors, backend=backend)
             return Response(serialize_config(config))
         elif source == 'backend-random':
             matching_skeleton_ids = get_request_list(request.data,
@@ -299,7 +499,7 @@ class ConfigurationList(APIView):
             config = self.compute_random_and_add_delayed(
                 project_id, user_id, name, matching_skeleton_ids,
                 distance_breaks, dot_breaks, None, None,
-                n_random_skeletons, min_length, tangent_neighbors)
+                n_random_skeletons, min_length, tangent_neighbors, backend)
             return Response(serialize_config(config))
         else:
             raise ValueError("Unknown source: " + source)
@@ -307,7 +507,7 @@ class ConfigurationList(APIView):
     def add_from_raw_data(self, project_id, user_id, name, data,
             distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks, match_sample_id=None,
-            random_sample_id=None, tangent_neighbors=20):
+            random_sample_id=None, tangent_neighbors=20, backend='r'):
         """Add a scoring matrix based on the passed in array of arrays and
         dimensions.
         """
@@ -339,12 +539,12 @@ class ConfigurationList(APIView):
             user=user, name=name, status='complete',
             distance_breaks=distance_breaks, dot_breaks=dot_breaks,
             match_sample=match_sample, random_sample=random_sample,
-            scoring=None, tangent_neighbors=tangent_neighbors)
+            scoring=None, tangent_neighbors=tangent_neighbors, backend=backend)
 
     def add_delayed(self, project_id, user_id, name, matching_skeleton_ids,
             random_skeleton_ids, distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks, match_sample_id=None,
-            random_sample_id=None, tangent_neighbors=20):
+            random_sample_id=None, tangent_neighbors=20, backend='r'):
         """Create and queue a new Celery task to create the scoring matrix.
         """
         histogram = []
@@ -370,7 +570,7 @@ class ConfigurationList(APIView):
             user=user, name=name, status='queued',
             distance_breaks=distance_breaks, dot_breaks=dot_breaks,
             match_sample=match_sample, random_sample=random_sample,
-            scoring=None, tangent_neighbors=tangent_neighbors)
+            scoring=None, tangent_neighbors=tangent_neighbors, backend=backend)
 
         # Queue recomputation task
         task = recompute_config.delay(config.id)
@@ -380,7 +580,8 @@ class ConfigurationList(APIView):
     def compute_random_and_add_delayed(self, project_id, user_id, name,
             matching_skeleton_ids, distance_breaks=NblastConfigDefaultDistanceBreaks,
             dot_breaks=NblastConfigDefaultDotBreaks, match_sample_id=None,
-            random_sample_id=None, n_random_skeletons=5000, min_length=0, tangent_neighbors=20):
+            random_sample_id=None, n_random_skeletons=5000, min_length=0,
+            tangent_neighbors=20, backend='r'):
         """Select a random set of neurons, optionally of a minimum length and
         queue a job to compute the scoring matrix.
         """
@@ -446,7 +647,8 @@ class ConfigurationList(APIView):
                 user_id=user_id, name=name, status='queued',
                 distance_breaks=distance_breaks, dot_breaks=dot_breaks,
                 match_sample=match_sample, random_sample=random_sample,
-                scoring=None, tangent_neighbors=tangent_neighbors)
+                scoring=None, tangent_neighbors=tangent_neighbors,
+                backend=backend)
 
             transaction.on_commit(lambda: compute_nblast_config.delay(config.id,
                     user_id))
@@ -481,7 +683,8 @@ def compute_nblast_config(config_id, user_id):
         scoring_info = compute_scoring_matrix(config.project_id, user_id,
                 config.match_sample.sample_neurons, config.random_sample.sample_neurons,
                 config.distance_breaks, config.dot_breaks,
-                config.resample_step, config.tangent_neighbors)
+                config.resample_step, config.tangent_neighbors,
+                backend=config.backend)
 
         # Update config and samples
         if scoring_info['errors']:
@@ -556,52 +759,84 @@ def get_all_object_ids(project_id, user_id, object_type, min_nodes=500,
                 "isn't supported yet")
 
 
+def prepare_similarity(project_id, user_id, similarity_id):
+    """Mark a similarity as computing and fill in its query and target objects,
+    if not yet present. Returns the similarity. A ValueError is raised if its
+    configuration can't be used.
+    """
+    min_nodes = 500
+    min_soma_nodes = 20
+    soma_tags = ('soma',)
+
+    with transaction.atomic():
+        similarity = NblastSimilarity.objects.select_related('config').get(
+                project_id=project_id, pk=similarity_id)
+        similarity.status = 'computing'
+        similarity.save()
+
+    # Fill in object IDs, if not yet present
+    updated = False
+    if not similarity.query_objects:
+        similarity.query_objects = get_all_object_ids(project_id, user_id,
+                similarity.query_type_id, min_nodes, min_soma_nodes,
+                soma_tags)
+        updated = True
+    if not similarity.target_objects:
+        similarity.target_objects = get_all_object_ids(project_id, user_id,
+                similarity.target_type_id, min_nodes, min_soma_nodes,
+                soma_tags)
+        updated = True
+    if updated:
+        similarity.save()
+
+    config = similarity.config
+    if not config.status == 'complete':
+        raise ValueError("NBLAST config #" + config.id +
+            "isn't marked as complete")
+
+    # Make sure we have a scoring matrix
+    if not config.scoring:
+        raise ValueError("NBLAST config #" + config.id +
+            " doesn't have a computed scoring.")
+
+    return similarity
+
+
+def mark_similarity_failed(user_id, similarity_id):
+    """Set the status of a similarity to 'error' and notify the user."""
+    similarities = NblastSimilarity.objects.filter(pk=similarity_id)
+    if similarities:
+        similarity = similarities[0]
+        similarity.status = 'error'
+        similarity.save()
+
+        msg_user(user_id, 'similarity-update', {
+            'similarity_id': similarity.id,
+            'similarity_status': similarity.status,
+        })
+
+    import traceback
+    logger.info(traceback.format_exc())
+
+
 @task()
 def compute_nblast(project_id, user_id, similarity_id, remove_target_duplicates,
-        simplify=True, required_branches=10, use_cache=True):
+        simplify=True, required_branches=10, use_cache=True, tile_size=None,
+        use_subtasks=True, resume=True):
+    """Compute the similarity matrix of a similarity. If <tile_size> is
+    provided, the matrix is computed in tiles, see compute_nblast_tiled().
+    """
     try:
-        min_nodes = 500
-        min_soma_nodes = 20
-        soma_tags = ('soma',)
+        similarity = prepare_similarity(project_id, user_id, similarity_id)
 
-        with transaction.atomic():
-            similarity = NblastSimilarity.objects.select_related('config').get(
-                    project_id=project_id, pk=similarity_id)
-            similarity.status = 'computing'
-            similarity.save()
-
-        query_object_ids = similarity.query_objects
-        target_object_ids = similarity.target_objects
-
-        # Fill in object IDs, if not yet present
-        updated = False
-        if not query_object_ids:
-            query_object_ids = get_all_object_ids(project_id, user_id,
-                    similarity.query_type_id, min_nodes, min_soma_nodes,
-                    soma_tags)
-            similarity.query_objects = query_object_ids
-            updated = True
-        if not target_object_ids:
-            target_object_ids = get_all_object_ids(project_id, user_id,
-                    similarity.target_type_id, min_nodes, min_soma_nodes,
-                    soma_tags)
-            similarity.target_objects = target_object_ids
-            updated = True
-        if updated:
-            similarity.save()
+        if tile_size:
+            return compute_nblast_tiled(project_id, user_id, similarity,
+                    remove_target_duplicates, simplify, required_branches,
+                    tile_size, use_subtasks, resume)
 
         config = similarity.config
-        if not config.status == 'complete':
-            raise ValueError("NBLAST config #" + config.id +
-                "isn't marked as complete")
-
-        # Make sure we have a scoring matrix
-        if not config.scoring:
-            raise ValueError("NBLAST config #" + config.id +
-                " doesn't have a computed scoring.")
-
         scoring_info = nblast(project_id, user_id, config.id,
-                query_object_ids, target_object_ids,
+                similarity.query_objects, similarity.target_objects,
                 similarity.query_type_id, similarity.target_type_id,
                 normalized=similarity.normalized,
                 use_alpha=similarity.use_alpha,
@@ -614,7 +849,7 @@ def compute_nblast(project_id, user_id, similarity_id, remove_target_duplicates,
                     ', '.join(str(i) for i in scoring_info['errors'])))
         else:
             similarity.status = 'complete'
-            similarity.scoring = scoring_info['similarity']
+            set_similarity_scoring(similarity, scoring_info['similarity'])
             similarity.save()
 
         msg_user(user_id, 'similarity-update', {
@@ -624,21 +859,208 @@ def compute_nblast(project_id, user_id, similarity_id, remove_target_duplicates,
 
         return "Computed new NBLAST similarity for config {}".format(config.id)
     except:
-        similarities = NblastSimilarity.objects.filter(pk=similarity_id)
-        if similarities:
-            similarity = similarities[0]
-            similarity.status = 'error'
+        mark_similarity_failed(user_id, similarity_id)
+        return "Computing new NBLAST similarity failed"
+
+
+def compute_nblast_tiled(project_id, user_id, similarity,
+        remove_target_duplicates, simplify=True, required_branches=10,
+        tile_size=DEFAULT_NBLAST_TILE_SIZE, use_subtasks=True, resume=True,
+        n_jobs=1):
+    """Compute the similarity matrix of a prepared similarity in tiles of at
+    most <tile_size> query and target objects. Each tile is stored as soon as
+    it is computed. If <resume> is true, tiles that are already stored from an
+    earlier, interrupted run are kept and not computed again.
+
+    With <use_subtasks>, every tile is queued as its own Celery task and the
+    last finished task assembles the result. Otherwise all tiles are computed
+    in this process or, if <n_jobs> is larger than one, by a pool of processes.
+    A pool can't be used from a Celery worker.
+    """
+    query_ids = list(similarity.query_objects)
+    target_ids = list(similarity.target_objects)
+
+    # Unlike for a single computation, the target list of the similarity is
+    # updated if duplicates are removed, so that the columns of all tiles
+    # refer to the same targets. All-by-all computations are kept as they are.
+    if remove_target_duplicates and query_ids != target_ids and \
+            similarity.query_type_id == similarity.target_type_id:
+        query_id_set = set(query_ids)
+        unique_target_ids = [t for t in target_ids if t not in query_id_set]
+        if unique_target_ids != target_ids:
+            target_ids = unique_target_ids
+            similarity.target_objects = target_ids
             similarity.save()
 
-            msg_user(user_id, 'similarity-update', {
-                'similarity_id': similarity.id,
-                'similarity_status': similarity.status,
-            })
+    tiles = get_tiles(len(query_ids), len(target_ids), tile_size)
+    if resume:
+        delete_tiles(similarity.id, keep=tiles)
+        stored_tiles = get_stored_tiles(similarity.id)
+    else:
+        delete_tiles(similarity.id)
+        stored_tiles = set()
+    remaining_tiles = [t for t in tiles if t not in stored_tiles]
+    n_done = len(tiles) - len(remaining_tiles)
+
+    logger.debug('Computing {} of {} NBLAST tiles for similarity {}'.format(
+            len(remaining_tiles), len(tiles), similarity.id))
+    report_tile_progress(user_id, similarity.id, n_done, len(tiles))
+
+    if use_subtasks and remaining_tiles:
+        group(compute_nblast_tile.s(project_id, user_id, similarity.id, tile,
+                tile_size, simplify, required_branches)
+                for tile in remaining_tiles).apply_async()
+        return "Queued {} NBLAST tiles for similarity {}".format(
+                len(remaining_tiles), similarity.id)
+
+    for tile, scores in iterate_similarity_tiles(project_id, user_id,
+            similarity, remaining_tiles, simplify, required_branches, n_jobs):
+        store_tile(similarity.id, tile, scores)
+        n_done += 1
+        report_tile_progress(user_id, similarity.id, n_done, len(tiles))
+
+    if not finish_tiled_similarity(user_id, similarity.id, tile_size):
+        raise ValueError("Could not assemble similarity {}".format(similarity.id))
+
+    return "Computed NBLAST similarity {} in {} tiles".format(similarity.id,
+            len(tiles))
+
+
+def compute_similarity_tile(project_id, user_id, similarity, tile,
+        simplify=True, required_branches=10):
+    """Return the scores of a single tile of a similarity matrix as array. The
+    tile is a (query_start, query_end, target_start, target_end) tuple.
+    """
+    query_start, query_end, target_start, target_end = tile
+    scoring_info = nblast(project_id, user_id, similarity.config_id,
+            similarity.query_objects[query_start:query_end],
+            similarity.target_objects[target_start:target_end],
+            similarity.query_type_id, similarity.target_type_id,
+            normalized=similarity.normalized, use_alpha=similarity.use_alpha,
+            remove_target_duplicates=False, simplify=simplify,
+            required_branches=required_branches)
 
-        import traceback
-        logger.info(traceback.format_exc())
+    if scoring_info.get('errors'):
+        raise ValueError("Errors during computation of tile {}: {}".format(
+                tile, ', '.join(str(i) for i in scoring_info['errors'])))
 
-        return "Computing new NBLAST similarity failed"
+    return np.asarray(scoring_info['similarity'], dtype=np.float32).reshape(
+            query_end - query_start, target_end - target_start)
+
+
+def _compute_similarity_tile_worker(args):
+    project_id, user_id, similarity_id, tile, simplify, required_branches = args
+    similarity = NblastSimilarity.objects.get(pk=similarity_id)
+    return tile, compute_similarity_tile(project_id, user_id, similarity, tile,
+            simplify, required_branches)
+
+
+def iterate_similarity_tiles(project_id, user_id, similarity, tiles,
+        simplify=True, required_branches=10, n_jobs=1):
+    """Yield a (tile, scores) tuple for each passed in tile. With more than
+    one job, tiles are computed by a pool of processes and are returned in the
+    order they are finished.
+    """
+    if n_jobs > 1 and len(tiles) > 1:
+        # Forked processes must not share the database connection of this
+        # process, each of them opens its own.
+        connections.close_all()
+        pool = multiprocessing.Pool(n_jobs)
+        try:
+            for result in pool.imap_unordered(_compute_similarity_tile_worker,
+                    [(project_id, user_id, similarity.id, tile, simplify,
+                        required_branches) for tile in tiles]):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for tile in tiles:
+            yield tile, compute_similarity_tile(project_id, user_id,
+                    similarity, tile, simplify, required_branches)
+
+
+def report_tile_progress(user_id, similarity_id, n_done, n_total):
+    msg_user(user_id, 'similarity-update', {
+        'similarity_id': similarity_id,
+        'similarity_status': 'computing',
+        'tiles_done': n_done,
+        'tiles_total': n_total,
+    })
+
+
+def finish_tiled_similarity(user_id, similarity_id, tile_size):
+    """Assemble the similarity matrix from its stored tiles, if all of them are
+    available. The tiles are removed afterwards. Returns whether the similarity
+    is complete.
+    """
+    with transaction.atomic():
+        # Lock the similarity, so that only one of multiple concurrently
+        # finishing tasks assembles the result.
+        similarity = NblastSimilarity.objects.select_for_update().get(
+                pk=similarity_id)
+        if similarity.status == 'complete':
+            return True
+        n_queries = len(similarity.query_objects)
+        n_targets = len(similarity.target_objects)
+        tiles = get_tiles(n_queries, n_targets, tile_size)
+        if not get_stored_tiles(similarity_id).issuperset(tiles):
+            return False
+
+        if similarity.storage == 'array':
+            similarity.scoring = assemble_tiles(similarity_id, n_queries,
+                    n_targets, tile_size).tolist()
+        else:
+            # Binary matrices are assembled in their file directly, without
+            # holding the complete matrix in memory.
+            write_similarity_file(similarity, (n_queries, n_targets),
+                    lambda matrix: assemble_tiles(similarity_id, n_queries,
+                        n_targets, tile_size, out=matrix))
+            similarity.scoring = None
+        similarity.status = 'complete'
+        similarity.save()
+        delete_tiles(similarity_id)
+
+    msg_user(user_id, 'similarity-update', {
+        'similarity_id': similarity.id,
+        'similarity_status': similarity.status,
+    })
+
+    return True
+
+
+@task()
+def compute_nblast_tile(project_id, user_id, similarity_id, tile, tile_size,
+        simplify=True, required_branches=10):
+    """Compute and store a single tile of a similarity matrix. The task that
+    stores the last missing tile assembles the complete similarity matrix.
+    """
+    try:
+        # Tuples are passed in as lists to Celery tasks
+        tile = tuple(tile)
+        similarity = NblastSimilarity.objects.get(project_id=project_id,
+                pk=similarity_id)
+        if similarity.status != 'computing':
+            return "Skipped NBLAST tile {} of {} similarity {}".format(tile,
+                    similarity.status, similarity_id)
+
+        scores = compute_similarity_tile(project_id, user_id, similarity, tile,
+                simplify, required_branches)
+        store_tile(similarity_id, tile, scores)
+
+        n_total = len(get_tiles(len(similarity.query_objects),
+                len(similarity.target_objects), tile_size))
+        report_tile_progress(user_id, similarity_id,
+                len(get_stored_tiles(similarity_id)), n_total)
+
+        if finish_tiled_similarity(user_id, similarity_id, tile_size):
+            return "Computed NBLAST similarity {}".format(similarity_id)
+
+        return "Computed NBLAST tile {} of similarity {}".format(tile,
+                similarity_id)
+    except:
+        mark_similarity_failed(user_id, similarity_id)
+        return "Computing NBLAST tile {} failed".format(tile)
 
 
 @api_view(['POST'])
@@ -731,6 +1153,27 @@ def compare_skeletons(request, project_id):
         type: boolean
         required: false
         defaultValue: 10
+      - name: tile_size
+        description: |
+          If provided, the similarity matrix is computed and stored in tiles of
+          at most this many query and target objects. This allows large
+          computations to be resumed.
+        type: integer
+        required: false
+      - name: use_subtasks
+        description: Whether tiles should be computed as separate asynchronous tasks.
+        type: boolean
+        required: false
+        defaultValue: true
+      - name: storage
+        description: |
+          How the similarity matrix is stored. Binary float32 and float16
+          matrices are stored in files, from which parts can be read
+          efficiently.
+        type: string
+        enum: [array, float32, float16]
+        required: false
+        defaultValue: array
     """
     name = request.POST.get('name', None)
     if not name:
@@ -746,6 +1189,15 @@ def compare_skeletons(request, project_id):
 
     simplify = get_request_bool(request.POST, 'simplify', True)
     required_branches = int(request.POST.get('required_branches', '10'))
+    tile_size = request.POST.get('tile_size')
+    tile_size = int(tile_size) if tile_size else None
+    if tile_size is not None and tile_size < 1:
+        raise ValueError("The tile size has to be positive")
+    use_subtasks = get_request_bool(request.POST, 'use_subtasks', True)
+    storage = request.POST.get('storage', 'array')
+    if storage not in NBLAST_SIMILARITY_STORAGE_TYPES:
+        raise ValueError("Need valid storage type ({})".format(
+                ', '.join(NBLAST_SIMILARITY_STORAGE_TYPES)))
 
     valid_type_ids = ('skeleton', 'pointcloud', 'pointset')
 
@@ -833,11 +1285,12 @@ def compare_skeletons(request, project_id):
                 user=request.user, name=name, status='queued', config_id=config_id,
                 query_objects=query_ids, target_objects=target_ids,
                 query_type_id=query_type_id, target_type_id=target_type_id,
-                normalized=normalized, use_alpha=use_alpha)
+                normalized=normalized, use_alpha=use_alpha, storage=storage)
         similarity.save()
 
     task = compute_nblast.delay(project_id, request.user.id, similarity.id,
-            remove_target_duplicates, simplify, required_branches)
+            remove_target_duplicates, simplify, required_branches,
+            tile_size=tile_size, use_subtasks=use_subtasks)
 
     return JsonResponse({
         'task_id': task.task_id,
@@ -845,6 +1298,173 @@ def compare_skeletons(request, project_id):
     })
 
 
+def find_nearest_skeletons(project_id, user_id, config, skeleton_id, k=10,
+        n_candidates=DEFAULT_NBLAST_CANDIDATES,
+        voxel_size=DEFAULT_NBLAST_VOXEL_SIZE, target_ids=None, min_nodes=500,
+        normalized='mean', use_alpha=False, simplify=True,
+        required_branches=10):
+    """Return a list of up to <k> (skeleton ID, score, overlap) tuples of the
+    skeletons that are most similar to the query skeleton, ordered by
+    decreasing NBLAST score. Rather than comparing the query with all
+    skeletons, at most <n_candidates> skeletons with the largest voxel overlap
+    with the query are scored, see find_candidate_skeletons().
+    """
+    candidates = find_candidate_skeletons(project_id, skeleton_id,
+            max(k, n_candidates), voxel_size, target_ids, min_nodes)
+    if not candidates:
+        return []
+    candidate_ids = [c[0] for c in candidates]
+
+    scoring_info = nblast(project_id, user_id, config.id, [skeleton_id],
+            candidate_ids, 'skeleton', 'skeleton', normalized=normalized,
+            use_alpha=use_alpha, remove_target_duplicates=False,
+            simplify=simplify, required_branches=required_branches)
+    if scoring_info.get('errors'):
+        raise ValueError("Errors during computation: {}".format(
+                ', '.join(str(i) for i in scoring_info['errors'])))
+
+    scores = np.asarray(scoring_info['similarity'], dtype=np.float64).ravel()
+    if len(scores) != len(candidates):
+        raise ValueError("Could not compute scores for all candidates")
+
+    best = np.argsort(-scores, kind='mergesort')[:k]
+    return [(candidates[i][0], float(scores[i]), float(candidates[i][1]))
+            for i in best]
+
+
+@api_view(['GET', 'POST'])
+@requires_user_role(UserRole.Browse)
+def nearest_skeletons(request, project_id):
+    """Find the skeletons that are most similar to a query skeleton.
+
+    Instead of comparing the query skeleton to all other skeletons, candidates
+    are preselected. These are skeletons with nodes within the bounding box of
+    the query skeleton, ranked by the fraction of coarse voxels they share with
+    it. Only these candidates are scored with NBLAST, using cached dotprops
+    where available. Matches are returned as list of objects with the fields
+    `skeleton_id`, `score` (NBLAST) and `overlap` (voxel overlap).
+    ---
+    parameters:
+      - name: project_id
+        description: Project to operate in
+        type: integer
+        paramType: path
+        required: true
+      - name: skeleton_id
+        description: The query skeleton
+        type: integer
+        paramType: form
+        required: true
+      - name: config_id
+        description: The NBLAST configuration to use
+        type: integer
+        paramType: form
+        required: true
+      - name: k
+        description: The number of matches to return
+        type: integer
+        paramType: form
+        required: false
+        defaultValue: 10
+      - name: n_candidates
+        description: The number of candidates to compute NBLAST scores for
+        type: integer
+        paramType: form
+        required: false
+        defaultValue: 200
+      - name: voxel_size
+        description: The edge length in nm of voxels used to find candidates
+        type: number
+        paramType: form
+        required: false
+        defaultValue: 5000
+      - name: target_ids
+        description: Consider only these skeletons as matches
+        type: array
+        items:
+          type: integer
+        paramType: form
+        required: false
+      - name: min_nodes
+        description: The minimum number of nodes of matching skeletons
+        type: integer
+        paramType: form
+        required: false
+        defaultValue: 500
+      - name: normalized
+        description: Whether and how scores should be normalized.
+        type: string
+        enum: [raw, normalized, mean]
+        paramType: form
+        required: false
+        defaultValue: mean
+      - name: use_alpha
+        description: Whether to consider local directions in the similarity computation
+        type: boolean
+        paramType: form
+        required: false
+        defaultValue: false
+      - name: simplify
+        description: Whether or not to simplify neurons and remove parts below a specified branch point level.
+        type: boolean
+        paramType: form
+        required: false
+        defaultValue: true
+      - name: required_branches
+        description: The required branch levels if neurons should be simplified.
+        type: integer
+        paramType: form
+        required: false
+        defaultValue: 10
+    """
+    if request.method == 'GET':
+        data = request.GET
+    elif request.method == 'POST':
+        data = request.POST
+    else:
+        raise ValueError("Invalid HTTP method: " + request.method)
+
+    skeleton_id = data.get('skeleton_id')
+    if not skeleton_id:
+        raise ValueError("Need query skeleton ID")
+    skeleton_id = int(skeleton_id)
+
+    config_id = data.get('config_id')
+    if not config_id:
+        raise ValueError("Need NBLAST configuration ID")
+    config = NblastConfig.objects.get(project_id=project_id, pk=int(config_id))
+    if not config.status == 'complete':
+        raise ValueError("NBLAST config #{} isn't marked as complete".format(
+                config.id))
+    if not config.scoring:
+        raise ValueError("NBLAST config #{} doesn't have a computed "
+                "scoring.".format(config.id))
+
+    k = int(data.get('k', 10))
+    n_candidates = int(data.get('n_candidates', DEFAULT_NBLAST_CANDIDATES))
+    voxel_size = float(data.get('voxel_size', DEFAULT_NBLAST_VOXEL_SIZE))
+    if k < 1 or n_candidates < 1 or voxel_size <= 0:
+        raise ValueError("Need positive k, n_candidates and voxel_size")
+
+    normalized = data.get('normalized', 'mean')
+    if normalized not in ('raw', 'normalized', 'mean'):
+        raise ValueError("Unknown normalization: {}".format(normalized))
+
+    matches = find_nearest_skeletons(project_id, request.user.id, config,
+            skeleton_id, k, n_candidates, voxel_size,
+            get_request_list(data, 'target_ids', map_fn=int),
+            int(data.get('min_nodes', 500)), normalized,
+            get_request_bool(data, 'use_alpha', False),
+            get_request_bool(data, 'simplify', True),
+            int(data.get('required_branches', 10)))
+
+    return JsonResponse([{
+        'skeleton_id': match_id,
+        'score': score,
+        'overlap': overlap,
+    } for match_id, score, overlap in matches], safe=False)
+
+
 class SimilarityList(APIView):
 
     @method_decorator(requires_user_role(UserRole.Browse))
@@ -862,8 +1482,15 @@ class SimilarityList(APIView):
             type: integer
             paramType: form
             required: false
+          - name: with_scoring
+            description: Whether to include the similarity matrices
+            type: boolean
+            paramType: form
+            required: false
+            defaultValue: true
         """
         config_id = request.query_params.get('config_id', None)
+        with_scoring = get_request_bool(request.query_params, 'with_scoring', True)
 
         params = {
             'project_id': int(project_id)
@@ -872,7 +1499,7 @@ class SimilarityList(APIView):
         if config_id:
             params['config_id'] = config_id
 
-        return JsonResponse([serialize_similarity(c) for c in
+        return JsonResponse([serialize_similarity(c, with_scoring) for c in
                 NblastSimilarity.objects.filter(**params)], safe=False)
 
 
@@ -881,9 +1508,92 @@ class SimilarityDetail(APIView):
     @method_decorator(requires_user_role(UserRole.Browse))
     def get(self, request, project_id, similarity_id):
         """Get a particular similarity query result.
+
+        By default the complete similarity matrix is returned as `scoring`.
+        Alternatively, only a part of it can be requested by selecting query
+        objects (rows) and target objects (columns) and by paging through the
+        selected rows. In this case, `scoring` contains only the selected part
+        and the object IDs of its rows and columns are returned as `rows` and
+        `columns`. If `top_k` is set, `top_matches` contains the best `top_k`
+        [target ID, score] pairs of each selected row, ordered by decreasing
+        score, instead of `scoring`.
+        ---
+        parameters:
+          - name: project_id
+            description: Project of the similarity
+            type: integer
+            paramType: path
+            required: true
+          - name: similarity_id
+            description: The similarity to return
+            type: integer
+            paramType: path
+            required: true
+          - name: with_scoring
+            description: Whether to include the similarity matrix
+            type: boolean
+            paramType: form
+            required: false
+            defaultValue: true
+          - name: query_ids
+            description: Return only the rows of these query objects
+            type: array
+            items:
+              type: integer
+            paramType: form
+            required: false
+          - name: target_ids
+            description: Return only the columns of these target objects
+            type: array
+            items:
+              type: integer
+            paramType: form
+            required: false
+          - name: row_offset
+            description: The first selected row to return
+            type: integer
+            paramType: form
+            required: false
+            defaultValue: 0
+          - name: row_limit
+            description: The maximum number of rows to return
+            type: integer
+            paramType: form
+            required: false
+          - name: top_k
+            description: Return only the best k matches of each row
+            type: integer
+            paramType: form
+            required: false
         """
         similarity = NblastSimilarity.objects.get(pk=similarity_id, project_id=project_id)
-        return JsonResponse(serialize_similarity(similarity))
+
+        params = request.query_params
+        query_ids = get_request_list(params, 'query_ids', map_fn=int)
+        target_ids = get_request_list(params, 'target_ids', map_fn=int)
+        row_offset = int(params.get('row_offset', 0))
+        row_limit = params.get('row_limit')
+        row_limit = int(row_limit) if row_limit else None
+        top_k = params.get('top_k')
+        top_k = int(top_k) if top_k else None
+        if row_offset < 0 or (row_limit is not None and row_limit < 1) or \
+                (top_k is not None and top_k < 1):
+            raise ValueError("Offsets need to be non-negative, limits positive")
+
+        partial = query_ids or target_ids or row_offset or row_limit or top_k
+        with_scoring = get_request_bool(params, 'with_scoring', True)
+        data = serialize_similarity(similarity, with_scoring and not partial)
+
+        if with_scoring and partial:
+            scoring = get_similarity_scoring(similarity)
+            if scoring is None:
+                raise ValueError("Similarity {} has no scoring".format(
+                        similarity.id))
+            data.update(select_scoring(scoring, similarity.query_objects,
+                    similarity.target_objects, query_ids, target_ids,
+                    row_offset, row_limit, top_k))
+
+        return JsonResponse(data)
 
     @method_decorator(requires_user_role(UserRole.Annotate))
     def delete(self, request, project_id, similarity_id):
@@ -891,12 +1601,7 @@ class SimilarityDetail(APIView):
         """
         can_edit_or_fail(request.user, similarity_id, 'nblast_similarity')
         similarity = NblastSimilarity.objects.get(pk=similarity_id, project_id=project_id)
-
-        cursor = connection.cursor()
-        cursor.execute("""
-            DELETE FROM nblast_similarity
-            WHERE project_id=%s AND id = %s
-        """, [project_id, similarity.id])
+        similarity.delete()
 
         return JsonResponse({
             'deleted': True,
@@ -907,13 +1612,23 @@ class SimilarityDetail(APIView):
 @requires_user_role(UserRole.QueueComputeTask)
 def recompute_similarity(request, project_id, similarity_id):
     """Recompute the similarity matrix of the passed in NBLAST configuration.
+    If a <tile_size> is passed in, the matrix is computed in tiles and tiles
+    that are stored from an earlier run with the same tile size are reused,
+    unless <resume> is false.
     """
     simplify = get_request_bool(request.GET, 'simplify', True)
     required_branches = int(request.GET.get('required_branches', '10'))
+    tile_size = request.GET.get('tile_size')
+    tile_size = int(tile_size) if tile_size else None
+    if tile_size is not None and tile_size < 1:
+        raise ValueError("The tile size has to be positive")
+    use_subtasks = get_request_bool(request.GET, 'use_subtasks', True)
+    resume = get_request_bool(request.GET, 'resume', True)
     can_edit_or_fail(request.user, similarity_id, 'nblast_similarity')
     task = compute_nblast.delay(project_id, request.user.id, similarity_id,
             remove_target_duplicates=True, simplify=simplify,
-            required_branches=required_branches)
+            required_branches=required_branches, tile_size=tile_size,
+            use_subtasks=use_subtasks, resume=resume)
 
     return JsonResponse({
         'status': 'queued',
@@ -34,6 +34,7 @@ from catmaid.control.common import (insert_into_log, get_class_to_id_map,
         get_request_list, Echo)
 from catmaid.control.link import LINK_TYPES
 from catmaid.control.neuron import _delete_if_empty
+from catmaid.control.bulkimport import import_swc_skeletons, parse_swc
 from catmaid.control.annotation import (annotations_for_skeleton,
         create_annotation_query, _annotate_entities, _update_neuron_annotations)
 from catmaid.control.review import get_review_status
@@ -2319,7 +2320,11 @@ def _update_samplers_in_merge(project_id, user_id, win_skeleton_id, lose_skeleto
 def import_skeleton(request, project_id=None):
     """Import a neuron modeled by a skeleton from an uploaded file.
 
-    Currently only SWC representation is supported.
+    Currently only SWC representation is supported. If more than one file is
+    uploaded or <bulk> is true, all files are imported at once with a faster
+    bulk import, each one as a new neuron named after the file. The result is
+    then a list of the return values below in the "skeletons" field, along
+    with the file name of each one.
     ---
     consumes: multipart/form-data
     parameters:
@@ -2338,6 +2343,13 @@ def import_skeleton(request, project_id=None):
         description: A skeleton representation file to import.
         paramType: body
         dataType: File
+      - name: bulk
+        description: >
+            Whether to use the bulk import, which is implied by uploading
+            more than one file. Can't be combined with neuron_id.
+        paramType: form
+        type: boolean
+        defaultValue: false
     type:
         neuron_id:
             type: integer
@@ -2358,19 +2370,30 @@ def import_skeleton(request, project_id=None):
     if neuron_id is not None:
         neuron_id = int(neuron_id)
     name = request.POST.get('name', None)
-
-    if len(request.FILES) == 1:
-        for uploadedfile in request.FILES.values():
-            if uploadedfile.size > settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE:
-                return HttpResponse('File too large. Maximum file size is {} bytes.'.format(settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE), status=413)
-
-            filename = uploadedfile.name
-            extension = filename.split('.')[-1].strip().lower()
-            if extension == 'swc':
-                swc_string = '\n'.join([line.decode('utf-8') for line in uploadedfile])
-                return import_skeleton_swc(request.user, project_id, swc_string, neuron_id, name)
-            else:
-                return HttpResponse('File type "{}" not understood. Known file types: swc'.format(extension), status=415)
+    bulk = get_request_bool(request.POST, 'bulk', False)
+
+    # Multiple files can be sent with separate field names or all with the
+    # same field name.
+    uploaded_files = [f for _, files in request.FILES.lists() for f in files]
+
+    if len(uploaded_files) > 1 or (bulk and uploaded_files):
+        if neuron_id is not None:
+            raise ValueError("Bulk imports can't use an existing neuron")
+        return import_skeletons_swc_bulk(request.user, project_id,
+                uploaded_files)
+
+    if len(uploaded_files) == 1:
+        uploadedfile = uploaded_files[0]
+        if uploadedfile.size > settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE:
+            return HttpResponse('File too large. Maximum file size is {} bytes.'.format(settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE), status=413)
+
+        filename = uploadedfile.name
+        extension = filename.split('.')[-1].strip().lower()
+        if extension == 'swc':
+            swc_string = '\n'.join([line.decode('utf-8') for line in uploadedfile])
+            return import_skeleton_swc(request.user, project_id, swc_string, neuron_id, name)
+        else:
+            return HttpResponse('File type "{}" not understood. Known file types: swc'.format(extension), status=415)
 
     return HttpResponseBadRequest('No file received.')
 
@@ -2410,6 +2433,39 @@ def import_skeleton_swc(user, project_id, swc_string, neuron_id=None, name=None)
         })
 
 
+def import_skeletons_swc_bulk(user, project_id, uploaded_files):
+    """Import each of the passed in uploaded SWC files as a new neuron, named
+    after the file, with a single COPY statement for all treenodes.
+    """
+    skeletons = []
+    filenames = []
+    for uploadedfile in uploaded_files:
+        if uploadedfile.size > settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE:
+            return HttpResponse('File too large. Maximum file size is {} bytes.'.format(settings.IMPORTED_SKELETON_FILE_MAXIMUM_SIZE), status=413)
+        filename = uploadedfile.name
+        name, _, extension = filename.rpartition('.')
+        if extension.strip().lower() != 'swc':
+            return HttpResponse('File type "{}" not understood. Known file types: swc'.format(extension), status=415)
+        swc_string = '\n'.join([line.decode('utf-8') for line in uploadedfile])
+        try:
+            skeletons.append((name, parse_swc(swc_string)))
+        except ValueError as e:
+            raise ValueError('{}: {}'.format(filename, e))
+        filenames.append(filename)
+
+    imported = import_swc_skeletons(user, project_id, skeletons)
+
+    return JsonResponse({
+        'skeletons': [{
+            'filename': filename,
+            'neuron_id': neuron_id,
+            'skeleton_id': skeleton_id,
+            'node_id_map': dict(zip(swc[0].tolist(), treenode_ids.tolist())),
+        } for filename, (_, swc), (neuron_id, skeleton_id, treenode_ids) in \
+                zip(filenames, skeletons, imported)]
+    })
+
+
 def _import_skeleton(user, project_id, arborescence, neuron_id=None, name=None):
     """Create a skeleton from a networkx directed tree.
 
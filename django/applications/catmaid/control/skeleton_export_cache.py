@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+
+
+def get_skeleton_export_etag(skeleton_id, export_type, options, version):
+    """Return a quoted entity tag for the export of a skeleton in the passed in
+    version. Export versions are unique across skeletons and change with every
+    edit of a skeleton, which makes the tag change as well.
+    """
+    key = '{}:{}:{}:{}'.format(export_type, skeleton_id, options, version)
+    return quote_etag(hashlib.md5(key.encode('utf-8')).hexdigest())
+
+
+def cached_skeleton_export(request, project_id, skeleton_id, export_type,
+        options, content_type, serialize):
+    """Return a response with the serialized export of a skeleton. If the
+    request's If-None-Match header matches the current entity tag of the
+    export, an empty 304 response is returned. If the SKELETON_EXPORT_CACHE
+    setting is enabled, serialized exports are stored in the database and
+    reused as long as the skeleton doesn't change. Otherwise or on a cache miss,
+    <serialize> is called to create the response content as bytes. The export
+    is identified by <export_type> and the <options> dict, which needs to
+    include everything that changes the result, including its format.
+    """
+    skeleton_id = int(skeleton_id)
+    options = json.dumps(options, sort_keys=True, separators=(',', ':'))
+    use_cache = getattr(settings, 'SKELETON_EXPORT_CACHE', False)
+
+    # Get the current version of the skeleton and, if cached, the data of the
+    # export in this version.
+    cursor = connection.cursor()
+    cursor.execute('''
+        SELECT v.version, {data}
+        FROM (
+            SELECT COALESCE(MAX(version), 0)
+            FROM skeleton_export_version
+            WHERE skeleton_id = %(skeleton_id)s
+        ) v(version)
+        {join}
+    '''.format(**{
+        'data': 'c.data' if use_cache else 'NULL',
+        'join': '''
+            LEFT JOIN skeleton_export_cache c
+                ON c.skeleton_id = %(skeleton_id)s
+                AND c.export_type = %(export_type)s
+                AND c.options = %(options)s
+                AND c.version = v.version
+        ''' if use_cache else '',
+    }), {
+        'skeleton_id': skeleton_id,
+        'export_type': export_type,
+        'options': options,
+    })
+    version, data = cursor.fetchone()
+
+    etag = get_skeleton_export_etag(skeleton_id, export_type, options, version)
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        if '*' in etags or etag in etags:
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+    if data is None:
+        data = serialize()
+        if use_cache:
+            # Entries are only replaced by newer versions, in case an older
+            # version is stored by a concurrent request.
+            cursor.execute('''
+                INSERT INTO skeleton_export_cache (project_id, skeleton_id,
+                    export_type, options, version, data)
+                VALUES (%(project_id)s, %(skeleton_id)s, %(export_type)s,
+                    %(options)s, %(version)s, %(data)s)
+                ON CONFLICT (skeleton_id, export_type, options)
+                DO UPDATE SET version = EXCLUDED.version, data = EXCLUDED.data,
+                    update_time = now()
+                WHERE skeleton_export_cache.version < EXCLUDED.version
+            ''', {
+                'project_id': project_id,
+                'skeleton_id': skeleton_id,
+                'export_type': export_type,
+                'options': options,
+                'version': version,
+                'data': data,
+            })
+    else:
+        data = bytes(data)
+
+    response = HttpResponse(data, content_type=content_type)
+    response['ETag'] = etag
+    return response
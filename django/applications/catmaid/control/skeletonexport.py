@@ -1,36 +1,37 @@
 # -*- coding: utf-8 -*-
 
-import array
 import json
 import logging
 import msgpack
 import networkx as nx
+import numpy as np
 import pytz
 import struct
 
 from functools import partial
-from collections import defaultdict, deque
-from math import sqrt
+from collections import defaultdict, deque, OrderedDict
 from datetime import datetime
 
 from django.core.serializers.json import DjangoJSONEncoder
 from django.db import connection
-from django.http import HttpResponse, JsonResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 
 from rest_framework.decorators import api_view
 
 from catmaid.models import UserRole, ClassInstance, Treenode, \
         TreenodeClassInstance, ConnectorClassInstance, Review
 from catmaid.control import export_NeuroML_Level3
+from catmaid.control.arbor import Arbor
 from catmaid.control.authentication import requires_user_role
 from catmaid.control.common import (get_relation_to_id_map, get_request_bool,
         get_request_list)
 from catmaid.control.review import get_treenodes_to_reviews, \
         get_treenodes_to_reviews_with_time
+from catmaid.control.skeleton_export_cache import cached_skeleton_export
 
 from psycopg2.extras import DateTimeTZRange
 
-from catmaid.control.tree_util import edge_count_to_root, partition
+from catmaid.control.tree_util import edge_count_to_root
 
 
 try:
@@ -52,6 +53,22 @@ def default(obj):
     raise TypeError('Not sure how to serialize object of type %s: %s' % (type(obj), obj,))
 
 
+# The number of skeletons that are loaded at once when streaming the compact
+# representation of multiple skeletons.
+COMPACT_SKELETON_STREAM_BATCH_SIZE = 100
+
+# Treenode columns that can be added as vertex attributes to neuroglancer
+# skeletons, along with their neuroglancer data type.
+NEUROGLANCER_VERTEX_ATTRIBUTES = OrderedDict((
+    ('radius', 'float32'),
+    ('confidence', 'uint8'),
+))
+
+# The number of skeletons that are loaded at once for the export to
+# neuroglancer's precomputed skeleton format.
+NEUROGLANCER_SKELETON_BATCH_SIZE = 1000
+
+
 def get_treenodes_qs(project_id=None, skeleton_id=None, with_labels=True):
     treenode_qs = Treenode.objects.filter(skeleton_id=skeleton_id)
     if with_labels:
@@ -67,102 +84,87 @@ def get_treenodes_qs(project_id=None, skeleton_id=None, with_labels=True):
     return treenode_qs, labels_qs, labelconnector_qs
 
 
-def get_swc_string(project_id, skeleton_id, treenodes_qs, linearize_ids=False,
-        soma_markers=None):
-    """
-    Structure identifiers (www.neuromorpho.org):
-    0 - undefined
-    1 - soma
-    2 - axon
-    3 - (basal) dendrite
-    4 - apical dendrite
-    5+ - custom
+def get_soma_node_ids(project_id, skeleton_ids, soma_markers):
+    """Return a dict that maps each of the passed in skeleton IDs to a list of
+    its nodes that are marked as soma by the passed in soma markers, either
+    "tag:soma" or "radius:<min radius>". Skeletons without such a node are not
+    included. The "root" marker doesn't need a database lookup and is ignored.
     """
-    # If there are soma tags asked for for soma marking, get them for the whole
-    # query set.
-    soma_node_id = None
-    if soma_markers:
-        radius_markers = list(filter(lambda x: x.startswith('radius:'),
-                soma_markers))
-        cursor = connection.cursor()
-        if 'tag:soma' in soma_markers:
-            # Get nodes tagges with soma
-            cursor.execute("""
-                SELECT DISTINCT t.id
-                FROM treenode_class_instance tci
-                JOIN class_instance ci
-                    ON ci.id = tci.class_instance_id
-                JOIN class c
-                    ON c.id = ci.class_id
-                JOIN relation r
-                    ON r.id = tci.relation_id
-                JOIN treenode t
-                    ON t.id = tci.treenode_id
-                WHERE c.project_id = %(project_id)s
-                    AND t.project_id = %(project_id)s
-                    AND t.skeleton_id = %(skeleton_id)s
-                    AND c.class_name = 'label'
-                    AND ci.name = 'soma'
-                    AND r.relation_name = 'labeled_as'
-            """, {
-                'project_id': project_id,
-                'skeleton_id': skeleton_id,
-            })
+    soma_nodes = defaultdict(list)
+    if not soma_markers:
+        return soma_nodes
 
-            soma_nodes = cursor.fetchall()
-            if len(soma_nodes) > 1:
-                raise ValueError("More than one node found that is tagged " +
-                        "\"soma\" in skeleton {}".format(skeleton_id))
-            elif len(soma_nodes) == 1:
-                soma_node_id = soma_nodes[0][0]
-        elif radius_markers:
-            radius_marker_parts = radius_markers[0].split(':')
-            if len(radius_marker_parts) != 2:
-                raise ValueError("Unexpected radius marker format: " +
-                        radius_markers[0])
-            radius = float(radius_marker_parts[1])
-
-            cursor.execute("""
-                SELECT id
-                FROM treenode t
-                WHERE t.project_id = %(project_id)s
-                    AND t.skeleton_id = %(skeleton_id)s
-                    AND t.radius >= %(radius)s
-            """, {
-                'project_id': project_id,
-                'skeleton_id': skeleton_id,
-                'radius': radius,
-            })
+    radius_markers = list(filter(lambda x: x.startswith('radius:'),
+            soma_markers))
+    cursor = connection.cursor()
+    if 'tag:soma' in soma_markers:
+        # Get nodes tagges with soma
+        cursor.execute("""
+            SELECT DISTINCT t.skeleton_id, t.id
+            FROM treenode_class_instance tci
+            JOIN class_instance ci
+                ON ci.id = tci.class_instance_id
+            JOIN class c
+                ON c.id = ci.class_id
+            JOIN relation r
+                ON r.id = tci.relation_id
+            JOIN treenode t
+                ON t.id = tci.treenode_id
+            WHERE c.project_id = %(project_id)s
+                AND t.project_id = %(project_id)s
+                AND t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+                AND c.class_name = 'label'
+                AND ci.name = 'soma'
+                AND r.relation_name = 'labeled_as'
+        """, {
+            'project_id': project_id,
+            'skeleton_ids': list(skeleton_ids),
+        })
+    elif radius_markers:
+        radius_marker_parts = radius_markers[0].split(':')
+        if len(radius_marker_parts) != 2:
+            raise ValueError("Unexpected radius marker format: " +
+                    radius_markers[0])
+        radius = float(radius_marker_parts[1])
 
-            soma_nodes = cursor.fetchall()
-            if len(soma_nodes) > 1:
-                raise ValueError("More than one node found with radius >= " +
-                        "{}nm in skeleton {}".format(radius, skeleton_id))
-            elif len(soma_nodes) == 1:
-                soma_node_id = soma_nodes[0][0]
+        cursor.execute("""
+            SELECT skeleton_id, id
+            FROM treenode t
+            WHERE t.project_id = %(project_id)s
+                AND t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+                AND t.radius >= %(radius)s
+        """, {
+            'project_id': project_id,
+            'skeleton_ids': list(skeleton_ids),
+            'radius': radius,
+        })
+    else:
+        return soma_nodes
+
+    for skeleton_id, node_id in cursor.fetchall():
+        soma_nodes[skeleton_id].append(node_id)
+    return soma_nodes
 
+
+def render_swc(rows, soma_node_id=None, mark_root_as_soma=False,
+        linearize_ids=False):
+    """Return the SWC representation of a skeleton, given as list of
+    (id, parent_id, x, y, z, radius) tuples. The soma structure identifier is
+    used for the node with the passed in ID or, if there is none and
+    <mark_root_as_soma> is true, for the root node.
+    """
     all_rows = []
-    for tn in treenodes_qs:
+    for node_id, parent_id, x, y, z, radius in rows:
         struct_identifier = 0
-        if soma_markers:
-            found = False
-            if soma_node_id:
-                if tn.id == soma_node_id:
-                    struct_identifier = 1
-                    found = True
-            elif 'root' in soma_markers:
-                if tn.parent_id is None:
-                    struct_identifier = 1
-                    found = True
-
-        swc_row = [tn.id]
-        swc_row.append(struct_identifier)
-        swc_row.append(tn.location_x)
-        swc_row.append(tn.location_y)
-        swc_row.append(tn.location_z)
-        swc_row.append(max(tn.radius, 0))
-        swc_row.append(-1 if tn.parent_id is None else tn.parent_id)
-        all_rows.append(swc_row)
+        if soma_node_id:
+            if node_id == soma_node_id:
+                struct_identifier = 1
+        elif mark_root_as_soma:
+            if parent_id is None:
+                struct_identifier = 1
+
+        all_rows.append([node_id, struct_identifier, x, y, z, max(radius, 0),
+                -1 if parent_id is None else parent_id])
 
     if linearize_ids:
         # Find successors for each node
@@ -190,10 +192,41 @@ def get_swc_string(project_id, skeleton_id, treenodes_qs, linearize_ids=False,
         # Sort based on node ID
         all_rows.sort(key=lambda tn: tn[0])
 
-    result = ""
-    for row in all_rows:
-        result += " ".join(map(str, row)) + "\n"
-    return result
+    return "".join(" ".join(map(str, row)) + "\n" for row in all_rows)
+
+
+def get_swc_string(project_id, skeleton_id, treenodes_qs, linearize_ids=False,
+        soma_markers=None):
+    """
+    Structure identifiers (www.neuromorpho.org):
+    0 - undefined
+    1 - soma
+    2 - axon
+    3 - (basal) dendrite
+    4 - apical dendrite
+    5+ - custom
+    """
+    # If there are soma tags asked for for soma marking, get them for the whole
+    # query set.
+    soma_node_id = None
+    if soma_markers:
+        soma_nodes = get_soma_node_ids(project_id, [skeleton_id],
+                soma_markers).get(int(skeleton_id), [])
+        if len(soma_nodes) > 1:
+            if 'tag:soma' in soma_markers:
+                raise ValueError("More than one node found that is tagged " +
+                        "\"soma\" in skeleton {}".format(skeleton_id))
+            radius_markers = [m for m in soma_markers if m.startswith('radius:')]
+            raise ValueError("More than one node found with radius >= " +
+                    "{}nm in skeleton {}".format(
+                    float(radius_markers[0].split(':')[1]), skeleton_id))
+        elif len(soma_nodes) == 1:
+            soma_node_id = soma_nodes[0]
+
+    rows = [(tn.id, tn.parent_id, tn.location_x, tn.location_y,
+            tn.location_z, tn.radius) for tn in treenodes_qs]
+    return render_swc(rows, soma_node_id,
+            bool(soma_markers) and 'root' in soma_markers, linearize_ids)
 
 def export_skeleton_response(request, project_id=None, skeleton_id=None, format=None):
     treenode_qs, labels_qs, labelconnector_qs = get_treenodes_qs(project_id, skeleton_id)
@@ -303,6 +336,26 @@ def compact_skeleton_detail(request, project_id=None, skeleton_id=None):
       type: boolean
       defaultValue: true
       paramType: form
+    - name: simplify_distance
+      description: |
+        If greater than zero, only a topology preserving subset of nodes is
+        returned: root, branch and end nodes, nodes with connectors or tags and
+        about one node per this distance (nm) along the cable. Parent IDs refer
+        to the nearest returned ancestor. Can't be combined with history.
+      required: false
+      type: number
+      defaultValue: 0
+      paramType: form
+    - name: simplify_tolerance
+      description: |
+        If greater than zero, only a topology preserving subset of nodes is
+        returned, like with simplify_distance, which deviates by no more than
+        this distance (nm) from the original cable. Can be combined with
+        simplify_distance, in which case nodes needed by either are returned.
+      required: false
+      type: number
+      defaultValue: 0
+      paramType: form
     type:
     - type: array
       items:
@@ -321,14 +374,21 @@ def compact_skeleton_detail(request, project_id=None, skeleton_id=None):
     with_user_info = get_request_bool(request.GET, "with_user_info", False)
     return_format = request.GET.get('format', 'json')
     ordered = get_request_bool(request.GET, "ordered", False)
+    simplify_distance, simplify_tolerance = get_simplify_options(request.GET)
+
+    if not with_annotations:
+        return _cached_compact_skeleton(request, project_id, skeleton_id,
+                with_connectors, with_tags, with_history, with_merge_history,
+                with_reviews, with_user_info, ordered, return_format,
+                simplify_distance, simplify_tolerance)
 
     result = _compact_skeleton(project_id, skeleton_id, with_connectors,
                                with_tags, with_history, with_merge_history,
                                with_reviews, with_annotations, with_user_info,
-                               ordered)
+                               ordered, simplify_distance, simplify_tolerance)
 
     if return_format == 'msgpack':
-        data = msgpack.packb(result)
+        data = msgpack.packb(result, default=default)
         return HttpResponse(data, content_type='application/octet-stream')
     else:
         return JsonResponse(result, safe=False,
@@ -359,11 +419,18 @@ def compact_skeleton(request, project_id=None, skeleton_id=None,
     with_annotations = get_request_bool(request.GET, "with_annotations", False)
     with_user_info = get_request_bool(request.GET, "with_user_info", False)
     ordered = get_request_bool(request.GET, "ordered", False)
+    simplify_distance, simplify_tolerance = get_simplify_options(request.GET)
+
+    if not with_annotations:
+        return _cached_compact_skeleton(request, project_id, skeleton_id,
+                with_connectors, with_tags, with_history, with_merge_history,
+                with_reviews, with_user_info, ordered, 'json',
+                simplify_distance, simplify_tolerance)
 
     result = _compact_skeleton(project_id, skeleton_id, with_connectors,
                                with_tags, with_history, with_merge_history,
                                with_reviews, with_annotations, with_user_info,
-                               ordered)
+                               ordered, simplify_distance, simplify_tolerance)
 
     return JsonResponse(result, safe=False,
             json_dumps_params={
@@ -372,6 +439,46 @@ def compact_skeleton(request, project_id=None, skeleton_id=None,
             })
 
 
+def _cached_compact_skeleton(request, project_id, skeleton_id, with_connectors,
+        with_tags, with_history, with_merge_history, with_reviews,
+        with_user_info, ordered, return_format='json', simplify_distance=None,
+        simplify_tolerance=None):
+    """Return a response with the compact representation of a skeleton, which
+    is taken from the skeleton export cache if possible. Annotations are not
+    supported, because the export version of a skeleton doesn't change with
+    its annotations. Simplified versions are cached separately for each set of
+    simplification parameters.
+    """
+    def serialize():
+        result = _compact_skeleton(project_id, skeleton_id, with_connectors,
+                with_tags, with_history, with_merge_history, with_reviews,
+                False, with_user_info, ordered, simplify_distance,
+                simplify_tolerance)
+        if return_format == 'msgpack':
+            return msgpack.packb(result, default=default)
+        else:
+            return json.dumps(result, separators=(',', ':'),
+                    default=default).encode('utf-8')
+
+    options = {
+        'with_connectors': with_connectors,
+        'with_tags': with_tags,
+        'with_history': with_history,
+        'with_merge_history': with_merge_history,
+        'with_reviews': with_reviews,
+        'with_user_info': with_user_info,
+        'ordered': ordered,
+        'format': return_format,
+        'simplify_distance': simplify_distance,
+        'simplify_tolerance': simplify_tolerance,
+    }
+    content_type = 'application/octet-stream' if return_format == 'msgpack' \
+            else 'application/json'
+
+    return cached_skeleton_export(request, project_id, skeleton_id,
+            'compact-skeleton', options, content_type, serialize)
+
+
 @api_view(['POST'])
 @requires_user_role(UserRole.Browse)
 def compact_skeleton_detail_many(request, project_id=None):
@@ -460,6 +567,51 @@ def compact_skeleton_detail_many(request, project_id=None):
       type: boolean
       defaultValue: "false"
       paramType: form
+    - name: format
+      description: |
+        Either "json" (default) or "msgpack".
+      required: false
+      type: string
+      defaultValue: json
+      paramType: form
+    - name: stream
+      description: |
+        Whether skeletons should be sent one at a time as soon as they are
+        loaded, rather than as a single object. Each skeleton is sent as
+        [skeleton_id, skeleton], either as a line of JSON text (newline
+        delimited JSON) or as msgpack data that is prefixed with its length
+        in bytes as unsigned 32 bit little-endian integer.
+      required: false
+      type: boolean
+      defaultValue: "false"
+      paramType: form
+    - name: batch_size
+      description: |
+        The number of skeletons to load at once when streaming.
+      required: false
+      type: integer
+      defaultValue: 100
+      paramType: form
+    - name: simplify_distance
+      description: |
+        If greater than zero, only a topology preserving subset of nodes is
+        returned: root, branch and end nodes, nodes with connectors or tags and
+        about one node per this distance (nm) along the cable. Parent IDs refer
+        to the nearest returned ancestor. Can't be combined with history.
+      required: false
+      type: number
+      defaultValue: 0
+      paramType: form
+    - name: simplify_tolerance
+      description: |
+        If greater than zero, only a topology preserving subset of nodes is
+        returned, like with simplify_distance, which deviates by no more than
+        this distance (nm) from the original cable. Can be combined with
+        simplify_distance, in which case nodes needed by either are returned.
+      required: false
+      type: number
+      defaultValue: 0
+      paramType: form
     type:
     - type: array
       items:
@@ -477,22 +629,50 @@ def compact_skeleton_detail_many(request, project_id=None):
     with_user_info = get_request_bool(request.POST, "with_user_info", False)
     return_format = request.POST.get('format', 'json')
     ordered = get_request_bool(request.POST, "ordered", False)
+    simplify_distance, simplify_tolerance = get_simplify_options(request.POST)
+
+    stream = get_request_bool(request.POST, "stream", False)
+    batch_size = int(request.POST.get('batch_size',
+            COMPACT_SKELETON_STREAM_BATCH_SIZE))
 
     if not skeleton_ids:
         raise ValueError("No skeleton IDs provided")
+    if batch_size < 1:
+        raise ValueError("The batch size has to be positive")
+
+    if stream:
+        # Check all skeletons before the response is started, errors can't
+        # be reported anymore afterwards.
+        skeleton_ids = list(OrderedDict.fromkeys(skeleton_ids))
+        existing = set(ClassInstance.objects.filter(pk__in=skeleton_ids) \
+                .values_list('id', flat=True))
+        missing = [skid for skid in skeleton_ids if skid not in existing]
+        if missing:
+            raise ValueError("Skeleton #%s doesn't exist" % missing[0])
+
+        skeletons = _stream_compact_skeletons(project_id, skeleton_ids,
+                batch_size, return_format, with_connectors, with_tags,
+                with_history, with_merge_history, with_reviews,
+                with_annotations, with_user_info, ordered, simplify_distance,
+                simplify_tolerance)
+        if return_format == 'msgpack':
+            return StreamingHttpResponse(skeletons,
+                    content_type='application/octet-stream')
+        else:
+            return StreamingHttpResponse(skeletons,
+                    content_type='application/x-ndjson')
 
-    skeletons = {}
-    for skeleton_id in skeleton_ids:
-        skeletons[skeleton_id] = _compact_skeleton(project_id, skeleton_id,
-                with_connectors, with_tags, with_history, with_merge_history,
-                with_reviews, with_annotations, with_user_info, ordered)
+    skeletons = _compact_skeletons(project_id, skeleton_ids, with_connectors,
+            with_tags, with_history, with_merge_history, with_reviews,
+            with_annotations, with_user_info, ordered, simplify_distance,
+            simplify_tolerance)
 
     result = {
         "skeletons": skeletons
     }
 
     if return_format == 'msgpack':
-        data = msgpack.packb(result)
+        data = msgpack.packb(result, default=default)
         return HttpResponse(data, content_type='application/octet-stream')
     else:
         return JsonResponse(result, safe=False, json_dumps_params={
@@ -501,10 +681,69 @@ def compact_skeleton_detail_many(request, project_id=None):
         })
 
 
+def _stream_compact_skeletons(project_id, skeleton_ids, batch_size,
+        return_format, *args):
+    """Generate the compact representation of the passed in skeletons one
+    skeleton at a time, either as newline delimited JSON or as length prefixed
+    msgpack frames. Skeletons are loaded in batches of <batch_size> skeletons,
+    which limits the memory use to that of a single batch. All other arguments
+    are passed to _compact_skeletons().
+    """
+    for i in range(0, len(skeleton_ids), batch_size):
+        batch = _compact_skeletons(project_id, skeleton_ids[i:i + batch_size],
+                *args)
+        while batch:
+            skeleton = batch.popitem(last=False)
+            if return_format == 'msgpack':
+                data = msgpack.packb(skeleton, default=default)
+                yield struct.pack('<I', len(data)) + data
+            else:
+                yield json.dumps(skeleton, separators=(',', ':'),
+                        default=default) + '\n'
+
+
+def get_simplify_options(params):
+    """Return the simplification distance and tolerance (in nanometers) from
+    the passed in request parameters, each one None if not set to a positive
+    value.
+    """
+    simplify_distance = float(params.get('simplify_distance', 0))
+    simplify_tolerance = float(params.get('simplify_tolerance', 0))
+    if simplify_distance < 0 or simplify_tolerance < 0:
+        raise ValueError("Simplification parameters can't be negative")
+    return simplify_distance or None, simplify_tolerance or None
+
+
+def _simplify_compact_nodes(nodes, keep_node_ids, simplify_distance=None,
+        simplify_tolerance=None):
+    """Return the passed in compact node rows (id, parent_id, user_id, x, y, z,
+    ...) reduced to a topology preserving simplification of their arbor, see
+    Arbor.simplify(). Nodes with an ID in <keep_node_ids> are always kept. The
+    parent ID of each returned node is replaced by the ID of its nearest kept
+    ancestor.
+    """
+    if not nodes:
+        return nodes
+    arbor = Arbor([row[0] for row in nodes], [row[1] for row in nodes],
+            [row[3:6] for row in nodes])
+    keep = arbor.indices(list(keep_node_ids), missing=-1)
+    mask, parent_index = arbor.simplify(keep[keep != -1],
+            simplify_distance, simplify_tolerance)
+    node_ids = arbor.node_ids.tolist()
+    parent_index = parent_index.tolist()
+    simplified = []
+    for i in np.flatnonzero(mask).tolist():
+        row = nodes[i]
+        parent = parent_index[i]
+        simplified.append((row[0], None if parent == -1 else node_ids[parent]) +
+                tuple(row[2:]))
+    return simplified
+
+
 def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         with_tags=True, with_history=False, with_merge_history=True,
         with_reviews=False, with_annotations=False, with_user_info=False,
-        ordered=False):
+        ordered=False, simplify_distance=None, simplify_tolerance=None):
     """Get a compact treenode representation of a skeleton, optionally with the
     history of individual nodes and connector, reviews and annotationss. Note
     this function is performance critical! Returns, in JSON:
@@ -523,35 +762,57 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
     data. This requires the client to do slightly more work, but unfortunately
     the original creation time is needed for data that was created without
     history tables enabled.
+
+    If <simplify_distance> or <simplify_tolerance> is set, only a topology
+    preserving subset of the nodes is returned, see _simplify_compact_nodes().
+    Nodes with connectors or tags are always part of it.
+    """
+    return _compact_skeletons(project_id, [skeleton_id], with_connectors,
+            with_tags, with_history, with_merge_history, with_reviews,
+            with_annotations, with_user_info, ordered, simplify_distance,
+            simplify_tolerance)[skeleton_id]
+
+
+def _compact_skeletons(project_id, skeleton_ids, with_connectors=True,
+        with_tags=True, with_history=False, with_merge_history=True,
+        with_reviews=False, with_annotations=False, with_user_info=False,
+        ordered=False, simplify_distance=None, simplify_tolerance=None):
+    """Get a compact treenode representation of multiple skeletons, see
+    _compact_skeleton(). Each type of data is retrieved with a single query for
+    all skeletons, whose result is partitioned by skeleton. Returns a dict that
+    maps each skeleton ID to its compact representation.
     """
+    simplify = simplify_distance or simplify_tolerance
+    if simplify and with_history:
+        raise ValueError("Simplified skeletons can't include history")
+
+    skeleton_ids = list(OrderedDict.fromkeys(int(skid) for skid in skeleton_ids))
+    skeletons = OrderedDict((skid, [[], [], defaultdict(list), [], []])
+            for skid in skeleton_ids)
 
     cursor = connection.cursor()
 
     if not with_history:
         cursor.execute('''
-            SELECT id, parent_id, user_id,
+            SELECT skeleton_id, id, parent_id, user_id,
                 location_x, location_y, location_z,
                 radius, confidence
             FROM treenode
-            WHERE skeleton_id = %(skeleton_id)s
+            WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
             {order}
         '''.format(**{
             'order': 'ORDER BY id' if ordered else '',
         }), {
-            'skeleton_id': skeleton_id,
+            'skeleton_ids': skeleton_ids,
         })
-
-        nodes = tuple(cursor.fetchall())
     else:
-        params = {
-            'skeleton_id': skeleton_id
-        }
         # Get present and historic nodes. If a historic validity range is empty
         # (e.g. due to a change in the same transaction), the edition time is
         # taken for both start and end validity, because this is what actually
         # happened.
         query = '''
             SELECT
+                treenode.skeleton_id,
                 treenode.id,
                 treenode.parent_id,
                 treenode.user_id,
@@ -564,9 +825,10 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 treenode.creation_time,
                 1 as ordering
             FROM treenode
-            WHERE treenode.skeleton_id = %(skeleton_id)s
+            WHERE treenode.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
             UNION ALL
             SELECT
+                treenode__history.skeleton_id,
                 treenode__history.id,
                 treenode__history.parent_id,
                 treenode__history.user_id,
@@ -579,14 +841,17 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 COALESCE(upper(treenode__history.sys_period), treenode__history.edition_time),
                 2 as ordering
             FROM treenode__history
-            WHERE treenode__history.skeleton_id = %(skeleton_id)s
+            WHERE treenode__history.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
         '''
 
+        # Historic versions of nodes that are now part of a requested skeleton
+        # are assigned to that skeleton.
         if with_merge_history:
             query =  '''
                 {}
                 UNION ALL
                 SELECT
+                    t.skeleton_id,
                     th.id,
                     th.parent_id,
                     th.user_id,
@@ -601,7 +866,7 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 FROM treenode__history th
                 JOIN treenode t
                     ON th.id = t.id
-                    AND t.skeleton_id = %(skeleton_id)s
+                    AND t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                     AND th.skeleton_id <> t.skeleton_id
             '''.format(query)
 
@@ -610,22 +875,24 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
             {order}
         """.format(**{
             'query': query,
-            'order': 'ORDER BY treenode.id, ordering' if ordered else 'ORDER BY ordering',
+            'order': 'ORDER BY 2, ordering' if ordered else 'ORDER BY ordering',
         })
 
-        cursor.execute(query, params)
-
-        nodes = tuple(cursor.fetchall())
+        cursor.execute(query, {
+            'skeleton_ids': skeleton_ids,
+        })
 
-    if 0 == len(nodes):
-        # Check if the skeleton exists
-        if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
-            raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
-        # Otherwise returns an empty list of nodes
+    for row in cursor.fetchall():
+        skeletons[row[0]][0].append(row[1:])
 
-    connectors = ()
-    tags = defaultdict(list)
-    reviews = []
+    empty_skeleton_ids = [skid for skid, s in skeletons.items() if not s[0]]
+    if empty_skeleton_ids:
+        # Check if the skeletons exist, otherwise return empty lists of nodes
+        existing = set(ClassInstance.objects.filter(pk__in=empty_skeleton_ids) \
+                .values_list('id', flat=True))
+        missing = [skid for skid in empty_skeleton_ids if skid not in existing]
+        if missing:
+            raise Exception("Skeleton #%s doesn't exist" % missing[0])
 
     if with_connectors or with_tags or with_annotations:
         # postgres is caching this query
@@ -641,23 +908,18 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         if not with_history:
             user_select = ', tc.user_id' if with_user_info else ''
             cursor.execute('''
-                SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
-                    c.location_x, c.location_y, c.location_z
+                SELECT tc.skeleton_id, tc.treenode_id, tc.connector_id,
+                    tc.relation_id, c.location_x, c.location_y, c.location_z
                     {user_select}
                 FROM treenode_connector tc,
                     connector c
-                WHERE tc.skeleton_id = %s
+                WHERE tc.skeleton_id = ANY(%s::bigint[])
                 AND tc.connector_id = c.id
                 AND (tc.relation_id = %s OR tc.relation_id = %s OR tc.relation_id = %s)
-            '''.format(user_select=user_select), (skeleton_id, pre, post, gj))
-
-            if with_user_info:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6]) for row in cursor.fetchall())
-            else:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5]) for row in cursor.fetchall())
+            '''.format(user_select=user_select), (skeleton_ids, pre, post, gj))
         else:
             params = {
-                'skeleton_id': skeleton_id,
+                'skeleton_ids': skeleton_ids,
                 'pre': pre,
                 'post': post,
                 'gj': gj
@@ -669,45 +931,45 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
             # edition time is taken for both start and end validity, because
             # this is what actually happened.
             query = '''
-                SELECT links.treenode_id, links.connector_id, links.relation_id,
-                        c.location_x, c.location_y, c.location_z,
-                        links.valid_from, links.valid_to
+                SELECT links.skeleton_id, links.treenode_id, links.connector_id,
+                        links.relation_id, c.location_x, c.location_y,
+                        c.location_z, links.valid_from, links.valid_to
                         {user_select}
                 FROM (
                     SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
                         tc.edition_time, tc.creation_time, tc.user_id,
-                        1 AS ordering
+                        tc.skeleton_id, 1 AS ordering
                     FROM treenode_connector tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
+                    WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                     UNION ALL
                     SELECT tc.treenode_id, tc.connector_id, tc.relation_id,
                         COALESCE(lower(tc.sys_period), tc.edition_time),
                         COALESCE(upper(tc.sys_period), tc.edition_time),
-                        tc.user_id, 2 AS ordering
+                        tc.user_id, tc.skeleton_id, 2 AS ordering
                     FROM treenode_connector__history tc
-                    WHERE tc.skeleton_id = %(skeleton_id)s
+                    WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                     {extra_query}
                     {order}
-                ) links(treenode_id, connector_id, relation_id, valid_from, valid_to, user_id)
+                ) links(treenode_id, connector_id, relation_id, valid_from,
+                        valid_to, user_id, skeleton_id)
                 JOIN connector__with_history c
                     ON links.connector_id = c.id
                 WHERE (links.relation_id = %(pre)s OR links.relation_id = %(post)s OR links.relation_id = %(gj)s)
             '''
 
             if with_merge_history:
-                merge_user_select = ', tch.user_id' if with_user_info else ''
                 extra_query = '''
                     UNION ALL
                     SELECT tch.treenode_id, tch.connector_id, tch.relation_id,
                         COALESCE(lower(tch.sys_period), tch.edition_time),
                         COALESCE(upper(tch.sys_period), tch.edition_time),
-                        tch.user_id, 3 AS ordering
+                        tch.user_id, tc.skeleton_id, 3 AS ordering
                     FROM treenode_connector__history tch
                     JOIN treenode_connector tc
                         ON tc.id = tch.id
-                        AND tc.skeleton_id = %(skeleton_id)s
+                        AND tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
                         AND tch.skeleton_id <> tc.skeleton_id
-                '''.format(user_select=merge_user_select)
+                '''
             else:
                 extra_query = ''
 
@@ -717,10 +979,9 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
                 'order': 'ORDER BY 1, ordering' if ordered else 'ORDER BY ordering',
             }), params)
 
-            if with_user_info:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6], row[7], row[8]) for row in cursor.fetchall())
-            else:
-                connectors = tuple((row[0], row[1], relation_index.get(row[2], -1), row[3], row[4], row[5], row[6], row[7]) for row in cursor.fetchall())
+        for row in cursor.fetchall():
+            skeletons[row[0]][1].append((row[1], row[2],
+                    relation_index.get(row[3], -1)) + row[4:])
 
     if with_tags:
         history_suffix = '__with_history' if with_history else ''
@@ -728,13 +989,13 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
         user_select = ', tci.user_id' if with_user_info else ''
         # Fetch all node tags
         cursor.execute('''
-            SELECT c.name, tci.treenode_id
+            SELECT t.skeleton_id, c.name, tci.treenode_id
                    {history_query}
                    {user_select}
             FROM treenode{history_suffix} t,
                  treenode_class_instance{history_suffix} tci,
                  class_instance{history_suffix} c
-            WHERE t.skeleton_id = %(skeleton_id)s
+            WHERE t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
               AND t.id = tci.treenode_id
               AND tci.relation_id = %(relation_id)s
               AND c.id = tci.class_instance_id
@@ -745,66 +1006,78 @@ def _compact_skeleton(project_id, skeleton_id, with_connectors=True,
             'user_select': user_select,
             'order': 'ORDER BY tci.treenode_id ASC' if ordered else '',
         }), {
-            'skeleton_id': skeleton_id,
+            'skeleton_ids': skeleton_ids,
             'relation_id': relations['labeled_as'],
         })
 
-        if with_history:
-            if with_user_info:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2], row[3]])
-            else:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2]])
+        if with_history or with_user_info:
+            for row in cursor.fetchall():
+                skeletons[row[0]][2][row[1]].append(list(row[2:]))
         else:
-            if with_user_info:
-                for row in cursor.fetchall():
-                    tags[row[0]].append([row[1], row[2]])
-            else:
-                for row in cursor.fetchall():
-                    tags[row[0]].append(row[1])
+            for row in cursor.fetchall():
+                skeletons[row[0]][2][row[1]].append(row[2])
 
     if with_reviews:
         r_history_query = ', r.review_time' if with_history else ''
         history_suffix = '__with_history' if with_history else ''
         cursor.execute("""
-            SELECT r.treenode_id, r.id, r.reviewer_id{0}
+            SELECT r.skeleton_id, r.treenode_id, r.id, r.reviewer_id{0}
             FROM review{1} r
-            WHERE r.skeleton_id = %s
-        """.format(r_history_query, history_suffix), [skeleton_id])
+            WHERE r.skeleton_id = ANY(%s::bigint[])
+        """.format(r_history_query, history_suffix), [skeleton_ids])
 
-        for r in cursor.fetchall():
-            reviews.append(r)
+        for row in cursor.fetchall():
+            skeletons[row[0]][3].append(row[1:])
 
-    annotations = []
     if with_annotations:
         history_suffix = '__with_history' if with_history else ''
         link_history_query = ', annotation_link.edition_time' if with_history else ''
         user_select = ', neuron_link.user_id' if with_user_info else ''
-        # Fetch all node tags
+        # Fetch all annotations of the neurons modeled by the skeletons
         cursor.execute('''
-            SELECT annotation_link.class_instance_b
+            SELECT neuron_link.class_instance_a,
+                   annotation_link.class_instance_b
                    {0}
                    {user_select}
             FROM class_instance_class_instance{1} neuron_link
             JOIN class_instance_class_instance{1} annotation_link
                 ON annotation_link.class_instance_a = neuron_link.class_instance_b
-            WHERE neuron_link.class_instance_a = %(skeleton_id)s
+            WHERE neuron_link.class_instance_a = ANY(%(skeleton_ids)s::bigint[])
               AND neuron_link.relation_id = %(model_of)s
               AND annotation_link.relation_id = %(annotated_with)s
         '''.format(link_history_query, history_suffix, user_select=user_select), {
-            'skeleton_id': skeleton_id,
+            'skeleton_ids': skeleton_ids,
             'model_of': relations['model_of'],
             'annotated_with': relations['annotated_with']
         })
 
-        annotations = list(cursor.fetchall())
+        for row in cursor.fetchall():
+            skeletons[row[0]][4].append(row[1:])
+
+    if simplify:
+        for skeleton in skeletons.values():
+            keep_node_ids = set(row[0] for row in skeleton[1])
+            for tagged in skeleton[2].values():
+                if with_user_info:
+                    keep_node_ids.update(t[0] for t in tagged)
+                else:
+                    keep_node_ids.update(tagged)
+            skeleton[0] = _simplify_compact_nodes(skeleton[0], keep_node_ids,
+                    simplify_distance, simplify_tolerance)
+            if skeleton[3]:
+                kept = set(row[0] for row in skeleton[0])
+                skeleton[3] = [row for row in skeleton[3] if row[0] in kept]
 
-    return [nodes, connectors, tags, reviews, annotations]
+    for skeleton in skeletons.values():
+        skeleton[0] = tuple(skeleton[0])
+        skeleton[1] = tuple(skeleton[1])
+
+    return skeletons
 
 
 def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
-        with_connectors=None, with_tags=None, with_time=None, ordered=False):
+        with_connectors=None, with_tags=None, with_time=None, ordered=False,
+        simplify_distance=None, simplify_tolerance=None):
     """
     Performance-critical function. Do not edit unless to improve performance.
     Returns, in JSON, [[nodes], [connections], {nodeID: [tags]}],
@@ -824,21 +1097,40 @@ def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
     and finally the two relations: first for the given skeleton_id and then for the other skeleton.
     The relation_id is 0 for pre and 1 for post. If <with_time> is truthy, each
     row will also contain both the creation time and edition time as last
-    elements.
+    elements. If <simplify_distance> or <simplify_tolerance> is set, only a
+    topology preserving subset of the nodes is returned, which includes all
+    nodes with connectors or tags, see _simplify_compact_nodes().
     """
-
-    # Sanitize
-    project_id = int(project_id)
     skeleton_id = int(skeleton_id)
+    arbor = _compact_arbors(project_id, [skeleton_id], with_nodes,
+            with_connectors, with_tags, with_time, ordered,
+            simplify_distance=simplify_distance,
+            simplify_tolerance=simplify_tolerance)[skeleton_id]
+    return arbor[0], arbor[1], arbor[2]
+
+
+def _compact_arbors(project_id, skeleton_ids, with_nodes=True,
+        with_connectors=True, with_tags=True, with_time=False, ordered=False,
+        with_minutes=False, simplify_distance=None, simplify_tolerance=None):
+    """Get the compact arbor representation of multiple skeletons, see
+    _compact_arbor(). Each type of data is retrieved with a single query for
+    all skeletons. In particular, the links of all connectors of all
+    skeletons are read only once, even if a connector is shared by many of the
+    requested skeletons, and paired up in one self-join. Returns a dict that
+    maps each skeleton ID to [nodes, connectors, tags]. If <with_minutes> is
+    truthy, a map of creation time bins (minutes) to node IDs is added, like
+    the one of _treenode_time_bins().
+    """
+    project_id = int(project_id)
+    skeleton_ids = list(OrderedDict.fromkeys(int(skid) for skid in skeleton_ids))
     with_nodes = int(with_nodes)
-    with_connectors  = int(with_connectors)
+    with_connectors = int(with_connectors)
     with_tags = int(with_tags)
 
-    cursor = connection.cursor()
+    arbors = OrderedDict((skid, [(), [], defaultdict(list)])
+            for skid in skeleton_ids)
 
-    nodes = ()
-    connectors = []
-    tags = defaultdict(list)
+    cursor = connection.cursor()
 
     if 0 != with_nodes:
         if with_time:
@@ -847,26 +1139,33 @@ def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
             extra_fields = ''
 
         cursor.execute('''
-            SELECT id, parent_id, user_id,
+            SELECT skeleton_id, id, parent_id, user_id,
                 location_x, location_y, location_z,
                 radius, confidence{extra_fields}
             FROM treenode
-            WHERE skeleton_id = %(skeleton_id)s
+            WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
             {order}
         '''.format(**{
             'extra_fields': extra_fields,
             'order': 'ORDER BY id' if ordered else ''
         }), {
-            'skeleton_id': skeleton_id
+            'skeleton_ids': skeleton_ids,
         })
 
-        nodes = tuple(cursor.fetchall())
-
-        if 0 == len(nodes):
-            # Check if the skeleton exists
-            if 0 == ClassInstance.objects.filter(pk=skeleton_id).count():
-                raise Exception("Skeleton #%s doesn't exist" % skeleton_id)
-            # Otherwise returns an empty list of nodes
+        nodes = defaultdict(list)
+        for row in cursor.fetchall():
+            nodes[row[0]].append(row[1:])
+        for skid, arbor in arbors.items():
+            arbor[0] = tuple(nodes[skid])
+
+        empty_skeleton_ids = [skid for skid, arbor in arbors.items() if not arbor[0]]
+        if empty_skeleton_ids:
+            # Check if the skeletons exist, otherwise return empty lists of nodes
+            existing = set(ClassInstance.objects.filter(pk__in=empty_skeleton_ids) \
+                    .values_list('id', flat=True))
+            missing = [skid for skid in empty_skeleton_ids if skid not in existing]
+            if missing:
+                raise Exception("Skeleton #%s doesn't exist" % missing[0])
 
     if 0 != with_connectors or 0 != with_tags:
         # postgres is caching this query
@@ -874,46 +1173,56 @@ def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
         relations = dict(cursor.fetchall())
 
     if 0 != with_connectors:
-        # Fetch all inputs and outputs
-
+        # Fetch all inputs and outputs. The links of each connector are read
+        # only once, regardless of how many requested skeletons share it.
         pre = relations['presynaptic_to']
         post = relations['postsynaptic_to']
 
         cursor.execute('''
-            SELECT tc1.treenode_id, tc1.confidence,
-                   tc1.connector_id,
-                   tc2.confidence, tc2.treenode_id, tc2.skeleton_id,
-                   tc1.relation_id, tc2.relation_id
-            FROM treenode_connector tc1,
-                 treenode_connector tc2
-            WHERE tc1.skeleton_id = %(skeleton_id)s
-              AND tc1.id != tc2.id
-              AND tc1.connector_id = tc2.connector_id
-              AND (tc1.relation_id = %(pre)s OR tc1.relation_id = %(post)s)
+            WITH links AS (
+                SELECT tc.id, tc.treenode_id, tc.confidence, tc.connector_id,
+                    tc.skeleton_id, tc.relation_id
+                FROM treenode_connector tc
+                WHERE tc.connector_id IN (
+                    SELECT DISTINCT connector_id
+                    FROM treenode_connector
+                    WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+                      AND (relation_id = %(pre)s OR relation_id = %(post)s))
+                  AND (tc.relation_id = %(pre)s OR tc.relation_id = %(post)s)
+            )
+            SELECT l1.skeleton_id, l1.treenode_id, l1.confidence,
+                   l1.connector_id,
+                   l2.confidence, l2.treenode_id, l2.skeleton_id,
+                   l1.relation_id, l2.relation_id
+            FROM links l1
+            JOIN links l2
+                ON l1.connector_id = l2.connector_id
+                AND l1.id != l2.id
+            WHERE l1.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
             {order}
         '''.format(**{
-            'order': 'ORDER BY tc1.treenode_id' if ordered else ''
+            'order': 'ORDER BY l1.treenode_id' if ordered else ''
         }), {
-            'skeleton_id': skeleton_id,
+            'skeleton_ids': skeleton_ids,
             'pre': pre,
             'post': post,
         })
 
         for row in cursor.fetchall():
             # Ignore all other kinds of relation pairs (there shouldn't be any)
-            if row[6] == pre and row[7] == post:
-                connectors.append((row[0], row[1], row[2], row[3], row[4], row[5], 0, 1))
-            elif row[6] == post and row[7] == pre:
-                connectors.append((row[0], row[1], row[2], row[3], row[4], row[5], 1, 0))
+            if row[7] == pre and row[8] == post:
+                arbors[row[0]][1].append((row[1], row[2], row[3], row[4], row[5], row[6], 0, 1))
+            elif row[7] == post and row[8] == pre:
+                arbors[row[0]][1].append((row[1], row[2], row[3], row[4], row[5], row[6], 1, 0))
 
     if 0 != with_tags:
         # Fetch all node tags
         cursor.execute('''
-            SELECT c.name, tci.treenode_id
+            SELECT t.skeleton_id, c.name, tci.treenode_id
             FROM treenode t,
                  treenode_class_instance tci,
                  class_instance c
-            WHERE t.skeleton_id = %(skeleton_id)s
+            WHERE t.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
               AND t.id = tci.treenode_id
               AND tci.relation_id = %(relation_id)s
               AND c.id = tci.class_instance_id
@@ -921,26 +1230,74 @@ def _compact_arbor(project_id=None, skeleton_id=None, with_nodes=None,
         '''.format(**{
             'order': 'ORDER BY tci.treenode_id' if ordered else '',
         }), {
-            'skeleton_id': skeleton_id,
+            'skeleton_ids': skeleton_ids,
             'relation_id': relations['labeled_as'],
         })
 
         for row in cursor.fetchall():
-            tags[row[0]].append(row[1])
+            arbors[row[0]][2][row[1]].append(row[2])
 
-    return nodes, connectors, tags
+    if simplify_distance or simplify_tolerance:
+        for arbor in arbors.values():
+            keep_node_ids = set(row[0] for row in arbor[1])
+            for tagged in arbor[2].values():
+                keep_node_ids.update(tagged)
+            arbor[0] = tuple(_simplify_compact_nodes(arbor[0], keep_node_ids,
+                    simplify_distance, simplify_tolerance))
+
+    if with_minutes:
+        cursor.execute('''
+            SELECT skeleton_id, id, EXTRACT(EPOCH FROM creation_time)
+            FROM treenode
+            WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+        ''', {
+            'skeleton_ids': skeleton_ids,
+        })
+
+        minutes = dict((skid, defaultdict(list)) for skid in skeleton_ids)
+        for row in cursor.fetchall():
+            minutes[row[0]][int(row[2] / 60)].append(row[1])
+
+        for skid, arbor in arbors.items():
+            if 0 != with_nodes and (simplify_distance or simplify_tolerance):
+                # Only refer to nodes of the simplified arbor
+                kept = set(row[0] for row in arbor[0])
+                skeleton_minutes = {}
+                for minute, node_ids in minutes[skid].items():
+                    node_ids = [n for n in node_ids if n in kept]
+                    if node_ids:
+                        skeleton_minutes[minute] = node_ids
+                arbor.append(skeleton_minutes)
+            else:
+                arbor.append(minutes[skid])
+
+    return arbors
 
 
 @requires_user_role(UserRole.Browse)
 def compact_arbor(request, project_id=None, skeleton_id=None, with_nodes=None, with_connectors=None, with_tags=None):
     with_time = get_request_bool(request.GET, "with_time", False)
     ordered = get_request_bool(request.GET, "ordered", False)
-    nodes, connectors, tags = _compact_arbor(project_id, skeleton_id,
-            with_nodes, with_connectors, with_tags, with_time, ordered)
-    return JsonResponse((nodes, connectors, tags), safe=False,
-            json_dumps_params={
-                'separators': (',', ':')
-            })
+    simplify_distance, simplify_tolerance = get_simplify_options(request.GET)
+
+    def serialize():
+        nodes, connectors, tags = _compact_arbor(project_id, skeleton_id,
+                with_nodes, with_connectors, with_tags, with_time, ordered,
+                simplify_distance, simplify_tolerance)
+        return json.dumps((nodes, connectors, tags), separators=(',', ':'),
+                cls=DjangoJSONEncoder).encode('utf-8')
+
+    options = {
+        'with_nodes': int(with_nodes),
+        'with_connectors': int(with_connectors),
+        'with_tags': int(with_tags),
+        'with_time': with_time,
+        'ordered': ordered,
+        'simplify_distance': simplify_distance,
+        'simplify_tolerance': simplify_tolerance,
+    }
+    return cached_skeleton_export(request, project_id, skeleton_id,
+            'compact-arbor', options, 'application/json', serialize)
 
 
 def _treenode_time_bins(skeleton_id=None):
@@ -966,13 +1323,146 @@ def treenode_time_bins(request, project_id=None, skeleton_id=None):
 def compact_arbor_with_minutes(request, project_id=None, skeleton_id=None,
         with_nodes=None, with_connectors=None, with_tags=None):
     ordered = get_request_bool(request.GET, "ordered", False)
-    nodes, connectors, tags = _compact_arbor(project_id, skeleton_id,
-            with_nodes, with_connectors, with_tags, ordered=ordered)
-    minutes = _treenode_time_bins(skeleton_id)
-    return JsonResponse((nodes, connectors, tags, minutes), safe=False,
-            json_dumps_params={
-                'separators': (',', ':')
-            })
+
+    def serialize():
+        nodes, connectors, tags = _compact_arbor(project_id, skeleton_id,
+                with_nodes, with_connectors, with_tags, ordered=ordered)
+        minutes = _treenode_time_bins(skeleton_id)
+        return json.dumps((nodes, connectors, tags, minutes),
+                separators=(',', ':'), cls=DjangoJSONEncoder).encode('utf-8')
+
+    options = {
+        'with_nodes': int(with_nodes),
+        'with_connectors': int(with_connectors),
+        'with_tags': int(with_tags),
+        'ordered': ordered,
+    }
+    return cached_skeleton_export(request, project_id, skeleton_id,
+            'compact-arbor-with-minutes', options, 'application/json',
+            serialize)
+
+
+@api_view(['POST'])
+@requires_user_role(UserRole.Browse)
+def compact_arbor_many(request, project_id=None):
+    """Get the compact arbor representation of a list of skeletons.
+
+    Returns {"skeletons": {skeleton_id: [[nodes], [connectors], {tag: [nodes]}]}}.
+    Each arbor has the same format as the one of the single skeleton
+    compact-arbor endpoint: connector rows contain the whole chain to the
+    partner skeleton, [treenode_id, confidence, connector_id, confidence,
+    treenode_id, skeleton_id, relation, relation], with relations being 0 for
+    pre and 1 for post. Connector partners of all skeletons are looked up
+    together, which is much faster than requesting densely connected skeletons
+    one by one.
+    ---
+    parameters:
+    - skeleton_ids:
+        description: List of skeletons
+        type: array
+        items:
+          type: integer
+        required: true
+    - name: with_nodes
+      description: |
+        Whether nodes should be returned.
+      required: false
+      type: boolean
+      defaultValue: "true"
+      paramType: form
+    - name: with_connectors
+      description: |
+        Whether connectors along with their partners should be returned.
+      required: false
+      type: boolean
+      defaultValue: "true"
+      paramType: form
+    - name: with_tags
+      description: |
+        Whether tags should be returned.
+      required: false
+      type: boolean
+      defaultValue: "true"
+      paramType: form
+    - name: with_time
+      description: |
+        Whether each node row should end with its creation and edition time.
+      required: false
+      type: boolean
+      defaultValue: "false"
+      paramType: form
+    - name: with_minutes
+      description: |
+        Whether each arbor should have a fourth element, which maps creation
+        time bins (minutes since epoch) to node IDs.
+      required: false
+      type: boolean
+      defaultValue: "false"
+      paramType: form
+    - name: ordered
+      description: |
+        Whether nodes, connectors and tags should be ordered by node ID.
+      required: false
+      type: boolean
+      defaultValue: "false"
+      paramType: form
+    - name: simplify_distance
+      description: |
+        If greater than zero, only a topology preserving subset of nodes is
+        returned, see the compact-detail endpoint.
+      required: false
+      type: number
+      defaultValue: 0
+      paramType: form
+    - name: simplify_tolerance
+      description: |
+        If greater than zero, only a topology preserving subset of nodes is
+        returned, see the compact-detail endpoint.
+      required: false
+      type: number
+      defaultValue: 0
+      paramType: form
+    - name: format
+      description: |
+        Either "json" (default) or "msgpack".
+      required: false
+      type: string
+      defaultValue: json
+      paramType: form
+    type:
+    - type: object
+      required: true
+    """
+    skeleton_ids = get_request_list(request.POST, "skeleton_ids", map_fn=int)
+    with_nodes = get_request_bool(request.POST, "with_nodes", True)
+    with_connectors = get_request_bool(request.POST, "with_connectors", True)
+    with_tags = get_request_bool(request.POST, "with_tags", True)
+    with_time = get_request_bool(request.POST, "with_time", False)
+    with_minutes = get_request_bool(request.POST, "with_minutes", False)
+    ordered = get_request_bool(request.POST, "ordered", False)
+    simplify_distance, simplify_tolerance = get_simplify_options(request.POST)
+    return_format = request.POST.get('format', 'json')
+
+    if not skeleton_ids:
+        raise ValueError("No skeleton IDs provided")
+
+    arbors = _compact_arbors(project_id, skeleton_ids, with_nodes,
+            with_connectors, with_tags, with_time, ordered, with_minutes,
+            simplify_distance, simplify_tolerance)
+
+    result = {
+        "skeletons": arbors
+    }
+
+    if return_format == 'msgpack':
+        # Encode values msgpack can't handle natively, e.g. times, the same
+        # way the JSON response does.
+        data = msgpack.packb(result, default=DjangoJSONEncoder().default)
+        return HttpResponse(data, content_type='application/octet-stream')
+    else:
+        return JsonResponse(result, safe=False, json_dumps_params={
+            'separators': (',', ':')
+        })
 
 
 # DEPRECATED. Will be removed.
@@ -1112,150 +1602,132 @@ def skeleton_with_metadata(request, project_id=None, skeleton_id=None):
         })
 
 def _measure_skeletons(skeleton_ids):
+    """Measure the passed in skeletons and return a dict that maps each
+    skeleton ID to a dict with the following measurements: raw_cable,
+    smooth_cable, principal_branch_cable, n_nodes, n_branch, n_ends, n_pre and
+    n_post. Skeletons without nodes are not included. All skeletons are
+    measured together using arrays of all their nodes.
+
+    Smoothing moves each slab node towards its neighbors, weighted by their
+    distance. Root, branch and end nodes don't move. The principal branch runs
+    from the end node with the most edges to the root to the root.
+    """
     if not skeleton_ids:
         raise Exception("Must provide the ID of at least one skeleton.")
 
-    skids_string = ",".join(map(str, skeleton_ids))
+    skeleton_ids = [int(skid) for skid in skeleton_ids]
 
     cursor = connection.cursor()
     cursor.execute('''
-    SELECT id, parent_id, skeleton_id, location_x, location_y, location_z
-    FROM treenode
-    WHERE skeleton_id IN (%s)
-    ''' % skids_string)
-
-    # TODO should be all done with numpy,
-    # TODO  by partitioning the skeleton into sequences of x,y,z representing the slabs
-    # TODO  and then convolving them.
-
-    class Skeleton():
-        def __init__(self):
-            self.nodes = {}
-            self.raw_cable = 0
-            self.smooth_cable = 0
-            self.principal_branch_cable = 0
-            self.n_ends = 0
-            self.n_branch = 0
-            self.n_pre = 0
-            self.n_post = 0
-
-    class Node():
-        def __init__(self, parent_id, x, y, z):
-            self.parent_id = parent_id
-            self.x = x
-            self.y = y
-            self.z = z
-            self.wx = x # weighted average of itself and neighbors
-            self.wy = y
-            self.wz = z
-            self.children = {} # node ID vs distance
-
-    skeletons = defaultdict(dict) # skeleton ID vs (node ID vs Node)
-    for row in cursor.fetchall():
-        skeleton = skeletons.get(row[2])
-        if not skeleton:
-            skeleton = Skeleton()
-            skeletons[row[2]] = skeleton
-        skeleton.nodes[row[0]] = Node(row[1], row[3], row[4], row[5])
-
-    for skeleton in skeletons.values():
-        nodes = skeleton.nodes
-        tree = nx.DiGraph()
-        root = None
-        # Accumulate children
-        for nodeID, node in nodes.items():
-            if not node.parent_id:
-                root = nodeID
-                continue
-            tree.add_edge(node.parent_id, nodeID)
-            parent = nodes[node.parent_id]
-            distance = sqrt(  pow(node.x - parent.x, 2)
-                            + pow(node.y - parent.y, 2)
-                            + pow(node.z - parent.z, 2))
-            parent.children[nodeID] = distance
-            # Measure raw cable, given that we have the parent already
-            skeleton.raw_cable += distance
-        # Utilize accumulated children and the distances to them
-        for nodeID, node in nodes.items():
-            # Count end nodes and branch nodes
-            n_children = len(node.children)
-            if not node.parent_id:
-                if 1 == n_children:
-                    skeleton.n_ends += 1
-                    continue
-                if n_children > 2:
-                    skeleton.n_branch += 1
-                    continue
-                # Else, if 2 == n_children, the root node is in the middle of the skeleton, being a slab node
-            elif 0 == n_children:
-                skeleton.n_ends += 1
-                continue
-            elif n_children > 1:
-                skeleton.n_branch += 1
-                continue
-            # Compute weighted position for slab nodes only
-            # (root, branch and end nodes do not move)
-            oids = node.children.copy()
-            if node.parent_id:
-                oids[node.parent_id] = skeleton.nodes[node.parent_id].children[nodeID]
-            sum_distances = sum(oids.values())
-            wx, wy, wz = 0, 0, 0
-            for oid, distance in oids.items():
-                other = skeleton.nodes[oid]
-                w = distance / sum_distances if sum_distances != 0 else 0
-                wx += other.x * w
-                wy += other.y * w
-                wz += other.z * w
-            node.wx = node.x * 0.4 + wx * 0.6
-            node.wy = node.y * 0.4 + wy * 0.6
-            node.wz = node.z * 0.4 + wz * 0.6
-        # Find out nodes that belong to the principal branch
-        principal_branch_nodes = set(sorted(partition(tree, root), key=len)[-1])
-        # Compute smoothed cable length, also for principal branch
-        for nodeID, node in nodes.items():
-            if not node.parent_id:
-                # root node
-                continue
-            parent = nodes[node.parent_id]
-            length = sqrt(  pow(node.wx - parent.wx, 2)
-                          + pow(node.wy - parent.wy, 2)
-                          + pow(node.wz - parent.wz, 2))
-            skeleton.smooth_cable += length
-            if nodeID in principal_branch_nodes:
-                skeleton.principal_branch_cable += length
-
-    # Count inputs
-    cursor.execute('''
-    SELECT tc.skeleton_id, count(tc.skeleton_id)
-    FROM treenode_connector tc,
-         relation r
-    WHERE tc.skeleton_id IN (%s)
-      AND tc.relation_id = r.id
-      AND r.relation_name = 'postsynaptic_to'
-    GROUP BY tc.skeleton_id
-    ''' % skids_string)
+        SELECT skeleton_id, id, parent_id,
+            location_x, location_y, location_z
+        FROM treenode
+        WHERE skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+    ''', {
+        'skeleton_ids': skeleton_ids,
+    })
+    rows = cursor.fetchall()
 
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_pre = row[1]
+    # All skeletons are measured as one arbor with one tree per skeleton
+    arbor = Arbor.from_rows(row[1:] for row in rows)
+    measured_skeleton_ids, skeleton_index = np.unique(
+            np.array([row[0] for row in rows], dtype=np.int64),
+            return_inverse=True)
+    n_skeletons = len(measured_skeleton_ids)
+    n = len(arbor)
+    parent_index = arbor.parent_index
+    has_parent = parent_index != -1
+    pos = arbor.positions if arbor.positions is not None else np.zeros((0, 3))
+
+    child = np.flatnonzero(has_parent)
+    parent = parent_index[has_parent]
+    edge_skeleton = skeleton_index[child]
+    lengths = np.linalg.norm(pos[child] - pos[parent], axis=1)
+    raw_cable = np.bincount(edge_skeleton, weights=lengths, minlength=n_skeletons)
+
+    # Classify nodes by their number of children. A root with two children
+    # is in the middle of a skeleton.
+    n_children = arbor.n_children
+    is_root = ~has_parent
+    is_end = np.where(is_root, n_children == 1, n_children == 0)
+    is_branch = np.where(is_root, n_children > 2, n_children > 1)
+    is_slab = np.where(is_root, n_children == 2, n_children == 1)
+    n_ends = np.bincount(skeleton_index[is_end], minlength=n_skeletons)
+    n_branch = np.bincount(skeleton_index[is_branch], minlength=n_skeletons)
+    n_nodes = np.bincount(skeleton_index, minlength=n_skeletons)
+
+    # Move slab nodes to a weighted average of themselves and their neighbors,
+    # where neighbors are weighted by their distance.
+    weight_sum = np.bincount(parent, weights=lengths, minlength=n) + \
+            np.bincount(child, weights=lengths, minlength=n)
+    smooth_pos = pos.copy()
+    move = is_slab & (weight_sum > 0)
+    for dim in range(3):
+        weighted = np.bincount(parent, weights=pos[child, dim] * lengths, minlength=n) + \
+                np.bincount(child, weights=pos[parent, dim] * lengths, minlength=n)
+        smooth_pos[move, dim] = pos[move, dim] * 0.4 + \
+                weighted[move] / weight_sum[move] * 0.6
+    smooth_lengths = np.zeros(n)
+    smooth_lengths[child] = np.linalg.norm(smooth_pos[child] - smooth_pos[parent], axis=1)
+    smooth_cable = np.bincount(skeleton_index, weights=smooth_lengths,
+            minlength=n_skeletons)
+
+    # The principal branch ends in the end node (without children) that is
+    # farthest away from the root, counted in edges.
+    depth = arbor.depths
+    smooth_distance = arbor.distances_to_root(smooth_lengths)
+    principal_branch_cable = np.zeros(n_skeletons)
+    leaves = np.flatnonzero(has_parent & (n_children == 0))
+    if len(leaves) > 0:
+        leaves = leaves[np.lexsort((-depth[leaves], skeleton_index[leaves]))]
+        leaf_skeletons = skeleton_index[leaves]
+        first = np.ones(len(leaves), dtype=bool)
+        first[1:] = leaf_skeletons[1:] != leaf_skeletons[:-1]
+        principal_branch_cable[leaf_skeletons[first]] = smooth_distance[leaves[first]]
+
+    skeletons = OrderedDict()
+    for i, skeleton_id in enumerate(measured_skeleton_ids.tolist()):
+        skeletons[skeleton_id] = {
+            'raw_cable': float(raw_cable[i]),
+            'smooth_cable': float(smooth_cable[i]),
+            'principal_branch_cable': float(principal_branch_cable[i]),
+            'n_nodes': int(n_nodes[i]),
+            'n_branch': int(n_branch[i]),
+            'n_ends': int(n_ends[i]),
+            'n_pre': 0,
+            'n_post': 0,
+        }
 
-    # Count outputs
+    # Count inputs (n_pre) and outputs (n_post), where each postsynaptic
+    # partner of a presynaptic link counts as an output.
     cursor.execute('''
-    SELECT tc1.skeleton_id, count(tc1.skeleton_id)
-    FROM treenode_connector tc1,
-         treenode_connector tc2,
-         relation r1,
-         relation r2
-    WHERE tc1.skeleton_id IN (%s)
-      AND tc1.connector_id = tc2.connector_id
-      AND tc1.relation_id = r1.id
-      AND r1.relation_name = 'presynaptic_to'
-      AND tc2.relation_id = r2.id
-      AND r2.relation_name = 'postsynaptic_to'
-      GROUP BY tc1.skeleton_id
-    ''' % skids_string)
+        SELECT tc.skeleton_id,
+            COUNT(*) FILTER (WHERE r.relation_name = 'postsynaptic_to'),
+            COALESCE(SUM(partners.n) FILTER (WHERE r.relation_name = 'presynaptic_to'), 0)
+        FROM treenode_connector tc
+        JOIN relation r
+            ON r.id = tc.relation_id
+        LEFT JOIN LATERAL (
+            SELECT COUNT(*)
+            FROM treenode_connector tc2
+            JOIN relation r2
+                ON r2.id = tc2.relation_id
+            WHERE tc2.connector_id = tc.connector_id
+              AND r2.relation_name = 'postsynaptic_to'
+        ) partners(n)
+            ON r.relation_name = 'presynaptic_to'
+        WHERE tc.skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+          AND r.relation_name IN ('presynaptic_to', 'postsynaptic_to')
+        GROUP BY tc.skeleton_id
+    ''', {
+        'skeleton_ids': skeleton_ids,
+    })
 
-    for row in cursor.fetchall():
-        skeletons[row[0]].n_post = row[1]
+    for skeleton_id, n_pre, n_post in cursor.fetchall():
+        skeleton = skeletons.get(skeleton_id)
+        if skeleton:
+            skeleton['n_pre'] = n_pre
+            skeleton['n_post'] = int(n_post)
 
     return skeletons
 
@@ -1264,8 +1736,10 @@ def _measure_skeletons(skeleton_ids):
 def measure_skeletons(request, project_id=None):
     skeleton_ids = tuple(int(v) for k,v in request.POST.items() if k.startswith('skeleton_ids['))
     def asRow(skid, sk):
-        return (skid, int(sk.raw_cable), int(sk.smooth_cable), sk.n_pre, sk.n_post, len(sk.nodes), sk.n_branch, sk.n_ends, sk.principal_branch_cable)
-    return JsonResponse([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).iteritems()], safe=False)
+        return (skid, int(sk['raw_cable']), int(sk['smooth_cable']),
+                sk['n_pre'], sk['n_post'], sk['n_nodes'], sk['n_branch'],
+                sk['n_ends'], sk['principal_branch_cable'])
+    return JsonResponse([asRow(skid, sk) for skid, sk in _measure_skeletons(skeleton_ids).items()], safe=False)
 
 
 def _skeleton_neuroml_cell(skeleton_id, preID, postID):
@@ -1736,39 +2210,122 @@ HAVING count(*) %s 1
 
     return JsonResponse(tuple(row[0] for row in cursor.fetchall()), safe=False)
 
-@api_view(['GET'])
-@requires_user_role(UserRole.Browse)
-def neuroglancer_skeleton(request, project_id=None, skeleton_id=None):
-    """Export a morphology-only skeleton in neuroglancer's binary format.
+def neuroglancer_skeleton_info(vertex_attributes=()):
+    """Return the info of a neuroglancer precomputed skeleton source, whose
+    skeletons include the passed in vertex attributes.
     """
-    cursor = connection.cursor()
-    cursor.execute("""
-        SELECT id, parent_id, location_x, location_y, location_z
-        FROM treenode
-        WHERE project_id = %s AND skeleton_id = %s
-    """, (project_id, skeleton_id))
+    return {
+        '@type': 'neuroglancer_skeletons',
+        'vertex_attributes': [{
+            'id': name,
+            'data_type': NEUROGLANCER_VERTEX_ATTRIBUTES[name],
+            'num_components': 1,
+        } for name in vertex_attributes],
+    }
 
-    rows = cursor.fetchall()
 
-    num_vertices = cursor.rowcount
-    id_map = {row[0]: i for i, row in enumerate(rows)}
+def _neuroglancer_skeletons(project_id, skeleton_ids, vertex_attributes=(),
+        batch_size=NEUROGLANCER_SKELETON_BATCH_SIZE):
+    """Yield a tuple of skeleton ID and the skeleton in neuroglancer's
+    precomputed skeleton format for each of the passed in skeletons that has
+    nodes. The nodes of <batch_size> skeletons are loaded at once and all
+    buffers of a batch are created as arrays.
+
+    Each skeleton consists of the number of vertices and edges as little endian
+    uint32 values, the vertex positions as float32 triples, the edges as pairs
+    of uint32 vertex indices (child, parent) and the values of each of the
+    requested vertex attributes.
+    """
+    for name in vertex_attributes:
+        if name not in NEUROGLANCER_VERTEX_ATTRIBUTES:
+            raise ValueError("Unknown vertex attribute: {}".format(name))
 
-    vertices = [row[2:] for row in rows]
-    edges = [[i, id_map[row[1]]] for i, row in enumerate(rows) if row[1] is not None]
+    dtype = [('skeleton_id', np.int64), ('id', np.int64),
+            ('parent_id', np.int64), ('x', np.float32), ('y', np.float32),
+            ('z', np.float32)] + [(name, NEUROGLANCER_VERTEX_ATTRIBUTES[name])
+            for name in vertex_attributes]
+    attribute_select = ''.join(', {}'.format(name) for name in vertex_attributes)
 
-    total_size = (16 + 12*num_vertices + 8*(num_vertices - 1))
-    buff = array.array('c', b'\x00'*total_size)
+    skeleton_ids = [int(skid) for skid in skeleton_ids]
+    cursor = connection.cursor()
+    for offset in range(0, len(skeleton_ids), batch_size):
+        cursor.execute('''
+            SELECT skeleton_id, id, COALESCE(parent_id, -1),
+                location_x, location_y, location_z {attribute_select}
+            FROM treenode
+            WHERE project_id = %(project_id)s
+              AND skeleton_id = ANY(%(skeleton_ids)s::bigint[])
+            ORDER BY skeleton_id, id
+        '''.format(attribute_select=attribute_select), {
+            'project_id': project_id,
+            'skeleton_ids': skeleton_ids[offset:offset + batch_size],
+        })
+        nodes = np.array(cursor.fetchall(), dtype=dtype)
+        if len(nodes) == 0:
+            continue
+
+        # Nodes are grouped by skeleton, vertex indices are relative to the
+        # first node of a skeleton.
+        arbor = Arbor(nodes['id'], nodes['parent_id'])
+        children = np.flatnonzero(arbor.parent_index != -1)
+        edges = np.column_stack((children, arbor.parent_index[children]))
+        vertices = np.column_stack((nodes['x'], nodes['y'], nodes['z'])).astype('<f4')
+        attributes = [nodes[name].astype(nodes.dtype[name].newbyteorder('<'))
+                for name in vertex_attributes]
+
+        batch_skeleton_ids = nodes['skeleton_id']
+        starts = np.flatnonzero(np.concatenate(([True],
+                batch_skeleton_ids[1:] != batch_skeleton_ids[:-1])))
+        ends = np.append(starts[1:], len(nodes))
+        edge_starts = np.searchsorted(children, starts)
+        edge_ends = np.searchsorted(children, ends)
+
+        for start, end, edge_start, edge_end in zip(starts, ends,
+                edge_starts, edge_ends):
+            skeleton_edges = (edges[edge_start:edge_end] - start).astype('<u4')
+            parts = [np.array([end - start, edge_end - edge_start], dtype='<u4'),
+                    vertices[start:end], skeleton_edges]
+            parts.extend(attribute[start:end] for attribute in attributes)
+            yield int(batch_skeleton_ids[start]), b''.join(part.tobytes() for part in parts)
+
+
+@api_view(['GET'])
+@requires_user_role(UserRole.Browse)
+def neuroglancer_skeleton(request, project_id=None, skeleton_id=None):
+    """Export a morphology-only skeleton in neuroglancer's binary format.
 
-    struct.pack_into('3I', buff, 0, num_vertices, 0, num_vertices - 1)
-    offset = 16
-    for v in vertices:
-        struct.pack_into('3f', buff, offset, *v)
-        offset += 12
-    for e in edges:
-        struct.pack_into('2I', buff, offset, *e)
-        offset += 8
+    The skeleton is returned in neuroglancer's precomputed skeleton format,
+    optionally including vertex attributes. A matching info file is returned by
+    neuroglancer_skeleton_info().
+    ---
+    parameters:
+    - name: project_id
+      description: Project of skeleton
+      type: integer
+      paramType: path
+      required: true
+    - name: skeleton_id
+      description: ID of the skeleton to export
+      type: integer
+      paramType: path
+      required: true
+    - name: vertex_attributes
+      description: |
+        Vertex attributes to add after the edges, in the passed in order.
+        Supported are "radius" (float32) and "confidence" (uint8).
+      type: array
+      items:
+        type: string
+      paramType: query
+      required: false
+    """
+    vertex_attributes = get_request_list(request.GET, 'vertex_attributes', [])
+    skeletons = list(_neuroglancer_skeletons(int(project_id),
+            [int(skeleton_id)], vertex_attributes))
+    if not skeletons:
+        raise ValueError("Skeleton {} has no nodes".format(skeleton_id))
 
-    return JsonResponse(buff, safe=False)
+    return HttpResponse(skeletons[0][1], content_type='application/octet-stream')
 
 @api_view(['GET'])
 @requires_user_role(UserRole.Browse)
@@ -2,40 +2,46 @@
 
 import logging
 import numpy as np
-from numpy import array, float32
-from numpy.linalg import norm
-import networkx as nx
 from collections import namedtuple
 
 logger = logging.getLogger(__name__)
 
 try:
+    from scipy.sparse import csr_matrix
     from scipy.sparse.csgraph import dijkstra
 except ImportError:
     logger.warning("CATMAID was unable to load the scipy module. "
         "Synapse clustering won't be available")
 
+from catmaid.control.arbor import load_arbor
 from catmaid.control.common import get_relation_to_id_map
-from catmaid.models import Treenode, TreenodeConnector, ClassInstance, Relation
+from catmaid.models import TreenodeConnector, ClassInstance, Relation
 
 
 def synapse_clustering( skeleton_id, h_list ):
 
-    Gwud = createSpatialGraphFromSkeletonID( skeleton_id )
+    arbor = createSpatialGraphFromSkeletonID( skeleton_id )
     synNodes, connector_ids, relations = synapseNodesFromSkeletonID( skeleton_id )
 
-    return tree_max_density(Gwud, synNodes, connector_ids, relations, h_list)
+    return tree_max_density(arbor, synNodes, connector_ids, relations, h_list)
 
 
-def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
-    """ Gwud: networkx graph were the edges are weighted by length, and undirected.
+def tree_max_density(arbor, synNodes, connector_ids, relations, h_list):
+    """ arbor: Arbor with node positions, its edges are weighted by length.
         synNodes: list of node IDs where there is a synapse.
         connector_ids: list of connector IDs.
         relations: list of the type of synapse, 'presynaptic_to' or 'postsynaptic_to'.
         The three lists are synchronized by index.
     """
 
-    D, id2index = distanceMatrix( Gwud, synNodes )
+    D, synIndices = distanceMatrix( arbor, synNodes )
+    nodeIndices = arbor.indices( synNodes )
+
+    # The neighbors of each node are its parent and its children
+    has_parent = arbor.parent_index != -1
+    child = np.flatnonzero(has_parent)
+    parent = arbor.parent_index[child]
+    self_index = np.arange(len(arbor))
 
     SynapseGroup = namedtuple("SynapseGroup", ['node_ids', 'connector_ids', 'relations', 'local_max'])
     synapseGroups = {}
@@ -43,70 +49,63 @@ def tree_max_density(Gwud, synNodes, connector_ids, relations, h_list):
     for h in h_list:
         expDh = np.exp(-1 * np.multiply(D, D) / (h * h) )
 
-        targLoc = {}            # targLocs hosts the final destination nodes of the hill climbing
-        densityField = {}            # densityField stores the height of the hill to be climbed
-        for startNode in synNodes:
-            if startNode not in targLoc:
-                currNode = startNode
-                allOnPath = []
-
-                if startNode not in densityField:
-                    densityField[startNode] = 0
-                    densityField[startNode] = np.sum(expDh[:,id2index[startNode]])
-
-                while True:
-                    allOnPath.append(currNode)
-
-                    #Make sure I have densityField of all neighbors for comparison
-                    if currNode in targLoc:
-                        currNode = targLoc[ currNode ] # Jump right to the end already.
-                        break
-
-                    for nn in Gwud.neighbors( currNode ):
-                        if nn not in densityField:
-                            densityField[nn] = 0
-                            densityField[nn] = np.sum(expDh[:,id2index[nn]])
-
-                    prevNode = currNode
-                    for nn in Gwud.neighbors( currNode ):
-                        if densityField[nn] > densityField[currNode]:
-                            currNode = nn
-
-                    if currNode == prevNode:
-                        break
-
-                for node in allOnPath:
-                    targLoc[node] = currNode
-
-        uniqueTargs = set(targLoc[node] for node in synNodes)
+        # The height of the hill to be climbed at each node
+        densityField = np.sum(expDh, axis=0)
+
+        # Every node climbs to its neighbor with the highest density, if
+        # that is higher than its own density. Find the densest child of each
+        # node first.
+        best = self_index.copy()
+        if len(child):
+            order = np.lexsort((densityField[child], parent))
+            last = np.flatnonzero(np.append(
+                    parent[order][1:] != parent[order][:-1], True))
+            best[parent[order][last]] = child[order][last]
+        best = np.where(densityField[best] > densityField, best, self_index)
+        parentDensity = np.where(has_parent,
+                densityField[arbor.parent_index], -np.inf)
+        best = np.where(parentDensity > densityField[best],
+                arbor.parent_index, best)
+
+        # targLoc hosts the final destination nodes of the hill climbing,
+        # found by pointer jumping to local density maxima.
+        targLoc = best
+        while True:
+            nextTargLoc = targLoc[targLoc]
+            if np.array_equal(nextTargLoc, targLoc):
+                break
+            targLoc = nextTargLoc
+
+        uniqueTargs = np.unique(targLoc[nodeIndices])
 
         loc2group = {}
 
         synapseGroups[h] = {}
-        for ind, val in enumerate(uniqueTargs):
+        for ind, val in enumerate(uniqueTargs.tolist()):
             loc2group[val] = ind
-            synapseGroups[h][ind] = SynapseGroup([], [], [], val)
+            synapseGroups[h][ind] = SynapseGroup([], [], [], int(arbor.node_ids[val]))
 
-        for ind, node in enumerate(synNodes):
-            gi = loc2group[targLoc[node]]
+        for ind, (node, index) in enumerate(zip(synNodes, targLoc[nodeIndices].tolist())):
+            gi = loc2group[index]
             synapseGroups[h][ gi ].node_ids.append( node )
             synapseGroups[h][ gi ].connector_ids.append( connector_ids[ind] )
             synapseGroups[h][ gi ].relations.append( relations[ind] )
 
     return synapseGroups
 
-def distanceMatrix( G, synNodes ):
-    """ Given a nx graph, produce an all to all distance dict via scipy sparse matrix black magic.
-     Also, you get in 'id2index' the the mapping from a node id to the index in matrix scaledDistance. """
-    dmat = {}
-    nodeList = tuple(G.nodes())
-    synNodes = set(synNodes)
-    synIndices = tuple(i for i,node in enumerate(nodeList) if node in synNodes)
+def distanceMatrix( arbor, synNodes ):
+    """ Given an arbor, produce the distances of the synapse nodes to all nodes
+    via a scipy sparse matrix of the edges weighted by their length. Also, you
+    get in 'synIndices' the arbor indices of the synapse nodes, one for each
+    row of the distance matrix. """
+    synIndices = np.unique(arbor.indices(synNodes))
+    child = np.flatnonzero(arbor.parent_index != -1)
+    edges = csr_matrix((arbor.edge_lengths()[child],
+            (child, arbor.parent_index[child])), shape=(len(arbor), len(arbor)))
 
-    dmat = dijkstra(nx.to_scipy_sparse_matrix(G, nodeList),
-            directed=False, indices=synIndices)
+    dmat = dijkstra(edges, directed=False, indices=synIndices)
 
-    return dmat, {node: i for i,node in enumerate(nodeList)}
+    return dmat, synIndices
 
 def countTargets( skeleton_id ):
     nTargets = {}
@@ -119,19 +118,9 @@ def countTargets( skeleton_id ):
     return nTargets
 
 def createSpatialGraphFromSkeletonID(sid):
-    # retrieve all nodes of the skeleton
-    treenode_qs = Treenode.objects.filter(skeleton_id=sid).values_list(
-        'id', 'parent_id', 'location_x', 'location_y', 'location_z')
-    # build the networkx graph from it
-    G = nx.Graph()
-    locations = {}
-    for tnid, parent_id, location_x, location_y, location_z in treenode_qs:
-        if parent_id:
-            G.add_edge(parent_id, tnid)
-        locations[tnid] = array((location_x, location_y, location_z), dtype=float32)
-    for iFrom, iTo in G.edges(data=False):
-        G[iFrom][iTo]['weight'] = norm(locations[iFrom] - locations[iTo])
-    return G
+    """ Return an arbor of all nodes of the skeleton, including their positions.
+    The length of its edges can be obtained from their node positions. """
+    return load_arbor(sid, with_positions=True)
 
 def synapseNodesFromSkeletonID(sid):
     sk = ClassInstance.objects.get(pk=sid)
@@ -6,7 +6,8 @@ from operator import itemgetter
 from networkx import Graph, DiGraph
 from collections import defaultdict
 from math import sqrt
-from itertools import islice
+from itertools import groupby
+from catmaid.control.arbor import Arbor
 from catmaid.models import Treenode
 
 
@@ -193,36 +194,25 @@ def cable_length(tree, locations):
 
 
 def lazy_load_trees(skeleton_ids, node_properties):
-    """ Return a lazy collection of pairs of (long, DiGraph)
-    representing (skeleton_id, tree).
+    """ Return a lazy collection of tuples of (long, Arbor, dict)
+    representing (skeleton_id, arbor, properties), where arbors include the
+    node positions.
     The node_properties is a list of strings, each being a name of a column
-    in the django model of the Treenode table that is not the treenode id, parent_id
-    or skeleton_id. """
+    in the django model of the Treenode table that is not the treenode id, parent_id,
+    skeleton_id or location. The properties dictionary maps each of them to the
+    list of values of all nodes, in the order of the arbor's node_ids. """
 
-    values_list = ('id', 'parent_id', 'skeleton_id')
+    values_list = ('id', 'parent_id', 'skeleton_id',
+            'location_x', 'location_y', 'location_z')
     props = tuple(set(node_properties) - set(values_list))
     values_list += props
 
     ts = Treenode.objects.filter(skeleton__in=skeleton_ids) \
             .order_by('skeleton') \
             .values_list(*values_list)
-    skid = None
-    tree = None
-    for t in ts:
-        if t[2] != skid:
-            if tree:
-                yield (skid, tree)
-            # Prepare for the next one
-            skid = t[2]
-            tree = DiGraph()
-
-        fields = {k: v for k,v in zip(props, islice(t, 3, 3 + len(props)))}
-        tree.add_node(t[0], fields)
-
-        if t[1]:
-            # From child to parent
-            tree.add_edge(t[0], t[1])
-
-    if tree:
-        yield (skid, tree)
-
+    for skid, rows in groupby(ts, itemgetter(2)):
+        rows = list(rows)
+        arbor = Arbor([t[0] for t in rows], [t[1] for t in rows],
+                [t[3:6] for t in rows])
+        fields = {k: [t[6 + i] for t in rows] for i, k in enumerate(props)}
+        yield (skid, arbor, fields)
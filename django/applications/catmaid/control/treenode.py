@@ -2,7 +2,6 @@
 
 import itertools
 import math
-import networkx as nx
 import re
 
 from collections import defaultdict
@@ -16,6 +15,7 @@ from rest_framework.decorators import api_view
 from catmaid import state
 from catmaid.models import UserRole, Treenode, ClassInstance, \
         TreenodeConnector, Location, SamplerInterval
+from catmaid.control.arbor import load_arbor
 from catmaid.control.authentication import requires_user_role, \
         can_edit_class_instance_or_fail, can_edit_or_fail
 from catmaid.control.common import (get_relation_to_id_map,
@@ -1128,23 +1128,9 @@ def update_confidence(request, project_id=None, treenode_id=None):
     else:
         raise ValueError('Failed to update confidence at treenode %s.' % tnid)
 
-def _skeleton_as_graph(skeleton_id):
-    # Fetch all nodes of the skeleton
-    cursor = connection.cursor()
-    cursor.execute('''
-        SELECT id, parent_id
-        FROM treenode
-        WHERE skeleton_id=%s''', [skeleton_id])
-    # Create a directed graph of the skeleton
-    graph = nx.DiGraph()
-    for row in cursor.fetchall():
-        # row[0]: id
-        # row[1]: parent_id
-        graph.add_node(row[0])
-        if row[1]:
-            # Create directional edge from parent to child
-            graph.add_edge(row[1], row[0])
-    return graph
+def _skeleton_as_arbor(skeleton_id):
+    """Return an arbor of the IDs of all nodes of a skeleton."""
+    return load_arbor(skeleton_id, with_positions=False)
 
 
 def _find_first_interesting_node(sequence):
@@ -1191,19 +1177,20 @@ def find_previous_branchnode_or_root(request, project_id=None, treenode_id=None)
         tnid = int(treenode_id)
         alt = 1 == int(request.POST['alt'])
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = _skeleton_as_arbor(skid)
+        n_children = arbor.n_children
         # Travel upstream until finding a parent node with more than one child
         # or reaching the root node
         seq = [] # Does not include the starting node tnid
+        index = arbor.index(tnid)
         while True:
-            parents = graph.predecessors(tnid)
-            if parents: # list of parents is not empty
-                tnid = parents[0] # Can ony have one parent
-                seq.append(tnid)
-                if 1 != len(graph.successors(tnid)):
-                    break # Found a branch node
-            else:
+            index = arbor.parent_index[index]
+            if -1 == index:
                 break # Found the root node
+            tnid = int(arbor.node_ids[index])
+            seq.append(tnid)
+            if 1 != n_children[index]:
+                break # Found a branch node
 
         if seq and alt:
             tnid = _find_first_interesting_node(seq)
@@ -1218,31 +1205,36 @@ def find_next_branchnode_or_end(request, project_id=None, treenode_id=None):
     try:
         tnid = int(treenode_id)
         skid = Treenode.objects.get(pk=tnid).skeleton_id
-        graph = _skeleton_as_graph(skid)
+        arbor = _skeleton_as_arbor(skid)
+        node_ids = arbor.node_ids
 
-        children = graph.successors(tnid)
+        children = arbor.children(arbor.index(tnid))
         branches = []
-        for child_node_id in children:
+        for child in children:
+            child_node_id = int(node_ids[child])
             # Travel downstream until finding a child node with more than one
             # child or reaching an end node
             seq = [child_node_id] # Does not include the starting node tnid
-            branch_end = child_node_id
+            branch_end = child
             while True:
-                branch_children = graph.successors(branch_end)
+                branch_children = arbor.children(branch_end)
                 if 1 == len(branch_children):
                     branch_end = branch_children[0]
-                    seq.append(branch_end)
+                    seq.append(int(node_ids[branch_end]))
                 else:
                     break # Found an end node or a branch node
 
             branches.append([child_node_id,
                              _find_first_interesting_node(seq),
-                             branch_end])
+                             int(node_ids[branch_end])])
 
-        # If more than one branch exists, sort based on downstream arbor size.
+        # If more than one branch exists, sort based on the number of
+        # downstream nodes that have children.
         if len(children) > 1:
+            has_children = arbor.n_children > 0
             branches.sort(
-                   key=lambda b: len(nx.algorithms.traversal.depth_first_search.dfs_successors(graph, b[0])),
+                   key=lambda b: (arbor.subtree_mask(arbor.index(b[0])) &
+                           has_children).sum(),
                    reverse=True)
 
         # Leaf nodes will have no branches
@@ -4,8 +4,9 @@ import json
 import pytz
 
 from datetime import datetime, timedelta
+import numpy as np
+
 from collections import defaultdict, namedtuple
-from networkx import connected_components
 from functools import partial
 
 from django.db.models import Count
@@ -18,24 +19,17 @@ from catmaid.control.authentication import requires_user_role
 from catmaid.control.tree_util import lazy_load_trees
 
 
-def _find_nearest(tree, nodes, loc1):
-    """ Returns a tuple of the closest node and the square of the distance. """
-    min_sqdist = float('inf')
-    for node in nodes:
-        loc2 = (tree.node[node]['location_x'],
-                tree.node[node]['location_y'],
-                tree.node[node]['location_z'])
-        dsq = pow(loc1[0] - loc2[0], 2) + pow(loc1[1] - loc2[1], 2) + pow(loc1[2] - loc2[2], 2)
-        if dsq < min_sqdist:
-            min_sqdist = dsq
-            closest = node
-
-    return node, min_sqdist
+def _find_nearest(arbor, indices, loc1):
+    """ Returns a tuple of the index of the closest node among the passed in
+    node indices and the square of the distance. """
+    dsq = np.sum((arbor.positions[indices] - loc1) ** 2, axis=1)
+    closest = int(np.argmin(dsq))
+    return int(indices[closest]), float(dsq[closest])
 
 def _parse_location(loc):
-    return map(float, loc[1:-1].split(','))
+    return list(map(float, loc[1:-1].split(',')))
 
-def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
+def _evaluate_epochs(epochs, skeleton_id, arbor, props, reviews, relations):
     """ Evaluate each epoch:
     1. Detect merges done by the reviewer: one of the two nodes is edited by the reviewer within the review epoch (but not both: could be a reroot then), with a corresponding join_skeleton entry in the log table. Perhaps the latter is enough, if the x,y,z of the log corresponds to that of the node (plus/minus a tiny bit, may have moved).
     2. Detect additions by the reviewer (a kind of merge), where the reviewer's node is newer than the other node, and it was created within the review epoch. These nodes would have been created and reviewed by the reviewer within the review epoch.
@@ -58,6 +52,9 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
     # List of EpochOps, indexed like epochs
     epoch_ops = []
 
+    user_ids = props['user_id']
+    creation_times = props['creation_time']
+
     # Synapses on the arbor: keyed by treenode_id
     all_synapses = defaultdict(list)
     for s in TreenodeConnector.objects.filter(skeleton=skeleton_id,
@@ -68,6 +65,7 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
     for epoch in epochs:
 
         reviewer_id, nodes = epoch
+        indices = arbor.indices(nodes)
 
         # Range of the review epoch
         start_date = datetime.max.replace(tzinfo=pytz.utc)
@@ -88,19 +86,18 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
         # Synapses, keyed by user and relation, created by a user other than the user who created the treenode, after the treeenode's creation time
         newer_synapses_count = defaultdict(partial(defaultdict, int))
 
-        for node in nodes:
-            props = tree.node[node]
+        for node, index in zip(nodes, indices.tolist()):
             # Find out review date range for this epoch, based on most recent
             # reviews
             tr = reviews[node][0].review_time
             start_date = min(start_date, tr)
             end_date = max(end_date, tr)
             # Count nodes created by each user
-            user_id = props['user_id']
+            user_id = user_ids[index]
             user_node_counts[user_id] += 1
             # Find out date range for each user's created nodes
             u = user_ranges[user_id]
-            tc = props['creation_time']
+            tc = creation_times[index]
             u['start'] = min(u['start'], tc)
             u['end'] = max(u['end'], tc)
             # Synapses
@@ -130,12 +127,12 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
             if pre:
                 for s in pre:
                     if in_range(s.creation_time):
-                        reviewer_n_pre[tree.node[s.treenode_id]['user_id']] += 1
+                        reviewer_n_pre[user_ids[arbor.index(s.treenode_id)]] += 1
             post = reviewer_synapses.get(relations['postsynaptic_to'])
             if post:
                 for s in post:
                     if in_range(s.creation_time):
-                        reviewer_n_post[tree.node[s.treenode_id]['user_id']] += 1
+                        reviewer_n_post[user_ids[arbor.index(s.treenode_id)]] += 1
 
 
         date_range = [start_date, end_date]
@@ -170,40 +167,43 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
             # For merges, the sqdist should be very close to zero.
             # For splits, the x,y,z are if the splitted node, which may no longer be part of the arbor (but could have been joined again).
             # False positives could originate in splitted and re-joined nodes (invalid split and merge error), and in deleted and re-created nodes (potentially incorrect user attribution).
-            node, sqdist = _find_nearest(tree, nodes, _parse_location(location))
+            node, sqdist = _find_nearest(arbor, indices, _parse_location(location))
 
             if 'split_skeleton' == operation_type:
-                splits[tree.node[node]['user_id']] += 1
+                splits[user_ids[node]] += 1
 
             elif 'join_skeleton' == operation_type:
-                edges = tree[node]
-                if edges:
+                parent = arbor.parent_index[node]
+                if parent != -1:
                     # Replace node with its parent
-                    node = next(edges.keys())
-                merges[tree.node[node]['user_id']] += 1
+                    node = parent
+                merges[user_ids[node]] += 1
 
         # Count nodes created by the reviewer, as well as
         # the number of connected arbors made by that nodes
         # which will add to the count of merges missed.
-        def newlyAdded(node):
-            props = tree.node[node]
-            return props['user_id'] == reviewer_id and in_range(props['creation_time'])
-
-        owned = filter(newlyAdded, nodes)
-
-        if owned:
-            sub = tree.subgraph(owned)
-            additions = connected_components(sub.to_undirected())
-            for addition in additions:
+        def newlyAdded(index):
+            return user_ids[index] == reviewer_id and in_range(creation_times[index])
+
+        owned = np.zeros(len(arbor), dtype=bool)
+        owned[[index for index in indices.tolist() if newlyAdded(index)]] = True
+
+        if owned.any():
+            # Group the owned nodes into connected arbor parts
+            component_roots = arbor.component_roots(owned)
+            owned_indices = np.flatnonzero(owned)
+            order = np.argsort(component_roots[owned_indices], kind='mergesort')
+            owned_indices = owned_indices[order]
+            boundaries = np.flatnonzero(np.diff(component_roots[owned_indices])) + 1
+            for addition in np.split(owned_indices, boundaries):
                 # Find a node whose parent's creator is not the reviewer, if any
                 # (Could not find any if the reviewer had created that parent node
                 # outside of the review epoch, in which case it does not count
                 # as an error)
-                for node in addition:
-                    edges = tree[node]
-                    if edges:
-                        parent = next(edges.keys())
-                        creator_id = tree.node[parent]['user_id']
+                for node in addition.tolist():
+                    parent = arbor.parent_index[node]
+                    if parent != -1:
+                        creator_id = user_ids[parent]
                         if creator_id != reviewer_id:
                             appended[creator_id].append(len(addition))
                             break
@@ -211,7 +211,7 @@ def _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations):
 
     return epoch_ops
 
-def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
+def _split_into_epochs(skeleton_id, arbor, reviews, max_gap):
     """ Split the arbor into one or more review epochs.
     An epoch is defined as a continuous range of time containing gaps
     of up to max_gap (e.g. 3 days) and fully reviewed by the same reviewer.
@@ -219,14 +219,12 @@ def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
     given that different subsets of the arbor may have been joined at a later time. """
 
     # Sort nodes by date of most recent review (first in list)
-    def get_review_time(e):
-        return reviews[e[0]][0].review_time
-    nodes = sorted(tree.nodes_iter(data=True), key=get_review_time)
+    def get_review_time(node):
+        return reviews[node][0].review_time
+    nodes = sorted(arbor.node_ids.tolist(), key=get_review_time)
 
     # Grab the oldest node
-    oldest = nodes[0]
-    last_id = oldest[0] # id of first node
-    last = oldest[1] # props of first node
+    last_id = nodes[0] # id of first node
 
     # First epoch contains the oldest node
     epoch = [last_id]
@@ -238,7 +236,7 @@ def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
     epochs = [(last_review.reviewer_id, epoch)]
 
     # Iterate from second-oldest node forward in time
-    for node, props in nodes:
+    for node in nodes:
         # Most recent review of current node
         node_review = reviews[node][0]
         # Add to current epoch if same reviewer and we are within max_gap
@@ -255,10 +253,10 @@ def _split_into_epochs(skeleton_id, tree, reviews, max_gap):
     return epochs
 
 
-def _evaluate_arbor(user_id, skeleton_id, tree, reviews, relations, max_gap):
+def _evaluate_arbor(user_id, skeleton_id, arbor, props, reviews, relations, max_gap):
     """ Split the arbor into review epochs and then evaluate each independently. """
-    epochs = _split_into_epochs(skeleton_id, tree, reviews, max_gap)
-    epoch_ops = _evaluate_epochs(epochs, skeleton_id, tree, reviews, relations)
+    epochs = _split_into_epochs(skeleton_id, arbor, reviews, max_gap)
+    epoch_ops = _evaluate_epochs(epochs, skeleton_id, arbor, props, reviews, relations)
     return epoch_ops
 
 
@@ -308,10 +306,9 @@ def _evaluate(project_id, user_id, start_date, end_date, max_gap, min_nodes):
     relations = dict(Relation.objects.filter(project_id=project_id, relation_name__in=['presynaptic_to', 'postsynaptic_to']).values_list('relation_name', 'id'))
 
     # 2. Load each fully reviewed skeleton one at a time
-    evaluations = {skid: _evaluate_arbor(user_id, skid, tree, reviews[skid], relations, max_gap) \
-        for skid, tree in lazy_load_trees(skeleton_ids, ('location_x', 'location_y', 'location_z', \
-                                                         'creation_time', 'user_id', 'editor_id', \
-                                                         'edition_time'))}
+    evaluations = {skid: _evaluate_arbor(user_id, skid, arbor, props, reviews[skid], relations, max_gap) \
+        for skid, arbor, props in lazy_load_trees(skeleton_ids, ('creation_time', 'user_id', \
+                                                                 'editor_id', 'edition_time'))}
 
     # 3. Extract evaluations for the user_id over time
     # Each evaluation contains an instance of EpochOps namedtuple, with members:
@@ -0,0 +1,439 @@
+import json
+import math
+import random
+import time
+
+import numpy as np
+import progressbar
+
+from collections import OrderedDict, defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection
+
+from catmaid.control.node import (get_configured_node_providers,
+        get_node_list_tuples, get_tracing_bounding_box, create_node_response,
+        decode_node_list_data, decompress_cache_data, AVAILABLE_NODE_PROVIDERS,
+        COMPRESSED_DATA_TYPES)
+from catmaid.models import Project
+
+
+DEFAULT_PROVIDERS = ('postgis3d', 'postgis3dblurry', 'postgis2d',
+        'postgis2dblurry', 'cached_json', 'cached_json_text', 'cached_msgpack',
+        'cached_json_grid', 'cached_json_text_grid', 'cached_msgpack_grid')
+
+OUTPUT_FORMATS = ('json', 'msgpack', 'columnar', 'png', 'gif')
+
+
+def get_viewport(center, orientation, width, height, step):
+    """Get a node query bounding box for a field of view of <width> x <height>
+    nm in the passed in orientation, centered at <center>, with a depth of
+    <step> nm.
+    """
+    x, y, z = center
+    if orientation == 'xy':
+        return {
+            'left': x - width / 2.0, 'right': x + width / 2.0,
+            'top': y - height / 2.0, 'bottom': y + height / 2.0,
+            'z1': z, 'z2': z + step,
+        }
+    elif orientation == 'xz':
+        return {
+            'left': x - width / 2.0, 'right': x + width / 2.0,
+            'top': y, 'bottom': y + step,
+            'z1': z - height / 2.0, 'z2': z + height / 2.0,
+        }
+    elif orientation == 'zy':
+        return {
+            'left': x, 'right': x + step,
+            'top': y - height / 2.0, 'bottom': y + height / 2.0,
+            'z1': z - width / 2.0, 'z2': z + width / 2.0,
+        }
+    else:
+        raise ValueError("Unknown orientation: {}".format(orientation))
+
+
+def get_query_params(project_id, viewport, orientation, node_limit,
+        accepted_encodings):
+    """Create the node query parameters node_list_tuples() would create for
+    the passed in bounding box.
+    """
+    params = {
+        'project_id': project_id,
+        'limit': node_limit,
+        'n_largest_skeletons_limit': 0,
+        'n_last_edited_skeletons_limit': 0,
+        'hidden_last_editor_id': None,
+        'orientation': orientation,
+        'accepted_encodings': accepted_encodings,
+    }
+    for p in ('left', 'top', 'z1', 'right', 'bottom', 'z2'):
+        params[p] = float(viewport[p])
+    params['width'] = params['right'] - params['left']
+    params['height'] = params['bottom'] - params['top']
+    params['depth'] = params['z2'] - params['z1']
+    return params
+
+
+def format_histogram(timings, n_bins=10, width=40):
+    """Render a text histogram of the passed in latencies (in seconds) with
+    logarithmically spaced bins.
+    """
+    timings = np.asarray(timings) * 1000.0
+    low, high = max(timings.min(), 0.001), max(timings.max(), 0.001)
+    if high <= low:
+        high = low * 1.01
+    edges = np.logspace(math.log10(low), math.log10(high), n_bins + 1)
+    counts, edges = np.histogram(np.clip(timings, low, high), bins=edges)
+    max_count = max(counts.max(), 1)
+    lines = []
+    for count, start, end in zip(counts, edges[:-1], edges[1:]):
+        bar = '#' * int(round(width * count / max_count))
+        lines.append('{:>10.2f} - {:>10.2f} ms {:>6} {}'.format(start, end,
+                count, bar))
+    return lines
+
+
+class Command(BaseCommand):
+    help = "Measure query latency, result size and encoding cost of node " \
+            "providers for sampled or replayed field of views"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', nargs='+',
+            default=False, help='Benchmark node providers for these projects only (otherwise all)')
+        parser.add_argument('--provider', dest='providers', nargs='+',
+            default=None, help='Node providers to benchmark. Defaults to ' \
+            'all providers except extra_nodes_only: {}'.format(', '.join(DEFAULT_PROVIDERS)))
+        parser.add_argument('--from-config', action='store_true', dest='from_config',
+            default=False, help='Also benchmark each entry of the NODE_PROVIDERS ' \
+            'setting with its options as well as the complete configured chain')
+        parser.add_argument('--format', dest='formats', nargs='+',
+            default=['json', 'msgpack', 'columnar'],
+            help='Output formats to measure: {}'.format(', '.join(OUTPUT_FORMATS)))
+        parser.add_argument('--accept-encoding', dest='accepted_encodings',
+            nargs='+', default=[], help='Content encodings the simulated ' \
+            'client accepts, allows cached providers to send compressed data')
+        parser.add_argument('--orientation', dest='orientations', nargs='+',
+            default=['xy'], help='Orientations to sample: xy, xz, zy')
+        parser.add_argument('--step', dest='steps', nargs='+', default=None,
+            help='Section thickness for each orientation (in nm), defaults to 40')
+        parser.add_argument('--fov-width', dest='fov_widths', nargs='+',
+            type=float, default=[160000, 80000, 40000, 20000, 10000],
+            help='Field of view widths (in nm) that represent the sampled zoom levels')
+        parser.add_argument('--aspect-ratio', dest='aspect_ratio', type=float,
+            default=16.0/9.0, help='Width to height ratio of the field of view')
+        parser.add_argument('--samples', dest='n_samples', type=int, default=20,
+            help='Number of sampled field of views per orientation and zoom level')
+        parser.add_argument('--sampling', dest='sampling', default='nodes',
+            choices=('nodes', 'uniform'), help='Center sampled field of ' \
+            'views on random treenodes (default) or sample uniformly in the ' \
+            'tracing data bounding box')
+        parser.add_argument('--replay', dest='replay', default=None,
+            help='A JSON file with a list of node queries to run instead of ' \
+            'sampling field of views. Each query is an object with the fields ' \
+            'left, top, z1, right, bottom, z2 and optionally project_id and ' \
+            'orientation, like the parameters of a node list request')
+        parser.add_argument('--repeat', dest='repeat', type=int, default=1,
+            help='How often each query is run per provider and format')
+        parser.add_argument('--warmup', dest='warmup', type=int, default=0,
+            help='Number of initial queries per provider that are not measured')
+        parser.add_argument('--node-limit', dest='node_limit',
+            default=settings.NODE_LIST_MAXIMUM_COUNT, help='Override node limit from settings. 0 means no limit')
+        parser.add_argument('--seed', dest='seed', type=int, default=None,
+            help='Seed for the field of view sampling to make runs comparable')
+        parser.add_argument('--histogram', action='store_true', dest='histogram',
+            default=False, help='Print a latency histogram for each provider and format')
+        parser.add_argument('--output', dest='output', default=None,
+            help='Write all individual measurements to this JSON file')
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+
+        project_ids = options['project_id']
+        if project_ids:
+            projects = list(Project.objects.filter(id__in=project_ids))
+        else:
+            projects = list(Project.objects.all())
+
+        formats = options['formats']
+        unknown_formats = [f for f in formats if f not in OUTPUT_FORMATS]
+        if unknown_formats:
+            raise CommandError("Unknown formats: {}".format(", ".join(unknown_formats)))
+
+        orientations = options['orientations']
+        for o in orientations:
+            if o not in ('xy', 'xz', 'zy'):
+                raise CommandError("Unknown orientation: {}".format(o))
+        steps = options['steps'] or [40.0] * len(orientations)
+        if len(steps) != len(orientations):
+            raise CommandError("Need a step (section thickness) for each orientation")
+        steps = [float(s) for s in steps]
+
+        node_limit = options['node_limit']
+        if node_limit is not None:
+            node_limit = int(node_limit) or None
+
+        if options['repeat'] < 1:
+            raise CommandError("Need to repeat each query at least once")
+
+        random.seed(options['seed'])
+
+        providers = self.get_providers(options)
+        self.stdout.write("Benchmarking the following providers: {}".format(
+                ", ".join(providers.keys())))
+
+        if options['replay']:
+            with open(options['replay'], 'r') as f:
+                replayed_queries = json.load(f)
+            queries = self.get_replayed_queries(replayed_queries, projects,
+                    steps, orientations)
+        else:
+            queries = self.sample_queries(cursor, projects, orientations, steps,
+                    options['fov_widths'], options['aspect_ratio'],
+                    options['n_samples'], options['sampling'])
+
+        if not queries:
+            raise CommandError("Found no node queries to run")
+
+        self.stdout.write("Running {} queries with {} provider(s) and {} " \
+                "format(s)".format(len(queries), len(providers), len(formats)))
+
+        measurements = self.run(queries, providers, formats, node_limit,
+                options['accepted_encodings'], options['repeat'],
+                options['warmup'])
+
+        self.report(measurements, options['histogram'])
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(measurements, f)
+            self.stdout.write("Wrote measurements to {}".format(options['output']))
+
+        self.stdout.write('Done')
+
+    def get_providers(self, options):
+        """Get a mapping of benchmark labels to lists of node providers. Node
+        lists are computed with the first provider of a list that returns a
+        result, like for regular requests.
+        """
+        providers = OrderedDict()
+        provider_names = options['providers'] or DEFAULT_PROVIDERS
+        unknown_providers = [p for p in provider_names if p not in AVAILABLE_NODE_PROVIDERS]
+        if unknown_providers:
+            raise CommandError("Unknown node providers: {}".format(
+                    ", ".join(unknown_providers)))
+        for name in provider_names:
+            providers[name] = get_configured_node_providers([name])
+
+        if options['from_config']:
+            for i, entry in enumerate(settings.NODE_PROVIDERS):
+                name = entry[0] if type(entry) in (list, tuple) else entry
+                providers['config-{}-{}'.format(i, name)] = \
+                        get_configured_node_providers([entry])
+            providers['config-chain'] = get_configured_node_providers(
+                    settings.NODE_PROVIDERS)
+
+        return providers
+
+    def get_replayed_queries(self, replayed_queries, projects, steps,
+            orientations):
+        """Convert replayed node list request parameters into queries.
+        Queries without a project ID are run for all selected projects.
+        """
+        project_ids = set(p.id for p in projects)
+        queries = []
+        for q in replayed_queries:
+            if 'project_id' in q:
+                if int(q['project_id']) not in project_ids:
+                    continue
+                query_project_ids = [int(q['project_id'])]
+            else:
+                query_project_ids = sorted(project_ids)
+            viewport = dict((k, float(q[k])) for k in
+                    ('left', 'top', 'z1', 'right', 'bottom', 'z2'))
+            orientation = q.get('orientation', 'xy')
+            for project_id in query_project_ids:
+                queries.append({
+                    'project_id': project_id,
+                    'orientation': orientation,
+                    'fov_width': viewport['right'] - viewport['left'],
+                    'viewport': viewport,
+                })
+        return queries
+
+    def sample_queries(self, cursor, projects, orientations, steps, fov_widths,
+            aspect_ratio, n_samples, sampling):
+        """Create <n_samples> random field of views for each project,
+        orientation and field of view width.
+        """
+        queries = []
+        for p in projects:
+            bb = get_tracing_bounding_box(p.id, cursor)
+            if None in bb[0] or None in bb[1]:
+                self.stdout.write(' -> Found no tracing data in project {}, ' \
+                        'skipping it'.format(p.id))
+                continue
+
+            n_centers = n_samples * len(fov_widths) * len(orientations)
+            if sampling == 'nodes':
+                # Make the database sampling follow the --seed option
+                cursor.execute("SELECT setseed(%s)", (random.uniform(-1, 1),))
+                cursor.execute("""
+                    SELECT location_x, location_y, location_z
+                    FROM treenode
+                    WHERE project_id = %(project_id)s
+                    ORDER BY random()
+                    LIMIT %(limit)s
+                """, {
+                    'project_id': p.id,
+                    'limit': n_centers,
+                })
+                centers = cursor.fetchall()
+            else:
+                centers = [tuple(random.uniform(bb[0][i], bb[1][i]) for i in range(3))
+                        for _ in range(n_centers)]
+
+            if not centers:
+                continue
+
+            i = 0
+            for orientation, step in zip(orientations, steps):
+                for fov_width in fov_widths:
+                    fov_height = fov_width / aspect_ratio
+                    for _ in range(n_samples):
+                        center = centers[i % len(centers)]
+                        i += 1
+                        # Sections start at multiples of the section thickness
+                        depth_dim = {'xy': 2, 'xz': 1, 'zy': 0}[orientation]
+                        center = list(center)
+                        center[depth_dim] = math.floor(center[depth_dim] / step) * step
+                        queries.append({
+                            'project_id': p.id,
+                            'orientation': orientation,
+                            'fov_width': fov_width,
+                            'viewport': get_viewport(center, orientation,
+                                    fov_width, fov_height, step),
+                        })
+        return queries
+
+    def run(self, queries, providers, formats, node_limit, accepted_encodings,
+            repeat, warmup):
+        """Run all queries with all providers and formats and return a list of
+        measurements.
+        """
+        measurements = []
+        n_runs = len(queries) * len(providers)
+        with progressbar.ProgressBar(max_value=n_runs, redirect_stdout=True) as pbar:
+            n = 0
+            for label, node_providers in providers.items():
+                for i, query in enumerate(queries):
+                    for fmt in formats:
+                        for r in range(repeat + (warmup if i == 0 else 0)):
+                            m = self.measure(query, node_providers, fmt,
+                                    node_limit, accepted_encodings)
+                            if i == 0 and r < warmup:
+                                continue
+                            m['provider'] = label
+                            measurements.append(m)
+                    n += 1
+                    pbar.update(n)
+        return measurements
+
+    def measure(self, query, node_providers, fmt, node_limit,
+            accepted_encodings):
+        """Run a single node query and return its latency (in seconds), split
+        into query time and total time, the number of returned rows and the
+        size of the response in bytes.
+        """
+        project_id = query['project_id']
+        params = get_query_params(project_id, query['viewport'],
+                query['orientation'], node_limit, accepted_encodings)
+        params['format'] = fmt
+        target_options = {
+            'view_width': 1000,
+            'view_height': int(1000 * params['height'] / params['width'])
+                    if params['width'] else 1000,
+        }
+
+        m = {
+            'project_id': project_id,
+            'orientation': query['orientation'],
+            'fov_width': query['fov_width'],
+            'format': fmt,
+            'viewport': query['viewport'],
+        }
+
+        start = time.time()
+        try:
+            result, data_type = get_node_list_tuples(project_id,
+                    node_providers, params, with_relation_map='used')
+        except ValueError:
+            # No provider could answer this query
+            m['found'] = False
+            return m
+        query_end = time.time()
+        response = create_node_response(result, params, fmt, target_options,
+                data_type)
+        end = time.time()
+
+        m['found'] = True
+        m['query_time'] = query_end - start
+        m['time'] = end - start
+        m['data_type'] = data_type
+        m['bytes'] = len(response.content)
+        m['rows'] = self.count_rows(result, data_type)
+        return m
+
+    def count_rows(self, result, data_type):
+        """Count the number of treenodes and connectors of a result, which
+        requires decoding encoded results.
+        """
+        if data_type in COMPRESSED_DATA_TYPES:
+            data_type, encoding = COMPRESSED_DATA_TYPES[data_type]
+            result = decompress_cache_data(result, encoding)
+            if data_type == 'json_text':
+                result = result.decode('utf-8')
+        data = decode_node_list_data(result, data_type)
+        n_rows = len(data[0]) + len(data[1])
+        if len(data) > 5:
+            for extra in data[5]:
+                n_rows += len(extra[0]) + len(extra[1])
+        return n_rows
+
+    def report(self, measurements, histogram=False):
+        groups = defaultdict(list)
+        for m in measurements:
+            key = (m['project_id'], m['orientation'], m['fov_width'],
+                    m['provider'], m['format'])
+            groups[key].append(m)
+
+        self.stdout.write('{:>8} {:>4} {:>10} {:>28} {:>9} {:>6} {:>6} ' \
+                '{:>9} {:>9} {:>9} {:>9} {:>8} {:>10}'.format('project',
+                'ori', 'fov width', 'provider', 'format', 'n', 'miss',
+                'query p50', 'p50 ms', 'p95 ms', 'p99 ms', 'rows', 'bytes'))
+
+        for key in sorted(groups.keys(), key=lambda k: (k[0], k[1], -k[2], k[3], k[4])):
+            group = groups[key]
+            found = [m for m in group if m['found']]
+            n_missed = len(group) - len(found)
+            if found:
+                times = np.array([m['time'] for m in found]) * 1000.0
+                query_times = np.array([m['query_time'] for m in found]) * 1000.0
+                p50, p95, p99 = np.percentile(times, [50, 95, 99])
+                query_p50 = np.percentile(query_times, 50)
+                rows = np.mean([m['rows'] for m in found])
+                n_bytes = np.mean([m['bytes'] for m in found])
+                self.stdout.write('{:>8} {:>4} {:>10.0f} {:>28} {:>9} {:>6} ' \
+                        '{:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>8.0f} ' \
+                        '{:>10.0f}'.format(key[0], key[1], key[2], key[3],
+                        key[4], len(found), n_missed, query_p50, p50, p95, p99,
+                        rows, n_bytes))
+                if histogram:
+                    for line in format_histogram([m['time'] for m in found]):
+                        self.stdout.write('    ' + line)
+            else:
+                self.stdout.write('{:>8} {:>4} {:>10.0f} {:>28} {:>9} {:>6} ' \
+                        '{:>6} {:>9} {:>9} {:>9} {:>9} {:>8} {:>10}'.format(
+                        key[0], key[1], key[2], key[3], key[4], 0, n_missed,
+                        '-', '-', '-', '-', '-', '-'))
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+
+from catmaid.control.nblast import DEFAULT_NBLAST_TILE_SIZE
+from catmaid.control.similarity import (compute_nblast_tiled,
+        mark_similarity_failed, prepare_similarity)
+from catmaid.models import NblastSimilarity
+
+
+class Command(BaseCommand):
+    help = "Compute the matrix of an NBLAST similarity in tiles, using " \
+        "multiple processes. Computed tiles are stored right away and an " \
+        "interrupted computation continues with the missing tiles when " \
+        "started again with the same tile size."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--similarity_id', dest='similarity_id',
+            type=int, required=True, help='The similarity to compute'),
+        parser.add_argument('--tile-size', dest='tile_size', type=int,
+            default=DEFAULT_NBLAST_TILE_SIZE,
+            help='The maximum number of query and target objects per tile'),
+        parser.add_argument('--jobs', dest='jobs', type=int, default=1,
+            help='The number of processes computing tiles in parallel'),
+        parser.add_argument('--no-resume', dest='resume',
+            action='store_false', default=True,
+            help='Discard tiles stored by an earlier computation'),
+        parser.add_argument('--no-simplify', dest='simplify',
+            action='store_false', default=True,
+            help='Don\'t remove branches of skeletons below the required ' +
+            'branch level'),
+        parser.add_argument('--required-branches', dest='required_branches',
+            type=int, default=10,
+            help='The branch levels to keep if skeletons are simplified'),
+        parser.add_argument('--keep-target-duplicates',
+            dest='remove_target_duplicates', action='store_false',
+            default=True, help='Don\'t remove query objects from the targets')
+
+    def handle(self, *args, **options):
+        try:
+            similarity = NblastSimilarity.objects.get(
+                    pk=options['similarity_id'])
+        except NblastSimilarity.DoesNotExist:
+            raise CommandError('Similarity "%s" does not exist' %
+                    options['similarity_id'])
+
+        if options['tile_size'] < 1:
+            raise CommandError('The tile size has to be positive')
+        if options['jobs'] < 1:
+            raise CommandError('The number of jobs has to be positive')
+
+        project_id, user_id = similarity.project_id, similarity.user_id
+        try:
+            similarity = prepare_similarity(project_id, user_id, similarity.id)
+            result = compute_nblast_tiled(project_id, user_id, similarity,
+                    options['remove_target_duplicates'], options['simplify'],
+                    options['required_branches'], options['tile_size'],
+                    use_subtasks=False, resume=options['resume'],
+                    n_jobs=options['jobs'])
+        except Exception as e:
+            mark_similarity_failed(user_id, similarity.id)
+            raise CommandError('Computing similarity {} failed: {}'.format(
+                    similarity.id, e))
+
+        self.stdout.write(result)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from catmaid.control.bulkexport import get_annotated_skeleton_ids
+from catmaid.control.skeletonexport import (_neuroglancer_skeletons,
+        neuroglancer_skeleton_info, NEUROGLANCER_VERTEX_ATTRIBUTES,
+        NEUROGLANCER_SKELETON_BATCH_SIZE)
+from catmaid.models import Class, Project
+
+
+class Command(BaseCommand):
+    help = "Write skeletons of a project as neuroglancer precomputed " \
+        "skeleton source to a directory: an info file along with one file " \
+        "per skeleton, named after the skeleton ID."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', required=True,
+            help='Export skeletons of this project'),
+        parser.add_argument('--output', dest='output', required=True,
+            help='The directory to write the info file and skeletons to. It '
+            'is created if it doesn\'t exist.'),
+        parser.add_argument('--skeleton', dest='skeleton_ids', nargs='+',
+            type=int, default=None, help='Export only these skeletons'),
+        parser.add_argument('--required-annotation', dest='required_annotations',
+            action='append', help='Name a required annotation for exported ' +
+            'skeletons. Meta-annotations can be used as well.')
+        parser.add_argument('--vertex-attribute', dest='vertex_attributes',
+            action='append', default=[],
+            choices=list(NEUROGLANCER_VERTEX_ATTRIBUTES.keys()),
+            help='Add this treenode property as vertex attribute'),
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+            default=NEUROGLANCER_SKELETON_BATCH_SIZE,
+            help='The number of skeletons to load at once'),
+
+    def get_skeleton_ids(self, project_id, required_annotations):
+        if not required_annotations:
+            classes = dict(Class.objects.filter(
+                    project_id=project_id).values_list('class_name', 'id'))
+            cursor = connection.cursor()
+            cursor.execute('''
+                SELECT id FROM class_instance
+                WHERE project_id = %(project_id)s
+                  AND class_id = %(skeleton_class_id)s
+                ORDER BY id
+            ''', {
+                'project_id': project_id,
+                'skeleton_class_id': classes['skeleton'],
+            })
+            return [row[0] for row in cursor.fetchall()]
+
+        try:
+            return get_annotated_skeleton_ids(project_id, required_annotations)
+        except ValueError as e:
+            raise CommandError(str(e))
+
+    def handle(self, *args, **options):
+        try:
+            project = Project.objects.get(pk=int(options['project_id']))
+        except Project.DoesNotExist:
+            raise CommandError('Project "%s" does not exist' % options['project_id'])
+
+        skeleton_ids = options['skeleton_ids']
+        if not skeleton_ids:
+            skeleton_ids = self.get_skeleton_ids(project.id,
+                    options['required_annotations'])
+
+        output = options['output']
+        if not os.path.exists(output):
+            os.makedirs(output)
+
+        vertex_attributes = options['vertex_attributes']
+        with open(os.path.join(output, 'info'), 'w') as f:
+            json.dump(neuroglancer_skeleton_info(vertex_attributes), f)
+
+        self.stdout.write('Exporting {} skeletons of project {} to {}'.format(
+                len(skeleton_ids), project.id, output))
+
+        n_exported = 0
+        batch_size = options['batch_size']
+        for skeleton_id, data in _neuroglancer_skeletons(project.id,
+                skeleton_ids, vertex_attributes, batch_size):
+            with open(os.path.join(output, str(skeleton_id)), 'wb') as f:
+                f.write(data)
+            n_exported += 1
+            if n_exported % batch_size == 0:
+                self.stdout.write('Exported {} skeletons'.format(n_exported))
+
+        self.stdout.write('Exported {} skeletons with nodes'.format(n_exported))
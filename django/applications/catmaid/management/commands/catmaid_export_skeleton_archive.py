@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand, CommandError
+
+from catmaid.control.bulkexport import (export_skeleton_archive,
+        get_annotated_skeleton_ids, ARCHIVE_FORMATS, EXPORT_FORMATS,
+        DEFAULT_BULK_EXPORT_BATCH_SIZE)
+from catmaid.models import Project
+
+
+class Command(BaseCommand):
+    help = "Export many skeletons of a project as SWC or NRRD files into a " \
+        "single zip or tar archive. Skeletons are selected by ID or by " \
+        "annotation."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', required=True,
+            help='Export skeletons of this project'),
+        parser.add_argument('--output', dest='output', required=True,
+            help='The path of the archive file to create'),
+        parser.add_argument('--skeleton', dest='skeleton_ids', nargs='+',
+            type=int, default=None, help='Export these skeletons'),
+        parser.add_argument('--required-annotation', dest='required_annotations',
+            action='append', help='Name a required annotation for exported ' +
+            'skeletons. Meta-annotations can be used as well.')
+        parser.add_argument('--format', dest='export_format', default='swc',
+            choices=EXPORT_FORMATS, help='The file format of each skeleton'),
+        parser.add_argument('--archive-format', dest='archive_format',
+            default='zip', choices=ARCHIVE_FORMATS, help='The archive format'),
+        parser.add_argument('--linearize-ids', dest='linearize_ids',
+            action='store_true', default=False,
+            help='Renumber SWC node IDs starting from 1'),
+        parser.add_argument('--soma-marker', dest='soma_markers',
+            action='append', default=[], help='How to find the SWC soma ' +
+            'node: "tag:soma", "radius:<min radius>" or "root"'),
+        parser.add_argument('--source-ref', dest='source_ref', default=None,
+            help='NRRD only: the source reference space'),
+        parser.add_argument('--target-ref', dest='target_ref', default=None,
+            help='NRRD only: the target reference space'),
+        parser.add_argument('--mirror', dest='mirror', action='store_true',
+            default=False, help='NRRD only: mirror skeletons'),
+        parser.add_argument('--user', dest='user_id', type=int, default=None,
+            help='NRRD only: the user on whose behalf skeletons are read'),
+        parser.add_argument('--jobs', dest='n_jobs', type=int, default=1,
+            help='The number of worker processes'),
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+            default=DEFAULT_BULK_EXPORT_BATCH_SIZE,
+            help='The number of skeletons to load at once'),
+
+    def handle(self, *args, **options):
+        try:
+            project = Project.objects.get(pk=int(options['project_id']))
+        except Project.DoesNotExist:
+            raise CommandError('Project "%s" does not exist' % options['project_id'])
+
+        skeleton_ids = options['skeleton_ids']
+        if not skeleton_ids:
+            if not options['required_annotations']:
+                raise CommandError('Please specify skeletons or annotations')
+            try:
+                skeleton_ids = get_annotated_skeleton_ids(project.id,
+                        options['required_annotations'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        nrrd_options = None
+        if options['export_format'] == 'nrrd':
+            if not options['source_ref'] or not options['target_ref'] or \
+                    options['user_id'] is None:
+                raise CommandError('NRRD export needs --source-ref, ' +
+                        '--target-ref and --user')
+            nrrd_options = {
+                'source_ref': options['source_ref'],
+                'target_ref': options['target_ref'],
+                'mirror': options['mirror'],
+            }
+
+        self.stdout.write('Exporting {} skeletons of project {} to {}'.format(
+                len(skeleton_ids), project.id, options['output']))
+
+        def progress(n_processed, n_total):
+            self.stdout.write(' -> {}/{} skeletons done'.format(n_processed, n_total))
+
+        errors = export_skeleton_archive(project.id, skeleton_ids,
+                options['output'], options['export_format'],
+                options['archive_format'], options['linearize_ids'],
+                options['soma_markers'], nrrd_options, options['user_id'],
+                options['n_jobs'], options['batch_size'], progress)
+
+        for skeleton_id, error in sorted(errors.items()):
+            self.stdout.write('Skeleton {} not exported: {}'.format(skeleton_id, error))
+        self.stdout.write('Exported {} skeletons'.format(len(skeleton_ids) - len(errors)))
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from catmaid.control.bulkimport import (import_swc_skeletons, parse_swc,
+        DEFAULT_BULK_IMPORT_BATCH_SIZE)
+from catmaid.models import Project, User
+
+
+class Command(BaseCommand):
+    help = "Import many SWC files into a project, each one as a new neuron " \
+        "named after the file. Treenodes of a batch of files are written " \
+        "with a single COPY statement."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project_id', dest='project_id', required=True,
+            help='Import skeletons into this project'),
+        parser.add_argument('--user', dest='user', required=True,
+            help='The ID or name of the user who imports the skeletons'),
+        parser.add_argument('--batch-size', dest='batch_size', type=int,
+            default=DEFAULT_BULK_IMPORT_BATCH_SIZE,
+            help='The number of files to import in one transaction'),
+        parser.add_argument('paths', nargs='+', help='SWC files or ' +
+            'directories, of which all .swc files are imported')
+
+    def get_files(self, paths):
+        for path in paths:
+            if os.path.isdir(path):
+                for filename in sorted(os.listdir(path)):
+                    if filename.lower().endswith('.swc'):
+                        yield os.path.join(path, filename)
+            else:
+                yield path
+
+    def import_batch(self, user, project_id, batch):
+        with transaction.atomic():
+            return len(import_swc_skeletons(user, project_id, batch))
+
+    def handle(self, *args, **options):
+        try:
+            project = Project.objects.get(pk=int(options['project_id']))
+        except Project.DoesNotExist:
+            raise CommandError('Project "%s" does not exist' % options['project_id'])
+
+        user = options['user']
+        try:
+            user = User.objects.get(pk=int(user)) if user.isdigit() else \
+                    User.objects.get(username=user)
+        except User.DoesNotExist:
+            raise CommandError('User "%s" does not exist' % user)
+
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('The batch size has to be positive')
+
+        n_imported = 0
+        n_failed = 0
+        batch = []
+        for path in self.get_files(options['paths']):
+            name = os.path.splitext(os.path.basename(path))[0]
+            try:
+                with open(path, 'r') as f:
+                    batch.append((name, parse_swc(f.read())))
+            except (IOError, ValueError) as e:
+                self.stdout.write('Skipping {}: {}'.format(path, e))
+                n_failed += 1
+                continue
+
+            if len(batch) == batch_size:
+                n_imported += self.import_batch(user, project.id, batch)
+                batch = []
+                self.stdout.write('Imported {} skeletons'.format(n_imported))
+
+        if batch:
+            n_imported += self.import_batch(user, project.id, batch)
+
+        self.stdout.write('Imported {} skeletons into project {}, skipped {} '
+                'files'.format(n_imported, project.id, n_failed))
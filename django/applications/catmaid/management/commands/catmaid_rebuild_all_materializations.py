@@ -11,7 +11,7 @@ class Command(BaseCommand):
     help = "Recreates all entries for the following tables, which act as " + \
            "materialized views: treenode_edge, treenode_connector_edge, " + \
            "connector_geom, catmaid_stats_summary, node_query_cache, " + \
-           "catmaid_skeleton_summary"
+           "node_grid_cache_cell, catmaid_skeleton_summary"
 
     def handle(self, *args, **options):
         cursor = connection.cursor()
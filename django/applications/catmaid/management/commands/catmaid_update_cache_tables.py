@@ -7,7 +7,10 @@ from django.conf import settings
 from django.db import connection
 
 from catmaid.control.node import (_node_list_tuples_query, update_cache,
-        Postgis2dNodeProvider, ORIENTATIONS, update_node_query_cache)
+        update_grid_cache, Postgis2dNodeProvider, ORIENTATIONS,
+        update_node_query_cache, create_cache_update_pool,
+        get_cache_data_type_list, DEFAULT_CACHE_UPDATE_BATCH_SIZE,
+        GRID_CACHE_DATA_TYPES, SECTION_CACHE_DATA_TYPES)
 from catmaid.models import Project
 
 
@@ -19,8 +22,10 @@ class Command(BaseCommand):
             default=False, help='Remove all existing cache data before update'),
         parser.add_argument('--project_id', dest='project_id', nargs='+',
             default=False, help='Compute only statistics for these projects only (otherwise all)'),
-        parser.add_argument('--type', dest='data_type', default="msgpack",
-            help='Which type of cache to populate: json, json_text, msgpack'),
+        parser.add_argument('--type', dest='data_types', nargs='+', default=["msgpack"],
+            help='Which types of cache to populate: json, json_text, msgpack. '
+            'For section caches also the pre-compressed types json_text_gzip, '
+            'json_text_br, msgpack_gzip and msgpack_br'),
         parser.add_argument('--orientation', dest='orientations', nargs='+',
             default='xz', help='Which orientations should be generated: xy, xz, zy'),
         parser.add_argument('--step', dest='steps', nargs='+',
@@ -45,6 +50,19 @@ class Command(BaseCommand):
                 default=None, help='Only show treenodes of the N most recently edited skeletons in the field of view'),
         parser.add_argument('--from-config', action="store_true", dest='from_config',
                 default=False, help="Update cache based on NODE_PROVIDERS variable in settings")
+        parser.add_argument('--cell-width', dest='cell_width', default=None,
+                help='If set along with --cell-height, a grid cache with this cell width (in nm) is populated')
+        parser.add_argument('--cell-height', dest='cell_height', default=None,
+                help='If set along with --cell-width, a grid cache with this cell height (in nm) is populated')
+        parser.add_argument('--allow-empty', action='store_true', dest='allow_empty',
+                default=False, help='Don\'t store empty grid cells, treat missing cells as empty')
+        parser.add_argument('--only-dirty', action='store_true', dest='only_dirty',
+                default=False, help='Only recompute cache entries that were invalidated by edits')
+        parser.add_argument('--jobs', dest='n_jobs', type=int, default=None,
+                help='Number of worker processes that compute cache entries in parallel (default: 1)')
+        parser.add_argument('--batch-size', dest='batch_size', type=int, default=None,
+                help='Number of sections or grid cells that are computed and '
+                'stored together (default: {})'.format(DEFAULT_CACHE_UPDATE_BATCH_SIZE))
 
     def handle(self, *args, **options):
         if options['from_config']:
@@ -55,7 +73,9 @@ class Command(BaseCommand):
         self.stdout.write('Done')
 
     def update_from_config(self, options):
-        update_node_query_cache(log=lambda x: self.stdout.write(x))
+        update_node_query_cache(only_dirty=options['only_dirty'],
+                n_jobs=options['n_jobs'], batch_size=options['batch_size'],
+                log=lambda x: self.stdout.write(x))
 
     def update_from_options(self, options):
         cursor = connection.cursor()
@@ -76,14 +96,22 @@ class Command(BaseCommand):
             raise CommandError('Need depth resolution per orientation (--step)')
         steps = [float(s) for s in steps]
 
+        cell_width, cell_height = options['cell_width'], options['cell_height']
+        if bool(cell_width) != bool(cell_height):
+            raise CommandError('Need both --cell-width and --cell-height for grid caches')
+        use_grid = bool(cell_width)
+
         delete = False
         clean = options['clean']
-        if clean:
+        if clean and not options['only_dirty']:
             if project_ids:
                 delete = True
             else:
                 # Removing cache data for all projects is faster this way.
-                cursor.execute("TRUNCATE node_query_cache")
+                if use_grid:
+                    cursor.execute("TRUNCATE node_grid_cache_cell")
+                else:
+                    cursor.execute("TRUNCATE node_query_cache")
 
         bb_limits = [
             [float(options['min_x']), float(options['min_y']), float(options['min_z'])],
@@ -102,16 +130,41 @@ class Command(BaseCommand):
         if options['n_last_edited_skeletons_limit']:
             n_last_edited_skeletons_limit = int(options['n_last_edited_skeletons_limit'])
 
-        data_type = options['data_type']
-
-        if data_type not in ('json', 'json_text', 'msgpack'):
-            raise CommandError('Type must be one of: json, json_text, msgpack')
+        data_types = options['data_types']
+        try:
+            get_cache_data_type_list(data_types, GRID_CACHE_DATA_TYPES
+                    if use_grid else SECTION_CACHE_DATA_TYPES)
+        except ValueError as e:
+            raise CommandError(str(e))
         if len(steps) != len(orientations):
             raise CommandError('Need one depth resolution flag per orientation')
 
-        for p in projects:
-            self.stdout.write('Updating cache for project {}'.format(p.id))
-            update_cache(p.id, data_type, orientations, steps, node_limit,
-                    n_largest_skeletons_limit, n_last_edited_skeletons_limit,
-                    delete, bb_limits, log=self.stdout.write)
-            self.stdout.write('Updated cache for project {}'.format(p.id))
+        n_jobs = options['n_jobs'] or 1
+        batch_size = options['batch_size'] or DEFAULT_CACHE_UPDATE_BATCH_SIZE
+        if n_jobs < 1 or batch_size < 1:
+            raise CommandError('Number of jobs and batch size need to be positive')
+
+        # All projects share the same worker processes.
+        with create_cache_update_pool(n_jobs) as pool:
+            for p in projects:
+                self.stdout.write('Updating cache for project {}'.format(p.id))
+                if use_grid:
+                    update_grid_cache(p.id, data_types, orientations, steps,
+                            float(cell_width), float(cell_height),
+                            node_limit=node_limit,
+                            n_largest_skeletons_limit=n_largest_skeletons_limit,
+                            n_last_edited_skeletons_limit=n_last_edited_skeletons_limit,
+                            allow_empty=options['allow_empty'], delete=delete,
+                            bb_limits=bb_limits, only_dirty=options['only_dirty'],
+                            batch_size=batch_size, pool=pool,
+                            log=self.stdout.write)
+                else:
+                    update_cache(p.id, data_types, orientations, steps,
+                            node_limit=node_limit,
+                            n_largest_skeletons_limit=n_largest_skeletons_limit,
+                            n_last_edited_skeletons_limit=n_last_edited_skeletons_limit,
+                            delete=delete, bb_limits=bb_limits,
+                            only_dirty=options['only_dirty'],
+                            batch_size=batch_size, pool=pool,
+                            log=self.stdout.write)
+                self.stdout.write('Updated cache for project {}'.format(p.id))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+forward = """
+    -- Neither table has a history table associated, they are pure caches.
+
+    CREATE TABLE node_grid_cache (
+        id serial PRIMARY KEY,
+        project_id integer REFERENCES project (id) ON DELETE CASCADE NOT NULL,
+        orientation integer DEFAULT 0 NOT NULL,
+        cell_width double precision NOT NULL,
+        cell_height double precision NOT NULL,
+        cell_depth double precision NOT NULL,
+        allow_empty boolean DEFAULT false NOT NULL,
+        CONSTRAINT node_grid_cache_project_orientation_cell_size_unique
+            UNIQUE (project_id, orientation, cell_width, cell_height, cell_depth)
+    );
+
+    CREATE TABLE node_grid_cache_cell (
+        id serial PRIMARY KEY,
+        grid_id integer REFERENCES node_grid_cache (id) ON DELETE CASCADE NOT NULL,
+        x_index integer NOT NULL,
+        y_index integer NOT NULL,
+        z_index integer NOT NULL,
+        update_time timestamptz DEFAULT now() NOT NULL,
+        json_data jsonb,
+        json_text_data text,
+        msgpack_data bytea,
+        CONSTRAINT node_grid_cache_cell_grid_index_unique
+            UNIQUE (grid_id, x_index, y_index, z_index)
+    );
+
+    -- The unique constraint above already provides an index on all
+    -- (grid_id, x_index, y_index, z_index) lookups. Section wise lookups are
+    -- faster with the depth index first.
+    CREATE INDEX node_grid_cache_cell_grid_z_y_x_idx
+        ON node_grid_cache_cell (grid_id, z_index, y_index, x_index);
+    CREATE INDEX node_grid_cache_cell_update_time_idx
+        ON node_grid_cache_cell (update_time);
+"""
+
+backward = """
+    DROP TABLE node_grid_cache_cell;
+    DROP TABLE node_grid_cache;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add the node_grid_cache and node_grid_cache_cell tables, which allow to
+    cache node query results for individual spatial cells of a regular grid,
+    rather than for whole sections.
+    """
+
+    dependencies = [
+        ('catmaid', '0055_fix_single_node_bug_in_summary_refresh'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.CreateModel(
+                name='NodeGridCache',
+                fields=[
+                    ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('orientation', models.IntegerField(default=0)),
+                    ('cell_width', models.FloatField()),
+                    ('cell_height', models.FloatField()),
+                    ('cell_depth', models.FloatField()),
+                    ('allow_empty', models.BooleanField(default=False)),
+                    ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                ],
+                options={
+                    'db_table': 'node_grid_cache',
+                },
+            ),
+            migrations.AlterUniqueTogether(
+                name='nodegridcache',
+                unique_together=set([('project', 'orientation', 'cell_width', 'cell_height', 'cell_depth')]),
+            ),
+            migrations.CreateModel(
+                name='NodeGridCacheCell',
+                fields=[
+                    ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('x_index', models.IntegerField()),
+                    ('y_index', models.IntegerField()),
+                    ('z_index', models.IntegerField()),
+                    ('update_time', models.DateTimeField(default=django.utils.timezone.now)),
+                    ('json_data', django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True)),
+                    ('json_text_data', models.TextField(blank=True, null=True)),
+                    ('msgpack_data', models.BinaryField(null=True)),
+                    ('grid', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.NodeGridCache')),
+                ],
+                options={
+                    'db_table': 'node_grid_cache_cell',
+                },
+            ),
+            migrations.AlterUniqueTogether(
+                name='nodegridcachecell',
+                unique_together=set([('grid', 'x_index', 'y_index', 'z_index')]),
+            ),
+        ]),
+    ]
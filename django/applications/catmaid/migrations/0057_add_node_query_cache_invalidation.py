@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+
+
+forward = """
+    -- Section cache entries remember their depth resolution so that it is
+    -- possible to find all entries that intersect with a changed edge.
+    ALTER TABLE node_query_cache
+    ADD COLUMN step real,
+    ADD COLUMN dirty boolean DEFAULT false NOT NULL;
+
+    ALTER TABLE node_grid_cache_cell
+    ADD COLUMN dirty boolean DEFAULT false NOT NULL;
+
+    CREATE INDEX node_query_cache_dirty_idx
+        ON node_query_cache (project_id, orientation) WHERE dirty;
+    CREATE INDEX node_grid_cache_cell_dirty_idx
+        ON node_grid_cache_cell (grid_id) WHERE dirty;
+
+
+    -- Get all grid cache cells that intersect with the passed in geometries.
+    CREATE OR REPLACE FUNCTION get_intersecting_node_grid_cache_cells(
+            project_ids integer[], geoms geometry[])
+    RETURNS TABLE(grid_id integer, allow_empty boolean, x_index integer,
+            y_index integer, z_index integer)
+    LANGUAGE sql STABLE AS
+    $$
+        SELECT DISTINCT g.id, g.allow_empty, x.x_index, y.y_index, z.z_index
+        FROM UNNEST(project_ids, geoms) e(project_id, geom)
+        JOIN node_grid_cache g
+            ON g.project_id = e.project_id
+        CROSS JOIN LATERAL generate_series(
+            floor(ST_XMin(e.geom) / g.cell_width)::integer,
+            floor(ST_XMax(e.geom) / g.cell_width)::integer) x(x_index)
+        CROSS JOIN LATERAL generate_series(
+            floor(ST_YMin(e.geom) / g.cell_height)::integer,
+            floor(ST_YMax(e.geom) / g.cell_height)::integer) y(y_index)
+        CROSS JOIN LATERAL generate_series(
+            floor(ST_ZMin(e.geom) / g.cell_depth)::integer,
+            floor(ST_ZMax(e.geom) / g.cell_depth)::integer) z(z_index);
+    $$;
+
+    -- Mark all section cache entries and grid cache cells as dirty that
+    -- intersect with one of the passed in geometries. For grids that allow
+    -- empty cells, missing cells are created as dirty placeholders, because
+    -- otherwise they would be treated as empty.
+    CREATE OR REPLACE FUNCTION mark_node_query_cache_dirty(project_ids integer[],
+            geoms geometry[]) RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            RETURN;
+        END IF;
+
+        IF EXISTS(SELECT 1 FROM node_query_cache LIMIT 1) THEN
+            UPDATE node_query_cache c
+            SET dirty = true
+            FROM (
+                SELECT DISTINCT g.project_id, ST_ZMin(g.geom), ST_ZMax(g.geom)
+                FROM UNNEST(project_ids, geoms) g(project_id, geom)
+            ) e(project_id, z_min, z_max)
+            WHERE c.project_id = e.project_id
+            AND c.depth <= e.z_max
+            AND (c.depth + c.step > e.z_min OR (c.step IS NULL AND c.depth >= e.z_min))
+            AND NOT c.dirty;
+        END IF;
+
+        IF EXISTS(SELECT 1 FROM node_grid_cache LIMIT 1) THEN
+            UPDATE node_grid_cache_cell c
+            SET dirty = true
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE NOT cc.allow_empty
+            AND c.grid_id = cc.grid_id
+            AND c.x_index = cc.x_index
+            AND c.y_index = cc.y_index
+            AND c.z_index = cc.z_index
+            AND NOT c.dirty;
+
+            INSERT INTO node_grid_cache_cell (grid_id, x_index, y_index, z_index, dirty)
+            SELECT cc.grid_id, cc.x_index, cc.y_index, cc.z_index, true
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE cc.allow_empty
+            ON CONFLICT (grid_id, x_index, y_index, z_index)
+            DO UPDATE SET dirty = true;
+        END IF;
+    END;
+    $$;
+
+
+    -- Both the treenode_edge table and the treenode_connector_edge table have
+    -- an "edge" column, which allows to share the trigger function.
+    CREATE OR REPLACE FUNCTION on_change_edge_invalidate_node_query_cache() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+            PERFORM mark_node_query_cache_dirty(array_agg(project_id), array_agg(edge))
+            FROM new_edge;
+        END IF;
+        IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+            PERFORM mark_node_query_cache_dirty(array_agg(project_id), array_agg(edge))
+            FROM old_edge;
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION on_change_connector_geom_invalidate_node_query_cache() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+            PERFORM mark_node_query_cache_dirty(array_agg(project_id), array_agg(geom))
+            FROM new_edge;
+        END IF;
+        IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+            PERFORM mark_node_query_cache_dirty(array_agg(project_id), array_agg(geom))
+            FROM old_edge;
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE TRIGGER on_insert_treenode_edge_invalidate_node_query_cache
+    AFTER INSERT ON treenode_edge
+    REFERENCING NEW TABLE as new_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_invalidate_node_query_cache();
+
+    CREATE TRIGGER on_edit_treenode_edge_invalidate_node_query_cache
+    AFTER UPDATE ON treenode_edge
+    REFERENCING NEW TABLE as new_edge OLD TABLE as old_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_invalidate_node_query_cache();
+
+    CREATE TRIGGER on_delete_treenode_edge_invalidate_node_query_cache
+    AFTER DELETE ON treenode_edge
+    REFERENCING OLD TABLE as old_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_invalidate_node_query_cache();
+
+    CREATE TRIGGER on_insert_treenode_connector_edge_invalidate_node_query_cache
+    AFTER INSERT ON treenode_connector_edge
+    REFERENCING NEW TABLE as new_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_invalidate_node_query_cache();
+
+    CREATE TRIGGER on_edit_treenode_connector_edge_invalidate_node_query_cache
+    AFTER UPDATE ON treenode_connector_edge
+    REFERENCING NEW TABLE as new_edge OLD TABLE as old_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_invalidate_node_query_cache();
+
+    CREATE TRIGGER on_delete_treenode_connector_edge_invalidate_node_query_cache
+    AFTER DELETE ON treenode_connector_edge
+    REFERENCING OLD TABLE as old_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_edge_invalidate_node_query_cache();
+
+    CREATE TRIGGER on_insert_connector_geom_invalidate_node_query_cache
+    AFTER INSERT ON connector_geom
+    REFERENCING NEW TABLE as new_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_connector_geom_invalidate_node_query_cache();
+
+    CREATE TRIGGER on_edit_connector_geom_invalidate_node_query_cache
+    AFTER UPDATE ON connector_geom
+    REFERENCING NEW TABLE as new_edge OLD TABLE as old_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_connector_geom_invalidate_node_query_cache();
+
+    CREATE TRIGGER on_delete_connector_geom_invalidate_node_query_cache
+    AFTER DELETE ON connector_geom
+    REFERENCING OLD TABLE as old_edge
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_connector_geom_invalidate_node_query_cache();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_treenode_edge_invalidate_node_query_cache ON treenode_edge;
+    DROP TRIGGER on_edit_treenode_edge_invalidate_node_query_cache ON treenode_edge;
+    DROP TRIGGER on_delete_treenode_edge_invalidate_node_query_cache ON treenode_edge;
+    DROP TRIGGER on_insert_treenode_connector_edge_invalidate_node_query_cache ON treenode_connector_edge;
+    DROP TRIGGER on_edit_treenode_connector_edge_invalidate_node_query_cache ON treenode_connector_edge;
+    DROP TRIGGER on_delete_treenode_connector_edge_invalidate_node_query_cache ON treenode_connector_edge;
+    DROP TRIGGER on_insert_connector_geom_invalidate_node_query_cache ON connector_geom;
+    DROP TRIGGER on_edit_connector_geom_invalidate_node_query_cache ON connector_geom;
+    DROP TRIGGER on_delete_connector_geom_invalidate_node_query_cache ON connector_geom;
+
+    DROP FUNCTION on_change_edge_invalidate_node_query_cache();
+    DROP FUNCTION on_change_connector_geom_invalidate_node_query_cache();
+    DROP FUNCTION mark_node_query_cache_dirty(integer[], geometry[]);
+    DROP FUNCTION get_intersecting_node_grid_cache_cells(integer[], geometry[]);
+
+    DROP INDEX node_query_cache_dirty_idx;
+    DROP INDEX node_grid_cache_cell_dirty_idx;
+
+    ALTER TABLE node_grid_cache_cell
+    DROP COLUMN dirty;
+
+    ALTER TABLE node_query_cache
+    DROP COLUMN step,
+    DROP COLUMN dirty;
+"""
+
+
+class Migration(migrations.Migration):
+    """Mark node query cache entries as dirty as soon as tracing data in their
+    bounding box changes. Dirty entries are ignored by the cached node
+    providers and can be refreshed selectively.
+    """
+
+    dependencies = [
+        ('catmaid', '0056_add_node_grid_cache_tables'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nodequerycache',
+                name='step',
+                field=models.FloatField(null=True),
+            ),
+            migrations.AddField(
+                model_name='nodequerycache',
+                name='dirty',
+                field=models.BooleanField(default=False),
+            ),
+            migrations.AddField(
+                model_name='nodegridcachecell',
+                name='dirty',
+                field=models.BooleanField(default=False),
+            ),
+        ]),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+
+
+forward = """
+    -- Pre-compressed representations of the JSON text and msgpack data, which
+    -- can be sent to clients without any re-encoding.
+    ALTER TABLE node_query_cache
+    ADD COLUMN json_text_gzip_data bytea,
+    ADD COLUMN json_text_br_data bytea,
+    ADD COLUMN msgpack_gzip_data bytea,
+    ADD COLUMN msgpack_br_data bytea;
+"""
+
+backward = """
+    ALTER TABLE node_query_cache
+    DROP COLUMN json_text_gzip_data,
+    DROP COLUMN json_text_br_data,
+    DROP COLUMN msgpack_gzip_data,
+    DROP COLUMN msgpack_br_data;
+"""
+
+
+class Migration(migrations.Migration):
+    """Allow the node query cache to store gzip and brotli compressed versions
+    of its JSON text and msgpack data.
+    """
+
+    dependencies = [
+        ('catmaid', '0057_add_node_query_cache_invalidation'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nodequerycache',
+                name='json_text_gzip_data',
+                field=models.BinaryField(null=True),
+            ),
+            migrations.AddField(
+                model_name='nodequerycache',
+                name='json_text_br_data',
+                field=models.BinaryField(null=True),
+            ),
+            migrations.AddField(
+                model_name='nodequerycache',
+                name='msgpack_gzip_data',
+                field=models.BinaryField(null=True),
+            ),
+            migrations.AddField(
+                model_name='nodequerycache',
+                name='msgpack_br_data',
+                field=models.BinaryField(null=True),
+            ),
+        ]),
+    ]
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations
+
+
+mark_node_query_cache_dirty_body = """
+        IF EXISTS(SELECT 1 FROM node_query_cache LIMIT 1) THEN
+            UPDATE node_query_cache c
+            SET dirty = true
+            FROM (
+                SELECT DISTINCT g.project_id, ST_ZMin(g.geom), ST_ZMax(g.geom)
+                FROM UNNEST(project_ids, geoms) g(project_id, geom)
+            ) e(project_id, z_min, z_max)
+            WHERE c.project_id = e.project_id
+            AND c.depth <= e.z_max
+            AND (c.depth + c.step > e.z_min OR (c.step IS NULL AND c.depth >= e.z_min))
+            AND NOT c.dirty;
+        END IF;
+
+        IF EXISTS(SELECT 1 FROM node_grid_cache LIMIT 1) THEN
+            UPDATE node_grid_cache_cell c
+            SET dirty = true
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE NOT cc.allow_empty
+            AND c.grid_id = cc.grid_id
+            AND c.x_index = cc.x_index
+            AND c.y_index = cc.y_index
+            AND c.z_index = cc.z_index
+            AND NOT c.dirty;
+
+            INSERT INTO node_grid_cache_cell (grid_id, x_index, y_index, z_index, dirty)
+            SELECT cc.grid_id, cc.x_index, cc.y_index, cc.z_index, true
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE cc.allow_empty
+            ON CONFLICT (grid_id, x_index, y_index, z_index)
+            DO UPDATE SET dirty = true;
+        END IF;
+"""
+
+forward = """
+    -- Besides marking persistent cache entries as dirty, notify listeners on
+    -- the catmaid_node_edits channel about the bounding box of the change in
+    -- each project. Notifications are only delivered once a transaction is
+    -- committed, in commit order, which allows in-memory caches of other
+    -- processes to drop affected results.
+    CREATE OR REPLACE FUNCTION mark_node_query_cache_dirty(project_ids integer[],
+            geoms geometry[]) RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            RETURN;
+        END IF;
+
+        PERFORM pg_notify('catmaid_node_edits', json_build_object(
+                'project_id', e.project_id,
+                'bb', ARRAY[ST_XMin(e.box), ST_YMin(e.box), ST_ZMin(e.box),
+                            ST_XMax(e.box), ST_YMax(e.box), ST_ZMax(e.box)])::text)
+        FROM (
+            SELECT g.project_id, ST_3DExtent(g.geom)
+            FROM UNNEST(project_ids, geoms) g(project_id, geom)
+            GROUP BY g.project_id
+        ) e(project_id, box);
+        """ + mark_node_query_cache_dirty_body + """
+    END;
+    $$;
+
+    -- Attributes like the skeleton ID, the radius or the confidence of a
+    -- treenode can change without any change of its edge. Cached results
+    -- that include these nodes are found through the edges of the changed
+    -- nodes and their child nodes.
+    CREATE OR REPLACE FUNCTION on_edit_treenode_invalidate_node_query_cache() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        PERFORM mark_node_query_cache_dirty(array_agg(e.project_id), array_agg(e.edge))
+        FROM (
+            SELECT te.project_id, te.edge
+            FROM new_treenode t
+            JOIN treenode_edge te
+                ON te.id = t.id
+            UNION
+            SELECT te.project_id, te.edge
+            FROM new_treenode t
+            JOIN treenode c
+                ON c.parent_id = t.id
+            JOIN treenode_edge te
+                ON te.id = c.id
+        ) e;
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_edit_treenode_invalidate_node_query_cache
+    AFTER UPDATE ON treenode
+    REFERENCING NEW TABLE as new_treenode
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_treenode_invalidate_node_query_cache();
+"""
+
+backward = """
+    DROP TRIGGER on_edit_treenode_invalidate_node_query_cache ON treenode;
+    DROP FUNCTION on_edit_treenode_invalidate_node_query_cache();
+
+    CREATE OR REPLACE FUNCTION mark_node_query_cache_dirty(project_ids integer[],
+            geoms geometry[]) RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            RETURN;
+        END IF;
+        """ + mark_node_query_cache_dirty_body + """
+    END;
+    $$;
+"""
+
+
+class Migration(migrations.Migration):
+    """Notify listeners about the bounding box of tracing data changes and
+    invalidate node query caches also when treenodes change without a change
+    of their edges, e.g. when skeletons are joined or split.
+    """
+
+    dependencies = [
+        ('catmaid', '0058_add_node_query_cache_compressed_data'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+forward = """
+    -- Every change of a skeleton's nodes, connector links, connectors, tags
+    -- or reviews gives the skeleton a new export version. Versions are taken
+    -- from a sequence, which makes them unique across skeletons and over time.
+    -- Skeletons without an entry have version 0. Neither table has a history
+    -- table associated, they are pure caches.
+    CREATE SEQUENCE skeleton_export_version_seq;
+
+    CREATE TABLE skeleton_export_version (
+        skeleton_id bigint PRIMARY KEY,
+        version bigint DEFAULT nextval('skeleton_export_version_seq') NOT NULL
+    );
+
+    CREATE TABLE skeleton_export_cache (
+        id bigserial PRIMARY KEY,
+        project_id integer REFERENCES project (id) ON DELETE CASCADE NOT NULL,
+        skeleton_id bigint REFERENCES class_instance (id) ON DELETE CASCADE NOT NULL,
+        export_type text NOT NULL,
+        options text NOT NULL,
+        version bigint NOT NULL,
+        update_time timestamptz DEFAULT now() NOT NULL,
+        data bytea NOT NULL,
+        CONSTRAINT skeleton_export_cache_skeleton_type_options_unique
+            UNIQUE (skeleton_id, export_type, options)
+    );
+
+    CREATE INDEX skeleton_export_cache_project_id_idx
+        ON skeleton_export_cache (project_id);
+
+
+    CREATE OR REPLACE FUNCTION bump_skeleton_export_version(skeleton_ids bigint[])
+    RETURNS void
+    LANGUAGE sql AS
+    $$
+        INSERT INTO skeleton_export_version (skeleton_id)
+        SELECT DISTINCT skeleton_id
+        FROM UNNEST(skeleton_ids) s(skeleton_id)
+        WHERE skeleton_id IS NOT NULL
+        ORDER BY skeleton_id
+        ON CONFLICT (skeleton_id)
+        DO UPDATE SET version = EXCLUDED.version;
+    $$;
+
+    CREATE OR REPLACE FUNCTION on_change_treenode_bump_skeleton_export_version()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+            PERFORM bump_skeleton_export_version(array_agg(skeleton_id))
+            FROM new_row;
+        END IF;
+        IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+            PERFORM bump_skeleton_export_version(array_agg(skeleton_id))
+            FROM old_row;
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+
+    -- Compact arbors include the partner skeletons of each connector, which
+    -- is why all skeletons linked to a changed connector get a new version.
+    CREATE OR REPLACE FUNCTION on_change_treenode_connector_bump_skeleton_export_version()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+            PERFORM bump_skeleton_export_version(array_agg(skeleton_id))
+            FROM (
+                SELECT skeleton_id FROM new_row
+                UNION
+                SELECT tc.skeleton_id
+                FROM treenode_connector tc
+                JOIN (SELECT DISTINCT connector_id FROM new_row) c
+                    ON c.connector_id = tc.connector_id
+            ) s;
+        END IF;
+        IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+            PERFORM bump_skeleton_export_version(array_agg(skeleton_id))
+            FROM (
+                SELECT skeleton_id FROM old_row
+                UNION
+                SELECT tc.skeleton_id
+                FROM treenode_connector tc
+                JOIN (SELECT DISTINCT connector_id FROM old_row) c
+                    ON c.connector_id = tc.connector_id
+            ) s;
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION on_edit_connector_bump_skeleton_export_version()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        PERFORM bump_skeleton_export_version(array_agg(tc.skeleton_id))
+        FROM treenode_connector tc
+        JOIN new_row c
+            ON c.id = tc.connector_id;
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE OR REPLACE FUNCTION on_change_treenode_class_instance_bump_skeleton_export_version()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+            PERFORM bump_skeleton_export_version(array_agg(t.skeleton_id))
+            FROM treenode t
+            JOIN new_row tci
+                ON tci.treenode_id = t.id;
+        END IF;
+        IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+            PERFORM bump_skeleton_export_version(array_agg(t.skeleton_id))
+            FROM treenode t
+            JOIN old_row tci
+                ON tci.treenode_id = t.id;
+        END IF;
+        RETURN NULL;
+    END;
+    $$;
+
+    -- Tags are exported with their name, renaming a label changes the export
+    -- of all skeletons it is linked to.
+    CREATE OR REPLACE FUNCTION on_edit_class_instance_bump_skeleton_export_version()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        PERFORM bump_skeleton_export_version(array_agg(t.skeleton_id))
+        FROM new_row ci
+        JOIN old_row oci
+            ON oci.id = ci.id
+            AND oci.name <> ci.name
+        JOIN treenode_class_instance tci
+            ON tci.class_instance_id = ci.id
+        JOIN treenode t
+            ON t.id = tci.treenode_id;
+        RETURN NULL;
+    END;
+    $$;
+
+
+    CREATE TRIGGER on_insert_treenode_bump_skeleton_export_version
+    AFTER INSERT ON treenode
+    REFERENCING NEW TABLE as new_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_edit_treenode_bump_skeleton_export_version
+    AFTER UPDATE ON treenode
+    REFERENCING NEW TABLE as new_row OLD TABLE as old_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_delete_treenode_bump_skeleton_export_version
+    AFTER DELETE ON treenode
+    REFERENCING OLD TABLE as old_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_insert_treenode_connector_bump_skeleton_export_version
+    AFTER INSERT ON treenode_connector
+    REFERENCING NEW TABLE as new_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_connector_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_edit_treenode_connector_bump_skeleton_export_version
+    AFTER UPDATE ON treenode_connector
+    REFERENCING NEW TABLE as new_row OLD TABLE as old_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_connector_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_delete_treenode_connector_bump_skeleton_export_version
+    AFTER DELETE ON treenode_connector
+    REFERENCING OLD TABLE as old_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_connector_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_edit_connector_bump_skeleton_export_version
+    AFTER UPDATE ON connector
+    REFERENCING NEW TABLE as new_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_connector_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_insert_treenode_class_instance_bump_skeleton_export_version
+    AFTER INSERT ON treenode_class_instance
+    REFERENCING NEW TABLE as new_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_class_instance_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_edit_treenode_class_instance_bump_skeleton_export_version
+    AFTER UPDATE ON treenode_class_instance
+    REFERENCING NEW TABLE as new_row OLD TABLE as old_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_class_instance_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_delete_treenode_class_instance_bump_skeleton_export_version
+    AFTER DELETE ON treenode_class_instance
+    REFERENCING OLD TABLE as old_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_class_instance_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_edit_class_instance_bump_skeleton_export_version
+    AFTER UPDATE ON class_instance
+    REFERENCING NEW TABLE as new_row OLD TABLE as old_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_class_instance_bump_skeleton_export_version();
+
+    -- The review table has a skeleton_id column as well, which allows to
+    -- share the treenode trigger function.
+    CREATE TRIGGER on_insert_review_bump_skeleton_export_version
+    AFTER INSERT ON review
+    REFERENCING NEW TABLE as new_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_edit_review_bump_skeleton_export_version
+    AFTER UPDATE ON review
+    REFERENCING NEW TABLE as new_row OLD TABLE as old_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_bump_skeleton_export_version();
+
+    CREATE TRIGGER on_delete_review_bump_skeleton_export_version
+    AFTER DELETE ON review
+    REFERENCING OLD TABLE as old_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_treenode_bump_skeleton_export_version();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_treenode_bump_skeleton_export_version ON treenode;
+    DROP TRIGGER on_edit_treenode_bump_skeleton_export_version ON treenode;
+    DROP TRIGGER on_delete_treenode_bump_skeleton_export_version ON treenode;
+    DROP TRIGGER on_insert_treenode_connector_bump_skeleton_export_version ON treenode_connector;
+    DROP TRIGGER on_edit_treenode_connector_bump_skeleton_export_version ON treenode_connector;
+    DROP TRIGGER on_delete_treenode_connector_bump_skeleton_export_version ON treenode_connector;
+    DROP TRIGGER on_edit_connector_bump_skeleton_export_version ON connector;
+    DROP TRIGGER on_insert_treenode_class_instance_bump_skeleton_export_version ON treenode_class_instance;
+    DROP TRIGGER on_edit_treenode_class_instance_bump_skeleton_export_version ON treenode_class_instance;
+    DROP TRIGGER on_delete_treenode_class_instance_bump_skeleton_export_version ON treenode_class_instance;
+    DROP TRIGGER on_edit_class_instance_bump_skeleton_export_version ON class_instance;
+    DROP TRIGGER on_insert_review_bump_skeleton_export_version ON review;
+    DROP TRIGGER on_edit_review_bump_skeleton_export_version ON review;
+    DROP TRIGGER on_delete_review_bump_skeleton_export_version ON review;
+
+    DROP FUNCTION on_change_treenode_bump_skeleton_export_version();
+    DROP FUNCTION on_change_treenode_connector_bump_skeleton_export_version();
+    DROP FUNCTION on_edit_connector_bump_skeleton_export_version();
+    DROP FUNCTION on_change_treenode_class_instance_bump_skeleton_export_version();
+    DROP FUNCTION on_edit_class_instance_bump_skeleton_export_version();
+    DROP FUNCTION bump_skeleton_export_version(bigint[]);
+
+    DROP TABLE skeleton_export_cache;
+    DROP TABLE skeleton_export_version;
+    DROP SEQUENCE skeleton_export_version_seq;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a persistent cache for serialized skeleton exports. Each skeleton
+    has an export version, which changes with every edit of its nodes,
+    connectors, tags or reviews. Cache entries are only valid for the version
+    they were created for.
+    """
+
+    dependencies = [
+        ('catmaid', '0059_add_node_edit_notifications'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.CreateModel(
+                name='SkeletonExportVersion',
+                fields=[
+                    ('skeleton_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                    ('version', models.BigIntegerField()),
+                ],
+                options={
+                    'db_table': 'skeleton_export_version',
+                },
+            ),
+            migrations.CreateModel(
+                name='SkeletonExportCache',
+                fields=[
+                    ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                    ('export_type', models.TextField()),
+                    ('options', models.TextField()),
+                    ('version', models.BigIntegerField()),
+                    ('update_time', models.DateTimeField(default=django.utils.timezone.now)),
+                    ('data', models.BinaryField()),
+                    ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                    ('skeleton', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.ClassInstance')),
+                ],
+                options={
+                    'db_table': 'skeleton_export_cache',
+                },
+            ),
+            migrations.AlterUniqueTogether(
+                name='skeletonexportcache',
+                unique_together=set([('skeleton', 'export_type', 'options')]),
+            ),
+        ]),
+    ]
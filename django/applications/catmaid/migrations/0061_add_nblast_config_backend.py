@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+
+
+forward = """
+    SELECT disable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass));
+
+    -- The NBLAST implementation used to compute scoring matrices and
+    -- similarities with a configuration: 'r' uses the nat.nblast R package
+    -- through Rpy2, 'native' the NumPy implementation in CATMAID.
+    ALTER TABLE nblast_config
+    ADD COLUMN backend text DEFAULT 'r' NOT NULL;
+
+    ALTER TABLE nblast_config
+    ADD CONSTRAINT nblast_config_backend_check
+    CHECK (backend IN ('r', 'native'));
+
+    -- Update history table
+    ALTER TABLE nblast_config__history
+    ADD COLUMN backend text;
+
+    UPDATE nblast_config__history
+    SET backend = 'r';
+
+    SELECT enable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass), FALSE);
+"""
+
+backward = """
+    SELECT disable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass));
+
+    ALTER TABLE nblast_config
+    DROP COLUMN backend;
+    ALTER TABLE nblast_config__history
+    DROP COLUMN backend;
+
+    SELECT enable_history_tracking_for_table('nblast_config'::regclass,
+            get_history_table_name('nblast_config'::regclass), FALSE);
+"""
+
+
+class Migration(migrations.Migration):
+    """Let each NBLAST configuration select whether it is computed with R or
+    with CATMAID's own NumPy implementation.
+    """
+
+    dependencies = [
+        ('catmaid', '0060_add_skeleton_export_cache'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nblastconfig',
+                name='backend',
+                field=models.TextField(default='r'),
+            ),
+        ]),
+    ]
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+forward = """
+    -- Precomputed NBLAST dotprops (points, tangents and alpha) of skeletons,
+    -- point clouds and point sets, stored as little-endian float32 arrays.
+    -- Skeleton entries are valid for the skeleton's export version, point
+    -- cloud and point set entries for the edition time of the object (in
+    -- microseconds since epoch). Point clouds and point sets aren't resampled
+    -- and are stored with a resample step of 0. Entries of skeletons that
+    -- aren't simplified have -1 as required_branches.
+    CREATE TABLE nblast_dotprops_cache (
+        id bigserial PRIMARY KEY,
+        project_id integer REFERENCES project (id) ON DELETE CASCADE NOT NULL,
+        object_type text NOT NULL,
+        object_id bigint NOT NULL,
+        resample_step double precision NOT NULL,
+        tangent_neighbors integer NOT NULL,
+        required_branches integer NOT NULL,
+        version bigint NOT NULL,
+        update_time timestamptz DEFAULT now() NOT NULL,
+        n_points integer NOT NULL,
+        points bytea NOT NULL,
+        tangents bytea NOT NULL,
+        alpha bytea NOT NULL,
+        CONSTRAINT nblast_dotprops_cache_object_type_check
+            CHECK (object_type IN ('skeleton', 'pointcloud', 'pointset')),
+        CONSTRAINT nblast_dotprops_cache_object_options_unique
+            UNIQUE (object_type, object_id, resample_step, tangent_neighbors,
+                required_branches)
+    );
+
+    CREATE INDEX nblast_dotprops_cache_project_id_idx
+        ON nblast_dotprops_cache (project_id);
+
+    -- Remove cached dotprops of edited skeletons right away, rather than
+    -- keeping them around until they are recomputed.
+    CREATE OR REPLACE FUNCTION on_change_skeleton_export_version_clear_dotprops()
+    RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        DELETE FROM nblast_dotprops_cache c
+        USING new_row v
+        WHERE c.object_type = 'skeleton'
+            AND c.object_id = v.skeleton_id
+            AND c.version <> v.version;
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_insert_skeleton_export_version_clear_dotprops
+    AFTER INSERT ON skeleton_export_version
+    REFERENCING NEW TABLE as new_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_skeleton_export_version_clear_dotprops();
+
+    CREATE TRIGGER on_edit_skeleton_export_version_clear_dotprops
+    AFTER UPDATE ON skeleton_export_version
+    REFERENCING NEW TABLE as new_row
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_change_skeleton_export_version_clear_dotprops();
+"""
+
+backward = """
+    DROP TRIGGER on_insert_skeleton_export_version_clear_dotprops ON skeleton_export_version;
+    DROP TRIGGER on_edit_skeleton_export_version_clear_dotprops ON skeleton_export_version;
+    DROP FUNCTION on_change_skeleton_export_version_clear_dotprops();
+    DROP TABLE nblast_dotprops_cache;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a persistent cache for NBLAST dotprops, so that they don't have to
+    be recomputed for every NBLAST query. Skeleton entries are removed when
+    the skeleton's export version changes.
+    """
+
+    dependencies = [
+        ('catmaid', '0061_add_nblast_config_backend'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.CreateModel(
+                name='NblastDotpropsCache',
+                fields=[
+                    ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                    ('object_type', models.TextField()),
+                    ('object_id', models.BigIntegerField()),
+                    ('resample_step', models.FloatField()),
+                    ('tangent_neighbors', models.IntegerField()),
+                    ('required_branches', models.IntegerField()),
+                    ('version', models.BigIntegerField()),
+                    ('update_time', models.DateTimeField(default=django.utils.timezone.now)),
+                    ('n_points', models.IntegerField()),
+                    ('points', models.BinaryField()),
+                    ('tangents', models.BinaryField()),
+                    ('alpha', models.BinaryField()),
+                    ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.Project')),
+                ],
+                options={
+                    'db_table': 'nblast_dotprops_cache',
+                },
+            ),
+            migrations.AlterUniqueTogether(
+                name='nblastdotpropscache',
+                unique_together=set([('object_type', 'object_id',
+                    'resample_step', 'tangent_neighbors', 'required_branches')]),
+            ),
+        ]),
+    ]
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+forward = """
+    -- Partial results of NBLAST similarity matrices that are computed in
+    -- tiles. Each tile covers the query rows [query_start, query_end) and the
+    -- target columns [target_start, target_end) of the similarity matrix and
+    -- stores its scores as little-endian float32 array in row-major order.
+    -- Tiles are removed once the complete matrix has been stored.
+    CREATE TABLE nblast_similarity_tile (
+        id bigserial PRIMARY KEY,
+        similarity_id integer REFERENCES nblast_similarity (id) ON DELETE CASCADE NOT NULL,
+        query_start integer NOT NULL,
+        query_end integer NOT NULL,
+        target_start integer NOT NULL,
+        target_end integer NOT NULL,
+        scores bytea NOT NULL,
+        CONSTRAINT nblast_similarity_tile_bounds_unique
+            UNIQUE (similarity_id, query_start, query_end, target_start, target_end)
+    );
+"""
+
+backward = """
+    DROP TABLE nblast_similarity_tile;
+"""
+
+
+class Migration(migrations.Migration):
+    """Allow NBLAST similarity matrices to be computed in tiles, which are
+    stored as soon as they are computed, so that interrupted computations can
+    be resumed.
+    """
+
+    dependencies = [
+        ('catmaid', '0062_add_nblast_dotprops_cache'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.CreateModel(
+                name='NblastSimilarityTile',
+                fields=[
+                    ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                    ('query_start', models.IntegerField()),
+                    ('query_end', models.IntegerField()),
+                    ('target_start', models.IntegerField()),
+                    ('target_end', models.IntegerField()),
+                    ('scores', models.BinaryField()),
+                    ('similarity', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='catmaid.NblastSimilarity')),
+                ],
+                options={
+                    'db_table': 'nblast_similarity_tile',
+                },
+            ),
+            migrations.AlterUniqueTogether(
+                name='nblastsimilaritytile',
+                unique_together=set([('similarity', 'query_start', 'query_end',
+                    'target_start', 'target_end')]),
+            ),
+        ]),
+    ]
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+from django.contrib.postgres.fields import ArrayField
+from django.db import migrations, models
+
+
+forward = """
+    SELECT disable_history_tracking_for_table('nblast_similarity'::regclass,
+            get_history_table_name('nblast_similarity'::regclass));
+
+    -- Similarity matrices are either stored in the scoring column ('array') or
+    -- in a binary file in the given float format, in which case the scoring
+    -- column is NULL.
+    ALTER TABLE nblast_similarity
+    ADD COLUMN storage text DEFAULT 'array' NOT NULL;
+
+    ALTER TABLE nblast_similarity ADD CONSTRAINT check_valid_storage
+        CHECK (storage IN ('array', 'float32', 'float16'));
+
+    -- Update history table
+    ALTER TABLE nblast_similarity__history
+    ADD COLUMN storage text;
+
+    UPDATE nblast_similarity__history
+    SET storage = 'array';
+
+    SELECT enable_history_tracking_for_table('nblast_similarity'::regclass,
+            get_history_table_name('nblast_similarity'::regclass), FALSE);
+"""
+
+backward = """
+    SELECT disable_history_tracking_for_table('nblast_similarity'::regclass,
+            get_history_table_name('nblast_similarity'::regclass));
+
+    ALTER TABLE nblast_similarity
+    DROP COLUMN storage;
+    ALTER TABLE nblast_similarity__history
+    DROP COLUMN storage;
+
+    SELECT enable_history_tracking_for_table('nblast_similarity'::regclass,
+            get_history_table_name('nblast_similarity'::regclass), FALSE);
+"""
+
+
+class Migration(migrations.Migration):
+    """Allow NBLAST similarity matrices to be stored as binary float32 or
+    float16 files, which can be read partially.
+    """
+
+    dependencies = [
+        ('catmaid', '0063_add_nblast_similarity_tiles'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nblastsimilarity',
+                name='storage',
+                field=models.TextField(default='array')),
+            migrations.AlterField(
+                model_name='nblastsimilarity',
+                name='scoring',
+                field=ArrayField(base_field=ArrayField(
+                    base_field=models.FloatField(), size=None), null=True,
+                    size=None)),
+        ]),
+    ]
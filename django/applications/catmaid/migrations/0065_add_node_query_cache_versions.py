@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+
+
+mark_node_query_cache_dirty_notify = """
+        PERFORM pg_notify('catmaid_node_edits', json_build_object(
+                'project_id', e.project_id,
+                'bb', ARRAY[ST_XMin(e.box), ST_YMin(e.box), ST_ZMin(e.box),
+                            ST_XMax(e.box), ST_YMax(e.box), ST_ZMax(e.box)])::text)
+        FROM (
+            SELECT g.project_id, ST_3DExtent(g.geom)
+            FROM UNNEST(project_ids, geoms) g(project_id, geom)
+            GROUP BY g.project_id
+        ) e(project_id, box);
+"""
+
+forward = """
+    -- Every change that marks a cache entry as dirty also increments its
+    -- version. Cache updates compute results without holding locks and only
+    -- store them if the version of an entry didn't change in the meantime.
+    ALTER TABLE node_query_cache
+    ADD COLUMN version integer DEFAULT 0 NOT NULL;
+
+    ALTER TABLE node_grid_cache_cell
+    ADD COLUMN version integer DEFAULT 0 NOT NULL;
+
+    -- Entries created before the depth resolution was stored get the distance
+    -- to the next section as their step.
+    UPDATE node_query_cache c
+    SET step = s.step
+    FROM (
+        SELECT id, COALESCE(
+            lead(depth) OVER w - depth,
+            depth - lag(depth) OVER w) AS step
+        FROM node_query_cache
+        WINDOW w AS (PARTITION BY project_id, orientation ORDER BY depth)
+    ) s
+    WHERE c.id = s.id
+    AND c.step IS NULL;
+
+    -- Sections without a known step (a single section in an orientation) only
+    -- match changes that include their exact depth.
+    CREATE OR REPLACE FUNCTION mark_node_query_cache_dirty(project_ids integer[],
+            geoms geometry[]) RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            RETURN;
+        END IF;
+        """ + mark_node_query_cache_dirty_notify + """
+        IF EXISTS(SELECT 1 FROM node_query_cache LIMIT 1) THEN
+            UPDATE node_query_cache c
+            SET dirty = true, version = c.version + 1
+            FROM (
+                SELECT DISTINCT g.project_id, ST_ZMin(g.geom), ST_ZMax(g.geom)
+                FROM UNNEST(project_ids, geoms) g(project_id, geom)
+            ) e(project_id, z_min, z_max)
+            WHERE c.project_id = e.project_id
+            AND CASE WHEN c.step IS NULL
+                THEN c.depth BETWEEN e.z_min AND e.z_max
+                ELSE c.depth <= e.z_max AND c.depth + c.step > e.z_min
+            END;
+        END IF;
+
+        IF EXISTS(SELECT 1 FROM node_grid_cache LIMIT 1) THEN
+            UPDATE node_grid_cache_cell c
+            SET dirty = true, version = c.version + 1
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE NOT cc.allow_empty
+            AND c.grid_id = cc.grid_id
+            AND c.x_index = cc.x_index
+            AND c.y_index = cc.y_index
+            AND c.z_index = cc.z_index;
+
+            INSERT INTO node_grid_cache_cell (grid_id, x_index, y_index, z_index,
+                dirty, version)
+            SELECT cc.grid_id, cc.x_index, cc.y_index, cc.z_index, true, 1
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE cc.allow_empty
+            ON CONFLICT (grid_id, x_index, y_index, z_index)
+            DO UPDATE SET dirty = true, version = node_grid_cache_cell.version + 1;
+        END IF;
+    END;
+    $$;
+"""
+
+backward = """
+    CREATE OR REPLACE FUNCTION mark_node_query_cache_dirty(project_ids integer[],
+            geoms geometry[]) RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            RETURN;
+        END IF;
+        """ + mark_node_query_cache_dirty_notify + """
+        IF EXISTS(SELECT 1 FROM node_query_cache LIMIT 1) THEN
+            UPDATE node_query_cache c
+            SET dirty = true
+            FROM (
+                SELECT DISTINCT g.project_id, ST_ZMin(g.geom), ST_ZMax(g.geom)
+                FROM UNNEST(project_ids, geoms) g(project_id, geom)
+            ) e(project_id, z_min, z_max)
+            WHERE c.project_id = e.project_id
+            AND c.depth <= e.z_max
+            AND (c.depth + c.step > e.z_min OR (c.step IS NULL AND c.depth >= e.z_min))
+            AND NOT c.dirty;
+        END IF;
+
+        IF EXISTS(SELECT 1 FROM node_grid_cache LIMIT 1) THEN
+            UPDATE node_grid_cache_cell c
+            SET dirty = true
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE NOT cc.allow_empty
+            AND c.grid_id = cc.grid_id
+            AND c.x_index = cc.x_index
+            AND c.y_index = cc.y_index
+            AND c.z_index = cc.z_index
+            AND NOT c.dirty;
+
+            INSERT INTO node_grid_cache_cell (grid_id, x_index, y_index, z_index, dirty)
+            SELECT cc.grid_id, cc.x_index, cc.y_index, cc.z_index, true
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE cc.allow_empty
+            ON CONFLICT (grid_id, x_index, y_index, z_index)
+            DO UPDATE SET dirty = true;
+        END IF;
+    END;
+    $$;
+
+    ALTER TABLE node_query_cache
+    DROP COLUMN version;
+
+    ALTER TABLE node_grid_cache_cell
+    DROP COLUMN version;
+"""
+
+
+class Migration(migrations.Migration):
+    """Add a version to node query cache entries, which is incremented on
+    every invalidation. This allows cache updates to compute results without
+    locking entries. Also, sections without a known depth resolution are only
+    invalidated by changes at their exact depth.
+    """
+
+    dependencies = [
+        ('catmaid', '0064_add_nblast_similarity_storage'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nodequerycache',
+                name='version',
+                field=models.IntegerField(default=0),
+            ),
+            migrations.AddField(
+                model_name='nodegridcachecell',
+                name='version',
+                field=models.IntegerField(default=0),
+            ),
+        ]),
+    ]
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations
+
+
+mark_node_query_cache_dirty_body = """
+        IF EXISTS(SELECT 1 FROM node_query_cache LIMIT 1) THEN
+            UPDATE node_query_cache c
+            SET dirty = true, version = c.version + 1
+            FROM (
+                SELECT DISTINCT g.project_id, ST_ZMin(g.geom), ST_ZMax(g.geom)
+                FROM UNNEST(project_ids, geoms) g(project_id, geom)
+            ) e(project_id, z_min, z_max)
+            WHERE c.project_id = e.project_id
+            AND CASE WHEN c.step IS NULL
+                THEN c.depth BETWEEN e.z_min AND e.z_max
+                ELSE c.depth <= e.z_max AND c.depth + c.step > e.z_min
+            END;
+        END IF;
+
+        IF EXISTS(SELECT 1 FROM node_grid_cache LIMIT 1) THEN
+            UPDATE node_grid_cache_cell c
+            SET dirty = true, version = c.version + 1
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE NOT cc.allow_empty
+            AND c.grid_id = cc.grid_id
+            AND c.x_index = cc.x_index
+            AND c.y_index = cc.y_index
+            AND c.z_index = cc.z_index;
+
+            INSERT INTO node_grid_cache_cell (grid_id, x_index, y_index, z_index,
+                dirty, version)
+            SELECT cc.grid_id, cc.x_index, cc.y_index, cc.z_index, true, 1
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE cc.allow_empty
+            ON CONFLICT (grid_id, x_index, y_index, z_index)
+            DO UPDATE SET dirty = true, version = node_grid_cache_cell.version + 1;
+        END IF;
+"""
+
+notify_body = """
+        PERFORM pg_notify('catmaid_node_edits', json_build_object(
+                'project_id', e.project_id,
+                'bb', ARRAY[ST_XMin(e.box), ST_YMin(e.box), ST_ZMin(e.box),
+                            ST_XMax(e.box), ST_YMax(e.box), ST_ZMax(e.box)])::text)
+        FROM (
+            SELECT g.project_id, ST_3DExtent(g.geom)
+            FROM UNNEST(project_ids, geoms) g(project_id, geom)
+            GROUP BY g.project_id
+        ) e(project_id, box);
+"""
+
+forward = """
+    -- Edit notifications are only sent if the connection that makes the change
+    -- enabled them with the catmaid.notify_node_edits setting, which is done
+    -- by processes that use the node result cache.
+    CREATE OR REPLACE FUNCTION mark_node_query_cache_dirty(project_ids integer[],
+            geoms geometry[]) RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            RETURN;
+        END IF;
+
+        IF current_setting('catmaid.notify_node_edits', true) = 'on' THEN
+            """ + notify_body + """
+        END IF;
+        """ + mark_node_query_cache_dirty_body + """
+    END;
+    $$;
+
+    -- Treenodes with a changed location, parent or skeleton are already
+    -- handled by the triggers on treenode_edge, which is updated for them and
+    -- their child nodes. Only other changes, e.g. of the radius or the
+    -- confidence, need to be handled separately. The location of these nodes
+    -- is enough to find all cached results that include them.
+    DROP TRIGGER on_edit_treenode_invalidate_node_query_cache ON treenode;
+
+    CREATE OR REPLACE FUNCTION on_edit_treenode_invalidate_node_query_cache() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        PERFORM mark_node_query_cache_dirty(array_agg(t.project_id),
+                array_agg(ST_MakePoint(t.location_x, t.location_y, t.location_z)))
+        FROM new_treenode t
+        JOIN old_treenode ot
+            ON ot.id = t.id
+        WHERE t.location_x = ot.location_x
+        AND t.location_y = ot.location_y
+        AND t.location_z = ot.location_z
+        AND t.parent_id IS NOT DISTINCT FROM ot.parent_id
+        AND t.skeleton_id = ot.skeleton_id;
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_edit_treenode_invalidate_node_query_cache
+    AFTER UPDATE ON treenode
+    REFERENCING NEW TABLE as new_treenode OLD TABLE as old_treenode
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_treenode_invalidate_node_query_cache();
+"""
+
+backward = """
+    CREATE OR REPLACE FUNCTION mark_node_query_cache_dirty(project_ids integer[],
+            geoms geometry[]) RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            RETURN;
+        END IF;
+        """ + notify_body + mark_node_query_cache_dirty_body + """
+    END;
+    $$;
+
+    DROP TRIGGER on_edit_treenode_invalidate_node_query_cache ON treenode;
+
+    CREATE OR REPLACE FUNCTION on_edit_treenode_invalidate_node_query_cache() RETURNS trigger
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        PERFORM mark_node_query_cache_dirty(array_agg(e.project_id), array_agg(e.edge))
+        FROM (
+            SELECT te.project_id, te.edge
+            FROM new_treenode t
+            JOIN treenode_edge te
+                ON te.id = t.id
+            UNION
+            SELECT te.project_id, te.edge
+            FROM new_treenode t
+            JOIN treenode c
+                ON c.parent_id = t.id
+            JOIN treenode_edge te
+                ON te.id = c.id
+        ) e;
+        RETURN NULL;
+    END;
+    $$;
+
+    CREATE TRIGGER on_edit_treenode_invalidate_node_query_cache
+    AFTER UPDATE ON treenode
+    REFERENCING NEW TABLE as new_treenode
+    FOR EACH STATEMENT EXECUTE PROCEDURE on_edit_treenode_invalidate_node_query_cache();
+"""
+
+
+class Migration(migrations.Migration):
+    """Only send node edit notifications if they are enabled for a database
+    connection and don't invalidate node query caches twice for moved
+    treenodes.
+    """
+
+    dependencies = [
+        ('catmaid', '0065_add_node_query_cache_versions'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward),
+    ]
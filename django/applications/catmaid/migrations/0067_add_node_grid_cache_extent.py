@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+
+
+section_body = """
+        IF EXISTS(SELECT 1 FROM node_query_cache LIMIT 1) THEN
+            UPDATE node_query_cache c
+            SET dirty = true, version = c.version + 1
+            FROM (
+                SELECT DISTINCT g.project_id, ST_ZMin(g.geom), ST_ZMax(g.geom)
+                FROM UNNEST(project_ids, geoms) g(project_id, geom)
+            ) e(project_id, z_min, z_max)
+            WHERE c.project_id = e.project_id
+            AND CASE WHEN c.step IS NULL
+                THEN c.depth BETWEEN e.z_min AND e.z_max
+                ELSE c.depth <= e.z_max AND c.depth + c.step > e.z_min
+            END;
+        END IF;
+
+"""
+
+old_grid_body = """
+        IF EXISTS(SELECT 1 FROM node_grid_cache LIMIT 1) THEN
+            UPDATE node_grid_cache_cell c
+            SET dirty = true, version = c.version + 1
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE NOT cc.allow_empty
+            AND c.grid_id = cc.grid_id
+            AND c.x_index = cc.x_index
+            AND c.y_index = cc.y_index
+            AND c.z_index = cc.z_index;
+
+            INSERT INTO node_grid_cache_cell (grid_id, x_index, y_index, z_index,
+                dirty, version)
+            SELECT cc.grid_id, cc.x_index, cc.y_index, cc.z_index, true, 1
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            WHERE cc.allow_empty
+            ON CONFLICT (grid_id, x_index, y_index, z_index)
+            DO UPDATE SET dirty = true, version = node_grid_cache_cell.version + 1;
+        END IF;
+"""
+
+grid_body = """
+        IF EXISTS(SELECT 1 FROM node_grid_cache LIMIT 1) THEN
+            INSERT INTO node_grid_cache_cell (grid_id, x_index, y_index, z_index,
+                dirty, version)
+            SELECT cc.grid_id, cc.x_index, cc.y_index, cc.z_index, true, 1
+            FROM get_intersecting_node_grid_cache_cells(project_ids, geoms) cc
+            ON CONFLICT (grid_id, x_index, y_index, z_index)
+            DO UPDATE SET dirty = true, version = node_grid_cache_cell.version + 1;
+        END IF;
+"""
+
+notify_body = """
+        IF current_setting('catmaid.notify_node_edits', true) = 'on' THEN
+            PERFORM pg_notify('catmaid_node_edits', json_build_object(
+                    'project_id', e.project_id,
+                    'bb', ARRAY[ST_XMin(e.box), ST_YMin(e.box), ST_ZMin(e.box),
+                                ST_XMax(e.box), ST_YMax(e.box), ST_ZMax(e.box)])::text)
+            FROM (
+                SELECT g.project_id, ST_3DExtent(g.geom)
+                FROM UNNEST(project_ids, geoms) g(project_id, geom)
+                GROUP BY g.project_id
+            ) e(project_id, box);
+        END IF;
+"""
+
+forward = """
+    -- Grids remember the range of cells that has been populated. Outside of
+    -- it, missing cells are known to be empty.
+    ALTER TABLE node_grid_cache
+    ADD COLUMN min_x_index integer,
+    ADD COLUMN max_x_index integer,
+    ADD COLUMN min_y_index integer,
+    ADD COLUMN max_y_index integer,
+    ADD COLUMN min_z_index integer,
+    ADD COLUMN max_z_index integer;
+
+    UPDATE node_grid_cache g
+    SET min_x_index = c.min_x, max_x_index = c.max_x,
+        min_y_index = c.min_y, max_y_index = c.max_y,
+        min_z_index = c.min_z, max_z_index = c.max_z
+    FROM (
+        SELECT grid_id, MIN(x_index), MAX(x_index), MIN(y_index),
+            MAX(y_index), MIN(z_index), MAX(z_index)
+        FROM node_grid_cache_cell
+        GROUP BY grid_id
+    ) c(grid_id, min_x, max_x, min_y, max_y, min_z, max_z)
+    WHERE g.id = c.grid_id;
+
+    -- Changes in cells that don't exist create dirty placeholder cells in
+    -- all grids, not only in grids that allow empty cells. This way a missing
+    -- cell outside of the populated range is always empty.
+    CREATE OR REPLACE FUNCTION mark_node_query_cache_dirty(project_ids integer[],
+            geoms geometry[]) RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            RETURN;
+        END IF;
+        """ + notify_body + section_body + grid_body + """
+    END;
+    $$;
+"""
+
+backward = """
+    CREATE OR REPLACE FUNCTION mark_node_query_cache_dirty(project_ids integer[],
+            geoms geometry[]) RETURNS void
+    LANGUAGE plpgsql AS
+    $$
+    BEGIN
+        IF project_ids IS NULL THEN
+            RETURN;
+        END IF;
+        """ + notify_body + section_body + old_grid_body + """
+    END;
+    $$;
+
+    ALTER TABLE node_grid_cache
+    DROP COLUMN min_x_index,
+    DROP COLUMN max_x_index,
+    DROP COLUMN min_y_index,
+    DROP COLUMN max_y_index,
+    DROP COLUMN min_z_index,
+    DROP COLUMN max_z_index;
+"""
+
+
+class Migration(migrations.Migration):
+    """Store the populated cell range of node grid caches, so that cells
+    outside of it can be treated as empty.
+    """
+
+    dependencies = [
+        ('catmaid', '0066_limit_node_edit_notifications'),
+    ]
+
+    operations = [
+        migrations.RunSQL(forward, backward, [
+            migrations.AddField(
+                model_name='nodegridcache',
+                name='min_x_index',
+                field=models.IntegerField(null=True),
+            ),
+            migrations.AddField(
+                model_name='nodegridcache',
+                name='max_x_index',
+                field=models.IntegerField(null=True),
+            ),
+            migrations.AddField(
+                model_name='nodegridcache',
+                name='min_y_index',
+                field=models.IntegerField(null=True),
+            ),
+            migrations.AddField(
+                model_name='nodegridcache',
+                name='max_y_index',
+                field=models.IntegerField(null=True),
+            ),
+            migrations.AddField(
+                model_name='nodegridcache',
+                name='min_z_index',
+                field=models.IntegerField(null=True),
+            ),
+            migrations.AddField(
+                model_name='nodegridcache',
+                name='max_z_index',
+                field=models.IntegerField(null=True),
+            ),
+        ]),
+    ]
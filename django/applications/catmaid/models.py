@@ -1021,6 +1021,8 @@ class NblastConfig(NonCascadingUserFocusedModel):
     scoring = ArrayField(ArrayField(models.FloatField()))
     resample_step = models.FloatField(default=1000)
     tangent_neighbors = models.IntegerField(default=5)
+    # Either 'r' (nat.nblast through Rpy2) or 'native' (NumPy)
+    backend = models.TextField(default='r')
 
 
     class Meta:
@@ -1045,7 +1047,8 @@ class NblastSimilarity(NonCascadingUserFocusedModel):
     name = models.TextField()
     status = models.TextField()
     config = models.ForeignKey(NblastConfig, on_delete=models.DO_NOTHING)
-    scoring = ArrayField(ArrayField(models.FloatField()))
+    # NULL if the matrix is stored in a binary file, see <storage>
+    scoring = ArrayField(ArrayField(models.FloatField()), null=True)
     query_type = models.ForeignKey(NblastSkeletonSourceType,
         related_name='query_type_set', on_delete=models.DO_NOTHING)
     target_type = models.ForeignKey(NblastSkeletonSourceType,
@@ -1054,11 +1057,57 @@ class NblastSimilarity(NonCascadingUserFocusedModel):
     target_objects = ArrayField(models.IntegerField())
     normalized = models.TextField(default='raw')
     use_alpha = models.BooleanField(default=False)
+    # Either 'array' (scoring column) or 'float32' and 'float16' (binary file)
+    storage = models.TextField(default='array')
 
     class Meta:
         db_table = "nblast_similarity"
 
 
+class NblastSimilarityTile(models.Model):
+    """The scores of a rectangular part of an NBLAST similarity matrix, stored
+    as little-endian float32 array in row-major order, while the matrix is
+    computed in tiles.
+    """
+    id = models.BigAutoField(primary_key=True)
+    similarity = models.ForeignKey(NblastSimilarity, on_delete=models.CASCADE)
+    query_start = models.IntegerField()
+    query_end = models.IntegerField()
+    target_start = models.IntegerField()
+    target_end = models.IntegerField()
+    scores = models.BinaryField()
+
+    class Meta:
+        db_table = "nblast_similarity_tile"
+        unique_together = (('similarity', 'query_start', 'query_end',
+                'target_start', 'target_end'),)
+
+
+class NblastDotpropsCache(models.Model):
+    """Precomputed NBLAST dotprops of a skeleton, point cloud or point set,
+    stored as little-endian float32 arrays. Entries are only valid for the
+    object version they were created for.
+    """
+    id = models.BigAutoField(primary_key=True)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    object_type = models.TextField()
+    object_id = models.BigIntegerField()
+    resample_step = models.FloatField()
+    tangent_neighbors = models.IntegerField()
+    required_branches = models.IntegerField()
+    version = models.BigIntegerField()
+    update_time = models.DateTimeField(default=timezone.now)
+    n_points = models.IntegerField()
+    points = models.BinaryField()
+    tangents = models.BinaryField()
+    alpha = models.BinaryField()
+
+    class Meta:
+        db_table = "nblast_dotprops_cache"
+        unique_together = (('object_type', 'object_id', 'resample_step',
+                'tangent_neighbors', 'required_branches'),)
+
+
 class PointCloud(NonCascadingUserFocusedModel):
     """A point cloud. Its points are linked through the point_cloud_point
     relation. A non-cascading user focused model is used, because cascading
@@ -1377,16 +1426,87 @@ class NodeQueryCache(models.Model):
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
     orientation = models.IntegerField(default=0, null=False)
     depth = models.FloatField(null=True)
+    step = models.FloatField(null=True)
     update_time = models.DateTimeField(default=timezone.now)
+    dirty = models.BooleanField(default=False)
+    version = models.IntegerField(default=0)
     json_data = JSONField(blank=True, null=True)
     json_text_data = models.TextField(blank=True, null=True)
     msgpack_data = models.BinaryField(null=True)
+    json_text_gzip_data = models.BinaryField(null=True)
+    json_text_br_data = models.BinaryField(null=True)
+    msgpack_gzip_data = models.BinaryField(null=True)
+    msgpack_br_data = models.BinaryField(null=True)
 
     class Meta:
         db_table = "node_query_cache"
         unique_together = (('project', 'orientation', 'depth'),)
 
 
+class NodeGridCache(models.Model):
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    orientation = models.IntegerField(default=0, null=False)
+    cell_width = models.FloatField()
+    cell_height = models.FloatField()
+    cell_depth = models.FloatField()
+    allow_empty = models.BooleanField(default=False)
+    # The range of cell indices that has been populated
+    min_x_index = models.IntegerField(null=True)
+    max_x_index = models.IntegerField(null=True)
+    min_y_index = models.IntegerField(null=True)
+    max_y_index = models.IntegerField(null=True)
+    min_z_index = models.IntegerField(null=True)
+    max_z_index = models.IntegerField(null=True)
+
+    class Meta:
+        db_table = "node_grid_cache"
+        unique_together = (('project', 'orientation', 'cell_width',
+                'cell_height', 'cell_depth'),)
+
+
+class NodeGridCacheCell(models.Model):
+    grid = models.ForeignKey(NodeGridCache, on_delete=models.CASCADE)
+    x_index = models.IntegerField()
+    y_index = models.IntegerField()
+    z_index = models.IntegerField()
+    update_time = models.DateTimeField(default=timezone.now)
+    dirty = models.BooleanField(default=False)
+    version = models.IntegerField(default=0)
+    json_data = JSONField(blank=True, null=True)
+    json_text_data = models.TextField(blank=True, null=True)
+    msgpack_data = models.BinaryField(null=True)
+
+    class Meta:
+        db_table = "node_grid_cache_cell"
+        unique_together = (('grid', 'x_index', 'y_index', 'z_index'),)
+
+
+class SkeletonExportVersion(models.Model):
+    """The export version of a skeleton, which is changed by database triggers
+    on every edit of its nodes, connectors, tags or reviews.
+    """
+    skeleton_id = models.BigIntegerField(primary_key=True)
+    version = models.BigIntegerField()
+
+    class Meta:
+        db_table = "skeleton_export_version"
+
+
+class SkeletonExportCache(models.Model):
+    id = models.BigAutoField(primary_key=True)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE)
+    skeleton = models.ForeignKey(ClassInstance, on_delete=models.CASCADE)
+    export_type = models.TextField()
+    options = models.TextField()
+    version = models.BigIntegerField()
+    update_time = models.DateTimeField(default=timezone.now)
+    data = models.BinaryField()
+
+    class Meta:
+        db_table = "skeleton_export_cache"
+        unique_together = (('skeleton', 'export_type', 'options'),)
+
+
 initial_colors = ((1, 0, 0, 1),
                   (0, 1, 0, 1),
                   (0, 0, 1, 1),
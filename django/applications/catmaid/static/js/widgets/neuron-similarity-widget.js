@@ -1116,6 +1116,7 @@
         let newDistBreaks = CATMAID.Similarity.defaultDistanceBreaks;
         let newDotBreaks = CATMAID.Similarity.defaultDotBreaks;
         let newTangentNeighbors = 20;
+        let newBackend = 'r';
         let backendRandomSelection = true;
         let numRandomNeurons = 1000;
         let lengthRandomNeurons = 10000;
@@ -1251,6 +1252,18 @@
           onchange: function() {
             newTangentNeighbors = parseInt(this.value, 10);
           }
+        }, {
+          type: 'select',
+          label: 'Backend',
+          title: 'Compute NBLAST either with the R packages nat and nat.nblast or natively in CATMAID',
+          value: newBackend,
+          entries: [
+            {title: 'R', value: 'r'},
+            {title: 'Native', value: 'native'},
+          ],
+          onchange: function() {
+            newBackend = this.value;
+          }
         }, {
           type: 'child',
           element: matchSelect,
@@ -1304,7 +1317,8 @@
 
             CATMAID.Similarity.addConfig(project.id, newIndexName,
                 matchingSkeletonIds, randomSkeletonIds, numRandomNeurons,
-                lengthRandomNeurons, newDistBreaks, newDotBreaks, newTangentNeighbors)
+                lengthRandomNeurons, newDistBreaks, newDotBreaks, newTangentNeighbors,
+                newBackend)
               .then(function() {
                 return widget.refresh();
               })
@@ -1437,6 +1451,11 @@
               title: "Tangent neighbors",
               orderable: true,
               class: 'cm-center',
+            }, {
+              data: "backend",
+              title: "Backend",
+              orderable: true,
+              class: 'cm-center',
             }, {
               data: "match_sample",
               title: "Match sample",
@@ -1062,6 +1062,9 @@ SkeletonAnnotations.TracingOverlay.Settings = new CATMAID.Settings(
           subviews_from_cache: {
             default: true
           },
+          prefetch_sections: {
+            default: 0
+          },
           presynaptic_to_rel_color: {
             default: 0xC80000
           },
@@ -3683,7 +3686,8 @@ SkeletonAnnotations.TracingOverlay.prototype.updateNodes = function (callback,
     self.old_height = stackViewer.viewHeight;
 
     // As regular transfer is considered what transfers vector data.
-    var regularTransfer = self.transferFormat == 'json' || self.transferFormat == 'msgpack';
+    var regularTransfer = self.transferFormat == 'json' || self.transferFormat == 'msgpack' ||
+        self.transferFormat == 'columnar';
 
     // No padding for image data
     var padding = regularTransfer ? self.padding : 0;
@@ -3760,6 +3764,22 @@ SkeletonAnnotations.TracingOverlay.prototype.updateNodes = function (callback,
     // be specified.
     // TODO: make parallel request to mirror and main source.
 
+    // Get the node list parameters for the section at the passed in offset
+    // from the current section, as they would be created when moving there.
+    var getSectionParams = function(offset) {
+      var sectionParams = CATMAID.tools.deepCopy(params);
+      var sz0 = z0 + offset, sz1 = z1 + offset;
+      var stack = stackViewer.primaryStack;
+      sectionParams.left = stack.stackToProjectX(sz0, y0, x0);
+      sectionParams.top = stack.stackToProjectY(sz0, y0, x0);
+      sectionParams.z1 = stack.stackToProjectZ(sz0, y0, x0);
+      sectionParams.right = stack.stackToProjectX(sz1, y1, x1);
+      sectionParams.bottom = stack.stackToProjectY(sz1, y1, x1);
+      sectionParams.z2 = stack.stackToProjectZ(sz1, y1, x1);
+      return sectionParams;
+    };
+    var nPrefetchSections = SkeletonAnnotations.TracingOverlay.Settings.session.prefetch_sections;
+
     var success = function (json) {
       // Bail if the overlay was destroyed or suspended before this callback.
       if (self.suspended) {
@@ -3864,6 +3884,8 @@ SkeletonAnnotations.TracingOverlay.prototype.updateNodes = function (callback,
           function(data, dataSize) {
             if (transferFormat === 'msgpack') {
               data = msgpack.decode(new Uint8Array(data));
+            } else if (transferFormat === 'columnar') {
+              data = CATMAID.decodeColumnarNodeList(data);
             } else if (transferFormat === 'png' || transferFormat == 'gif') {
               data = new Uint8Array(data);
             } else {
@@ -3877,6 +3899,10 @@ SkeletonAnnotations.TracingOverlay.prototype.updateNodes = function (callback,
             }
             self.nodeListCache.set(paramsKey, data, dataSize);
             success(data);
+            if (nPrefetchSections > 0 && !dedicatedActiveSkeletonUpdate) {
+              self.prefetchAdjacentSections(url, getSectionParams,
+                  nPrefetchSections, transferFormat, headers);
+            }
           },
           false,
           true,
@@ -3902,6 +3928,65 @@ SkeletonAnnotations.TracingOverlay.prototype.updateNodes = function (callback,
   });
 };
 
+/**
+ * Load the node lists of <nSections> sections below and above the current
+ * section with a single request and add them to the node list cache, unless
+ * all of them are cached already. Parameters of individual sections are
+ * created with getSectionParams(offset).
+ */
+SkeletonAnnotations.TracingOverlay.prototype.prefetchAdjacentSections = function(
+    url, getSectionParams, nSections, transferFormat, headers) {
+  var sectionParams = [];
+  for (var offset=-nSections; offset<=nSections; ++offset) {
+    sectionParams.push(getSectionParams(offset));
+  }
+  var self = this;
+  var missing = sectionParams.some(function(p, i) {
+    return i !== nSections && !self.nodeListCache.get(JSON.stringify(p));
+  });
+  if (!missing) {
+    return;
+  }
+
+  var prefetchParams = CATMAID.tools.deepCopy(sectionParams[nSections]);
+  var binaryTransfer = transferFormat === 'msgpack';
+  prefetchParams['format'] = binaryTransfer ? 'msgpack' : 'json';
+  prefetchParams['n_sections_below'] = nSections;
+  prefetchParams['n_sections_above'] = nSections;
+
+  this.submit(
+    url + '/sections',
+    'GET',
+    prefetchParams,
+    function(data, dataSize) {
+      if (self.suspended) {
+        return;
+      }
+      data = binaryTransfer ? msgpack.decode(new Uint8Array(data)) : JSON.parse(data);
+      if (!data || data.error) {
+        return;
+      }
+      var sectionSize = dataSize / data.length;
+      for (var i=0; i<data.length; ++i) {
+        if (i !== nSections) {
+          self.nodeListCache.set(JSON.stringify(sectionParams[i]),
+              data[i].nodes, sectionSize);
+        }
+      }
+    },
+    false,
+    true,
+    function() {
+      // Prefetching is optional, errors are ignored.
+      return true;
+    },
+    true,
+    'stack-' + this.stackViewer.getId() + '-prefetch-url-' + url,
+    true,
+    binaryTransfer ? 'arraybuffer' : undefined,
+    headers);
+};
+
 SkeletonAnnotations.TracingOverlay.prototype.createSubViewNodeListFromCache = function(params) {
   var nodeList = null;
   var self = this;
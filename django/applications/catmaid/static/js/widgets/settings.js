@@ -885,6 +885,29 @@
           'subviews_from_cache',
           SETTINGS_SCOPE));
 
+      ds.append(wrapSettingsControl(
+          CATMAID.DOM.createNumericInputSetting(
+              'Prefetch adjacent sections',
+              SkeletonAnnotations.TracingOverlay.Settings[SETTINGS_SCOPE].prefetch_sections,
+              1,
+              'If larger than zero, the tracing data of this many sections ' +
+              'below and above the current section is loaded in the background ' +
+              'with a single request, which speeds up browsing through sections.',
+              function() {
+                var nSections = parseInt(this.value, 10);
+                if (!nSections || Number.isNaN(nSections) || nSections < 0) {
+                  nSections = 0;
+                }
+                SkeletonAnnotations.TracingOverlay.Settings
+                    .set(
+                      'prefetch_sections',
+                      nSections,
+                      SETTINGS_SCOPE);
+              }),
+          SkeletonAnnotations.TracingOverlay.Settings,
+          'prefetch_sections',
+          SETTINGS_SCOPE));
+
 
       // Add explanatory text
       ds.append($('<div/>').addClass('setting').append("Choose how nodes, " +
@@ -989,6 +1012,7 @@
           {
             'JSON': 'json',
             'Msgpack': 'msgpack',
+            'Columnar': 'columnar',
             'GIF image': 'gif',
             'PNG image': 'png'
           },
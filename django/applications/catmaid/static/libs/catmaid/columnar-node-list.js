@@ -0,0 +1,144 @@
+/* -*- mode: espresso; espresso-indent-level: 2; indent-tabs-mode: nil -*- */
+/* vim: set softtabstop=2 shiftwidth=2 tabstop=2 expandtab: */
+
+(function(CATMAID) {
+
+  "use strict";
+
+  var MAGIC = 'CMNL';
+  var VERSION = 1;
+  var HEADER_SIZE = 24;
+  var LIMIT_REACHED = 1;
+
+  // Fields of the typed arrays that follow the header, in order. This has to
+  // match COLUMNAR_*_FIELDS in catmaid/control/node.py.
+  var TREENODE_FIELDS = [
+    ['id', 'int64'], ['parent_id', 'int64'], ['x', 'float32'],
+    ['y', 'float32'], ['z', 'float32'], ['confidence', 'uint8'],
+    ['radius', 'float32'], ['skeleton_id', 'int64'],
+    ['edition_time', 'float64'], ['user_id', 'int32']
+  ];
+
+  var CONNECTOR_FIELDS = [
+    ['id', 'int64'], ['x', 'float32'], ['y', 'float32'], ['z', 'float32'],
+    ['confidence', 'uint8'], ['edition_time', 'float64'], ['user_id', 'int32'],
+    ['n_links', 'uint32']
+  ];
+
+  var LINK_FIELDS = [
+    ['treenode_id', 'int64'], ['relation_id', 'int64'], ['confidence', 'uint8'],
+    ['edition_time', 'float64'], ['link_id', 'int64']
+  ];
+
+  var TYPE_SIZES = {
+    'uint8': 1,
+    'int32': 4,
+    'uint32': 4,
+    'float32': 4,
+    'int64': 8,
+    'float64': 8
+  };
+
+  /**
+   * Read a column of <n> values of the passed in type at <offset>. 64 bit
+   * integers are returned as regular numbers, which is exact for all IDs below
+   * 2^53.
+   */
+  function readColumn(buffer, view, offset, type, n) {
+    if (type === 'uint8') {
+      return new Uint8Array(buffer, offset, n);
+    } else if (type === 'int32') {
+      return new Int32Array(buffer, offset, n);
+    } else if (type === 'uint32') {
+      return new Uint32Array(buffer, offset, n);
+    } else if (type === 'float32') {
+      return new Float32Array(buffer, offset, n);
+    } else if (type === 'float64') {
+      return new Float64Array(buffer, offset, n);
+    } else if (type === 'int64') {
+      var values = new Array(n);
+      for (var i=0; i<n; ++i) {
+        var pos = offset + i * 8;
+        values[i] = view.getInt32(pos + 4, true) * 4294967296 +
+            view.getUint32(pos, true);
+      }
+      return values;
+    }
+    throw new CATMAID.ValueError("Unknown column type: " + type);
+  }
+
+  function readColumns(buffer, view, offset, fields, n) {
+    var columns = {};
+    for (var i=0; i<fields.length; ++i) {
+      var name = fields[i][0], type = fields[i][1];
+      var size = n * TYPE_SIZES[type];
+      columns[name] = readColumn(buffer, view, offset, type, n);
+      // Arrays are padded to a multiple of eight bytes
+      offset += size + ((8 - size % 8) % 8);
+    }
+    return [columns, offset];
+  }
+
+  /**
+   * Decode a node list in the columnar format (format=columnar) into the
+   * regular node list form: [treenodes, connectors, labels, limitReached,
+   * relationMap].
+   */
+  CATMAID.decodeColumnarNodeList = function(buffer) {
+    if (buffer.byteLength < HEADER_SIZE) {
+      throw new CATMAID.ValueError("Columnar node list too short");
+    }
+    var view = new DataView(buffer);
+    var magic = String.fromCharCode(view.getUint8(0), view.getUint8(1),
+        view.getUint8(2), view.getUint8(3));
+    if (magic !== MAGIC) {
+      throw new CATMAID.ValueError("Unknown columnar node list format");
+    }
+    var version = view.getUint16(4, true);
+    if (version !== VERSION) {
+      throw new CATMAID.ValueError("Unsupported columnar node list version: " + version);
+    }
+    var flags = view.getUint16(6, true);
+    var nTreenodes = view.getUint32(8, true);
+    var nConnectors = view.getUint32(12, true);
+    var nLinks = view.getUint32(16, true);
+    var trailerLength = view.getUint32(20, true);
+
+    var offset = HEADER_SIZE;
+    var result = readColumns(buffer, view, offset, TREENODE_FIELDS, nTreenodes);
+    var tn = result[0];
+    result = readColumns(buffer, view, result[1], CONNECTOR_FIELDS, nConnectors);
+    var cn = result[0];
+    result = readColumns(buffer, view, result[1], LINK_FIELDS, nLinks);
+    var ln = result[0];
+    offset = result[1];
+
+    var treenodes = new Array(nTreenodes);
+    for (var i=0; i<nTreenodes; ++i) {
+      var parentId = tn.parent_id[i];
+      treenodes[i] = [tn.id[i], parentId === -1 ? null : parentId, tn.x[i],
+          tn.y[i], tn.z[i], tn.confidence[i], tn.radius[i], tn.skeleton_id[i],
+          tn.edition_time[i], tn.user_id[i]];
+    }
+
+    var connectors = new Array(nConnectors);
+    var link = 0;
+    for (var j=0; j<nConnectors; ++j) {
+      var nConnectorLinks = cn.n_links[j];
+      var partners = new Array(nConnectorLinks);
+      for (var k=0; k<nConnectorLinks; ++k, ++link) {
+        partners[k] = [ln.treenode_id[link], ln.relation_id[link],
+            ln.confidence[link], ln.edition_time[link], ln.link_id[link]];
+      }
+      connectors[j] = [cn.id[j], cn.x[j], cn.y[j], cn.z[j], cn.confidence[j],
+          cn.edition_time[j], cn.user_id[j], partners];
+    }
+
+    var trailerBytes = new Uint8Array(buffer, offset, trailerLength);
+    var trailer = JSON.parse(new TextDecoder('utf-8').decode(trailerBytes));
+
+    return [treenodes, connectors, trailer.labels,
+        (flags & LIMIT_REACHED) !== 0, trailer.relation_map];
+  };
+
+})(CATMAID);
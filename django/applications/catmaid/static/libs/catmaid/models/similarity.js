@@ -51,7 +51,7 @@
    */
   Similarity.addConfig = function(projectId, name, matchingSkeletonIds,
       randomSkeletonIds, numRandomNeurons, lengthRandomNeurons, distanceBreaks,
-      dotBreaks, tangentNeighbors) {
+      dotBreaks, tangentNeighbors, backend) {
     if (!matchingSkeletonIds || matchingSkeletonIds.length === 0) {
       return Promise.reject(new CATMAID.Warning("No matching set skeleton IDs found"));
     }
@@ -67,6 +67,9 @@
       dot_breaks: dotBreaks,
       tangent_neighbors: tangentNeighbors,
     };
+    if (backend) {
+      params.backend = backend;
+    }
     if (randomSkeletonIds === 'backend') {
       params.n_random_skeletons = numRandomNeurons;
       params.min_length = lengthRandomNeurons;
@@ -120,12 +123,16 @@
    *                              branch level. Default: true.
    * @param requiredBranches {Integer} (optional) The number of branch levels to
    *                              keep when simplifying neurons.
+   * @param storage    {String}   (optional) How the similarity matrix is
+   *                              stored, 'array' (default), 'float32' or
+   *                              'float16'.
    *
    * @returns {Promise} Resolves once the similarity query is queued.
    */
   Similarity.computeSimilarity = function(projectId, configId, queryIds,
       targetIds, queryType, targetType, name, normalized, useAlpha,
-      queryMeta, targetMeta, removeTargetDuplicates, simplify, requiredBranches) {
+      queryMeta, targetMeta, removeTargetDuplicates, simplify, requiredBranches,
+      storage) {
     return CATMAID.fetch(projectId + '/similarity/queries/similarity', 'POST', {
       'query_ids': queryIds,
       'target_ids': targetIds,
@@ -140,9 +147,37 @@
       'remove_target_duplicates': removeTargetDuplicates,
       'simplify': simplify,
       'required_branches': requiredBranches,
+      'storage': storage,
     });
   };
 
+  /**
+   * Find the skeletons that are most similar to a query skeleton. Only
+   * skeletons that share coarse voxels with the query skeleton are scored
+   * with NBLAST.
+   *
+   * @param projectId  {Integer} The project to operate in.
+   * @param configId   {Integer} The NBLAST configuration to use.
+   * @param skeletonId {Integer} The query skeleton.
+   * @param k          {Integer} (optional) The number of matches to return.
+   * @param options    {Object}  (optional) Other parameters of the search, like
+   *                             n_candidates, voxel_size, target_ids,
+   *                             min_nodes, normalized and use_alpha.
+   *
+   * @returns {Promise} Resolves in a list of matches with the fields
+   *                    skeleton_id, score and overlap.
+   */
+  Similarity.findNearestSkeletons = function(projectId, configId, skeletonId,
+      k, options) {
+    let params = Object.assign({
+      'config_id': configId,
+      'skeleton_id': skeletonId,
+      'k': k,
+    }, options);
+    return CATMAID.fetch(projectId + '/similarity/queries/nearest', 'POST',
+        params);
+  };
+
   /**
    * Queue recomputation of a similarity configuration.
    */
@@ -155,9 +190,14 @@
 
   /**
    * Get a specific similarity query result.
+   *
+   * @param options {Object} (optional) Select only parts of the similarity
+   *                         matrix with the fields query_ids, target_ids,
+   *                         row_offset, row_limit and top_k.
    */
-  Similarity.getSimilarity = function(projectId, similarityId) {
-    return CATMAID.fetch(projectId + '/similarity/queries/' + similarityId + '/');
+  Similarity.getSimilarity = function(projectId, similarityId, options) {
+    return CATMAID.fetch(projectId + '/similarity/queries/' + similarityId + '/',
+        'GET', options);
   };
 
   /**
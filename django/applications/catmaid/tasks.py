@@ -1,6 +1,7 @@
 from django.core.management import call_command
 from django.conf import settings
 from catmaid.control.cropping import cleanup as cropping_cleanup, process_crop_job
+from catmaid.control.bulkexport import export_skeleton_archive_async
 from catmaid.control.nat import export_skeleton_as_nrrd_async
 from catmaid.control.treenodeexport import process_export_job
 from catmaid.control.roi import create_roi_image
@@ -37,7 +38,17 @@ def update_project_statistics_from_scratch():
 @shared_task
 def update_node_query_cache():
     """Update the query cache of changed sections for node providers defined in
-    the NODE_PROVIDERS settings variable.
+    the NODE_PROVIDERS settings variable. Only cache entries that have been
+    invalidated by edits are recomputed, unless a cache isn't populated yet.
     """
-    do_update_node_query_cache()
+    do_update_node_query_cache(only_dirty=True)
     return "Updating node query cache"
+
+
+@shared_task
+def update_node_query_cache_from_scratch():
+    """Recompute all cache entries for node providers defined in the
+    NODE_PROVIDERS settings variable.
+    """
+    do_update_node_query_cache()
+    return "Updating node query cache from scratch"
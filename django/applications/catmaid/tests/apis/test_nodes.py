@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import gzip
+import io
 import json
+import mock
+import msgpack
+import numpy as np
+import time
 
 from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
 
 from catmaid.models import Connector, Treenode
 from catmaid.state import make_nocheck_state
@@ -517,3 +525,723 @@ class NodesApiTests(CatmaidApiTestCase):
         self.assertEqual({}, parsed_response[2])
         self.assertEqual(False, parsed_response[3])
         self.assertEqual(expected_rel_response, parsed_response[4])
+
+
+    def test_node_list_lod(self):
+        self.fake_authentication()
+
+        query = {
+            'z1': 0,
+            'top': 2280,
+            'left': 4430,
+            'right': 12430,
+            'bottom': 5730,
+            'z2': 9,
+            'src': 'postgis2d',
+        }
+
+        response = self.client.post('/%d/node/list' % (self.test_project_id,), query)
+        self.assertEqual(response.status_code, 200)
+        expected_response = json.loads(response.content.decode('utf-8'))
+
+        # Below the node limit, level of detail sampling doesn't change the
+        # result.
+        response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                dict(query, lod='true'))
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertCountEqual(expected_response[0], parsed_response[0])
+        self.assertEqual(False, parsed_response[3])
+
+        # Above the node limit, a subset of the regular result is returned.
+        with override_settings(NODE_LIST_MAXIMUM_COUNT=5):
+            response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                    dict(query, lod='true'))
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(5, len(parsed_response))
+        self.assertEqual(True, parsed_response[3])
+
+        treenode_ids = [t[0] for t in parsed_response[0]]
+        self.assertEqual(len(treenode_ids), len(set(treenode_ids)))
+        self.assertTrue(len(treenode_ids) < len(expected_response[0]))
+        for row in parsed_response[0]:
+            self.assertTrue(row in expected_response[0])
+
+        # Treenodes linked to connectors in view are always included.
+        linked_ids = set(l[0] for c in parsed_response[1] for l in c[7])
+        self.assertTrue(linked_ids.issubset(set(treenode_ids)))
+        self.assertTrue(len(treenode_ids) - len(linked_ids) <= 5)
+
+
+    def test_node_list_sections(self):
+        self.fake_authentication()
+
+        query = {
+            'z1': 0,
+            'top': 2280,
+            'left': 4430,
+            'right': 12430,
+            'bottom': 5730,
+            'z2': 9,
+            'src': 'postgis2d',
+        }
+
+        response = self.client.get('/%d/node/list/sections' % (self.test_project_id,),
+                dict(query, n_sections_below=1, n_sections_above=1))
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(3, len(parsed_response))
+
+        # Each section has to match the result of a regular query for it.
+        for section, offset in zip(parsed_response, (-9, 0, 9)):
+            self.assertEqual(offset, section['start'])
+            self.assertEqual(offset + 9, section['end'])
+            response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                    dict(query, z1=offset, z2=offset + 9))
+            self.assertEqual(response.status_code, 200)
+            expected_response = json.loads(response.content.decode('utf-8'))
+            self.assertCountEqual([t[0] for t in expected_response[0]],
+                    [t[0] for t in section['nodes'][0]])
+            self.assertCountEqual([c[0] for c in expected_response[1]],
+                    [c[0] for c in section['nodes'][1]])
+
+        self.assertTrue(len(parsed_response[1]['nodes'][0]) > 0)
+
+        # The node limit applies to each section and explicitly requested
+        # treenodes are only included in the section that contains them.
+        with override_settings(NODE_LIST_MAXIMUM_COUNT=5):
+            response = self.client.get('/%d/node/list/sections' % (self.test_project_id,),
+                    dict(query, n_sections_below=1, n_sections_above=1,
+                        treenode_ids=2423))
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(3, len(parsed_response))
+        for section in parsed_response:
+            treenode_ids = [t[0] for t in section['nodes'][0]]
+            self.assertEqual(section['start'] == 0, 2423 in treenode_ids)
+        self.assertEqual(True, parsed_response[1]['nodes'][3])
+
+
+    def test_node_list_columnar(self):
+        from catmaid.control.node import (COLUMNAR_NODE_LIST_HEADER,
+                COLUMNAR_NODE_LIST_MAGIC, COLUMNAR_TREENODE_FIELDS,
+                COLUMNAR_CONNECTOR_FIELDS, COLUMNAR_LINK_FIELDS)
+        self.fake_authentication()
+
+        query = {
+            'z1': 0,
+            'top': 2280,
+            'left': 4430,
+            'right': 12430,
+            'bottom': 5730,
+            'z2': 9,
+            'treenode_ids': 2423,
+        }
+
+        response = self.client.post('/%d/node/list' % (self.test_project_id,), query)
+        self.assertEqual(response.status_code, 200)
+        expected_response = json.loads(response.content.decode('utf-8'))
+
+        response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                dict(query, format='columnar'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('application/octet-stream', response['Content-Type'])
+        data = response.content
+
+        magic, version, flags, n_treenodes, n_connectors, n_links, \
+                trailer_length = COLUMNAR_NODE_LIST_HEADER.unpack_from(data)
+        self.assertEqual(COLUMNAR_NODE_LIST_MAGIC, magic)
+        self.assertEqual(1, version)
+        self.assertEqual(0, flags)
+        self.assertEqual(len(expected_response[0]), n_treenodes)
+        self.assertEqual(len(expected_response[1]), n_connectors)
+        self.assertEqual(sum(len(c[7]) for c in expected_response[1]), n_links)
+
+        offset = COLUMNAR_NODE_LIST_HEADER.size
+        columns = {}
+        for prefix, fields, n in (('treenode', COLUMNAR_TREENODE_FIELDS, n_treenodes),
+                ('connector', COLUMNAR_CONNECTOR_FIELDS, n_connectors),
+                ('link', COLUMNAR_LINK_FIELDS, n_links)):
+            for name, dtype in fields:
+                column = np.frombuffer(data, dtype=dtype, count=n, offset=offset)
+                columns[(prefix, name)] = column.tolist()
+                offset += column.nbytes + (-column.nbytes % 8)
+        trailer = json.loads(data[offset:offset + trailer_length].decode('utf-8'))
+        self.assertEqual(len(data), offset + trailer_length)
+
+        treenodes = list(zip(*[columns[('treenode', f[0])] for f in COLUMNAR_TREENODE_FIELDS]))
+        parsed_treenodes = dict((t[0], t) for t in treenodes)
+        for row in expected_response[0]:
+            tn = parsed_treenodes[row[0]]
+            self.assertEqual(row[1] or -1, tn[1])
+            self.assertEqual(row[2:5], list(tn[2:5]))
+            self.assertEqual(row[5], tn[5])
+            self.assertEqual(row[6], tn[6])
+            self.assertEqual(row[7], tn[7])
+            self.assertAlmostEqual(row[8], tn[8], places=3)
+            self.assertEqual(row[9], tn[9])
+
+        links = list(zip(*[columns[('link', f[0])] for f in COLUMNAR_LINK_FIELDS]))
+        expected_connectors = dict((c[0], c) for c in expected_response[1])
+        link_offset = 0
+        for i, connector_id in enumerate(columns[('connector', 'id')]):
+            n_connector_links = columns[('connector', 'n_links')][i]
+            expected = expected_connectors[connector_id]
+            self.assertEqual(expected[1:4], [columns[('connector', f)][i] for f in 'xyz'])
+            self.assertCountEqual([l[4] for l in expected[7]],
+                    [l[4] for l in links[link_offset:link_offset + n_connector_links]])
+            link_offset += n_connector_links
+
+        self.assertEqual({}, trailer['labels'])
+        self.assertEqual(expected_response[4], trailer['relation_map'])
+
+
+    def test_node_list_image(self):
+        from PIL import Image
+        self.fake_authentication()
+
+        query = {
+            'z1': 0,
+            'top': 2280,
+            'left': 4430,
+            'right': 12430,
+            'bottom': 5730,
+            'z2': 9,
+            'view_width': 800,
+            'view_height': 345,
+        }
+
+        for image_format, content_type in (('png', 'image/png'), ('gif', 'image/gif')):
+            response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                    dict(query, format=image_format))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(content_type, response['Content-Type'])
+            image = Image.open(io.BytesIO(response.content))
+            self.assertEqual((800, 345), image.size)
+            # Nodes, edges and connectors are drawn on a transparent background.
+            self.assertTrue(image.convert('RGBA').getbbox())
+
+        # Treenode 403 at (7840, 2380) is drawn as a node.
+        response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                dict(query, format='png'))
+        image = Image.open(io.BytesIO(response.content)).convert('RGBA')
+        self.assertEqual((255, 0, 255, 255), image.getpixel((341, 10)))
+
+
+    def test_node_list_grid_cache(self):
+        from catmaid.control.node import update_grid_cache
+        self.fake_authentication()
+
+        query = {
+            'z1': 0,
+            'top': 4625,
+            'left': 2860,
+            'right': 12625,
+            'bottom': 8075,
+            'z2': 9,
+        }
+
+        # Without populated grid cache, no result is available
+        response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                dict(query, src='cached_msgpack_grid'))
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertTrue('error' in parsed_response)
+
+        response = self.client.post('/%d/node/list' % (self.test_project_id,), query)
+        self.assertEqual(response.status_code, 200)
+        expected_response = json.loads(response.content.decode('utf-8'))
+
+        update_grid_cache(self.test_project_id, 'msgpack', ['xy'], [10],
+                5000, 5000, log=lambda x: x)
+
+        response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                dict(query, src='cached_msgpack_grid'))
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(5, len(parsed_response))
+
+        # Grid cells can extend beyond the query bounding box, which is why
+        # more nodes can be returned.
+        for row in expected_response[0]:
+            self.assertTrue(row in parsed_response[0])
+        cached_connectors = dict((c[0], c) for c in parsed_response[1])
+        for row in expected_response[1]:
+            self.assertTrue(row[0] in cached_connectors)
+            self.assertCountEqual(row[7], cached_connectors[row[0]][7])
+
+        # Nodes and links that are part of multiple cells are only returned
+        # once.
+        treenode_ids = [t[0] for t in parsed_response[0]]
+        self.assertEqual(len(treenode_ids), len(set(treenode_ids)))
+        for c in parsed_response[1]:
+            link_ids = [l[4] for l in c[7]]
+            self.assertEqual(len(link_ids), len(set(link_ids)))
+        for relation_id, relation_name in expected_response[4].items():
+            self.assertEqual(relation_name, parsed_response[4].get(relation_id))
+
+        # Queries that extend beyond the populated range of the grid can be
+        # answered, missing cells outside of it are empty.
+        wide_query = dict(query, left=-50000, right=100000, top=-50000,
+                bottom=100000, z1=-100, z2=200)
+        response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                dict(wide_query, src='cached_msgpack_grid'))
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(5, len(parsed_response))
+        self.assertTrue(2374 in [t[0] for t in parsed_response[0]])
+
+        # Edits outside of the populated range create dirty cells, which makes
+        # the grid unusable for this region until it is refreshed.
+        response = self.client.post('/%d/treenode/create' % self.test_project_id, {
+            'x': 90000,
+            'y': 90000,
+            'z': 150,
+            'confidence': 5,
+            'parent_id': -1,
+            'radius': 2})
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post('/%d/node/list' % (self.test_project_id,),
+                dict(wide_query, src='cached_msgpack_grid'))
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertTrue('error' in parsed_response)
+
+
+    def test_node_list_cache_passthrough(self):
+        from catmaid.control.node import update_cache
+        self.fake_authentication()
+
+        url = '/%d/node/list' % (self.test_project_id,)
+        query = {
+            'z1': 0,
+            'top': 4625,
+            'left': 2860,
+            'right': 12625,
+            'bottom': 8075,
+            'z2': 9,
+            'src': 'cached_msgpack',
+        }
+
+        update_cache(self.test_project_id, ['msgpack', 'json_text',
+                'json_text_gzip', 'msgpack_gzip'], ['xy'], [10],
+                log=lambda x: x)
+
+        # Cached JSON text is used for JSON responses of msgpack providers
+        response = self.client.post(url, query)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        json_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(5, len(json_response))
+
+        response = self.client.post(url, dict(query, format='msgpack'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        msgpack_response = msgpack.unpackb(response.content, raw=False)
+        self.assertEqual(json_response[0:4], msgpack_response[0:4])
+
+        # Pre-compressed data is sent as is if the client accepts it
+        response = self.client.post(url, query,
+                HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual(json_response, json.loads(
+                gzip.decompress(response.content).decode('utf-8')))
+
+        response = self.client.post(url, dict(query, format='msgpack'),
+                HTTP_ACCEPT_ENCODING='br;q=0, gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual(msgpack_response, msgpack.unpackb(
+                gzip.decompress(response.content), raw=False))
+
+        # Extra nodes are added to uncompressed data
+        for data_format in ('json', 'msgpack'):
+            response = self.client.post(url, dict(query, format=data_format,
+                    treenode_ids=2423), HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.has_header('Content-Encoding'))
+            if data_format == 'json':
+                parsed_response = json.loads(response.content.decode('utf-8'))
+            else:
+                parsed_response = msgpack.unpackb(response.content, raw=False)
+            self.assertEqual(6, len(parsed_response))
+            extra_treenode_ids = [t[0] for t in parsed_response[5][0][0]]
+            self.assertTrue(2423 in extra_treenode_ids)
+
+
+    @override_settings(NODE_RESULT_CACHE_SIZE=10**7,
+            NODE_RESULT_CACHE_QUANTIZATION=1000)
+    def test_node_list_result_cache(self):
+        from catmaid.control.node_result_cache import get_node_result_cache
+        self.fake_authentication()
+
+        cache = get_node_result_cache()
+        # Edit notifications are only sent for committed transactions, which
+        # doesn't happen in tests.
+        cache.listener = None
+        cache.clear()
+
+        def get_stats():
+            response = self.client.get('/%d/nodes/result-cache/stats' % (self.test_project_id,))
+            self.assertEqual(response.status_code, 200)
+            stats = json.loads(response.content.decode('utf-8'))
+            self.assertTrue(stats['enabled'])
+            return stats
+
+        url = '/%d/node/list' % (self.test_project_id,)
+        query = {
+            'z1': 0,
+            'top': 4625,
+            'left': 2860,
+            'right': 12625,
+            'bottom': 8075,
+            'z2': 9,
+        }
+
+        stats = get_stats()
+        response = self.client.post(url, query)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(5, len(parsed_response))
+        treenode_ids = set(t[0] for t in parsed_response[0])
+        self.assertTrue(2374 in treenode_ids)
+        new_stats = get_stats()
+        self.assertEqual(stats['misses'] + 1, new_stats['misses'])
+        self.assertEqual(stats['hits'], new_stats['hits'])
+        self.assertEqual(1, new_stats['entries'])
+
+        # A query with a slightly different bounding box shares the result
+        response = self.client.post(url, dict(query, left=2900, right=12600))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(parsed_response, json.loads(response.content.decode('utf-8')))
+        stats, new_stats = new_stats, get_stats()
+        self.assertEqual(stats['hits'] + 1, new_stats['hits'])
+
+        # Extra nodes are added to cached results
+        response = self.client.post(url, dict(query, treenode_ids=2423))
+        self.assertEqual(response.status_code, 200)
+        extra_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(6, len(extra_response))
+        self.assertEqual(parsed_response, extra_response[0:5])
+        stats, new_stats = new_stats, get_stats()
+        self.assertEqual(stats['hits'] + 1, new_stats['hits'])
+
+        # Columnar results are cached separately, in their final encoding
+        response = self.client.post(url, dict(query, format='columnar'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        columnar_data = response.content
+        stats, new_stats = new_stats, get_stats()
+        self.assertEqual(stats['misses'] + 1, new_stats['misses'])
+        self.assertEqual(2, new_stats['entries'])
+        response = self.client.post(url, dict(query, format='columnar'))
+        self.assertEqual(columnar_data, response.content)
+        stats, new_stats = new_stats, get_stats()
+        self.assertEqual(stats['hits'] + 1, new_stats['hits'])
+
+        # Results that intersect with a change are removed
+        cache.invalidate(self.test_project_id, [3300, 5180, 0, 3320, 5200, 0])
+        stats, new_stats = new_stats, get_stats()
+        self.assertEqual(stats['invalidations'] + 1, new_stats['invalidations'])
+        self.assertEqual(0, new_stats['entries'])
+        response = self.client.post(url, query)
+        self.assertEqual(response.status_code, 200)
+        stats, new_stats = new_stats, get_stats()
+        self.assertEqual(stats['misses'] + 1, new_stats['misses'])
+
+        # Changes elsewhere don't affect cached results
+        cache.invalidate(self.test_project_id, [0, 0, 1000, 100, 100, 1000])
+        self.assertEqual(1, get_stats()['entries'])
+
+        # The least recently used results are removed first
+        size = cache.size
+        cache.set('a', 'a', cache.max_size - size, self.test_project_id, [0] * 6)
+        self.assertEqual(2, len(cache.entries))
+        response = self.client.post(url, query)
+        cache.set('b', 'b', 1, self.test_project_id, [0] * 6)
+        self.assertEqual(2, len(cache.entries))
+        self.assertTrue('a' not in cache.entries)
+
+        cache.clear()
+
+
+    @override_settings(NODE_RESULT_CACHE_SIZE=10**7,
+            NODE_RESULT_CACHE_QUANTIZATION=1000)
+    def test_node_list_result_cache_notifications(self):
+        from catmaid.control.node_result_cache import (get_node_result_cache,
+                NodeEditListener, NODE_EDIT_CHANNEL)
+        self.fake_authentication()
+
+        cache = get_node_result_cache()
+        cache.listener = NodeEditListener()
+        cache.clear()
+
+        # The first sync connects the listener
+        cache.sync()
+        self.assertTrue(cache.listener.connection is not None)
+
+        url = '/%d/node/list' % (self.test_project_id,)
+        query = {
+            'z1': 0,
+            'top': 4625,
+            'left': 2860,
+            'right': 12625,
+            'bottom': 8075,
+            'z2': 9,
+        }
+        response = self.client.post(url, query)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(1, len(cache.entries))
+        n_invalidations = cache.stats()['invalidations']
+
+        # Notifications of test transactions are never delivered, because
+        # they aren't committed. A notification is therefore sent through a
+        # separate connection.
+        db = connection
+        notifier = db.get_new_connection(db.get_connection_params())
+        notifier.autocommit = True
+        try:
+            cursor = notifier.cursor()
+            cursor.execute("SELECT pg_notify(%s, %s)", (NODE_EDIT_CHANNEL,
+                    json.dumps({
+                        'project_id': self.test_project_id,
+                        'bb': [3300, 5180, 0, 3320, 5200, 0],
+                    })))
+            cursor.close()
+        finally:
+            notifier.close()
+
+        for _ in range(50):
+            cache.sync()
+            if not cache.entries:
+                break
+            time.sleep(0.1)
+        self.assertEqual(0, len(cache.entries))
+        self.assertEqual(n_invalidations + 1, cache.stats()['invalidations'])
+
+        # Results computed before an invalidation aren't stored after it.
+        generation = cache.sync()
+        cache.invalidate(self.test_project_id, [0, 0, 0, 10, 10, 10])
+        cache.set('a', 'a', 1, self.test_project_id, [5, 5, 5, 20, 20, 20],
+                generation)
+        self.assertTrue('a' not in cache.entries)
+        cache.set('b', 'b', 1, self.test_project_id, [50, 50, 50, 60, 60, 60],
+                generation)
+        self.assertTrue('b' in cache.entries)
+
+        cache.listener.close()
+        cache.listener = None
+        cache.clear()
+
+
+    def test_node_query_cache_invalidation(self):
+        from catmaid.control.node import update_cache, update_grid_cache
+        self.fake_authentication()
+
+        update_cache(self.test_project_id, 'msgpack', ['xy'], [10],
+                log=lambda x: x)
+        update_grid_cache(self.test_project_id, 'msgpack', ['xy'], [10],
+                5000, 5000, log=lambda x: x)
+
+        def count_dirty():
+            cursor = connection.cursor()
+            cursor.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM node_query_cache WHERE dirty),
+                    (SELECT COUNT(*) FROM node_grid_cache_cell WHERE dirty)
+            """)
+            return cursor.fetchone()
+
+        self.assertEqual((0, 0), count_dirty())
+
+        # Move treenode 2374 (at 3310, 5190, 0) within section 0
+        response = self.client.post(
+            '/%d/node/update' % self.test_project_id, {
+                'state': make_nocheck_state(),
+                't[0][0]': 2374,
+                't[0][1]': 3320,
+                't[0][2]': 5200,
+                't[0][3]': 0})
+        self.assertEqual(response.status_code, 200)
+
+        n_dirty_sections, n_dirty_cells = count_dirty()
+        self.assertEqual(1, n_dirty_sections)
+        self.assertTrue(n_dirty_cells > 0)
+
+        # Dirty cache entries are ignored by cached node providers
+        for src in ('cached_msgpack', 'cached_msgpack_grid'):
+            response = self.client.post('/%d/node/list' % (self.test_project_id,), {
+                'z1': 0,
+                'top': 4625,
+                'left': 2860,
+                'right': 12625,
+                'bottom': 8075,
+                'z2': 9,
+                'src': src,
+            })
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content.decode('utf-8'))
+            self.assertTrue('error' in parsed_response)
+
+        update_cache(self.test_project_id, 'msgpack', ['xy'], [10],
+                only_dirty=True, log=lambda x: x)
+        update_grid_cache(self.test_project_id, 'msgpack', ['xy'], [10],
+                5000, 5000, only_dirty=True, log=lambda x: x)
+        self.assertEqual((0, 0), count_dirty())
+
+
+    def test_node_query_cache_concurrent_edit(self):
+        from catmaid.control import node
+        from catmaid.control.node import update_cache, update_grid_cache
+
+        update_cache(self.test_project_id, 'msgpack', ['xy'], [10],
+                log=lambda x: x)
+        update_grid_cache(self.test_project_id, 'msgpack', ['xy'], [10],
+                5000, 5000, log=lambda x: x)
+
+        def count_dirty():
+            cursor = connection.cursor()
+            cursor.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM node_query_cache WHERE dirty),
+                    (SELECT COUNT(*) FROM node_grid_cache_cell WHERE dirty)
+            """)
+            return cursor.fetchone()
+
+        # Move treenode 2374 (at 3310, 5190, 0) while results are computed.
+        # Affected entries must not be marked as clean by the update.
+        node_list_tuples_query = node._node_list_tuples_query
+        edits = []
+        def edit_during_query(*args, **kwargs):
+            result = node_list_tuples_query(*args, **kwargs)
+            if not edits:
+                edits.append(True)
+                Treenode.objects.filter(id=2374).update(location_x=3320)
+            return result
+
+        for update in (update_cache, update_grid_cache):
+            del edits[:]
+            cursor = connection.cursor()
+            cursor.execute("UPDATE node_query_cache SET dirty = true")
+            cursor.execute("UPDATE node_grid_cache_cell SET dirty = true")
+            with mock.patch('catmaid.control.node._node_list_tuples_query',
+                    edit_during_query):
+                if update == update_cache:
+                    update_cache(self.test_project_id, 'msgpack', ['xy'], [10],
+                            only_dirty=True, batch_size=1000, log=lambda x: x)
+                    self.assertEqual(1, count_dirty()[0])
+                else:
+                    update_grid_cache(self.test_project_id, 'msgpack', ['xy'],
+                            [10], 5000, 5000, only_dirty=True, batch_size=1000,
+                            log=lambda x: x)
+                    self.assertTrue(count_dirty()[1] > 0)
+
+        # A regular update refreshes the remaining dirty entries
+        update_cache(self.test_project_id, 'msgpack', ['xy'], [10],
+                only_dirty=True, log=lambda x: x)
+        update_grid_cache(self.test_project_id, 'msgpack', ['xy'], [10],
+                5000, 5000, only_dirty=True, log=lambda x: x)
+        self.assertEqual((0, 0), count_dirty())
+
+
+    def test_node_query_cache_batch_update(self):
+        from catmaid.control.node import update_cache, update_grid_cache
+
+        def get_cache_data():
+            cursor = connection.cursor()
+            cursor.execute("""
+                SELECT depth, step, json_data FROM node_query_cache
+                WHERE project_id = %(project_id)s
+                ORDER BY depth
+            """, {
+                'project_id': self.test_project_id,
+            })
+            sections = cursor.fetchall()
+            cursor.execute("""
+                SELECT x_index, y_index, z_index, json_data
+                FROM node_grid_cache_cell
+                ORDER BY z_index, y_index, x_index
+            """)
+            return sections, cursor.fetchall()
+
+        update_cache(self.test_project_id, 'json', ['xy'], [10], batch_size=1,
+                log=lambda x: x)
+        update_grid_cache(self.test_project_id, 'json', ['xy'], [10], 5000,
+                5000, allow_empty=True, batch_size=1, log=lambda x: x)
+        expected_sections, expected_cells = get_cache_data()
+        self.assertTrue(len(expected_sections) > 1)
+        self.assertTrue(len(expected_cells) > 1)
+
+        # Larger batches store the same results
+        update_cache(self.test_project_id, 'json', ['xy'], [10], batch_size=4,
+                delete=True, log=lambda x: x)
+        update_grid_cache(self.test_project_id, 'json', ['xy'], [10], 5000,
+                5000, allow_empty=True, batch_size=4, delete=True,
+                log=lambda x: x)
+        sections, cells = get_cache_data()
+        self.assertEqual(expected_sections, sections)
+        self.assertEqual(expected_cells, cells)
+
+
+class NodeQueryCacheUpdatePoolTests(TransactionTestCase):
+    """Worker processes use their own database connections, which means they
+    can only see committed test data.
+    """
+    fixtures = ['catmaid_testdata']
+
+    test_project_id = 3
+
+    def get_cache_data(self):
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT depth, step, json_data FROM node_query_cache
+            WHERE project_id = %(project_id)s
+            ORDER BY depth
+        """, {
+            'project_id': self.test_project_id,
+        })
+        sections = cursor.fetchall()
+        cursor.execute("""
+            SELECT x_index, y_index, z_index, json_data
+            FROM node_grid_cache_cell
+            ORDER BY z_index, y_index, x_index
+        """)
+        return sections, cursor.fetchall()
+
+    def test_parallel_cache_update(self):
+        from catmaid.control.node import update_cache, update_grid_cache
+
+        update_cache(self.test_project_id, 'json', ['xy'], [10], batch_size=2,
+                log=lambda x: x)
+        update_grid_cache(self.test_project_id, 'json', ['xy'], [10], 5000,
+                5000, batch_size=2, log=lambda x: x)
+        expected_sections, expected_cells = self.get_cache_data()
+        self.assertTrue(len(expected_sections) > 1)
+        self.assertTrue(len(expected_cells) > 1)
+
+        # Worker processes store the same results
+        update_cache(self.test_project_id, 'json', ['xy'], [10], batch_size=2,
+                n_jobs=2, delete=True, log=lambda x: x)
+        update_grid_cache(self.test_project_id, 'json', ['xy'], [10], 5000,
+                5000, batch_size=2, n_jobs=2, delete=True, log=lambda x: x)
+        sections, cells = self.get_cache_data()
+        self.assertEqual(expected_sections, sections)
+        self.assertEqual(expected_cells, cells)
+
+    def test_daemon_process_fallback(self):
+        from catmaid.control.node import create_cache_update_pool, update_cache
+
+        # Daemon processes, like Celery workers, can't start worker processes
+        # and run all jobs themselves.
+        with mock.patch('multiprocessing.current_process') as current_process:
+            current_process.return_value.daemon = True
+            with create_cache_update_pool(4) as pool:
+                self.assertEqual(1, pool.n_jobs)
+                self.assertTrue(pool.pool is None)
+                update_cache(self.test_project_id, 'json', ['xy'], [10],
+                        pool=pool, log=lambda x: x)
+
+        sections, _ = self.get_cache_data()
+        self.assertTrue(len(sections) > 1)
@@ -1,15 +1,21 @@
 # -*- coding: utf-8 -*-
 
 import json
+import os
 import re
+import struct
 import platform
+import tempfile
+import zipfile
 
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.shortcuts import get_object_or_404
 from guardian.shortcuts import assign_perm
 
 from catmaid.models import ClassInstance, ClassInstanceClassInstance
 from catmaid.models import Log, Review, Treenode, TreenodeConnector
-from catmaid.models import ReviewerWhitelist
+from catmaid.models import ReviewerWhitelist, SkeletonSummary
+from catmaid.control.bulkexport import export_skeleton_archive
 
 from .common import CatmaidApiTestCase
 
@@ -96,6 +102,75 @@ class SkeletonsApiTests(CatmaidApiTestCase):
             self.assertEqual(max(tn.radius, 0), max(new_tn.radius, 0))
 
 
+    def test_import_skeletons_bulk(self):
+        self.fake_authentication()
+        assign_perm('can_import', self.test_user, self.test_project)
+
+        orig_skeleton_ids = (235, 373)
+        swc_files = {}
+        for skeleton_id in orig_skeleton_ids:
+            response = self.client.get('/%d/skeleton/%d/swc' % (self.test_project_id, skeleton_id))
+            self.assertEqual(response.status_code, 200)
+            swc_files['%d.swc' % skeleton_id] = StringIO(response.content.decode('utf-8'))
+
+        response = self.client.post('/%d/skeletons/import' % (self.test_project_id,),
+                swc_files)
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(2, len(parsed_response['skeletons']))
+
+        for imported in parsed_response['skeletons']:
+            orig_skeleton_id = int(imported['filename'].split('.')[0])
+            new_skeleton_id = imported['skeleton_id']
+            id_map = imported['node_id_map']
+
+            neuron = ClassInstanceClassInstance.objects.get(
+                    class_instance_a=new_skeleton_id,
+                    relation__relation_name='model_of').class_instance_b
+            self.assertEqual(imported['neuron_id'], neuron.id)
+            self.assertEqual(str(orig_skeleton_id), neuron.name)
+
+            orig_treenodes = Treenode.objects.filter(skeleton_id=orig_skeleton_id)
+            self.assertEqual(orig_treenodes.count(),
+                    Treenode.objects.filter(skeleton_id=new_skeleton_id).count())
+            for tn in orig_treenodes:
+                new_tn = Treenode.objects.get(id=id_map[str(tn.id)])
+                self.assertEqual(new_skeleton_id, new_tn.skeleton_id)
+                if tn.parent_id:
+                    self.assertEqual(id_map[str(tn.parent_id)], new_tn.parent_id)
+                else:
+                    self.assertIsNone(new_tn.parent_id)
+                self.assertEqual(tn.location_x, new_tn.location_x)
+                self.assertEqual(tn.location_y, new_tn.location_y)
+                self.assertEqual(tn.location_z, new_tn.location_z)
+
+            # The skeleton summary is updated by the treenode triggers
+            summary = SkeletonSummary.objects.get(skeleton_id=new_skeleton_id)
+            self.assertEqual(orig_treenodes.count(), summary.num_nodes)
+
+        # Multiple files can also be sent with a single field name
+        n_skeletons = ClassInstance.objects.filter(
+                class_column__class_name='skeleton').count()
+        response = self.client.post('/%d/skeletons/import' % (self.test_project_id,), {
+            'file': [SimpleUploadedFile(filename, swc.getvalue().encode('utf-8'))
+                    for filename, swc in sorted(swc_files.items())],
+        })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(['235.swc', '373.swc'],
+                [imported['filename'] for imported in parsed_response['skeletons']])
+        self.assertEqual(n_skeletons + 2, ClassInstance.objects.filter(
+                class_column__class_name='skeleton').count())
+
+        # A cycle is rejected without importing anything
+        n_treenodes = Treenode.objects.count()
+        response = self.client.post('/%d/skeletons/import' % (self.test_project_id,),
+                {'cycle.swc': StringIO('1 0 1 1 1 1 2\n2 0 2 2 2 1 1\n3 0 3 3 3 1 -1\n'),
+                 'bulk': True})
+        self.assertIn('cycle', json.loads(response.content.decode('utf-8'))['error'])
+        self.assertEqual(n_treenodes, Treenode.objects.count())
+
+
     def test_skeleton_contributor_statistics(self):
         self.fake_authentication()
 
@@ -475,6 +550,83 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.assertEqual(expected_result, parsed_response)
 
 
+    def test_measure_skeletons(self):
+        self.fake_authentication()
+
+        response = self.client.post(
+                '/%d/skeletons/measure' % (self.test_project_id,), {
+                    'skeleton_ids[0]': 373,
+                })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(1, len(parsed_response))
+        # [skeleton_id, raw_cable, smooth_cable, n_pre, n_post, n_nodes,
+        #  n_branch, n_ends, principal_branch_cable]
+        row = parsed_response[0]
+        self.assertEqual([373, 2345, 2324, 2, 0, 5, 0, 2], row[:8])
+        self.assertAlmostEqual(1705.8585, row[8], places=3)
+
+
+    def test_neuroglancer_skeleton(self):
+        self.fake_authentication()
+
+        response = self.client.get(
+                '/%d/skeletons/373/neuroglancer' % (self.test_project_id,), {
+                    'vertex_attributes': ['radius', 'confidence'],
+                })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        data = response.content
+
+        # Vertices are ordered by node ID: 377, 403, 405, 407, 409
+        n_vertices, n_edges = struct.unpack_from('<II', data, 0)
+        self.assertEqual(5, n_vertices)
+        self.assertEqual(4, n_edges)
+        vertices = struct.unpack_from('<15f', data, 8)
+        self.assertEqual((7620.0, 2890.0, 0.0), vertices[:3])
+        self.assertEqual((6630.0, 4330.0, 0.0), vertices[12:])
+        edges = struct.unpack_from('<8I', data, 68)
+        self.assertEqual((1, 0, 2, 0, 3, 2, 4, 3), edges)
+        radii = struct.unpack_from('<5f', data, 100)
+        self.assertEqual((-1.0,) * 5, radii)
+        confidences = struct.unpack_from('<5B', data, 120)
+        self.assertEqual((5,) * 5, confidences)
+        self.assertEqual(125, len(data))
+
+
+    def test_simplified_compact_skeleton(self):
+        self.fake_authentication()
+
+        # Nodes 377 and 409 have connectors, node 403 is tagged.
+        response = self.client.get(
+                '/%d/skeletons/373/compact-detail' % (self.test_project_id,), {
+                    'with_connectors': True,
+                    'with_tags': True,
+                    'simplify_distance': 10000,
+                })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        expected_nodes = [
+                [377, None, 3, 7620.0, 2890.0, 0.0, -1.0, 5],
+                [403, 377, 3, 7840.0, 2380.0, 0.0, -1.0, 5],
+                [409, 377, 3, 6630.0, 4330.0, 0.0, -1.0, 5]]
+        self.assertCountEqual(expected_nodes, parsed_response[0])
+        self.assertEqual(2, len(parsed_response[1]))
+        self.assertEqual({"uncertain end": [403]}, parsed_response[2])
+
+        # Node 405 is more than 100nm away from the line between 377 and 409
+        response = self.client.get(
+                '/%d/373/1/1/1/compact-arbor' % (self.test_project_id,), {
+                    'simplify_tolerance': 100,
+                })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        self.assertCountEqual([377, 403, 405, 409],
+                [node[0] for node in parsed_response[0]])
+        self.assertEqual([409, 405], [node[:2] for node in parsed_response[0]
+                if node[0] == 409][0])
+
+
     def test_skeleton_ancestry(self):
         skeleton_id = 361
 
@@ -1011,6 +1163,28 @@ class SkeletonsApiTests(CatmaidApiTestCase):
         self.compare_swc_data(response.content.decode('utf-8'), swc_output_for_skeleton_235)
 
 
+    def test_export_skeleton_archive(self):
+        self.fake_authentication()
+        swc = {}
+        for skeleton_id in (235, 373):
+            response = self.client.get('/%d/skeleton/%d/swc' % (self.test_project_id, skeleton_id))
+            self.assertEqual(response.status_code, 200)
+            swc[skeleton_id] = response.content.decode('utf-8')
+
+        with tempfile.TemporaryDirectory() as output_dir:
+            path = os.path.join(output_dir, 'skeletons.zip')
+            errors = export_skeleton_archive(self.test_project_id,
+                    [235, 373, 999999], path, batch_size=1)
+            self.assertEqual([999999], list(errors.keys()))
+
+            with zipfile.ZipFile(path) as archive:
+                self.assertEqual(['235.swc', '373.swc', 'errors.txt'],
+                        sorted(archive.namelist()))
+                for skeleton_id in (235, 373):
+                    self.assertEqual(swc[skeleton_id], archive.read(
+                            '{}.swc'.format(skeleton_id)).decode('utf-8'))
+
+
     def test_swc_file_linearized(self):
         self.fake_authentication()
         url = '/%d/skeleton/235/swc' % (self.test_project_id,)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+
+from django.test import TestCase
+
+
+class ArborTests(TestCase):
+
+    def make_arbor(self):
+        from catmaid.control.arbor import Arbor
+
+        # A skeleton with a root in the middle and two branches, passed in
+        # out of order.
+        return Arbor.from_rows([
+            (407, 405, 7080.0, 3960.0, 0.0),
+            (377, None, 7620.0, 2890.0, 0.0),
+            (409, 407, 6630.0, 4330.0, 0.0),
+            (403, 377, 7840.0, 2380.0, 0.0),
+            (405, 377, 7390.0, 3510.0, 0.0),
+        ])
+
+    def ids(self, arbor, indices):
+        return sorted(arbor.node_ids[indices].tolist())
+
+    def test_structure(self):
+        arbor = self.make_arbor()
+
+        self.assertEqual(len(arbor), 5)
+        self.assertEqual(arbor.root, 377)
+        self.assertEqual(self.ids(arbor, arbor.children(arbor.index(377))), [403, 405])
+        self.assertEqual(self.ids(arbor, arbor.children(arbor.index(409))), [])
+        self.assertEqual(self.ids(arbor, arbor.children_of(arbor.indices([377, 405]))),
+                [403, 405, 407])
+        self.assertEqual(arbor.depths[arbor.indices([377, 403, 405, 407, 409])].tolist(),
+                [0, 1, 1, 2, 3])
+        self.assertRaises(ValueError, arbor.index, 1)
+
+        order = arbor.topological_order.tolist()
+        for index in order:
+            parent = arbor.parent_index[index]
+            if parent != -1:
+                self.assertLess(order.index(parent), order.index(index))
+
+    def test_lengths(self):
+        arbor = self.make_arbor()
+
+        lengths = arbor.edge_lengths()
+        self.assertEqual(lengths[arbor.index(377)], 0.0)
+        self.assertAlmostEqual(lengths[arbor.index(403)], 555.4277630799526)
+        self.assertAlmostEqual(arbor.cable_length(), 2345.737898012321)
+        distances = arbor.distances_to_root()
+        self.assertAlmostEqual(distances[arbor.index(409)],
+                sum(lengths[arbor.indices([405, 407, 409])]))
+
+    def test_traversal(self):
+        arbor = self.make_arbor()
+
+        self.assertEqual(arbor.node_ids[arbor.path_to_root(arbor.index(409))].tolist(),
+                [409, 407, 405, 377])
+        self.assertEqual(arbor.node_ids[arbor.common_ancestor(
+                arbor.index(409), arbor.index(403))], 377)
+        self.assertEqual(self.ids(arbor, arbor.subtree_mask(arbor.index(405))),
+                [405, 407, 409])
+        self.assertEqual(self.ids(arbor, arbor.nodes_within_edges(arbor.index(405), 1)),
+                [377, 405, 407])
+        self.assertEqual([arbor.node_ids[s].tolist() for s in arbor.partition()],
+                [[409, 407, 405, 377], [403, 377]])
+
+    def test_simplify(self):
+        arbor = self.make_arbor()
+
+        def simplify(**kwargs):
+            mask, parent_index = arbor.simplify(**kwargs)
+            return dict((int(arbor.node_ids[i]), int(arbor.node_ids[parent_index[i]])
+                    if parent_index[i] != -1 else None) for i in np.flatnonzero(mask))
+
+        # Root, branch and end nodes are always kept
+        self.assertEqual(simplify(), {377: None, 403: 377, 409: 377})
+        self.assertEqual(simplify(keep=arbor.indices([407])),
+                {377: None, 403: 377, 407: 377, 409: 407})
+        # Node 407 is the first one more than 1000nm away from the root
+        self.assertEqual(simplify(min_distance=1000),
+                {377: None, 403: 377, 407: 377, 409: 407})
+        # Node 405 is about 160nm away from the line between 377 and 409
+        self.assertEqual(simplify(tolerance=200), {377: None, 403: 377, 409: 377})
+        self.assertEqual(simplify(tolerance=100),
+                {377: None, 403: 377, 405: 377, 409: 405})
+
+    def test_components(self):
+        arbor = self.make_arbor()
+
+        counts = arbor.accumulate_to_leaves(np.ones(len(arbor), dtype=np.int64))
+        self.assertEqual(counts[arbor.indices([377, 403, 405, 407, 409])].tolist(),
+                [5, 1, 3, 2, 1])
+
+        mask = arbor.node_ids != 405
+        roots = arbor.component_roots(mask)
+        self.assertEqual(roots[arbor.index(405)], -1)
+        self.assertEqual(arbor.node_ids[roots[arbor.indices([377, 403, 407, 409])]].tolist(),
+                [377, 377, 407, 407])
+
+        def minify(node_ids):
+            indices, edges = arbor.minify(arbor.indices(node_ids))
+            return (self.ids(arbor, indices), set(frozenset(e) for e in
+                    arbor.node_ids[edges].tolist()))
+
+        # The root isn't a branch node between the nodes to keep
+        self.assertEqual(minify([403, 409]),
+                ([403, 409], {frozenset((403, 409))}))
+        self.assertEqual(minify([403, 405, 409]),
+                ([403, 405, 409], {frozenset((403, 405)), frozenset((405, 409))}))
+
+    def test_reroot(self):
+        arbor = self.make_arbor().reroot(409)
+
+        self.assertEqual(arbor.root, 409)
+        self.assertEqual(arbor.node_ids[arbor.path_to_root(arbor.index(403))].tolist(),
+                [403, 377, 405, 407, 409])
+        self.assertEqual(self.ids(arbor, arbor.children(arbor.index(377))), [403])
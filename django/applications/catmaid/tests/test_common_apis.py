@@ -1,12 +1,15 @@
 # -*- coding: utf-8 -*-
 
 import json
+import msgpack
+import struct
 
 from django.contrib.auth.models import Permission
 from django.db import connection, transaction
 from django.http import JsonResponse
 from django.test import TestCase, TransactionTestCase
 from django.test.client import Client
+from django.test.utils import override_settings
 from guardian.shortcuts import assign_perm
 from guardian.utils import get_anonymous_user
 from guardian.management import create_anonymous_user
@@ -523,6 +526,126 @@ class ViewPageTests(TestCase):
         self.assertEqual(parsed_response[3], expected_response[3])
         self.assertEqual(parsed_response[4], expected_response[4])
 
+    def test_export_compact_skeleton_etag(self):
+        self.fake_authentication()
+
+        skeleton_id = 373
+        url = '/%d/%d/1/1/compact-skeleton' % (self.test_project_id, skeleton_id)
+        with override_settings(SKELETON_EXPORT_CACHE=True):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            content = response.content
+
+            # Unchanged skeletons aren't sent again
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+
+            # Cached exports match the original export
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(etag, response['ETag'])
+            self.assertEqual(content, response.content)
+
+            # A changed node changes the export and its entity tag
+            Treenode.objects.filter(pk=403).update(radius=5)
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(etag, response['ETag'])
+            parsed_response = json.loads(response.content.decode('utf-8'))
+            node = [n for n in parsed_response[0] if n[0] == 403][0]
+            self.assertEqual(5, node[6])
+
+    def test_export_compact_skeleton_many(self):
+        self.fake_authentication()
+
+        skeleton_ids = [373, 235, 361]
+        for with_history in (False, True):
+            options = {
+                'with_connectors': True,
+                'with_tags': True,
+                'with_reviews': True,
+                'with_annotations': True,
+                'with_history': with_history,
+                'with_merge_history': with_history,
+                'ordered': True,
+            }
+            response = self.client.post('/%d/skeletons/compact-detail' % self.test_project_id,
+                    dict(options, skeleton_ids=skeleton_ids))
+            self.assertEqual(response.status_code, 200)
+            parsed_response = json.loads(response.content.decode('utf-8'))
+            self.assertCountEqual([str(s) for s in skeleton_ids],
+                    parsed_response['skeletons'].keys())
+
+            # Each skeleton has to match the result of a single skeleton query
+            for skeleton_id in skeleton_ids:
+                response = self.client.get('/%d/skeletons/%d/compact-detail' % (
+                        self.test_project_id, skeleton_id), options)
+                self.assertEqual(response.status_code, 200)
+                expected_response = json.loads(response.content.decode('utf-8'))
+                skeleton = parsed_response['skeletons'][str(skeleton_id)]
+                self.assertEqual(expected_response[0], skeleton[0])
+                self.assertCountEqual(expected_response[1], skeleton[1])
+                self.assertEqual(expected_response[2], skeleton[2])
+                self.assertCountEqual(expected_response[3], skeleton[3])
+                self.assertCountEqual(expected_response[4], skeleton[4])
+
+    def test_export_compact_skeleton_many_stream(self):
+        self.fake_authentication()
+
+        skeleton_ids = [373, 235, 361]
+        options = {
+            'skeleton_ids': skeleton_ids,
+            'with_connectors': True,
+            'with_tags': True,
+            'ordered': True,
+        }
+        url = '/%d/skeletons/compact-detail' % self.test_project_id
+        response = self.client.post(url, options)
+        self.assertEqual(response.status_code, 200)
+        expected_response = json.loads(response.content.decode('utf-8'))['skeletons']
+
+        response = self.client.post(url, dict(options, stream=True, batch_size=2))
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content).decode('utf-8')
+        lines = content.strip().split('\n')
+        self.assertEqual(3, len(lines))
+        for skeleton_id, line in zip(skeleton_ids, lines):
+            parsed_line = json.loads(line)
+            self.assertEqual(skeleton_id, parsed_line[0])
+            self.assertEqual(expected_response[str(skeleton_id)], parsed_line[1])
+
+        response = self.client.post(url, dict(options, stream=True, format='msgpack'))
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content)
+        offset = 0
+        streamed_skeleton_ids = []
+        while offset < len(content):
+            length = struct.unpack_from('<I', content, offset)[0]
+            offset += 4
+            skeleton_id, skeleton = msgpack.unpackb(content[offset:offset + length], raw=False)
+            offset += length
+            streamed_skeleton_ids.append(skeleton_id)
+            self.assertEqual(expected_response[str(skeleton_id)][0], skeleton[0])
+        self.assertEqual(skeleton_ids, streamed_skeleton_ids)
+
+        # Node histories contain times, which are encoded like in JSON
+        history_options = dict(options, with_history=True)
+        response = self.client.post(url, history_options)
+        self.assertEqual(response.status_code, 200)
+        expected_response = json.loads(response.content.decode('utf-8'))['skeletons']
+        response = self.client.post(url, dict(history_options, stream=True,
+                format='msgpack'))
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content)
+        offset = 0
+        while offset < len(content):
+            length = struct.unpack_from('<I', content, offset)[0]
+            offset += 4
+            skeleton_id, skeleton = msgpack.unpackb(content[offset:offset + length], raw=False)
+            offset += length
+            self.assertEqual(expected_response[str(skeleton_id)][0], skeleton[0])
+
     def test_export_compact_arbor(self):
         self.fake_authentication()
 
@@ -568,6 +691,61 @@ class ViewPageTests(TestCase):
         for k, v in expected_response[3].items():
             self.assertCountEqual(parsed_response[3][k], v)
 
+    def test_export_compact_arbor_many(self):
+        self.fake_authentication()
+
+        # Skeletons 373 and 235 share connectors 356 and 421
+        response = self.client.post(
+                '/%d/skeletons/compact-arbor' % (self.test_project_id,), {
+                    'skeleton_ids': [373, 235],
+                    'with_minutes': True,
+                })
+        self.assertEqual(response.status_code, 200)
+        parsed_response = json.loads(response.content.decode('utf-8'))
+        skeletons = parsed_response['skeletons']
+        self.assertCountEqual(['373', '235'], skeletons.keys())
+
+        single_response = self.client.post(
+                '/%d/373/1/1/1/compact-arbor-with-minutes' % (self.test_project_id,))
+        expected_response = json.loads(single_response.content.decode('utf-8'))
+        arbor = skeletons['373']
+        self.assertCountEqual(expected_response[0], arbor[0])
+        self.assertCountEqual(expected_response[1], arbor[1])
+        self.assertEqual(expected_response[2], arbor[2])
+        self.assertEqual(expected_response[3].keys(), arbor[3].keys())
+
+        self.assertIn([285, 5, 356, 5, 377, 373, 0, 1], skeletons['235'][1])
+        self.assertIn([415, 5, 421, 5, 409, 373, 0, 1], skeletons['235'][1])
+
+        response = self.client.post(
+                '/%d/skeletons/compact-arbor' % (self.test_project_id,), {
+                    'skeleton_ids': [373],
+                    'with_nodes': False,
+                    'format': 'msgpack',
+                })
+        self.assertEqual(response.status_code, 200)
+        skeletons = msgpack.unpackb(response.content, raw=False)['skeletons']
+        self.assertEqual([], skeletons[373][0])
+        self.assertEqual(2, len(skeletons[373][1]))
+
+        # Node times are encoded like in JSON
+        options = {
+            'skeleton_ids': [373],
+            'with_time': True,
+            'ordered': True,
+        }
+        response = self.client.post(
+                '/%d/skeletons/compact-arbor' % (self.test_project_id,), options)
+        self.assertEqual(response.status_code, 200)
+        expected_nodes = json.loads(response.content.decode('utf-8'))['skeletons']['373'][0]
+        response = self.client.post(
+                '/%d/skeletons/compact-arbor' % (self.test_project_id,),
+                dict(options, format='msgpack'))
+        self.assertEqual(response.status_code, 200)
+        skeletons = msgpack.unpackb(response.content, raw=False)['skeletons']
+        self.assertEqual(expected_nodes, skeletons[373][0])
+        self.assertEqual(10, len(skeletons[373][0][0]))
+
 
 class TreenodeTests(TestCase):
     fixtures = ['catmaid_testdata']
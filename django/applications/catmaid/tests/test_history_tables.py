@@ -254,6 +254,8 @@ class HistoryTableTests(TransactionTestCase):
 
         # Regular unversioned CATMAID tables
         'node_query_cache',
+        'node_grid_cache',
+        'node_grid_cache_cell',
         'log',
         'treenode_edge',
         'catmaid_history_table',
@@ -263,6 +265,10 @@ class HistoryTableTests(TransactionTestCase):
         'catmaid_transaction_info',
         'catmaid_stats_summary',
         'catmaid_skeleton_summary',
+        'skeleton_export_version',
+        'skeleton_export_cache',
+        'nblast_dotprops_cache',
+        'nblast_similarity_tile',
 
         # Regular unversioned non-CATMAID tables
         'djkombu_queue',
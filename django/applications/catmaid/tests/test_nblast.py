@@ -0,0 +1,450 @@
+# -*- coding: utf-8 -*-
+
+import mock
+import numpy as np
+import os
+import tempfile
+
+from unittest import skipUnless
+
+from django.db import connection
+from django.test import TestCase
+
+from catmaid.control.arbor import Arbor
+from catmaid.control.nat import nblast, rnat_enaled
+from catmaid.control.nblast import (Dotprops, assemble_tiles, dilate_voxels,
+        find_candidate_skeletons, get_stored_tiles, get_tiles, histogram,
+        nblast_scores, object_dotprops, resample_arbor, score_pair,
+        simplify_arbor, store_tile, voxel_signature)
+from catmaid.control.similarity import (compute_nblast_tiled,
+        find_nearest_skeletons, get_similarity_file_path,
+        get_similarity_scoring, prepare_similarity, select_scoring,
+        serialize_similarity)
+from catmaid.models import (NblastConfig, NblastConfigDefaultDistanceBreaks,
+        NblastConfigDefaultDotBreaks, NblastDotpropsCache, NblastSample,
+        NblastSimilarity, NblastSimilarityTile)
+
+
+def random_walks(n_walks, n_points, seed=1):
+    """Return a list of N x 3 arrays of random walk points, which resemble
+    neurites of a few µm length.
+    """
+    state = np.random.RandomState(seed)
+    return [np.cumsum(state.randn(n_points, 3), axis=0)
+            for _ in range(n_walks)]
+
+
+def distance_to(dotprops, point):
+    """The distance of a point to the nearest point of dotprops."""
+    return np.linalg.norm(dotprops.points - point, axis=1).min()
+
+
+def scoring_matrix(seed=2):
+    state = np.random.RandomState(seed)
+    return state.randn(len(NblastConfigDefaultDistanceBreaks) - 1,
+            len(NblastConfigDefaultDotBreaks) - 1)
+
+
+def create_native_config(project_id, user_id):
+    """Create a complete NBLAST configuration with a random scoring matrix,
+    which uses the native backend.
+    """
+    samples = [NblastSample.objects.create(project_id=project_id,
+            user_id=user_id, name='Sample {}'.format(i), sample_neurons=[],
+            sample_pointclouds=[], sample_pointsets=[], histogram=[],
+            probability=[]) for i in range(2)]
+    return NblastConfig.objects.create(project_id=project_id, user_id=user_id,
+            name='Config', status='complete',
+            distance_breaks=NblastConfigDefaultDistanceBreaks,
+            dot_breaks=NblastConfigDefaultDotBreaks, match_sample=samples[0],
+            random_sample=samples[1], scoring=scoring_matrix().tolist(),
+            resample_step=100, backend='native')
+
+
+class NblastTests(TestCase):
+
+    def test_dotprops(self):
+        # Points on a line have the line as tangent and an alpha of 1
+        points = np.zeros((10, 3))
+        points[:, 0] = np.arange(10)
+        dotprops = Dotprops.from_points(points, k=5)
+        self.assertEqual(len(dotprops), 10)
+        self.assertTrue(np.allclose(np.abs(dotprops.tangents[:, 0]), 1))
+        self.assertTrue(np.allclose(dotprops.alpha, 1))
+
+    def test_resample_arbor(self):
+        # A 10 long path from the root to a branch node at x=5, from which a
+        # 6.5 long branch goes off.
+        arbor = Arbor.from_rows([
+            (1, None, 0.0, 0.0, 0.0),
+            (2, 1, 5.0, 0.0, 0.0),
+            (3, 2, 10.0, 0.0, 0.0),
+            (4, 2, 5.0, 3.0, 0.0),
+            (5, 4, 5.0, 6.5, 0.0),
+        ])
+        points = resample_arbor(arbor, 1.0)
+        expected = [(float(x), 0.0, 0.0) for x in range(11)] + \
+                [(5.0, float(y), 0.0) for y in range(1, 7)] + [(5.0, 6.5, 0.0)]
+        self.assertEqual(sorted(map(tuple, points.tolist())), sorted(expected))
+
+    def test_simplify_arbor(self):
+        # A root with a long branch and two short side branches
+        arbor = Arbor.from_rows([
+            (1, None, 0.0, 0.0, 0.0),
+            (2, 1, 10.0, 0.0, 0.0),
+            (3, 2, 20.0, 0.0, 0.0),
+            (4, 1, 0.0, 1.0, 0.0),
+            (5, 2, 10.0, 3.0, 0.0),
+        ])
+        simplified = simplify_arbor(arbor, 1)
+        self.assertEqual(sorted(simplified.node_ids.tolist()), [1, 2, 3, 5])
+        simplified = simplify_arbor(arbor, 0)
+        self.assertEqual(sorted(simplified.node_ids.tolist()), [1, 2, 3])
+        self.assertIs(simplify_arbor(arbor, 2), arbor)
+
+    def test_scores(self):
+        dotprops = [Dotprops.from_points(p, k=5) for p in random_walks(4, 50)]
+        smat = scoring_matrix()
+        distance_breaks = np.array(NblastConfigDefaultDistanceBreaks)
+        dot_breaks = np.array(NblastConfigDefaultDotBreaks)
+
+        for use_alpha in (False, True):
+            raw = nblast_scores(dotprops[:2], dotprops[2:], smat,
+                    distance_breaks, dot_breaks, 'raw', use_alpha)
+            self.assertEqual(raw.shape, (2, 2))
+
+            # Compare with a point by point computation
+            query, target = dotprops[0], dotprops[3]
+            expected = 0.0
+            for point, tangent, alpha in zip(query.points, query.tangents,
+                    query.alpha):
+                distances = np.linalg.norm(target.points - point, axis=1)
+                nearest = np.argmin(distances)
+                dot = abs(np.dot(tangent, target.tangents[nearest]))
+                i = min(np.flatnonzero(distance_breaks <= distances[nearest])[-1],
+                        len(distance_breaks) - 2)
+                j = min(np.flatnonzero(dot_breaks <= dot)[-1],
+                        len(dot_breaks) - 2)
+                factor = np.sqrt(alpha * target.alpha[nearest]) \
+                        if use_alpha else 1.0
+                expected += smat[i, j] * factor
+            self.assertAlmostEqual(raw[0, 1], expected)
+            self.assertAlmostEqual(raw[0, 1], score_pair(query, target, smat,
+                    distance_breaks, dot_breaks, use_alpha))
+
+            normalized = nblast_scores(dotprops, dotprops, smat,
+                    distance_breaks, dot_breaks, 'normalized', use_alpha)
+            self.assertTrue(np.allclose(np.diag(normalized), 1))
+
+            mean = nblast_scores(dotprops, dotprops, smat, distance_breaks,
+                    dot_breaks, 'mean', use_alpha)
+            self.assertTrue(np.allclose(mean, mean.T))
+            self.assertTrue(np.allclose(mean,
+                    (normalized + normalized.T) / 2.0))
+
+            # Separate query and target lists give the same scores
+            partial = nblast_scores(dotprops[:2], list(dotprops), smat,
+                    distance_breaks, dot_breaks, 'mean', use_alpha)
+            self.assertTrue(np.allclose(partial, mean[:2]))
+
+    def test_histogram(self):
+        dotprops = [Dotprops.from_points(p, k=5) for p in random_walks(3, 40)]
+        counts = histogram(dotprops, NblastConfigDefaultDistanceBreaks,
+                NblastConfigDefaultDotBreaks)
+        self.assertEqual(counts.shape, (len(NblastConfigDefaultDistanceBreaks) - 1,
+                len(NblastConfigDefaultDotBreaks) - 1))
+        # Each point of each walk is matched against both other walks
+        self.assertEqual(counts.sum(), 3 * 2 * 40)
+
+        # Distances and dot products at the lowest break are counted too
+        copy = Dotprops(dotprops[0].points, dotprops[0].tangents,
+                dotprops[0].alpha)
+        counts = histogram([dotprops[0], copy],
+                NblastConfigDefaultDistanceBreaks, NblastConfigDefaultDotBreaks)
+        self.assertEqual(counts[0].sum(), 2 * 40)
+
+    def test_get_tiles(self):
+        tiles = get_tiles(5, 3, 2)
+        self.assertEqual(tiles, [(0, 2, 0, 2), (0, 2, 2, 3), (2, 4, 0, 2),
+                (2, 4, 2, 3), (4, 5, 0, 2), (4, 5, 2, 3)])
+        self.assertEqual(get_tiles(5, 3, 10), [(0, 5, 0, 3)])
+        self.assertEqual(get_tiles(0, 3, 2), [])
+        self.assertRaises(ValueError, get_tiles, 5, 3, 0)
+
+    def test_voxel_signature(self):
+        points = [(0, 0, 0), (4, 9, 0), (10, 0, -1), (12, 3, -4)]
+        voxels = voxel_signature(points, 10)
+        self.assertEqual(voxels.tolist(), [[0, 0, 0], [1, 0, -1]])
+        self.assertEqual(voxel_signature([], 10).shape, (0, 3))
+
+        # Two overlapping 3x3x3 cubes, which share 2x3x2 voxels
+        dilated = dilate_voxels(voxels)
+        self.assertEqual(len(dilated), 2 * 27 - 12)
+        distances = np.abs(dilated[:, np.newaxis] - voxels).max(axis=2)
+        self.assertTrue((distances.min(axis=1) <= 1).all())
+        self.assertEqual(len(dilate_voxels([[0, 0, 0]], 2)), 125)
+
+    @skipUnless(rnat_enaled, 'Rpy2 is not available')
+    def test_r_regression(self):
+        """The native NBLAST has to produce the same scores as nat.nblast for
+        the same points.
+        """
+        from rpy2.robjects.packages import importr
+        import rpy2.robjects as robjects
+
+        try:
+            rnat = importr('nat')
+            rnblast = importr('nat.nblast')
+        except Exception:
+            self.skipTest('The R packages nat and nat.nblast are not available')
+
+        walks = random_walks(3, 50)
+        smat = scoring_matrix()
+        Matrix = robjects.r.matrix
+
+        rsmat = Matrix(robjects.FloatVector(smat.ravel().tolist()),
+                nrow=smat.shape[0], byrow=True)
+        rsmat.do_slot_assign('distbreaks',
+                robjects.FloatVector(NblastConfigDefaultDistanceBreaks))
+        rsmat.do_slot_assign('dotprodbreaks',
+                robjects.FloatVector(NblastConfigDefaultDotBreaks))
+        rquery = rnat.dotprops(Matrix(robjects.FloatVector(
+                walks[0].ravel().tolist()), nrow=len(walks[0]), byrow=True),
+                k=5)
+        rtargets = rnat.dotprops(rnat.as_neuronlist([
+                Matrix(robjects.FloatVector(w.ravel().tolist()), nrow=len(w),
+                    byrow=True) for w in walks[1:]]), k=5)
+
+        query = [Dotprops.from_points(walks[0], k=5)]
+        targets = [Dotprops.from_points(w, k=5) for w in walks[1:]]
+        for use_alpha in (False, True):
+            for normalized in (False, True):
+                expected = np.asarray(rnblast.NeuriteBlast(rquery, rtargets, **{
+                    'smat': rsmat,
+                    'NNDistFun': rnblast.lodsby2dhist,
+                    'UseAlpha': use_alpha,
+                    'normalised': normalized,
+                }))
+                scores = nblast_scores(query, targets, smat,
+                        NblastConfigDefaultDistanceBreaks,
+                        NblastConfigDefaultDotBreaks,
+                        'normalized' if normalized else 'raw', use_alpha)
+                self.assertTrue(np.allclose(scores[0], expected),
+                        "{} != {}".format(scores[0], expected))
+
+
+class NblastDotpropsCacheTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def test_skeleton_dotprops_cache(self):
+        project_id = 3
+        skeleton_ids = [373, 235]
+        computed = object_dotprops('skeleton', skeleton_ids, resample_step=100,
+                k=5)
+        self.assertEqual(NblastDotpropsCache.objects.count(), 0)
+
+        cached = object_dotprops('skeleton', skeleton_ids, resample_step=100,
+                k=5, project_id=project_id)
+        self.assertEqual(NblastDotpropsCache.objects.count(), 2)
+        for a, b in zip(computed, cached):
+            self.assertTrue(np.allclose(a.points, b.points, atol=1e-5))
+            self.assertTrue(np.allclose(a.alpha, b.alpha, atol=1e-5))
+
+        # Reading the dotprops again doesn't add entries and returns the
+        # stored float32 values.
+        entry = NblastDotpropsCache.objects.get(object_id=373)
+        stored = np.frombuffer(entry.points, dtype='<f4').reshape(-1, 3)
+        again = object_dotprops('skeleton', skeleton_ids, resample_step=100,
+                k=5, project_id=project_id)
+        self.assertEqual(NblastDotpropsCache.objects.count(), 2)
+        self.assertTrue(np.array_equal(again[0].points, stored))
+
+        # Other options use separate entries
+        object_dotprops('skeleton', skeleton_ids, resample_step=100, k=3,
+                project_id=project_id)
+        self.assertEqual(NblastDotpropsCache.objects.count(), 4)
+
+        # Editing a skeleton removes its entries and new dotprops are computed
+        # on the next request.
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE treenode SET location_x = location_x + 1000 WHERE id = 409
+        """)
+        self.assertFalse(NblastDotpropsCache.objects.filter(
+                object_id=373).exists())
+        edited = object_dotprops('skeleton', skeleton_ids, resample_step=100,
+                k=5, project_id=project_id)
+        self.assertAlmostEqual(distance_to(computed[0], (6.63, 4.33, 0)), 0)
+        self.assertAlmostEqual(distance_to(edited[0], (7.63, 4.33, 0)), 0,
+                places=5)
+        self.assertGreater(distance_to(edited[0], (6.63, 4.33, 0)), 0.05)
+        self.assertTrue(np.allclose(edited[1].points, computed[1].points,
+                atol=1e-5))
+        self.assertEqual(NblastDotpropsCache.objects.filter(
+                object_id=373).count(), 1)
+
+
+class NblastSimilarityTileTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def setUp(self):
+        self.project_id = 3
+        self.user_id = 3
+        self.config = create_native_config(self.project_id, self.user_id)
+        self.similarity = NblastSimilarity.objects.create(
+                project_id=self.project_id, user_id=self.user_id,
+                name='Similarity', status='queued', config=self.config,
+                query_objects=[235, 373], target_objects=[235, 361, 373],
+                query_type_id='skeleton', target_type_id='skeleton',
+                normalized='mean', scoring=[])
+
+    def test_tiled_similarity(self):
+        expected = nblast(self.project_id, self.user_id, self.config.id,
+                [235, 373], [361], 'skeleton', 'skeleton', normalized='mean',
+                remove_target_duplicates=False)['similarity']
+
+        # Target duplicates are removed from the stored target list, so that
+        # all tiles refer to the same columns.
+        similarity = prepare_similarity(self.project_id, self.user_id,
+                self.similarity.id)
+        compute_nblast_tiled(self.project_id, self.user_id, similarity,
+                remove_target_duplicates=True, tile_size=1, use_subtasks=False)
+        similarity = NblastSimilarity.objects.get(pk=self.similarity.id)
+        self.assertEqual(similarity.status, 'complete')
+        self.assertEqual(similarity.target_objects, [361])
+        self.assertTrue(np.allclose(similarity.scoring, expected, atol=1e-5))
+        self.assertEqual(NblastSimilarityTile.objects.count(), 0)
+
+    def test_resume_tiled_similarity(self):
+        # A tile stored by an earlier run is reused, a tile of another tile
+        # size is removed.
+        store_tile(self.similarity.id, (0, 1, 0, 1), [[42.0]])
+        store_tile(self.similarity.id, (0, 2, 0, 3), np.zeros((2, 3)))
+        self.assertEqual(get_stored_tiles(self.similarity.id),
+                set([(0, 1, 0, 1), (0, 2, 0, 3)]))
+        self.assertRaises(ValueError, assemble_tiles, self.similarity.id, 3, 3, 2)
+        self.assertRaises(ValueError, store_tile, self.similarity.id,
+                (1, 2, 0, 1), np.zeros((2, 2)))
+
+        similarity = prepare_similarity(self.project_id, self.user_id,
+                self.similarity.id)
+        compute_nblast_tiled(self.project_id, self.user_id, similarity,
+                remove_target_duplicates=False, tile_size=1,
+                use_subtasks=False)
+        similarity = NblastSimilarity.objects.get(pk=self.similarity.id)
+        self.assertEqual(similarity.status, 'complete')
+        self.assertEqual(np.asarray(similarity.scoring).shape, (2, 3))
+        self.assertEqual(similarity.scoring[0][0], 42.0)
+
+        # Without resuming, all tiles are computed again
+        similarity = prepare_similarity(self.project_id, self.user_id,
+                self.similarity.id)
+        compute_nblast_tiled(self.project_id, self.user_id, similarity,
+                remove_target_duplicates=False, tile_size=1,
+                use_subtasks=False, resume=False)
+        similarity = NblastSimilarity.objects.get(pk=self.similarity.id)
+        self.assertAlmostEqual(similarity.scoring[0][0], 1.0, places=5)
+
+    def test_binary_similarity_storage(self):
+        def compute():
+            similarity = prepare_similarity(self.project_id, self.user_id,
+                    self.similarity.id)
+            compute_nblast_tiled(self.project_id, self.user_id, similarity,
+                    remove_target_duplicates=False, tile_size=2,
+                    use_subtasks=False)
+            return NblastSimilarity.objects.get(pk=self.similarity.id)
+
+        expected = np.array(compute().scoring)
+
+        with tempfile.TemporaryDirectory() as output_dir, \
+                mock.patch('catmaid.control.similarity.similarity_path',
+                    output_dir):
+            NblastSimilarity.objects.filter(pk=self.similarity.id).update(
+                    storage='float16')
+            similarity = compute()
+            self.assertIsNone(similarity.scoring)
+            self.assertTrue(os.path.exists(get_similarity_file_path(
+                    similarity.id)))
+
+            scoring = get_similarity_scoring(similarity)
+            self.assertIsInstance(scoring, np.memmap)
+            self.assertEqual(scoring.dtype, np.float16)
+            self.assertTrue(np.allclose(scoring, expected, atol=1e-2))
+            self.assertTrue(np.allclose(serialize_similarity(
+                    similarity)['scoring'], expected, atol=1e-2))
+            self.assertIsNone(serialize_similarity(similarity,
+                    with_scoring=False)['scoring'])
+
+            selection = select_scoring(scoring, similarity.query_objects,
+                    similarity.target_objects, query_ids=[373],
+                    target_ids=[361, 235])
+            self.assertEqual(selection['rows'], [373])
+            self.assertEqual(selection['columns'], [361, 235])
+            self.assertTrue(np.allclose(selection['scoring'],
+                    expected[[1]][:, [1, 0]], atol=1e-2))
+
+            selection = select_scoring(scoring, similarity.query_objects,
+                    similarity.target_objects, row_offset=1, top_k=2)
+            self.assertEqual(selection['rows'], [373])
+            matches = selection['top_matches'][0]
+            self.assertEqual(len(matches), 2)
+            self.assertGreaterEqual(matches[0][1], matches[1][1])
+            self.assertAlmostEqual(matches[0][1], expected[1].max(), places=2)
+
+            # Raw scores can exceed the float16 range and are stored as float32
+            NblastSimilarity.objects.filter(pk=self.similarity.id).update(
+                    normalized='raw')
+            similarity = compute()
+            self.assertEqual(get_similarity_scoring(similarity).dtype,
+                    np.float32)
+
+            # Files are removed along with their similarity
+            path = get_similarity_file_path(similarity.id)
+            with mock.patch('django.db.transaction.on_commit',
+                    lambda f: f()):
+                similarity.delete()
+            self.assertFalse(os.path.exists(path))
+
+
+class NblastNearestSkeletonTests(TestCase):
+    fixtures = ['catmaid_testdata']
+
+    def test_find_candidate_skeletons(self):
+        # Skeleton 2388 is too far away from skeleton 235
+        candidates = find_candidate_skeletons(3, 235, voxel_size=1000)
+        self.assertEqual(sorted(c[0] for c in candidates), [1, 361, 373,
+                2364, 2411, 2433, 2440, 2451, 2462, 2468])
+        self.assertEqual(candidates[0][0], 2364)
+        for candidate_id, overlap in candidates:
+            self.assertGreater(overlap, 0)
+            self.assertLessEqual(overlap, 1)
+        self.assertEqual([c[1] for c in candidates],
+                sorted((c[1] for c in candidates), reverse=True))
+
+        # Candidates can be limited to a set of skeletons, a number of
+        # candidates and a minimum number of nodes.
+        self.assertEqual([c[0] for c in find_candidate_skeletons(3, 235,
+                voxel_size=1000, target_ids=[373, 2388])], [373])
+        self.assertEqual([c[0] for c in find_candidate_skeletons(3, 235,
+                n_candidates=1, voxel_size=1000)], [2364])
+        self.assertEqual([c[0] for c in find_candidate_skeletons(3, 235,
+                voxel_size=1000, min_nodes=10)], [1])
+        self.assertRaises(ValueError, find_candidate_skeletons, 3, 999999)
+
+    def test_find_nearest_skeletons(self):
+        config = create_native_config(3, 3)
+        matches = find_nearest_skeletons(3, 3, config, 235, k=3,
+                voxel_size=1000, min_nodes=0)
+        self.assertEqual(len(matches), 3)
+
+        # Matches are the candidates with the highest NBLAST scores
+        candidate_ids = [c[0] for c in find_candidate_skeletons(3, 235,
+                voxel_size=1000)]
+        scores = nblast(3, 3, config.id, [235], candidate_ids, 'skeleton',
+                'skeleton', normalized='mean',
+                remove_target_duplicates=False)['similarity'][0]
+        best = sorted(scores, reverse=True)[:3]
+        for match, score in zip(matches, best):
+            self.assertAlmostEqual(match[1], score)
+            self.assertAlmostEqual(scores[candidate_ids.index(match[0])],
+                    score)
@@ -18,7 +18,7 @@ from catmaid.control import (authentication, user, group, log, message, client,
         classification, notifications, roi, clustering, volume, noop,
         useranalytics, user_evaluation, search, graphexport, transaction,
         graph2, circles, analytics, review, wiringdiagram, object, sampler,
-        similarity, nat, point, landmarks, pointcloud)
+        similarity, nat, point, landmarks, pointcloud, bulkexport)
 
 from catmaid.views import CatmaidView
 from catmaid.history import record_request_action as record_view
@@ -231,9 +231,11 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/node/nearest$', node.node_nearest),
     url(r'^(?P<project_id>\d+)/node/update$', record_view("nodes.update_location")(node.node_update)),
     url(r'^(?P<project_id>\d+)/node/list$', node.node_list_tuples),
+    url(r'^(?P<project_id>\d+)/node/list/sections$', node.node_list_sections),
     url(r'^(?P<project_id>\d+)/node/get_location$', node.get_location),
     url(r'^(?P<project_id>\d+)/node/user-info$', node.user_info),
     url(r'^(?P<project_id>\d+)/nodes/find-labels$', node.find_labels),
+    url(r'^(?P<project_id>\d+)/nodes/result-cache/stats$', node.node_result_cache_stats),
     url(r'^(?P<project_id>\d+)/nodes/$', api_view(['POST'])(node.node_list_tuples)),
 ]
 
@@ -319,6 +321,8 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/neuroglancer$', skeletonexport.neuroglancer_skeleton),
     url(r'^(?P<project_id>\d+)/skeletons/(?P<skeleton_id>\d+)/node-overview$', skeletonexport.treenode_overview),
     url(r'^(?P<project_id>\d+)/skeletons/compact-detail$', skeletonexport.compact_skeleton_detail_many),
+    url(r'^(?P<project_id>\d+)/skeletons/compact-arbor$', skeletonexport.compact_arbor_many),
+    url(r'^(?P<project_id>\d+)/skeletons/export-archive$', bulkexport.export_skeleton_archive_view),
     # Marked as deprecated, but kept for backwards compatibility
     url(r'^(?P<project_id>\d+)/(?P<skeleton_id>\d+)/(?P<with_connectors>\d)/(?P<with_tags>\d)/compact-skeleton$', skeletonexport.compact_skeleton),
 ]
@@ -341,6 +345,7 @@ urlpatterns += [
     url(r'^(?P<project_id>\d+)/similarity/configs/(?P<config_id>\d+)/recompute$', similarity.recompute_config),
     url(r'^(?P<project_id>\d+)/similarity/queries/$', similarity.SimilarityList.as_view()),
     url(r'^(?P<project_id>\d+)/similarity/queries/similarity$', similarity.compare_skeletons),
+    url(r'^(?P<project_id>\d+)/similarity/queries/nearest$', similarity.nearest_skeletons),
     url(r'^(?P<project_id>\d+)/similarity/queries/(?P<similarity_id>\d+)/$', similarity.SimilarityDetail.as_view()),
     url(r'^(?P<project_id>\d+)/similarity/queries/(?P<similarity_id>\d+)/recompute$', similarity.recompute_similarity),
     url(r'^(?P<project_id>\d+)/similarity/test-setup$', similarity.test_setup),
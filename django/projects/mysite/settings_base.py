@@ -176,7 +176,9 @@ SITE_ID = 1
 # Defines which type of spatial query should be used for treenodes. The
 # available options are 'classic', 'postgis2d' and 'postgis3d'. Additionally,
 # cache tables can be populated, which allows to make use of the following node
-# providers: cached_json, cached_json_text and cached_msgpack. If multiple are
+# providers: cached_json, cached_json_text and cached_msgpack as well as their
+# grid based variants cached_json_grid, cached_json_text_grid and
+# cached_msgpack_grid. If multiple are
 # provided, node providers are asked one after the other for a result until a
 # result is returned. Entries can either be node provider names or tuples of
 # the form (name, options) to provide options for a particular node provider.
@@ -184,6 +186,30 @@ NODE_PROVIDERS = [
     'postgis3d'
 ]
 
+# Node query results can optionally be cached in the memory of each server
+# process. This is useful if many users look at the same region, e.g. during
+# review sessions. NODE_RESULT_CACHE_SIZE is the maximum size of all cached
+# results in bytes per process, 0 disables the cache. Least recently used
+# results are removed first. The XY extent of queries is expanded to multiples
+# of NODE_RESULT_CACHE_QUANTIZATION (in project coordinates) so that similar
+# queries can share a result. Results that intersect with changed tracing data
+# are removed immediately, others are removed at the latest after
+# NODE_RESULT_CACHE_MAX_AGE seconds, which e.g. limits how long changed labels
+# can be missing.
+NODE_RESULT_CACHE_SIZE = 0
+NODE_RESULT_CACHE_QUANTIZATION = 1000
+NODE_RESULT_CACHE_MAX_AGE = 60
+
+# Serialized skeleton exports (compact skeletons and arbors) can be stored in
+# the database and reused until the skeleton changes. Every export includes an
+# ETag header regardless of this setting, which allows clients to avoid
+# downloading unchanged skeletons again.
+SKELETON_EXPORT_CACHE = False
+
+# The number of worker processes that render skeletons for bulk exports into
+# archives, which run as asynchronous tasks.
+BULK_EXPORT_JOBS = 1
+
 # By default, prepared statements are disabled. If connection pooling is used,
 # this can further improve performance.
 PREPARED_STATEMENTS = False
@@ -232,6 +258,7 @@ MEDIA_CROPPING_SUBDIRECTORY = 'cropping'
 MEDIA_ROI_SUBDIRECTORY = 'roi'
 MEDIA_TREENODE_SUBDIRECTORY = 'treenode_archives'
 MEDIA_EXPORT_SUBDIRECTORY = 'export'
+MEDIA_NBLAST_SUBDIRECTORY = 'nblast'
 
 # Cropping output extension
 CROPPING_OUTPUT_FILE_EXTENSION = "tiff"